@@ -0,0 +1,906 @@
+"""
+In-Process Fake CouchDB Server
+==============================
+Start a lightweight, in-process HTTP server, on an available port upon
+instantiation, that implements the subset of the CouchDB API used by
+`SofterCouchDB` (and thus `Sofabed` and `BiscuitTin`). Exposes the host
+URL and provides a means to tear it down, in the same way as
+`CouchDBContainer`, but without the need for Docker or CouchDB.
+It is used by the pipeline benchmark, as well as by the tests.
+
+Exportable Classes: `FakeCouchDBServer`, `LatencyProfile`,
+                    `FailureProfile`
+
+FakeCouchDBServer
+-----------------
+The following are implemented:
+
+* Server: `GET /`, `GET /_all_dbs`
+
+* Databases: `HEAD`, `GET`, `PUT` and `DELETE`
+
+* Documents (including design documents): `HEAD`, `GET` (with `rev`
+  and `revs_info`), `PUT` and `DELETE`
+
+* `_all_docs` (`GET`, with the `startkey`, `endkey`, `descending`,
+  `limit` and `skip` options, or `POST` with `keys`) and `_bulk_docs`
+
+* `_changes` (normal and longpoll feeds, optionally with the `_view`
+  filter)
+
+* Views (`GET`, or `POST` with `keys`), with the `key`, `keys`,
+  `startkey`, `startkey_docid`, `endkey`, `inclusive_end`, `limit`,
+  `skip`, `include_docs`, `reduce`, `group`, `stale` and `update`
+  options and the `_count`, `_sum` and `_stats` built-in reduce
+  functions
+
+Views are not evaluated from their JavaScript definitions. Instead, a
+view that is defined in a design document is emulated by the Python map
+function registered against its name (e.g., "queue/to_process"); by
+default, those of the views defined by `BiscuitTin` (which are tested
+against its design documents, so must be kept in step with them).
+Python truthiness is used in place of JavaScript's and keys are
+collated by type, then by value (i.e., strings by code point, rather
+than by Unicode collation).
+As with CouchDB, view indices are only brought up to date when queried,
+unless the query accepts a stale index (`stale=ok` or `update=false`,
+or `stale=update_after` or `update=lazy`, which update it afterwards).
+
+Other simplifications: documents are never compacted, although only
+the bodies of the most recent revisions are retained; and, when a
+`_bulk_docs` request is made with `all_or_nothing`, revisions are still
+checked and no documents are written if any conflict.
+
+Latency and Failure Profiles
+----------------------------
+Artificial latency can be added to every request with a
+`LatencyProfile` and failures injected with a `FailureProfile`, such
+that batching and retry behaviour can be tested and benchmarked. Both
+can be changed on a running server. The number of requests made to each
+endpoint are counted in `FakeCouchDBServer.request_counts`.
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from random import Random
+from socketserver import ThreadingMixIn
+from threading import Condition, Lock, Thread
+from time import sleep
+from typing import Any, Callable, Container, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+from uuid import uuid4
+
+# Map function signature: Document -> Iterable of emitted (key, value)
+MapFunctionT = Callable[[dict], Iterable[Tuple[Any, Any]]]
+
+# Number of revisions of each document for which the body is retained
+_RETAINED_REVISIONS = 10
+
+_DESIGN_PREFIX = '_design/'
+
+
+def _emit_queue_to_process(doc:dict) -> Iterable[Tuple[Any, Any]]:
+    if doc.get('$queue') and doc.get('dirty') and not doc.get('processing') and not doc.get('deleted'):
+        yield doc.get('queue_from'), doc.get('identifier')
+
+def _emit_queue_in_progress(doc:dict) -> Iterable[Tuple[Any, Any]]:
+    if doc.get('$queue') and doc.get('processing') and not doc.get('deleted'):
+        yield doc.get('identifier'), doc['_id']
+
+def _emit_queue_leases(doc:dict) -> Iterable[Tuple[Any, Any]]:
+    if doc.get('$queue') and doc.get('processing'):
+        yield doc.get('lease_expires') or 0, doc.get('owner') or None
+
+def _emit_queue_to_clean(doc:dict) -> Iterable[Tuple[Any, Any]]:
+    if doc.get('$queue') and doc.get('deleted'):
+        yield doc.get('identifier'), doc['_id']
+
+def _emit_queue_get_id(doc:dict) -> Iterable[Tuple[Any, Any]]:
+    if doc.get('$queue'):
+        yield doc.get('identifier'), doc['_id']
+
+def _emit_queue_legacy(doc:dict) -> Iterable[Tuple[Any, Any]]:
+    if doc.get('$queue') and not doc['_id'].startswith('queue-'):
+        yield doc.get('identifier'), doc['_id']
+
+def _emit_metadata_collate(doc:dict) -> Iterable[Tuple[Any, Any]]:
+    if doc.get('$metadata'):
+        yield doc.get('identifier'), doc['_id']
+
+def _emit_metadata_chunks(doc:dict) -> Iterable[Tuple[Any, Any]]:
+    if doc.get('$metadata_chunk'):
+        yield doc.get('identifier'), doc['_id']
+
+
+# Python emulations of the views defined by BiscuitTin
+BISCUIT_TIN_VIEWS = {
+    'queue/to_process':  _emit_queue_to_process,
+    'queue/in_progress': _emit_queue_in_progress,
+    'queue/leases':      _emit_queue_leases,
+    'queue/to_clean':    _emit_queue_to_clean,
+    'queue/get_id':      _emit_queue_get_id,
+    'queue/legacy':      _emit_queue_legacy,
+    'metadata/collate':  _emit_metadata_collate,
+    'metadata/chunks':   _emit_metadata_chunks
+}   # type: Dict[str, MapFunctionT]
+
+
+def _collation_key(value:Any) -> tuple:
+    """
+    Key with which JSON values are sorted, by type (null < false < true
+    < numbers < strings < arrays < objects) and then by value
+    """
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, list):
+        return (5, tuple(_collation_key(element) for element in value))
+    if isinstance(value, dict):
+        return (6, tuple((key, _collation_key(element)) for key, element in value.items()))
+    raise TypeError('Cannot collate {}'.format(type(value)))
+
+
+def _builtin_reduce(name:str, values:List[Any]) -> Any:
+    """ Apply a built-in reduce function to the given values """
+    if name == '_count':
+        return len(values)
+    if name == '_sum':
+        return sum(values)
+    if name == '_stats':
+        return {
+            'sum':    sum(values),
+            'count':  len(values),
+            'min':    min(values),
+            'max':    max(values),
+            'sumsqr': sum(value * value for value in values)
+        }
+    raise _HTTPError(400, 'bad_request', 'Reduce function not emulated: {}'.format(name))
+
+
+class _HTTPError(Exception):
+    """ CouchDB error response """
+    def __init__(self, status:int, error:str, reason:str):
+        super().__init__(reason)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+
+class LatencyProfile(object):
+    """ Artificial latency added to each request """
+    def __init__(self, base:float = 0.0, per_document:float = 0.0, jitter:float = 0.0, seed:Optional[int] = None):
+        """
+        Constructor
+
+        @param   base          Latency added to every request (seconds)
+        @param   per_document  Latency added per document read or
+                               written by the request (seconds)
+        @param   jitter        Maximum random latency added (seconds)
+        @param   seed          Seed for the random jitter
+        """
+        self.base = base
+        self.per_document = per_document
+        self.jitter = jitter
+        self._random = Random(seed)
+        self._lock = Lock()
+
+    def get_latency(self, number_of_documents:int) -> float:
+        """
+        Get the latency of a request
+
+        @param   number_of_documents  Number of documents in the request
+        @return  Latency (seconds)
+        """
+        with self._lock:
+            jitter = self._random.uniform(0, self.jitter) if self.jitter else 0.0
+        return self.base + self.per_document * number_of_documents + jitter
+
+
+class FailureProfile(object):
+    """ Injected request failures """
+    def __init__(self, rate:float = 0.0, status:int = 503, endpoints:Optional[Container[str]] = None,
+                       after_processing:bool = False, seed:Optional[int] = None):
+        """
+        Constructor
+
+        @param   rate              Probability of a request failing
+        @param   status            HTTP status of failed responses
+        @param   endpoints         Endpoints (as counted in
+                                   `FakeCouchDBServer.request_counts`)
+                                   that can fail (None for all)
+        @param   after_processing  Whether requests fail after they have
+                                   been processed (i.e., the response,
+                                   rather than the request, is lost)
+        @param   seed              Seed for the random failures
+        """
+        self.rate = rate
+        self.status = status
+        self.endpoints = endpoints
+        self.after_processing = after_processing
+        self._random = Random(seed)
+        self._forced_failures = 0
+        self._lock = Lock()
+
+    def fail_next(self, count:int = 1):
+        """
+        Force the next requests (to the profile's endpoints) to fail
+
+        @param   count  Number of requests to fail
+        """
+        with self._lock:
+            self._forced_failures += count
+
+    def should_fail(self, endpoint:str) -> bool:
+        """
+        Determine whether a request should fail
+
+        @param   endpoint  Endpoint of the request
+        @return  Whether it should fail
+        """
+        if self.endpoints is not None and endpoint not in self.endpoints:
+            return False
+
+        with self._lock:
+            if self._forced_failures > 0:
+                self._forced_failures -= 1
+                return True
+            return self.rate > 0 and self._random.random() < self.rate
+
+
+class _Document(object):
+    """ Document, with its revision history """
+    __slots__ = ['doc_id', 'revisions', 'seq']
+
+    def __init__(self, doc_id:str):
+        self.doc_id = doc_id
+        self.revisions = []  # type: List[Tuple[str, Optional[dict]]]
+        self.seq = 0
+
+    @property
+    def rev(self) -> str:
+        return self.revisions[-1][0]
+
+    @property
+    def deleted(self) -> bool:
+        return self.revisions[-1][1].get('_deleted', False)
+
+    def body(self, rev:Optional[str] = None) -> Optional[dict]:
+        """ Get the document body (with _id and _rev) at a revision """
+        for revision, data in reversed(self.revisions):
+            if rev is None or revision == rev:
+                return None if data is None else {'_id': self.doc_id, '_rev': revision, **data}
+        return None
+
+    def add_revision(self, data:dict) -> str:
+        """ Add a new revision, returning its revision ID """
+        generation = int(self.rev.split('-', 1)[0]) + 1 if self.revisions else 1
+        rev = '{}-{}'.format(generation, uuid4().hex)
+        self.revisions.append((rev, data))
+
+        # Old revision bodies are discarded, as if compacted
+        if len(self.revisions) > _RETAINED_REVISIONS:
+            old_rev, _ = self.revisions[-_RETAINED_REVISIONS - 1]
+            self.revisions[-_RETAINED_REVISIONS - 1] = (old_rev, None)
+
+        return rev
+
+
+class _ViewIndex(object):
+    """ Incrementally maintained index of the rows emitted by a view """
+    def __init__(self, map_fn:MapFunctionT):
+        self._map_fn = map_fn
+        # Sorted (collation key, doc ID, emission number, key, value)
+        self._rows = []  # type: List[tuple]
+        self._rows_by_doc = {}  # type: Dict[str, List[tuple]]
+        # Documents changed since the index was last brought up to date
+        self._pending = OrderedDict()  # type: Dict[str, Optional[dict]]
+
+    @property
+    def is_stale(self) -> bool:
+        return len(self._pending) > 0
+
+    def update(self, doc_id:str, body:Optional[dict]):
+        """ Mark a document for re-indexing (None if deleted) """
+        self._pending.pop(doc_id, None)
+        self._pending[doc_id] = body
+
+    def refresh(self):
+        """ Re-index the documents that have changed """
+        while self._pending:
+            self._reindex(*self._pending.popitem(last=False))
+
+    def _reindex(self, doc_id:str, body:Optional[dict]):
+        """ Re-index a document (None if deleted) """
+        for row in self._rows_by_doc.pop(doc_id, []):
+            del self._rows[bisect_left(self._rows, row[:3])]
+
+        if body is not None:
+            rows = [
+                (_collation_key(key), doc_id, n, key, value)
+                for n, (key, value) in enumerate(self._map_fn(body))
+            ]
+            for row in rows:
+                insort(self._rows, row)
+            if rows:
+                self._rows_by_doc[doc_id] = rows
+
+    def with_key(self, key:Any) -> Iterable[tuple]:
+        """ Rows with the given key """
+        collation_key = _collation_key(key)
+        i = bisect_left(self._rows, (collation_key,))
+        while i < len(self._rows) and self._rows[i][0] == collation_key:
+            yield self._rows[i]
+            i += 1
+
+    def in_range(self, start:Any = None, end:Any = None, inclusive_end:bool = True,
+                       has_start:bool = False, has_end:bool = False,
+                       start_doc_id:Optional[str] = None) -> Iterable[tuple]:
+        """ Rows with keys in the given range """
+        start_row = (_collation_key(start),) if start_doc_id is None else (_collation_key(start), start_doc_id)
+        i = bisect_left(self._rows, start_row) if has_start else 0
+        end_key = _collation_key(end) if has_end else None
+
+        while i < len(self._rows):
+            row = self._rows[i]
+            if has_end and (row[0] > end_key or (not inclusive_end and row[0] == end_key)):
+                break
+            yield row
+            i += 1
+
+
+class _Database(object):
+    """ In-memory database """
+    def __init__(self, name:str, views:Dict[str, MapFunctionT]):
+        self.name = name
+        self.docs = {}  # type: Dict[str, _Document]
+        self.update_seq = 0
+        self.changes = OrderedDict()  # type: Dict[str, int]
+        self.indices = {name: _ViewIndex(map_fn) for name, map_fn in views.items()}
+
+    def write(self, data:dict, check_rev:bool = True) -> Dict:
+        """
+        Write a document (deleting it, if marked as such)
+
+        @param   data       Document
+        @param   check_rev  Only check the revision, without writing
+        @return  Result row (as per _bulk_docs)
+        """
+        doc_id = data.get('_id') or uuid4().hex
+        rev = data.get('_rev')
+        doc = self.docs.get(doc_id)
+        deleting = data.get('_deleted', False)
+
+        if doc is None or doc.deleted:
+            if doc is None and deleting:
+                return {'id': doc_id, 'error': 'not_found', 'reason': 'missing'}
+            conflict = rev is not None and (doc is None or rev != doc.rev)
+        else:
+            conflict = rev != doc.rev
+
+        if conflict:
+            return {'id': doc_id, 'error': 'conflict', 'reason': 'Document update conflict.'}
+
+        if not check_rev:
+            if doc is None:
+                doc = self.docs[doc_id] = _Document(doc_id)
+
+            # As with CouchDB, deletion tombstones retain any fields
+            # that were provided with the deletion
+            body = {
+                key: value
+                for key, value in data.items()
+                if  key not in ['_id', '_rev']
+            }
+            new_rev = doc.add_revision(body)
+
+            # Design documents aren't indexed by views
+            if not doc_id.startswith(_DESIGN_PREFIX):
+                indexed = None if deleting else doc.body()
+                for index in self.indices.values():
+                    index.update(doc_id, indexed)
+
+            self.update_seq += 1
+            doc.seq = self.update_seq
+            self.changes.pop(doc_id, None)
+            self.changes[doc_id] = doc.seq
+
+            return {'ok': True, 'id': doc_id, 'rev': new_rev}
+
+        return {'ok': True, 'id': doc_id}
+
+    def get_live(self, doc_id:str) -> _Document:
+        """ Get a document that exists and isn't deleted """
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            raise _HTTPError(404, 'not_found', 'missing')
+        if doc.deleted:
+            raise _HTTPError(404, 'not_found', 'deleted')
+        return doc
+
+
+class _FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """ Handler that dispatches requests to the fake server """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _handle(self, method:str):
+        url = urlsplit(self.path)
+        segments = [unquote(segment) for segment in url.path.split('/') if segment]
+        params = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        status, result, headers = self.server.couchdb.handle(method, segments, params, body)
+        payload = b'' if method == 'HEAD' else json.dumps(result).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _parse_bool(params:Dict[str, str], name:str, default:bool) -> bool:
+    if name not in params:
+        return default
+    return params[name].lower() == 'true'
+
+
+def _parse_json(params:Dict[str, str], name:str) -> Any:
+    try:
+        return json.loads(params[name])
+    except ValueError:
+        raise _HTTPError(400, 'bad_request', 'Invalid JSON for {}'.format(name))
+
+
+class FakeCouchDBServer(object):
+    """ In-process fake of a CouchDB server """
+    def __init__(self, latency_profile:Optional[LatencyProfile] = None,
+                       failure_profile:Optional[FailureProfile] = None,
+                       views:Dict[str, MapFunctionT] = BISCUIT_TIN_VIEWS):
+        """
+        Start the fake server
+
+        @param   latency_profile  Artificial latency
+        @param   failure_profile  Injected failures
+        @param   views            Python map functions by view name
+                                  (i.e., "design/view")
+        """
+        self.latency_profile = latency_profile
+        self.failure_profile = failure_profile
+        self.request_counts = Counter()
+
+        self._views = views
+        self._databases = {}  # type: Dict[str, _Database]
+        self._changed = Condition()
+
+        self._server = _FakeHTTPServer(('127.0.0.1', 0), _RequestHandler)
+        self._server.couchdb = self
+        host, port = self._server.server_address
+
+        # Exposed interface for CouchDB
+        self.couchdb_fqdn = 'http://{host}:{port}'.format(host=host, port=port)
+
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def tear_down(self):
+        """ Stop the fake server """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def handle(self, method:str, segments:List[str], params:Dict[str, str], body:bytes) -> Tuple[int, Any, Dict]:
+        """
+        Handle a request
+
+        @param   method    HTTP method
+        @param   segments  Decoded URL path segments
+        @param   params    Query string parameters
+        @param   body      Request body
+        @return  Response status, JSON body and additional headers
+        """
+        endpoint = '{} {}'.format(method, self._get_endpoint_name(segments))
+        self.request_counts[endpoint] += 1
+
+        failure_profile = self.failure_profile
+        fail = failure_profile is not None and failure_profile.should_fail(endpoint)
+        if fail and not failure_profile.after_processing:
+            return failure_profile.status, {'error': 'unavailable', 'reason': 'Injected failure'}, {}
+
+        try:
+            data = json.loads(body.decode('utf-8')) if body else None
+            status, result, headers, number_of_documents = self._route(method, segments, params, data)
+        except _HTTPError as e:
+            status, result, headers, number_of_documents = e.status, {'error': e.error, 'reason': e.reason}, {}, 0
+        except ValueError:
+            status, result, headers, number_of_documents = 400, {'error': 'bad_request', 'reason': 'invalid_json'}, {}, 0
+
+        latency_profile = self.latency_profile
+        if latency_profile is not None:
+            latency = latency_profile.get_latency(number_of_documents)
+            if latency > 0:
+                sleep(latency)
+
+        if fail:
+            return failure_profile.status, {'error': 'unavailable', 'reason': 'Injected failure'}, {}
+
+        return status, result, headers
+
+    @staticmethod
+    def _get_endpoint_name(segments:List[str]) -> str:
+        """ Name of the endpoint, for counting and failure injection """
+        if len(segments) == 0:
+            return '/'
+        if len(segments) == 1:
+            return segments[0] if segments[0].startswith('_') else 'database'
+        if segments[1] == '_design' and len(segments) == 5:
+            return '_view/{}/{}'.format(segments[2], segments[4])
+        if segments[1].startswith('_') and segments[1] != '_design':
+            return segments[1]
+        return 'document'
+
+    def _route(self, method:str, segments:List[str], params:Dict[str, str], data:Any) -> Tuple[int, Any, Dict, int]:
+        """ Route a request, returning the status, result, headers and number of documents involved """
+        if len(segments) == 0:
+            return 200, {'couchdb': 'Welcome', 'version': '1.6.1'}, {}, 0
+
+        if segments == ['_all_dbs']:
+            with self._changed:
+                return 200, sorted(self._databases.keys()), {}, 0
+
+        name = segments[0]
+
+        if len(segments) == 1:
+            return self._database(method, name)
+
+        with self._changed:
+            if name not in self._databases:
+                raise _HTTPError(404, 'not_found', 'no_db_file')
+            db = self._databases[name]
+
+        resource = segments[1]
+
+        if resource == '_all_docs' and method in ['GET', 'POST']:
+            return self._all_docs(db, params, data)
+
+        if resource == '_bulk_docs' and method == 'POST':
+            return self._bulk_docs(db, params, data)
+
+        if resource == '_changes' and method in ['GET', 'POST']:
+            return self._changes_feed(db, params)
+
+        if resource in ['_ensure_full_commit', '_compact', '_view_cleanup'] and method == 'POST':
+            return 201, {'ok': True}, {}, 0
+
+        if resource == '_design' and len(segments) == 5 and segments[3] == '_view' and method in ['GET', 'POST']:
+            return self._view(db, segments[2], segments[4], params, data)
+
+        if resource == '_design' and len(segments) == 3:
+            return self._document(db, method, _DESIGN_PREFIX + segments[2], params, data)
+
+        if len(segments) == 2 and not resource.startswith('_'):
+            return self._document(db, method, resource, params, data)
+
+        raise _HTTPError(404, 'not_found', 'missing')
+
+    def _database(self, method:str, name:str) -> Tuple[int, Any, Dict, int]:
+        with self._changed:
+            db = self._databases.get(name)
+
+            if method == 'PUT':
+                if db is not None:
+                    raise _HTTPError(412, 'file_exists', 'The database could not be created, the file already exists.')
+                self._databases[name] = _Database(name, self._views)
+                return 201, {'ok': True}, {}, 0
+
+            if db is None:
+                raise _HTTPError(404, 'not_found', 'no_db_file')
+
+            if method == 'DELETE':
+                del self._databases[name]
+                self._changed.notify_all()
+                return 200, {'ok': True}, {}, 0
+
+            if method in ['GET', 'HEAD']:
+                return 200, {
+                    'db_name':       name,
+                    'doc_count':     sum(1 for doc in db.docs.values() if not doc.deleted),
+                    'doc_del_count': sum(1 for doc in db.docs.values() if doc.deleted),
+                    'update_seq':    db.update_seq
+                }, {}, 0
+
+        raise _HTTPError(405, 'method_not_allowed', 'Only GET,HEAD,PUT,DELETE allowed')
+
+    def _document(self, db:_Database, method:str, doc_id:str, params:Dict[str, str], data:Any) -> Tuple[int, Any, Dict, int]:
+        with self._changed:
+            if method in ['GET', 'HEAD']:
+                doc = db.docs.get(doc_id)
+
+                if 'rev' in params:
+                    result = doc.body(params['rev']) if doc is not None else None
+                    if result is None:
+                        raise _HTTPError(404, 'not_found', 'missing')
+                else:
+                    doc = db.get_live(doc_id)
+                    result = doc.body()
+
+                    if _parse_bool(params, 'revs_info', False):
+                        result['_revs_info'] = [
+                            {'rev': rev, 'status': 'available' if body is not None else 'missing'}
+                            for rev, body in reversed(doc.revisions)
+                        ]
+
+                return 200, result, {'ETag': '"{}"'.format(result['_rev'])}, 1
+
+            if method == 'PUT':
+                if not isinstance(data, dict):
+                    raise _HTTPError(400, 'bad_request', 'Document must be a JSON object')
+                row = self._write(db, [{**data, '_id': doc_id}], False)[0]
+
+            elif method == 'DELETE':
+                row = self._write(db, [{'_id': doc_id, '_rev': params.get('rev'), '_deleted': True}], False)[0]
+
+            else:
+                raise _HTTPError(405, 'method_not_allowed', 'Only DELETE,GET,HEAD,PUT allowed')
+
+        if 'error' in row:
+            raise _HTTPError(409 if row['error'] == 'conflict' else 404, row['error'], row['reason'])
+
+        return 201 if method == 'PUT' else 200, row, {'ETag': '"{}"'.format(row['rev'])}, 1
+
+    def _write(self, db:_Database, docs:List[dict], all_or_nothing:bool) -> List[Dict]:
+        """ Write documents to the database (lock must be held) """
+        if all_or_nothing:
+            checks = [db.write(doc, check_rev=True) for doc in docs]
+            if any('error' in check for check in checks):
+                return [check for check in checks if 'error' in check]
+
+        results = [db.write(doc, check_rev=False) for doc in docs]
+        self._changed.notify_all()
+        return results
+
+    def _bulk_docs(self, db:_Database, params:Dict[str, str], data:Any) -> Tuple[int, Any, Dict, int]:
+        if not isinstance(data, dict) or not isinstance(data.get('docs'), list):
+            raise _HTTPError(400, 'bad_request', 'POST body must include `docs` parameter.')
+
+        all_or_nothing = _parse_bool(params, 'all_or_nothing', False) or data.get('all_or_nothing', False)
+        with self._changed:
+            results = self._write(db, data['docs'], all_or_nothing)
+
+        return 201, results, {}, len(data['docs'])
+
+    def _all_docs(self, db:_Database, params:Dict[str, str], data:Any) -> Tuple[int, Any, Dict, int]:
+        include_docs = _parse_bool(params, 'include_docs', False)
+
+        def to_row(doc:_Document) -> Dict:
+            row = {'id': doc.doc_id, 'key': doc.doc_id, 'value': {'rev': doc.rev}}
+            if doc.deleted:
+                row['value']['deleted'] = True
+                if include_docs:
+                    row['doc'] = None
+            elif include_docs:
+                row['doc'] = doc.body()
+            return row
+
+        with self._changed:
+            keys = data.get('keys') if isinstance(data, dict) else None
+            if keys is None and 'keys' in params:
+                keys = _parse_json(params, 'keys')
+
+            if keys is not None:
+                rows = [
+                    to_row(db.docs[key]) if key in db.docs else {'key': key, 'error': 'not_found'}
+                    for key in keys
+                ]
+            else:
+                start = _parse_json(params, 'startkey') if 'startkey' in params else None
+                end = _parse_json(params, 'endkey') if 'endkey' in params else None
+                descending = _parse_bool(params, 'descending', False)
+                low, high = (end, start) if descending else (start, end)
+                rows = [
+                    to_row(db.docs[doc_id])
+                    for doc_id in sorted(db.docs.keys(), reverse=descending)
+                    if  not db.docs[doc_id].deleted
+                    and (low is None or doc_id >= low)
+                    and (high is None or doc_id <= high)
+                ]
+
+            total_rows = sum(1 for doc in db.docs.values() if not doc.deleted)
+
+        rows = self._limit(rows, params)
+        return 200, {'total_rows': total_rows, 'offset': 0, 'rows': rows}, {}, len(rows)
+
+    def _view(self, db:_Database, design:str, view:str, params:Dict[str, str], data:Any) -> Tuple[int, Any, Dict, int]:
+        view_name = '{}/{}'.format(design, view)
+
+        with self._changed:
+            design_doc = db.docs.get(_DESIGN_PREFIX + design)
+            if design_doc is None or design_doc.deleted:
+                raise _HTTPError(404, 'not_found', 'missing')
+
+            definition = design_doc.body().get('views', {}).get(view)
+            if definition is None:
+                raise _HTTPError(404, 'not_found', 'missing_named_view')
+
+            if view_name not in db.indices:
+                raise _HTTPError(400, 'bad_request', 'View not emulated: {}'.format(view_name))
+            index = db.indices[view_name]
+
+            stale = params.get('stale')
+            update = params.get('update', 'true')
+            update_after = stale == 'update_after' or update == 'lazy'
+            if stale not in ('ok', 'update_after') and update not in ('false', 'lazy'):
+                index.refresh()
+
+            try:
+                return self._query_index(db, index, definition, params, data)
+            finally:
+                if update_after:
+                    index.refresh()
+
+    def _query_index(self, db:_Database, index:_ViewIndex, definition:dict,
+                           params:Dict[str, str], data:Any) -> Tuple[int, Any, Dict, int]:
+        reduce_fn = definition.get('reduce')
+        do_reduce = reduce_fn is not None and _parse_bool(params, 'reduce', True)
+        include_docs = _parse_bool(params, 'include_docs', False)
+
+        if do_reduce and include_docs:
+            raise _HTTPError(400, 'query_parse_error', '`include_docs` is invalid for reduce')
+
+        keys = data.get('keys') if isinstance(data, dict) else None
+        if keys is None and 'keys' in params:
+            keys = _parse_json(params, 'keys')
+
+        if keys is not None:
+            matched = [row for key in keys for row in index.with_key(key)]
+        elif 'key' in params:
+            matched = list(index.with_key(_parse_json(params, 'key')))
+        else:
+            matched = list(index.in_range(
+                start         = _parse_json(params, 'startkey') if 'startkey' in params else None,
+                end           = _parse_json(params, 'endkey') if 'endkey' in params else None,
+                inclusive_end = _parse_bool(params, 'inclusive_end', True),
+                has_start     = 'startkey' in params,
+                has_end       = 'endkey' in params,
+                start_doc_id  = params.get('startkey_docid')
+            ))
+
+        total_rows = len(index._rows)
+
+        if do_reduce:
+            if _parse_bool(params, 'group', False):
+                groups = OrderedDict()  # type: Dict[str, Tuple[Any, List[Any]]]
+                for _, _, _, key, value in matched:
+                    group_key = json.dumps(key, sort_keys=True)
+                    groups.setdefault(group_key, (key, []))[1].append(value)
+                rows = [
+                    {'key': key, 'value': _builtin_reduce(reduce_fn, values)}
+                    for key, values in groups.values()
+                ]
+            else:
+                rows = [{'key': None, 'value': _builtin_reduce(reduce_fn, [row[4] for row in matched])}] \
+                       if matched else []
+
+            rows = self._limit(rows, params)
+            return 200, {'rows': rows}, {}, len(rows)
+
+        rows = self._limit(matched, params)
+        output = []
+        for _, doc_id, _, key, value in rows:
+            row = {'id': doc_id, 'key': key, 'value': value}
+            if include_docs:
+                # Stale indices can have rows for deleted documents
+                doc = db.docs[doc_id]
+                row['doc'] = None if doc.deleted else doc.body()
+            output.append(row)
+
+        return 200, {'total_rows': total_rows, 'offset': int(params.get('skip', 0)), 'rows': output}, {}, len(output)
+
+    def _changes_feed(self, db:_Database, params:Dict[str, str]) -> Tuple[int, Any, Dict, int]:
+        since = int(params.get('since', 0))
+        include_docs = _parse_bool(params, 'include_docs', False)
+        feed = params.get('feed', 'normal')
+
+        if feed not in ['normal', 'longpoll']:
+            raise _HTTPError(400, 'bad_request', 'Feed not emulated: {}'.format(feed))
+
+        # Only the built-in _view filter is emulated
+        view_filter = None
+        if 'filter' in params:
+            if params['filter'] != '_view':
+                raise _HTTPError(400, 'bad_request', 'Filter not emulated: {}'.format(params['filter']))
+            if params.get('view') not in self._views:
+                raise _HTTPError(404, 'not_found', 'missing')
+            view_filter = self._views[params['view']]
+
+        with self._changed:
+            if feed == 'longpoll':
+                timeout = int(params.get('timeout', 60000)) / 1000
+                self._changed.wait_for(lambda: db.update_seq > since or self._databases.get(db.name) is not db,
+                                       timeout)
+
+            results = []
+            for doc_id, seq in db.changes.items():
+                if seq > since:
+                    doc = db.docs[doc_id]
+                    if view_filter is not None and not any(True for _ in view_filter(doc.body())):
+                        continue
+                    result = {'seq': seq, 'id': doc_id, 'changes': [{'rev': doc.rev}]}
+                    if doc.deleted:
+                        result['deleted'] = True
+                    if include_docs:
+                        result['doc'] = doc.body()
+                    results.append(result)
+
+            last_seq = db.update_seq
+
+        results = self._limit(results, params)
+        if results and 'limit' in params:
+            last_seq = results[-1]['seq']
+
+        return 200, {'results': results, 'last_seq': last_seq}, {}, len(results)
+
+    @staticmethod
+    def _limit(rows:List[Any], params:Dict[str, str]) -> List[Any]:
+        """ Apply the `skip` and `limit` options """
+        skip = int(params.get('skip', 0))
+        if 'limit' in params:
+            return rows[skip:skip + int(params['limit'])]
+        return rows[skip:]
@@ -0,0 +1,102 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import math
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, Sequence
+
+
+class Timings:
+    """
+    Thread-safe record of the latencies of the operations in a benchmark run.
+    """
+    def __init__(self):
+        self.latencies = []    # type: List[float]
+        self._lock = Lock()
+
+    def time(self, operation: Callable[[], Any]) -> Any:
+        """
+        Runs and records the latency of the given operation.
+        :param operation: the operation to run
+        :return: the result of the operation
+        """
+        started_at = time.monotonic()
+        result = operation()
+        latency = time.monotonic() - started_at
+        with self._lock:
+            self.latencies.append(latency)
+        return result
+
+    def time_all(self, operations: Iterable[Callable[[], Any]], number_of_threads: int=1):
+        """
+        Runs and records the latencies of all of the given operations, using the given number of threads.
+        :param operations: the operations to run
+        :param number_of_threads: the number of threads to run the operations on
+        """
+        if number_of_threads == 1:
+            for operation in operations:
+                self.time(operation)
+        else:
+            with ThreadPoolExecutor(max_workers=number_of_threads) as executor:
+                for future in [executor.submit(self.time, operation) for operation in operations]:
+                    future.result()
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    """
+    Gets the given percentile of the values, using the nearest-rank method.
+    :param values: the values (need not be sorted)
+    :param fraction: the percentile, as a fraction between 0 and 1
+    :return: the percentile value
+    """
+    if len(values) == 0:
+        raise ValueError("Cannot get percentile of no values")
+    sorted_values = sorted(values)
+    rank = max(int(math.ceil(fraction * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def get_peak_rss() -> int:
+    """
+    Gets the peak resident set size of this process.
+    :return: the peak resident set size in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarise(timings: Timings, seconds: float) -> Dict:
+    """
+    Summarises the given timings of a benchmark run.
+    :param timings: the timings of the operations in the run
+    :param seconds: the wall time that the run took
+    :return: machine-readable summary of the run
+    """
+    number_of_operations = len(timings.latencies)
+    return {
+        "operations": number_of_operations,
+        "seconds": seconds,
+        "operations_per_second": number_of_operations / seconds if seconds > 0 else None,
+        "latency_p50": percentile(timings.latencies, 0.5) if number_of_operations > 0 else None,
+        "latency_p99": percentile(timings.latencies, 0.99) if number_of_operations > 0 else None,
+        "peak_rss_kb": get_peak_rss()
+    }
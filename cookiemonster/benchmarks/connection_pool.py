@@ -0,0 +1,113 @@
+"""
+CouchDB Connection Pool Benchmark
+=================================
+Compares the throughput of concurrent CouchDB requests, made through a
+`SofterCouchDB`, for different sizes of its connection pool. Each thread
+repeatedly fetches documents, as processor threads do when hydrating
+Cookies.
+
+Usage:
+
+    python -m cookiemonster.benchmarks.connection_pool --couchdb-url http://localhost:5984 --threads 16
+
+For every pool size, the throughput, p50 and p99 latencies and the
+number of requests made, connections opened and connections reused are
+reported. Results are written to standard out as JSON.
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import logging
+import time
+from argparse import ArgumentParser
+from typing import Dict, List
+from uuid import uuid4
+
+from cookiemonster.benchmarks._measurements import Timings, summarise
+from cookiemonster.cookiejar.couchdb.softer import SofterCouchDB
+
+_DEFAULT_POOL_SIZES = [1, 2, 4, 8, 16, 32]
+_DEFAULT_NUMBER_OF_THREADS = 16
+_DEFAULT_NUMBER_OF_REQUESTS = 2000
+_NUMBER_OF_DOCUMENTS = 100
+
+
+def run(couchdb_url: str, pool_sizes: List[int]=None, number_of_threads: int=_DEFAULT_NUMBER_OF_THREADS,
+        number_of_requests: int=_DEFAULT_NUMBER_OF_REQUESTS, pool_block: bool=False) -> List[Dict]:
+    """
+    Runs the benchmark.
+    :param couchdb_url: the URL of the CouchDB server to run against
+    :param pool_sizes: the connection pool sizes to compare
+    :param number_of_threads: the number of threads making requests concurrently
+    :param number_of_requests: the number of requests made for each pool size
+    :param pool_block: whether the connection pool blocks when all of its connections are in use
+    :return: the results for each pool size
+    """
+    if pool_sizes is None:
+        pool_sizes = _DEFAULT_POOL_SIZES
+    logging.disable(logging.CRITICAL)
+
+    database = "benchmark-%s" % uuid4().hex
+    SofterCouchDB(couchdb_url, database).save_bulk(
+        [{"_id": "document-%d" % i, "value": i} for i in range(_NUMBER_OF_DOCUMENTS)])
+
+    results = []
+    for pool_size in pool_sizes:
+        db = SofterCouchDB(couchdb_url, database, max_connections=pool_size, pool_block=pool_block)
+        initial_stats = db.connection_stats()
+
+        timings = Timings()
+        operations = [
+            lambda i=i: db.get("document-%d" % (i % _NUMBER_OF_DOCUMENTS)) for i in range(number_of_requests)
+        ]
+        started_at = time.monotonic()
+        timings.time_all(operations, number_of_threads)
+        result = summarise(timings, time.monotonic() - started_at)
+
+        connection_stats = db.connection_stats()
+        result.update({
+            "pool_size": pool_size,
+            "pool_block": pool_block,
+            "threads": number_of_threads,
+            **{key: value - initial_stats[key] for key, value in connection_stats.items()}
+        })
+        results.append(result)
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the throughput of CouchDB requests against connection pool size")
+    parser.add_argument("--couchdb-url", required=True, help="URL of the CouchDB server to run against")
+    parser.add_argument("--pool-size", type=int, action="append", dest="pool_sizes",
+                        help="connection pool size to run with (may be given more than once; defaults to %s)"
+                             % ", ".join(str(pool_size) for pool_size in _DEFAULT_POOL_SIZES))
+    parser.add_argument("--threads", type=int, default=_DEFAULT_NUMBER_OF_THREADS, dest="number_of_threads",
+                        help="number of threads making requests concurrently")
+    parser.add_argument("--requests", type=int, default=_DEFAULT_NUMBER_OF_REQUESTS, dest="number_of_requests",
+                        help="number of requests made for each pool size")
+    parser.add_argument("--pool-block", action="store_true",
+                        help="block when all pooled connections are in use, rather than opening another")
+    arguments = vars(parser.parse_args())
+    print(json.dumps(run(**arguments), indent=2))
+
+
+if __name__ == "__main__":
+    main()
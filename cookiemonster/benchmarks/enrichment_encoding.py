@@ -0,0 +1,92 @@
+"""
+Enrichment Encoding Benchmark
+=============================
+Compares the time taken to encode enrichments to JSON and decode them
+back, as is done for every enrichment that is stored in or fetched from
+a cookie jar, using the codec built from the generic property mappings
+against the direct codec (which parses with orjson, where installed).
+
+Usage:
+
+    python -m cookiemonster.benchmarks.enrichment_encoding --enrichments 100000
+
+Results are written to standard out as JSON.
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from typing import Dict
+
+from hgicommon.collections import Metadata
+
+from cookiemonster.common.helpers import EnrichmentJSONDecoder, EnrichmentJSONEncoder, FastEnrichmentJSONDecoder, \
+    FastEnrichmentJSONEncoder
+from cookiemonster.common.models import Enrichment
+
+_DEFAULT_NUMBER_OF_ENRICHMENTS = 100000
+_KEYS = ["collection", "data_object", "checksum", "replica", "study_id", "sample_id", "target"]
+_TIMESTAMP = datetime(2016, 1, 1, tzinfo=timezone.utc)
+
+
+def run(number_of_enrichments: int) -> Dict:
+    """
+    Runs the benchmark.
+    :param number_of_enrichments: the number of enrichments to encode and decode
+    :return: the results
+    """
+    enrichments = [
+        Enrichment("irods_update", _TIMESTAMP + timedelta(seconds=i),
+                   Metadata({key: "%s_%d" % (key, i) for key in _KEYS}))
+        for i in range(number_of_enrichments)
+    ]
+    results = {"enrichments": number_of_enrichments}
+
+    for name, encoder, decoder in (("generic_codec", EnrichmentJSONEncoder, EnrichmentJSONDecoder),
+                                   ("fast_codec", FastEnrichmentJSONEncoder, FastEnrichmentJSONDecoder)):
+        started_at = time.monotonic()
+        encoded = [json.dumps(enrichment, cls=encoder) for enrichment in enrichments]
+        encoding_seconds = time.monotonic() - started_at
+
+        started_at = time.monotonic()
+        for enrichment in encoded:
+            json.loads(enrichment, cls=decoder)
+        decoding_seconds = time.monotonic() - started_at
+
+        results[name] = {
+            "encodings_per_second": number_of_enrichments / encoding_seconds,
+            "decodings_per_second": number_of_enrichments / decoding_seconds
+        }
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the JSON encoding and decoding of enrichments")
+    parser.add_argument("--enrichments", type=int, default=_DEFAULT_NUMBER_OF_ENRICHMENTS,
+                        help="number of enrichments to encode and decode")
+    arguments = parser.parse_args()
+    print(json.dumps(run(arguments.enrichments), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Enrichment Memory Benchmark
+===========================
+Compares the memory used per enrichment, as decoded from the JSON that
+is stored by the CouchDB and SQLite backed cookie jars, by the (former)
+`Model` representation, with an instance `__dict__`, a `datetime` per
+timestamp and its own copy of every source and metadata key, against
+the slotted `Enrichment`, with interned strings and epoch timestamps.
+
+Usage:
+
+    python -m cookiemonster.benchmarks.enrichment_memory --enrichments 100000
+
+Results are written to standard out as JSON.
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import gc
+import json
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List
+
+from hgicommon.collections import Metadata
+from hgicommon.models import Model
+
+from cookiemonster.common.helpers import EnrichmentJSONDecoder, EnrichmentJSONEncoder
+from cookiemonster.common.models import Enrichment
+
+_DEFAULT_NUMBER_OF_ENRICHMENTS = 100000
+_SOURCES = ["irods_update", "rule_application"]
+_KEYS = ["collection", "data_object", "checksum", "replica", "study_id", "sample_id", "target"]
+_TIMESTAMP = datetime(2016, 1, 1, tzinfo=timezone.utc)
+
+
+class _ModelEnrichment(Model):
+    """
+    The `Model` representation of an enrichment, as it was before `Enrichment` was slotted.
+    """
+    def __init__(self, source: str, timestamp: datetime, metadata: Metadata):
+        self.source = source
+        self.timestamp = timestamp
+        self.metadata = metadata
+
+
+def _decode_to_model(encoded: str) -> _ModelEnrichment:
+    """
+    Decodes an enrichment to its former `Model` representation.
+    :param encoded: the JSON encoded enrichment
+    :return: the decoded enrichment
+    """
+    decoded = json.loads(encoded)
+    return _ModelEnrichment(decoded["source"], datetime.fromtimestamp(decoded["timestamp"], timezone.utc),
+                            Metadata(decoded["metadata"]))
+
+
+def _decode(encoded: str) -> Enrichment:
+    """
+    Decodes an enrichment, as the cookie jars do.
+    :param encoded: the JSON encoded enrichment
+    :return: the decoded enrichment
+    """
+    return json.loads(encoded, cls=EnrichmentJSONDecoder)
+
+
+def _measure(decode: Callable[[str], Any], encoded: List[str]) -> float:
+    """
+    Measures the memory retained by the decoded enrichments.
+    :param decode: the function that decodes an enrichment
+    :param encoded: the JSON encoded enrichments
+    :return: the bytes used per enrichment
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        decoded = [decode(enrichment) for enrichment in encoded]
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert len(decoded) == len(encoded)
+    return (after - before) / len(encoded)
+
+
+def run(number_of_enrichments: int) -> Dict:
+    """
+    Runs the benchmark.
+    :param number_of_enrichments: the number of enrichments to decode
+    :return: the results
+    """
+    encoded = [
+        json.dumps(Enrichment(_SOURCES[i % len(_SOURCES)], _TIMESTAMP + timedelta(seconds=i),
+                              Metadata({key: "%s_%d" % (key, i) for key in _KEYS})), cls=EnrichmentJSONEncoder)
+        for i in range(number_of_enrichments)
+    ]
+
+    model_bytes = _measure(_decode_to_model, encoded)
+    slotted_bytes = _measure(_decode, encoded)
+
+    return {
+        "enrichments": number_of_enrichments,
+        "model_bytes_per_enrichment": model_bytes,
+        "slotted_bytes_per_enrichment": slotted_bytes,
+        "saving": 1 - slotted_bytes / model_bytes
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the memory used per decoded enrichment")
+    parser.add_argument("--enrichments", type=int, default=_DEFAULT_NUMBER_OF_ENRICHMENTS,
+                        help="number of enrichments to decode")
+    arguments = parser.parse_args()
+    print(json.dumps(run(arguments.enrichments), indent=2))
+
+
+if __name__ == "__main__":
+    main()
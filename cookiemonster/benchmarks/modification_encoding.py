@@ -0,0 +1,80 @@
+"""
+Modification Encoding Benchmark
+===============================
+Compares the time taken to encode the `DataObjectModification` of each
+merged update to JSON, as is done for every update that is retrieved,
+using the encoder built from the generic property mappings against the
+direct encoder.
+
+Usage:
+
+    python -m cookiemonster.benchmarks.modification_encoding --rows 1000000
+
+Results are written to standard out as JSON.
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import time
+from argparse import ArgumentParser
+from typing import Dict
+
+from cookiemonster.benchmarks.retrieval_merge import generate_rows
+from cookiemonster.retriever.source.irods.baton_mappers import _UpdateRows
+from cookiemonster.retriever.source.irods.json_convert import DataObjectModificationJSONEncoder, \
+    FastDataObjectModificationJSONEncoder
+
+_DEFAULT_NUMBER_OF_ROWS = 1000000
+_DEFAULT_ROWS_PER_DATA_OBJECT = 10
+
+
+def run(number_of_rows: int, rows_per_data_object: int=_DEFAULT_ROWS_PER_DATA_OBJECT) -> Dict:
+    """
+    Runs the benchmark.
+    :param number_of_rows: the number of synthetic rows to merge into the updates that are encoded
+    :param rows_per_data_object: the number of rows related to each data object
+    :return: the results
+    """
+    modifications = [update.modification for update in
+                     _UpdateRows(generate_rows(number_of_rows, rows_per_data_object)).combine_for_same_entity()]
+    results = {"modifications": len(modifications)}
+
+    for name, encoder in (("generic_encoder", DataObjectModificationJSONEncoder()),
+                          ("fast_encoder", FastDataObjectModificationJSONEncoder())):
+        started_at = time.monotonic()
+        for modification in modifications:
+            encoder.default(modification)
+        seconds = time.monotonic() - started_at
+        results[name] = {"seconds": seconds, "modifications_per_second": len(modifications) / seconds}
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the JSON encoding of data object modifications")
+    parser.add_argument("--rows", type=int, default=_DEFAULT_NUMBER_OF_ROWS, help="number of synthetic rows")
+    parser.add_argument("--rows-per-data-object", type=int, default=_DEFAULT_ROWS_PER_DATA_OBJECT,
+                        help="number of rows related to each data object")
+    arguments = parser.parse_args()
+    print(json.dumps(run(arguments.rows, arguments.rows_per_data_object), indent=2))
+
+
+if __name__ == "__main__":
+    main()
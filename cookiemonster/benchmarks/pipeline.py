@@ -0,0 +1,363 @@
+"""
+CookieJar to Processor Pipeline Benchmarks
+==========================================
+Reproducible scenarios that exercise the CookieJar to processor
+pipeline, each run against an `InMemoryCookieJar`, a SQLite backed
+`SQLiteCookieJar` and a CouchDB backed `BiscuitTin`:
+
+* `bulk_enrich` Enrich many Cookies, with several enrichments each
+
+* `dequeue_complete_churn` Repeatedly get the next Cookie for
+  processing, mark it as complete and then mark it for processing again
+
+* `rule_evaluation` Evaluate N rules against a Cookie with M enrichments
+
+* `retrieval_merge` Retrieve (merge and convert) iRODS update rows from a
+  local dataset and enrich the related Cookies with them
+
+Each run happens in a fresh process, such that its peak resident set
+size can be measured. For every run, the throughput, p50 and p99
+latencies of its operations and the peak RSS are reported.
+
+Usage:
+
+    python -m cookiemonster.benchmarks.pipeline --couchdb-url http://localhost:5984
+
+Where a CouchDB server is not available, the `BiscuitTin` runs can
+instead be made against the in-process fake CouchDB server used by the
+tests, optionally with artificial latency and injected (and retried)
+request failures:
+
+    python -m cookiemonster.benchmarks.pipeline --fake-couchdb --fake-couchdb-latency 0.001 \
+        --fake-couchdb-failure-rate 0.01
+
+If neither a CouchDB URL nor the fake server is given, the `BiscuitTin`
+runs are skipped.
+Results are written to standard out as JSON, for regression comparison.
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from tempfile import mkdtemp
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+from hgicommon.collections import Metadata
+
+from cookiemonster.benchmarks._fake_couchdb import FailureProfile, FakeCouchDBServer, LatencyProfile
+from cookiemonster.benchmarks._measurements import Timings, summarise
+from cookiemonster.benchmarks.retrieval_merge import generate_rows
+from cookiemonster.common.collections import UpdateCollection
+from cookiemonster.common.models import Enrichment
+from cookiemonster.cookiejar import BiscuitTin, CookieJar
+from cookiemonster.cookiejar.in_memory_cookiejar import InMemoryCookieJar
+from cookiemonster.cookiejar.sqlite_cookiejar import SQLiteCookieJar
+from cookiemonster.processor.basic_processing import BasicProcessor
+from cookiemonster.processor.models import Rule
+from cookiemonster.retriever.manager import RetrievalManager
+from cookiemonster.retriever.source.irods.replay_mappers import FileUpdateMapper
+
+IN_MEMORY_COOKIE_JAR = "in_memory"
+COUCHDB_COOKIE_JAR = "couchdb"
+SQLITE_COOKIE_JAR = "sqlite"
+COOKIE_JAR_TYPES = [IN_MEMORY_COOKIE_JAR, SQLITE_COOKIE_JAR, COUCHDB_COOKIE_JAR]
+
+_DEFAULT_NUMBER_OF_COOKIES = 1000
+_DEFAULT_ENRICHMENTS_PER_COOKIE = 3
+_DEFAULT_NUMBER_OF_RULES = 50
+_DEFAULT_NUMBER_OF_ENRICHMENTS = 50
+_DEFAULT_NUMBER_OF_EVALUATIONS = 20
+_DEFAULT_NUMBER_OF_ROWS = 10000
+_DEFAULT_BATCH_SIZE = 100
+_DEFAULT_NUMBER_OF_THREADS = 1
+_NUMBER_OF_SOURCES = 10
+_NUMBER_OF_KEYS = 10
+_TIMESTAMP = datetime(2016, 1, 1, tzinfo=timezone.utc)
+_FAILURE_SEED = 42
+
+
+def _create_enrichment(i: int) -> Enrichment:
+    """
+    Creates a synthetic enrichment.
+    :param i: the (deterministic) seed of the enrichment
+    :return: the enrichment
+    """
+    return Enrichment("source_%d" % (i % _NUMBER_OF_SOURCES), _TIMESTAMP + timedelta(seconds=i),
+                      Metadata({"key_%d" % (j % _NUMBER_OF_KEYS): "value_%d" % (i + j) for j in range(i, i + 5)}))
+
+
+def bulk_enrich(cookie_jar: CookieJar, timings: Timings, number_of_cookies: int=_DEFAULT_NUMBER_OF_COOKIES,
+                enrichments_per_cookie: int=_DEFAULT_ENRICHMENTS_PER_COOKIE,
+                number_of_threads: int=_DEFAULT_NUMBER_OF_THREADS, **kwargs):
+    """
+    Enriches many Cookies, timing each enrichment.
+    :param cookie_jar: the cookie jar to benchmark
+    :param timings: where the timings of the operations are recorded
+    :param number_of_cookies: the number of Cookies to enrich
+    :param enrichments_per_cookie: the number of enrichments to give each Cookie
+    :param number_of_threads: the number of threads to enrich from
+    """
+    operations = []
+    for i in range(enrichments_per_cookie):
+        for j in range(number_of_cookies):
+            def enrich(identifier="/cookie/%d" % j, enrichment=_create_enrichment(i * number_of_cookies + j)):
+                cookie_jar.enrich_cookie(identifier, enrichment)
+            operations.append(enrich)
+    timings.time_all(operations, number_of_threads)
+
+
+def dequeue_complete_churn(cookie_jar: CookieJar, timings: Timings, number_of_cookies: int=_DEFAULT_NUMBER_OF_COOKIES,
+                           number_of_threads: int=_DEFAULT_NUMBER_OF_THREADS, **kwargs):
+    """
+    Repeatedly gets the next Cookie for processing, marks it as complete and then marks it for processing again,
+    timing each cycle.
+    :param cookie_jar: the cookie jar to benchmark
+    :param timings: where the timings of the operations are recorded
+    :param number_of_cookies: the number of Cookies in the queue (and number of cycles)
+    :param number_of_threads: the number of threads to churn from
+    """
+    for i in range(number_of_cookies):
+        cookie_jar.mark_for_processing("/cookie/%d" % i)
+
+    def churn():
+        cookie = cookie_jar.get_next_for_processing()
+        if cookie is not None:
+            cookie_jar.mark_as_complete(cookie.identifier)
+            cookie_jar.mark_for_processing(cookie.identifier)
+
+    timings.time_all([churn] * number_of_cookies, number_of_threads)
+
+
+def rule_evaluation(cookie_jar: CookieJar, timings: Timings, number_of_rules: int=_DEFAULT_NUMBER_OF_RULES,
+                    number_of_enrichments: int=_DEFAULT_NUMBER_OF_ENRICHMENTS,
+                    number_of_evaluations: int=_DEFAULT_NUMBER_OF_EVALUATIONS, **kwargs):
+    """
+    Evaluates N rules against a Cookie with M enrichments, timing each evaluation of all of the rules.
+    :param cookie_jar: the cookie jar to benchmark
+    :param timings: where the timings of the operations are recorded
+    :param number_of_rules: the number of rules (N)
+    :param number_of_enrichments: the number of enrichments of the Cookie (M)
+    :param number_of_evaluations: the number of times to evaluate all of the rules
+    """
+    identifier = "/cookie/rules"
+    for i in range(number_of_enrichments):
+        cookie_jar.enrich_cookie(identifier, _create_enrichment(i), mark_for_processing=False)
+    cookie = cookie_jar.fetch_cookie(identifier)
+
+    def create_rule(i: int) -> Rule:
+        source = "source_%d" % (i % _NUMBER_OF_SOURCES)
+        key = "key_%d" % (i % _NUMBER_OF_KEYS)
+
+        def precondition(cookie, context) -> bool:
+            enrichment = cookie.enrichments.get_most_recent_from_source(source)
+            return enrichment is not None and enrichment.metadata.get(key) == "value_%d" % i
+
+        return Rule(precondition, lambda cookie, context: False, "rule_%d" % i, i)
+
+    processor = BasicProcessor(cookie_jar, [create_rule(i) for i in range(number_of_rules)], [])
+    # Evaluation adds the rule applications to the given Cookie, therefore each evaluation is given its own copy
+    cookies = [copy.deepcopy(cookie) for _ in range(number_of_evaluations)]
+    timings.time_all([lambda cookie=cookie: processor.evaluate_rules_with_cookie(cookie) for cookie in cookies])
+
+
+def retrieval_merge(cookie_jar: CookieJar, timings: Timings, number_of_rows: int=_DEFAULT_NUMBER_OF_ROWS,
+                    batch_size: int=_DEFAULT_BATCH_SIZE, **kwargs):
+    """
+    Retrieves updates from a local dataset of iRODS update rows and enriches the related Cookies with them, timing
+    each enrichment.
+    :param cookie_jar: the cookie jar to benchmark
+    :param timings: where the timings of the operations are recorded
+    :param number_of_rows: the number of rows in the dataset
+    :param batch_size: the number of updates that are streamed from the retriever at a time
+    """
+    temp_directory = mkdtemp(suffix=retrieval_merge.__name__)
+    try:
+        dataset_location = os.path.join(temp_directory, "rows.json")
+        FileUpdateMapper.write_rows(dataset_location, generate_rows(number_of_rows))
+
+        retrieval_manager = RetrievalManager(FileUpdateMapper(dataset_location), batch_size=batch_size)
+
+        def put_updates_in_cookie_jar(updates: UpdateCollection):
+            for update in updates:
+                enrichment = Enrichment("irods_update", update.timestamp, update.metadata)
+                timings.time(lambda: cookie_jar.enrich_cookie(update.target, enrichment))
+
+        retrieval_manager.add_listener(put_updates_in_cookie_jar)
+        retrieval_manager.run()
+    finally:
+        shutil.rmtree(temp_directory)
+
+
+SCENARIOS = {
+    scenario.__name__: scenario for scenario in [bulk_enrich, dequeue_complete_churn, rule_evaluation, retrieval_merge]
+}   # type: Dict[str, Callable[..., None]]
+
+
+def _create_cookie_jar(cookie_jar_type: str, couchdb_url: Optional[str], directory: str) -> CookieJar:
+    """
+    Creates a cookie jar of the given type.
+    :param cookie_jar_type: the type of cookie jar
+    :param couchdb_url: the URL of the CouchDB server to use with a CouchDB backed cookie jar
+    :param directory: the directory in which to put the database of a SQLite backed cookie jar
+    :return: the cookie jar
+    """
+    if cookie_jar_type == IN_MEMORY_COOKIE_JAR:
+        return InMemoryCookieJar()
+    elif cookie_jar_type == SQLITE_COOKIE_JAR:
+        return SQLiteCookieJar(os.path.join(directory, "benchmark.db"))
+    elif cookie_jar_type == COUCHDB_COOKIE_JAR:
+        return BiscuitTin(couchdb_url, "benchmark-%s" % uuid4().hex)
+    raise ValueError("Unknown cookie jar type: %s" % cookie_jar_type)
+
+
+def _run_in_process(scenario_name: str, cookie_jar_type: str, couchdb_url: Optional[str], parameters: Dict) -> Dict:
+    """
+    Runs the given scenario against a new cookie jar of the given type. Intended to be run in a fresh process.
+    :param scenario_name: the name of the scenario to run
+    :param cookie_jar_type: the type of cookie jar to run the scenario against
+    :param couchdb_url: the URL of the CouchDB server to use with a CouchDB backed cookie jar
+    :param parameters: the parameters of the scenario
+    :return: summary of the run
+    """
+    logging.disable(logging.CRITICAL)
+    temp_directory = mkdtemp(suffix=scenario_name)
+    try:
+        cookie_jar = _create_cookie_jar(cookie_jar_type, couchdb_url, temp_directory)
+        timings = Timings()
+        started_at = time.monotonic()
+        SCENARIOS[scenario_name](cookie_jar, timings, **parameters)
+        summary = summarise(timings, time.monotonic() - started_at)
+
+        if isinstance(cookie_jar, SQLiteCookieJar):
+            cookie_jar.stop()
+        return summary
+    finally:
+        shutil.rmtree(temp_directory)
+
+
+def run(scenario_names: List[str], cookie_jar_types: List[str], couchdb_url: Optional[str]=None,
+        parameters: Dict=None, fake_couchdb: bool=False, fake_couchdb_latency: float=0.0,
+        fake_couchdb_latency_per_document: float=0.0, fake_couchdb_failure_rate: float=0.0) -> List[Dict]:
+    """
+    Runs the given scenarios against each of the given types of cookie jar.
+    :param scenario_names: the names of the scenarios to run
+    :param cookie_jar_types: the types of cookie jar to run the scenarios against
+    :param couchdb_url: the URL of the CouchDB server to use with CouchDB backed cookie jars. If not given (and the
+    fake CouchDB server is not used), runs against CouchDB backed cookie jars are skipped
+    :param parameters: the parameters of the scenarios (parameters not relevant to a scenario are ignored)
+    :param fake_couchdb: whether to run CouchDB backed cookie jars against an in-process fake CouchDB server, rather
+    than the server at the given URL
+    :param fake_couchdb_latency: the latency (in seconds) the fake CouchDB server adds to every request
+    :param fake_couchdb_latency_per_document: the latency (in seconds) the fake CouchDB server adds to a request for
+    every document it reads or writes
+    :param fake_couchdb_failure_rate: the probability of a request to the fake CouchDB server failing (which the
+    CouchDB backed cookie jar will retry)
+    :return: summaries of the runs
+    """
+    if parameters is None:
+        parameters = {}
+    # Each run gets its own process, such that its peak RSS is not inflated by previous runs
+    context = multiprocessing.get_context("spawn")
+
+    fake_couchdb_server = None
+    if fake_couchdb and COUCHDB_COOKIE_JAR in cookie_jar_types:
+        # The fake server is run in this process, such that it does not contribute to the peak RSS of the runs
+        fake_couchdb_server = FakeCouchDBServer(
+            latency_profile=LatencyProfile(fake_couchdb_latency, fake_couchdb_latency_per_document),
+            failure_profile=FailureProfile(fake_couchdb_failure_rate, seed=_FAILURE_SEED))
+        couchdb_url = fake_couchdb_server.couchdb_fqdn
+
+    try:
+        results = []
+        for scenario_name in scenario_names:
+            for cookie_jar_type in cookie_jar_types:
+                result = {"scenario": scenario_name, "cookie_jar": cookie_jar_type, "parameters": parameters}
+                if cookie_jar_type == COUCHDB_COOKIE_JAR and couchdb_url is None:
+                    result["skipped"] = "No CouchDB URL given"
+                else:
+                    if cookie_jar_type == COUCHDB_COOKIE_JAR and fake_couchdb_server is not None:
+                        result["fake_couchdb"] = {"latency": fake_couchdb_latency,
+                                                  "latency_per_document": fake_couchdb_latency_per_document,
+                                                  "failure_rate": fake_couchdb_failure_rate}
+                    with context.Pool(1) as pool:
+                        result.update(pool.apply(
+                            _run_in_process, (scenario_name, cookie_jar_type, couchdb_url, parameters)))
+                results.append(result)
+        return results
+    finally:
+        if fake_couchdb_server is not None:
+            fake_couchdb_server.tear_down()
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the CookieJar to processor pipeline")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS.keys()), dest="scenarios",
+                        help="scenario to run (may be given more than once; defaults to all)")
+    parser.add_argument("--cookie-jar", action="append", choices=COOKIE_JAR_TYPES,
+                        dest="cookie_jars", help="cookie jar to run against (may be given more than once; defaults to "
+                                                 "all)")
+    parser.add_argument("--couchdb-url", help="URL of the CouchDB server to run CouchDB backed cookie jars against")
+    parser.add_argument("--fake-couchdb", action="store_true",
+                        help="run CouchDB backed cookie jars against an in-process fake CouchDB server")
+    parser.add_argument("--fake-couchdb-latency", type=float, default=0.0,
+                        help="latency (in seconds) added to every request to the fake CouchDB server")
+    parser.add_argument("--fake-couchdb-latency-per-document", type=float, default=0.0,
+                        help="latency (in seconds) added to a request to the fake CouchDB server for every document it "
+                             "reads or writes")
+    parser.add_argument("--fake-couchdb-failure-rate", type=float, default=0.0,
+                        help="probability of a request to the fake CouchDB server failing")
+    parser.add_argument("--cookies", type=int, default=_DEFAULT_NUMBER_OF_COOKIES, dest="number_of_cookies",
+                        help="number of Cookies to enrich or churn")
+    parser.add_argument("--enrichments-per-cookie", type=int, default=_DEFAULT_ENRICHMENTS_PER_COOKIE,
+                        help="number of enrichments given to each Cookie when bulk enriching")
+    parser.add_argument("--rules", type=int, default=_DEFAULT_NUMBER_OF_RULES, dest="number_of_rules",
+                        help="number of rules to evaluate")
+    parser.add_argument("--enrichments", type=int, default=_DEFAULT_NUMBER_OF_ENRICHMENTS,
+                        dest="number_of_enrichments", help="number of enrichments of the Cookie rules are evaluated "
+                                                           "against")
+    parser.add_argument("--evaluations", type=int, default=_DEFAULT_NUMBER_OF_EVALUATIONS,
+                        dest="number_of_evaluations", help="number of times to evaluate the rules")
+    parser.add_argument("--rows", type=int, default=_DEFAULT_NUMBER_OF_ROWS, dest="number_of_rows",
+                        help="number of iRODS update rows to retrieve")
+    parser.add_argument("--batch-size", type=int, default=_DEFAULT_BATCH_SIZE,
+                        help="number of updates streamed from the retriever at a time")
+    parser.add_argument("--threads", type=int, default=_DEFAULT_NUMBER_OF_THREADS, dest="number_of_threads",
+                        help="number of threads to enrich or churn from")
+    arguments = vars(parser.parse_args())
+
+    scenario_names = arguments.pop("scenarios") or sorted(SCENARIOS.keys())
+    cookie_jar_types = arguments.pop("cookie_jars") or COOKIE_JAR_TYPES
+    couchdb_url = arguments.pop("couchdb_url")
+    fake_couchdb = {key: arguments.pop(key) for key in
+                    ["fake_couchdb", "fake_couchdb_latency", "fake_couchdb_latency_per_document",
+                     "fake_couchdb_failure_rate"]}
+    print(json.dumps(run(scenario_names, cookie_jar_types, couchdb_url, arguments, **fake_couchdb), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Retrieval Merge Benchmark
+=========================
+Compares the time taken to merge the rows returned by the iRODS modified
+data and metadata specific queries into one update per data object,
+using the object-based merge (a model per row) against the columnar
+merge (models for the merged updates only).
+
+Usage:
+
+    python -m cookiemonster.benchmarks.retrieval_merge --rows 1000000
+
+Results are written to standard out as JSON.
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import time
+from argparse import ArgumentParser
+from random import Random
+from typing import Dict, List
+
+from cookiemonster.retriever.source.irods._constants import MODIFIED_COLLECTION_NAME_PROPERTY, \
+    MODIFIED_DATA_NAME_PROPERTY, MODIFIED_DATA_ID_PROPERTY, MODIFIED_DATA_REPLICA_NUMBER_PROPERTY, \
+    MODIFIED_DATA_REPLICA_CHECKSUM_PROPERTY, MODIFIED_DATA_TIMESTAMP_PROPERTY, MODIFIED_DATA_REPLICA_STATUS_PROPERTY, \
+    MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY, MODIFIED_METADATA_ATTRIBUTE_VALUE_PROPERTY, \
+    MODIFIED_METADATA_TIMESTAMP_PROPERTY
+from cookiemonster.retriever.source.irods.baton_mappers import BatonUpdateMapper, _UpdateRows, \
+    _row_to_data_object_update
+
+_DEFAULT_NUMBER_OF_ROWS = 1000000
+_DEFAULT_ROWS_PER_DATA_OBJECT = 10
+_DEFAULT_SEED = 42
+
+
+def generate_rows(number_of_rows: int, rows_per_data_object: int=_DEFAULT_ROWS_PER_DATA_OBJECT,
+                  seed: int=_DEFAULT_SEED) -> List[Dict]:
+    """
+    Generates synthetic rows, in the format returned by the modified data and metadata specific queries. Each data
+    object has one replica row, with the rest of its rows being metadata modifications.
+    :param number_of_rows: the number of rows to generate
+    :param rows_per_data_object: the number of rows related to each data object
+    :param seed: seed for the (reproducible) random shuffling of the rows
+    :return: the rows
+    """
+    rows = []
+    for i in range(number_of_rows):
+        data_id = i // rows_per_data_object
+        row = {
+            MODIFIED_COLLECTION_NAME_PROPERTY: "/zone/collection_%d" % (data_id % 100),
+            MODIFIED_DATA_NAME_PROPERTY: "data_object_%d" % data_id,
+            MODIFIED_DATA_ID_PROPERTY: str(data_id)
+        }
+        timestamp = str(1400000000 + i)
+        if i % rows_per_data_object == 0:
+            row[MODIFIED_DATA_REPLICA_NUMBER_PROPERTY] = "0"
+            row[MODIFIED_DATA_REPLICA_CHECKSUM_PROPERTY] = "%032x" % data_id
+            row[MODIFIED_DATA_TIMESTAMP_PROPERTY] = timestamp
+            row[MODIFIED_DATA_REPLICA_STATUS_PROPERTY] = "1"
+        else:
+            row[MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY] = "key_%d" % (i % rows_per_data_object % 4)
+            row[MODIFIED_METADATA_ATTRIBUTE_VALUE_PROPERTY] = "value_%d" % i
+            row[MODIFIED_METADATA_TIMESTAMP_PROPERTY] = timestamp
+        rows.append(row)
+
+    Random(seed).shuffle(rows)
+    return rows
+
+
+def run(number_of_rows: int, rows_per_data_object: int=_DEFAULT_ROWS_PER_DATA_OBJECT) -> Dict:
+    """
+    Runs the benchmark.
+    :param number_of_rows: the number of synthetic rows to merge
+    :param rows_per_data_object: the number of rows related to each data object
+    :return: the results
+    """
+    rows = generate_rows(number_of_rows, rows_per_data_object)
+
+    started_at = time.monotonic()
+    updates = [_row_to_data_object_update(row) for row in rows]
+    object_merged = BatonUpdateMapper._combine_updates_for_same_entity(updates)
+    object_merge_time = time.monotonic() - started_at
+
+    started_at = time.monotonic()
+    columnar_merged = _UpdateRows(rows).combine_for_same_entity()
+    columnar_merge_time = time.monotonic() - started_at
+
+    assert len(object_merged) == len(columnar_merged)
+
+    return {
+        "rows": number_of_rows,
+        "merged_updates": len(columnar_merged),
+        "object_merge": {"seconds": object_merge_time, "rows_per_second": number_of_rows / object_merge_time},
+        "columnar_merge": {"seconds": columnar_merge_time, "rows_per_second": number_of_rows / columnar_merge_time}
+    }
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the merging of iRODS update rows")
+    parser.add_argument("--rows", type=int, default=_DEFAULT_NUMBER_OF_ROWS, help="number of synthetic rows")
+    parser.add_argument("--rows-per-data-object", type=int, default=_DEFAULT_ROWS_PER_DATA_OBJECT,
+                        help="number of rows related to each data object")
+    arguments = parser.parse_args()
+    print(json.dumps(run(arguments.rows, arguments.rows_per_data_object), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,12 +20,12 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+from bisect import bisect_left, bisect_right
 from datetime import datetime
-from typing import List, Sequence, Optional, Iterable, Any, Union
+from typing import Dict, List, Sequence, Optional, Iterable, Any, Union
 
 from cookiemonster.common.helpers import localise_to_utc
-from cookiemonster.common.models import Update, Enrichment
-from hgicommon.collections import Metadata
+from cookiemonster.common.models import Update, Enrichment, EnrichmentDiff
 
 
 class UpdateCollection(list):
@@ -42,18 +42,19 @@ class UpdateCollection(list):
         if len(self) == 0:
             raise ValueError("No updates in collection")
 
-        most_recent = [Update("sentinel", datetime.min, Metadata())]
+        most_recent = []    # type: List[Update]
+        most_recent_so_far = localise_to_utc(datetime.min)
         for update in self:
-            assert len(most_recent) > 0
-            most_recent_so_far = localise_to_utc(most_recent[0].timestamp)
             timestamp = localise_to_utc(update.timestamp)
             assert timestamp != datetime.min
 
             if timestamp > most_recent_so_far:
                 most_recent.clear()
+                most_recent_so_far = timestamp
             if timestamp >= most_recent_so_far:
                 most_recent.append(update)
 
+        assert len(most_recent) > 0
         return most_recent
 
     def get_entity_updates(self, entity_location: str) -> List[Update]:
@@ -67,14 +68,67 @@ class UpdateCollection(list):
         return [update for update in self if update.target == entity_location]
 
 
+class _SourceDiffs(object):
+    """
+    Index of the enrichments from one source, in timestamp order, and the differences between each consecutive pair.
+    """
+    def __init__(self, enrichments: Iterable[Enrichment]):
+        """
+        Constructor.
+        :param enrichments: the enrichments from the source, in timestamp order
+        """
+        self.enrichments = list(enrichments)     # type: List[Enrichment]
+        self.timestamps = [enrichment.timestamp for enrichment in self.enrichments]   # type: List[datetime]
+        # The difference between enrichments i and i + 1 is at i
+        self.diffs = [EnrichmentDiff(basis, comparator)     # type: List[EnrichmentDiff]
+                      for basis, comparator in zip(self.enrichments, self.enrichments[1:])]
+
+    def add(self, enrichment: Enrichment):
+        """
+        Adds an enrichment from the source, recalculating only the differences either side of it.
+        :param enrichment: the enrichment to add
+        """
+        i = bisect_right(self.enrichments, enrichment)
+        self.enrichments.insert(i, enrichment)
+        self.timestamps.insert(i, enrichment.timestamp)
+
+        diffs = []
+        if i > 0:
+            diffs.append(EnrichmentDiff(self.enrichments[i - 1], enrichment))
+        if i < len(self.enrichments) - 1:
+            diffs.append(EnrichmentDiff(enrichment, self.enrichments[i + 1]))
+        # Replaces the difference between the enrichments either side, if there were any
+        self.diffs[max(i - 1, 0):i] = diffs
+
+    def get_changes(self, keys: Optional[List[str]]=None, since: Optional[datetime]=None) -> List[EnrichmentDiff]:
+        """
+        Gets the differences between consecutive enrichments from the source that are non-trivial.
+        :param keys: the metadata keys to check (all if not given)
+        :param since: the time from which to check for changes (all if not given)
+        :return: the differences
+        """
+        # The differences with the first enrichment since the given time onwards
+        first = max(bisect_left(self.timestamps, since), 1) - 1 if since else 0
+        diffs = self.diffs[first:]
+
+        if keys:
+            diffs = [diff.restricted_to(keys) for diff in diffs]
+        return [diff for diff in diffs if diff.is_different()]
+
+
 class EnrichmentCollection(Sequence):
     """
     Collection of `Enrichment` instances.
+
+    The differences between consecutive enrichments from each source (see `get_changes_from_source`) are indexed when
+    they are first requested and kept up to date as enrichments are added, such that they are not recalculated for
+    every request.
     """
     def __init__(self, seq: Iterable[Enrichment]=None):
         if seq is None:
             seq = {}
         self._data = []     # type: List[Enrichment]
+        self._source_diffs = {}     # type: Dict[str, _SourceDiffs]
         self.add(seq)
 
     def __iter__(self) -> Iterable:
@@ -103,20 +157,12 @@ class EnrichmentCollection(Sequence):
             for x in enrichment:
                 self.add(x)
         else:
-            if len(self._data) == 0:
-                self._data.append(enrichment)
-            else:
-                number_of_pre_existing_enrichments = len(self._data)
-                i = 0
-                while i < number_of_pre_existing_enrichments:
-                    prexisting_enrichment = self._data[i]
-                    if prexisting_enrichment.timestamp > enrichment.timestamp:
-                        self._data.insert(i, enrichment)
-                        i = number_of_pre_existing_enrichments
-                    elif i == number_of_pre_existing_enrichments - 1:
-                        self._data.append(enrichment)
-                    i += 1
-                assert len(self._data) == number_of_pre_existing_enrichments + 1
+            # After any enrichments with the same timestamp
+            self._data.insert(bisect_right(self._data, enrichment), enrichment)
+
+            source_diffs = self._source_diffs.get(enrichment.source)
+            if source_diffs is not None:
+                source_diffs.add(enrichment)
 
     def get_most_recent_from_source(self, source: str) -> Optional[Enrichment]:
         """
@@ -143,3 +189,23 @@ class EnrichmentCollection(Sequence):
                 enrichments.add(enrichment)
         return enrichments
 
+    def get_changes_from_source(self, source: str, keys: Union[None, str, List[str]]=None,
+                                since: Optional[datetime]=None) -> List[EnrichmentDiff]:
+        """
+        Gets the running changes in the metadata of the enrichments from the given source (ignoring those from any other
+        source), optionally only of the given key(s) and since the given time.
+
+        The returned differences are shared between calls, so must not be modified.
+        :param source: the source of the enrichments
+        :param keys: the metadata key(s) to check (all if not given)
+        :param since: the time from which to check for changes (all if not given)
+        :return: the non-trivial differences between consecutive enrichments from the source
+        """
+        source_diffs = self._source_diffs.get(source)
+        if source_diffs is None:
+            source_diffs = _SourceDiffs(enrichment for enrichment in self._data if enrichment.source == source)
+            self._source_diffs[source] = source_diffs
+
+        if isinstance(keys, str):
+            keys = [keys]
+        return source_diffs.get_changes(keys, since)
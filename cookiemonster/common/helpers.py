@@ -22,8 +22,12 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import json
+from bisect import bisect_left
 from datetime import datetime
-from typing import List, Optional, Union, Sequence
+from json import JSONDecoder, JSONEncoder
+from sys import intern
+from typing import Any, Dict, List, Optional, Union, Sequence
 
 import pytz
 
@@ -32,6 +36,12 @@ from hgicommon.collections import Metadata
 from hgijson import DatetimeEpochJSONEncoder, DatetimeEpochJSONDecoder, JsonPropertyMapping, \
     MappingJSONEncoderClassBuilder, MappingJSONDecoderClassBuilder
 
+try:
+    # Faster JSON parser, which is used when it is installed
+    from orjson import loads as _fast_loads
+except ImportError:
+    _fast_loads = None
+
 
 def localise_to_utc(timestamp: datetime) -> datetime:
     """
@@ -45,6 +55,20 @@ def localise_to_utc(timestamp: datetime) -> datetime:
         return timestamp.astimezone(pytz.utc)
 
 
+class _Timestamps(Sequence):
+    """
+    View of the timestamps of a sequence of enrichments, to bisect.
+    """
+    def __init__(self, enrichments: Sequence[Enrichment]):
+        self._enrichments = enrichments
+
+    def __getitem__(self, index: int) -> datetime:
+        return self._enrichments[index].timestamp
+
+    def __len__(self) -> int:
+        return len(self._enrichments)
+
+
 def get_enrichment_changes_from_source(enrichments: Sequence[Enrichment], source: str,
                                        keys: Union[None, str, List[str]]=None,
                                        since: Optional[datetime]=None) -> List[EnrichmentDiff]:
@@ -53,6 +77,10 @@ def get_enrichment_changes_from_source(enrichments: Sequence[Enrichment], source
     and, optional, key/list of keys based from the first known
     enrichment
 
+    An `EnrichmentCollection` is filtered to the source by its cached
+    index of differences (see `EnrichmentCollection.get_changes_from_source`),
+    otherwise the enrichments must all be from the source
+
     @param   enrichments    Enrichments ordered by timestamp (most recent last)
     @param   source  Enrichment source
     @param   keys    Metadata key(s) to check (optional; check all if omitted)
@@ -61,16 +89,16 @@ def get_enrichment_changes_from_source(enrichments: Sequence[Enrichment], source
 
     TODO? Do we need a `before` parameter, as well...
     """
+    from cookiemonster.common.collections import EnrichmentCollection
+    if isinstance(enrichments, EnrichmentCollection):
+        return enrichments.get_changes_from_source(source, keys, since)
+
     first_comparator_index = 1
     output = []
 
     if since:
-        for enrichment in enrichments[1:]:
-            if enrichment.timestamp < since:
-                first_comparator_index += 1
-            else:
-                # Enrichment list should be ordered by timestamp
-                break
+        # Enrichment list should be ordered by timestamp
+        first_comparator_index = max(bisect_left(_Timestamps(enrichments), since), 1)
 
     total = len(enrichments)
     if total <= first_comparator_index:
@@ -88,6 +116,16 @@ def get_enrichment_changes_from_source(enrichments: Sequence[Enrichment], source
     return output
 
 
+def _to_interned_metadata(metadata: dict) -> Metadata:
+    """
+    Converts decoded metadata to a `Metadata`, interning its keys, which are shared by the many enrichments that are
+    decoded.
+    :param metadata: the decoded metadata
+    :return: the metadata, with interned keys
+    """
+    return Metadata((intern(key) if type(key) is str else key, value) for key, value in metadata.items())
+
+
 _ENRICHMENT_JSON_MAPPING = [
     JsonPropertyMapping('source',    'source',
                                      object_constructor_parameter_name='source'),
@@ -96,9 +134,73 @@ _ENRICHMENT_JSON_MAPPING = [
                                      encoder_cls=DatetimeEpochJSONEncoder,
                                      decoder_cls=DatetimeEpochJSONDecoder),
     JsonPropertyMapping('metadata',  object_constructor_parameter_name='metadata',
-                                     object_constructor_argument_modifier=Metadata,
+                                     object_constructor_argument_modifier=_to_interned_metadata,
                                      object_property_getter=lambda enrichment: dict(enrichment.metadata.items()))
 ]
 
 EnrichmentJSONEncoder = MappingJSONEncoderClassBuilder(Enrichment, _ENRICHMENT_JSON_MAPPING).build()
 EnrichmentJSONDecoder = MappingJSONDecoderClassBuilder(Enrichment, _ENRICHMENT_JSON_MAPPING).build()
+
+
+def encode_enrichment(enrichment: Enrichment) -> Dict:
+    """
+    Encodes an enrichment to a JSON serialisable dictionary, as `EnrichmentJSONEncoder` does.
+    :param enrichment: the enrichment
+    :return: the encoded enrichment
+    """
+    return {
+        "source": enrichment.source,
+        "timestamp": enrichment.epoch_timestamp,
+        "metadata": dict(enrichment.metadata.items())
+    }
+
+
+def decode_enrichment(encoded: Dict) -> Enrichment:
+    """
+    Decodes an enrichment from its JSON dictionary (ignoring any other properties, e.g., those of a database document),
+    as `EnrichmentJSONDecoder` does.
+    :param encoded: the encoded enrichment
+    :return: the enrichment
+    """
+    return Enrichment.from_epoch_timestamp(
+        encoded["source"], encoded["timestamp"], _to_interned_metadata(encoded["metadata"]))
+
+
+def _loads(encoded: str) -> Any:
+    """
+    Parses JSON with the faster parser, if it is installed, falling back to the standard library's for what it doesn't
+    support (e.g., `NaN` or integers wider than 64 bits).
+    :param encoded: the JSON
+    :return: the parsed JSON
+    """
+    if _fast_loads is not None:
+        try:
+            return _fast_loads(encoded)
+        except ValueError:
+            pass
+    return json.loads(encoded)
+
+
+class FastEnrichmentJSONEncoder(JSONEncoder):
+    """
+    JSON encoder for `Enrichment` (and lists thereof) that produces the same output as `EnrichmentJSONEncoder` but
+    builds it directly, rather than through the generic property mappings.
+    """
+    def default(self, to_encode: Any) -> Any:
+        if isinstance(to_encode, Enrichment):
+            return encode_enrichment(to_encode)
+        if isinstance(to_encode, list):
+            return [encode_enrichment(item) if isinstance(item, Enrichment) else item for item in to_encode]
+        return super().default(to_encode)
+
+
+class FastEnrichmentJSONDecoder(JSONDecoder):
+    """
+    JSON decoder for `Enrichment` (and lists thereof) that produces the same output as `EnrichmentJSONDecoder` but
+    decodes it directly, rather than through the generic property mappings.
+    """
+    def decode(self, to_decode: str, **kwargs) -> Union[Enrichment, List[Enrichment]]:
+        decoded = _loads(to_decode)
+        if isinstance(decoded, list):
+            return [decode_enrichment(item) for item in decoded]
+        return decode_enrichment(decoded)
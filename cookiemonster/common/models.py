@@ -22,9 +22,10 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
-from datetime import datetime
+from datetime import datetime, timezone
 from functools import total_ordering
-from typing import Any, List, Optional
+from sys import intern
+from typing import Any, Iterable, List, Optional, Set, Tuple, Union
 
 from hgicommon.collections import Metadata
 from hgicommon.models import Model
@@ -40,19 +41,125 @@ class Update(Model):
         self.metadata = metadata if metadata is not None else Metadata()
 
 
+class _SlottedModel(object):
+    """
+    Equivalent of `Model` for models with `__slots__`, which (unlike `Model`) can't use the instance `__dict__` to
+    find their properties. Subclasses list their properties in `_properties` instead.
+    """
+    __slots__ = ()
+    _properties = ()    # type: Tuple[str, ...]
+
+    def __eq__(self, other):
+        if not isinstance(other, self.__class__):
+            return False
+        for property_name in self._properties:
+            if getattr(other, property_name) != getattr(self, property_name):
+                return False
+        return True
+
+    def __str__(self) -> str:
+        string_builder = []
+        for property_name in self._properties:
+            value = getattr(self, property_name)
+            if isinstance(value, Set):
+                value = str(sorted(value, key=id))
+            string_builder.append("%s: %s" % (property_name, value))
+        string_builder = sorted(string_builder)
+        return "{ %s }" % ', '.join(string_builder)
+
+    def __repr__(self) -> str:
+        return "<%s object at %s: %s>" % (type(self), id(self), str(self))
+
+    def __hash__(self):
+        return hash(str(self))
+
+
 @total_ordering
-class Enrichment(Model):
+class Enrichment(_SlottedModel):
     """
-    Metadata enrichment model
+    Metadata enrichment model.
+
+    There can be millions of enrichments in memory, from a handful of sources, so they are slotted, their source is
+    interned and whole second UTC timestamps (e.g., those decoded from JSON) are kept as seconds since the epoch, from
+    which the `datetime` is only made when it is used.
     """
+    __slots__ = ("_source", "_timestamp", "metadata")
+    _properties = ("source", "timestamp", "metadata")
+
     def __init__(self, source: str, timestamp: datetime, metadata: Metadata):
         self.source = source
         self.timestamp = timestamp
         self.metadata = metadata
 
+    @property
+    def source(self) -> str:
+        return self._source
+
+    @source.setter
+    def source(self, source: str):
+        self._source = intern(source) if type(source) is str else source
+
+    @property
+    def timestamp(self) -> datetime:
+        timestamp = self._timestamp
+        if type(timestamp) is int:
+            return datetime.fromtimestamp(timestamp, timezone.utc)
+        return timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp: datetime):
+        self._timestamp = Enrichment._compact_timestamp(timestamp)
+
+    @property
+    def epoch_timestamp(self) -> int:
+        """
+        The timestamp as (whole) seconds since the epoch, as it is encoded to JSON.
+        """
+        timestamp = self._timestamp
+        if type(timestamp) is int:
+            return timestamp
+        return int(timestamp.timestamp())
+
+    @classmethod
+    def from_epoch_timestamp(cls, source: str, timestamp: int, metadata: Metadata) -> "Enrichment":
+        """
+        Creates an enrichment with the UTC timestamp at the given seconds since the epoch, without making a `datetime`.
+        :param source: the source of the enrichment
+        :param timestamp: the timestamp, as seconds since the epoch
+        :param metadata: the metadata of the enrichment
+        :return: the enrichment
+        """
+        enrichment = cls.__new__(cls)
+        enrichment.source = source
+        enrichment._timestamp = int(timestamp)
+        enrichment.metadata = metadata
+        return enrichment
+
+    @staticmethod
+    def _compact_timestamp(timestamp: datetime) -> Union[int, datetime]:
+        """
+        Gets the seconds since the epoch of the given timestamp, if they represent it exactly, else the timestamp.
+        :param timestamp: the timestamp
+        :return: the compact representation of the timestamp
+        """
+        if type(timestamp) is datetime and timestamp.tzinfo is timezone.utc and timestamp.microsecond == 0:
+            return int(timestamp.timestamp())
+        return timestamp
+
+    def __eq__(self, other):
+        if not isinstance(other, Enrichment):
+            return False
+        return self._source == other._source and self.metadata == other.metadata \
+            and (self._timestamp == other._timestamp or self.timestamp == other.timestamp)
+
     def __lt__(self, other):
+        if type(self._timestamp) is int and type(other._timestamp) is int:
+            return self._timestamp < other._timestamp
         return self.timestamp < other.timestamp
 
+    def __hash__(self):
+        return super().__hash__()
+
 
 class EnrichmentDiff(Model):
     """
@@ -103,12 +210,32 @@ class EnrichmentDiff(Model):
         """
         return bool(self.additions or self.deletions)
 
+    def restricted_to(self, keys:Iterable[str]) -> 'EnrichmentDiff':
+        """
+        Get this diff, restricted to a list of keys, as if it were
+        calculated only for those keys
+
+        @param   keys  Interested keys
+        @return  Restricted diff
+        """
+        keys = set(keys)
 
+        restricted = EnrichmentDiff.__new__(EnrichmentDiff)
+        restricted.source = self.source
+        restricted.timestamp = self.timestamp
+        restricted.additions = Metadata({key: value for key, value in self.additions.items() if key in keys})
+        restricted.deletions = Metadata({key: value for key, value in self.deletions.items() if key in keys})
 
-class Cookie(Model):
+        return restricted
+
+
+class Cookie(_SlottedModel):
     """
     A "Cookie" is a representation of a data object's iteratively enriched metadata.
     """
+    __slots__ = ("identifier", "enrichments")
+    _properties = ("identifier", "enrichments")
+
     def __init__(self, identifier: str):
         from cookiemonster.common.collections import EnrichmentCollection
         self.identifier = identifier
@@ -4,6 +4,11 @@ Configurable HTTP Connection Pool
 Patch the urllib3 HTTP connection pool, used by Requests in pycouchdb,
 such that the pool settings can be changed.
 
+Deprecated: this patches the pools of every Requests session in the
+process. CouchDB backed CookieJars now have their own connection pool,
+configured with their `max_connections` parameter, which should be
+preferred.
+
 Legalese
 --------
 Copyright (c) 2014 Michael Scharf
@@ -15,12 +20,19 @@ Authors:
 
 This file is part of Cookie Monster.
 """
+import warnings
+
 
 def patch_connection_pools(**constructor_kwargs):
     """
     Override the default parameters of the HTTPConnectionPool and
     HTTPSConnectionPool constructors
+
+    Deprecated in favour of the per-client connection pool
     """
+    warnings.warn("patch_connection_pools is deprecated; configure CouchDB backed CookieJars with max_connections",
+                  DeprecationWarning, stacklevel=2)
+
     from requests.packages.urllib3 import connectionpool, poolmanager
 
     def subtype_connection_pool(base):
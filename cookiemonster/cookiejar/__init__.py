@@ -1,2 +1,4 @@
 from cookiemonster.cookiejar.cookiejar import CookieJar
 from cookiemonster.cookiejar.biscuit_tin import BiscuitTin, RateLimitedBiscuitTin
+from cookiemonster.cookiejar.sharded_cookiejar import ShardedCookieJar
+from cookiemonster.cookiejar.sqlite_cookiejar import SQLiteCookieJar
@@ -4,7 +4,8 @@ Cookie Jar
 An implementation of `CookieJar` using CouchDB as its database
 
 Exportable classes: `BiscuitTin`, `RateLimitedBiscuitTin`
-Exportable functions: `add_couchdb_logging`
+Exportable functions: `add_couchdb_logging`, `get_queue_document_id`,
+                      `get_metadata_chunk_id`, `get_worker_id`
 
 BiscuitTin
 ----------
@@ -18,6 +19,52 @@ manage the processing queue and metadata repository.
 metadata enrichment or exceptional marking), it will broadcast the
 queue change to all downstream listeners.
 
+`BiscuitTin` keeps a bounded, write-through cache of the queue state of
+the most recently used files, such that state transitions don't need to
+first look up the state from the database. The cache is kept coherent by
+the `BiscuitTin`'s own writes; if other instances share the same
+database, `follow_changes` should also be set, to keep it coherent with
+their writes via the database's changes feed.
+
+Bulk deletions (`delete_cookies` and `delete_by_prefix`) look up the
+documents to delete with one view query per batch and delete them
+through the buffer, such that each batch can go in one bulk request. The
+batch size is the buffer capacity.
+
+Counting the queue exactly is a reduce over a view, which CouchDB can't
+cache, as it's keyed by time. `BiscuitTin` also keeps an approximate
+queue length, maintained by its own changes to the queue and reconciled
+with the exact count at most `queue_length_max_age` apart, which is what
+`approximate_queue_length` returns in between. Changes made by other
+instances sharing the same database are only picked up on
+reconciliation.
+
+On start up, the queue state of files left processing by an unclean
+restart is reset, and files left marked for deletion are cleaned up, a
+page of documents at a time, with bulk writes. With
+`sanitise_in_background` set, this happens in the background, while
+other files are already being processed (those dequeued in the meantime
+are left alone by it).
+
+With `prefetch_capacity` set, `BiscuitTin` dequeues and hydrates Cookies
+in the background, keeping enough ready to cover the time it takes to
+fetch the next batch, as estimated from the observed processing rate and
+dequeue latency, up to the capacity. Prefetched Cookies are marked as
+processing, so they are returned to the queue by `stop`, or else reset
+on the next start up, like any other interrupted processing.
+
+Resetting every file left processing on start up assumes there's only
+one `BiscuitTin` consuming the queue. With `lease_duration` set, several
+instances (e.g., on different nodes) can share it: dequeued files are
+leased, with the instance's `worker_id` as their owner and an expiry
+time. Claims are made against the revision of the queue document that
+was read, so only one instance can win any given file, and the leases
+are renewed in the background while the files are processed. Only files
+with expired leases (i.e., whose owner has died) are reset, both on
+start up and periodically thereafter; and an instance that has lost a
+lease in the meantime leaves the file to its new owner when it finishes.
+Instances sharing a queue should also set `follow_changes`.
+
 `RateLimitedBiscuitTin` is a rate-limited version of `BiscuitTin` which
 takes an additional argument, at initial position, in its constructor:
 `max_requests_per_second`.
@@ -26,6 +73,18 @@ add_couchdb_logging
 -------------------
 Inject CouchDB response time logging into an instantiated `BiscuitTin`
 
+get_queue_document_id
+---------------------
+Get the ID of the queue document of a file
+
+get_metadata_chunk_id
+---------------------
+Get the ID of a consolidated metadata chunk document of a file
+
+get_worker_id
+-------------
+Get a unique worker ID, to identify the owner of leased queue documents
+
 Bert and Ernie
 --------------
 `_Bert` and `_Ernie` are the queue management and metadata repository
@@ -44,6 +103,12 @@ life's rich tapestry.
 * `queue_length` Get the current length of the queue of files to be
   processed
 
+* `approximate_queue_length` Get the approximate length of the queue of
+  files to be processed, and whether it is exact
+
+* `next_queued_from` Get when the file at the head of the queue was
+  queued
+
 * `mark_dirty` Mark a file as requiring (re)processing, inserting a new
   record if it doesn't already exist, with an optional delay
 
@@ -51,17 +116,46 @@ life's rich tapestry.
 
 * `mark_finished` Mark a file as having finished processing
 
+* `release` Return a dequeued file, that wasn't processed, to the queue
+
+* `renew_leases` Extend the leases on the files dequeued by this
+  instance, when leasing
+
+* `reclaim_expired_leases` Reset the queue state of files whose leases
+  have expired, when leasing
+
 * `delete` Remove a file's queue state, or mark it for deletion if
   currently processing
 
+* `delete_all` Remove the queue state of many files, in batches
+
+* `get_identifiers_by_prefix` Page through the files with identifiers
+  starting with a prefix
+
+Queue documents have IDs derived from their file identifier (see
+`get_queue_document_id`), such that they can be fetched directly, rather
+than through a view. Databases with queue documents from before this
+was the case are still supported, by looking them up through a view,
+but ought to be migrated (see `cookiemonster.cookiejar.migration`).
+
 Document schema:
 
-    $queue      boolean  true (i.e., used as a schema classifier)
-    identifier  string   File identifier
-    dirty       boolean  Whether the file needs reprocessing
-    processing  boolean  Whether the file is currently being processed
-    deleted     boolean  Whether the file has been deleted
-    queue_from  int      Timestamp from when to queue (Unix epoch)
+    $queue         boolean  true (i.e., used as a schema classifier)
+    identifier     string   File identifier
+    dirty          boolean  Whether the file needs reprocessing
+    processing     boolean  Whether the file is currently being processed
+    deleted        boolean  Whether the file has been deleted
+    queue_from     int      Timestamp from when to queue (Unix epoch)
+    owner          string   Worker ID of the instance processing the
+                            file, when leased (otherwise null)
+    lease_expires  float    Timestamp from when the lease can be
+                            reclaimed (Unix epoch; otherwise null)
+
+`_QueueCache` is the cache of queue documents, keyed by file identifier,
+used by `_Bert`. It is not locked: it relies upon the atomicity of the
+individual operations of its underlying `OrderedDict` and, where a
+lookup from the database could have raced with a change, it errs on the
+side of eviction.
 
 `_Ernie` (metadata repository DBI) methods:
 
@@ -73,6 +167,12 @@ Document schema:
 
 * `delete_metadata` Delete all the metadata enrichments for a file
 
+* `delete_all_metadata` Delete all the metadata enrichments for many
+  files, in batches
+
+* `delete_by_prefix` Delete all the metadata enrichments for the files
+  with identifiers starting with a prefix
+
 Document schema:
 
     $metadata   boolean  true (i.e., used as a schema classifier)
@@ -81,6 +181,25 @@ Document schema:
     timestamp   int      Timestamp (Unix epoch)
     metadata    object   Key-value store
 
+`_ConsolidatedErnie` is an alternative metadata repository DBI, with the
+same methods, that stores all of a file's enrichments in a handful of
+documents, rather than one document per enrichment. Enrichments are
+appended to the file's latest chunk document until it reaches the chunk
+size, whereupon a new chunk is started. Chunks have IDs derived from the
+file identifier (see `get_metadata_chunk_id`), so fetching the metadata
+of a file is a single request for a range of IDs, rather than a view
+query, and deleting it is a single batch. It is used by `BiscuitTin`
+when `consolidate_metadata` is set; the choice must be consistent for
+any given database, as neither DBI can see the other's documents.
+
+Document schema:
+
+    $metadata_chunk  boolean  true (i.e., used as a schema classifier)
+    identifier       string   File identifier
+    chunk            int      Chunk number
+    enrichments      array    Enrichments, each with the `source`,
+                              `timestamp` and `metadata` described above
+
 Legalese
 --------
 Copyright (c) 2015, 2016 Genome Research Ltd.
@@ -102,23 +221,31 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
-import json
 import logging
-from collections import deque
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from datetime import timedelta
 from functools import wraps
-from os import environ
-from threading import Timer
-from time import sleep, time
-from typing import Any, Callable, Iterable, List, Optional, Tuple
+from itertools import count
+from math import ceil
+from heapq import heappop, heappush
+from os import getpid
+from socket import gethostname
+from threading import Condition, Event, Lock, Thread, Timer
+from hashlib import sha1
+from uuid import uuid4
+from time import monotonic, sleep, time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from cookiemonster.common.collections import EnrichmentCollection
-from cookiemonster.common.helpers import EnrichmentJSONEncoder, EnrichmentJSONDecoder
+from cookiemonster.common.helpers import decode_enrichment, encode_enrichment
 from cookiemonster.common.models import Enrichment, Cookie
 from cookiemonster.logging.logger import Logger
 from cookiemonster.cookiejar._rate_limiter import rate_limited
 from cookiemonster.cookiejar.cookiejar import CookieJar
 from cookiemonster.cookiejar.couchdb import Actions, Sofabed, inject_logging
+from cookiemonster.cookiejar.couchdb.sofabed import _LockPool
+from cookiemonster.cookiejar.couchdb.softer import CouchDBCircuitOpen, backoff
 from hgicommon.threading import CountingLock
 
 
@@ -127,9 +254,66 @@ def _now() -> int:
     return int(time())
 
 
-# Use the same CouchDB hammering configuration from the environment as
-# used by the softer client...with the difference that we don't give up
-_COUCHDB_GRACE = timedelta(milliseconds=int(environ.get('COOKIEMONSTER_COUCHDB_GRACE', 1000))).total_seconds()
+def get_worker_id() -> str:
+    """
+    Get a worker ID that is unique to this instance, to identify the
+    owner of leased queue documents
+
+    @return  Worker ID (host name, process ID and a random suffix)
+    """
+    return '{}-{}-{}'.format(gethostname(), getpid(), uuid4().hex[:8])
+
+
+# Prefix of queue document IDs
+QUEUE_DOCUMENT_ID_PREFIX = 'queue-'
+
+def get_queue_document_id(identifier:str) -> str:
+    """
+    Get the ID of the queue document of a file, which is derived from
+    its identifier
+
+    @param   identifier  File identifier
+    @return  Document ID
+    """
+    return QUEUE_DOCUMENT_ID_PREFIX + sha1(identifier.encode('utf-8')).hexdigest()
+
+
+# Prefix of consolidated metadata chunk document IDs
+METADATA_CHUNK_ID_PREFIX = 'metadata-'
+
+def get_metadata_chunk_id(identifier:str, chunk:Optional[int] = None) -> str:
+    """
+    Get the ID of a consolidated metadata chunk document of a file,
+    which is derived from its identifier and the chunk number
+
+    @param   identifier  File identifier
+    @param   chunk       Chunk number (None for the prefix common to
+                         all of the file's chunks)
+    @return  Document ID (or prefix)
+    """
+    prefix = '{}{}-'.format(METADATA_CHUNK_ID_PREFIX, sha1(identifier.encode('utf-8')).hexdigest())
+    # Zero-padded, such that the IDs sort in chunk order
+    return prefix if chunk is None else '{}{:06d}'.format(prefix, chunk)
+
+
+def _batches(iterable:Iterable[Any], size:int) -> Iterable[List[Any]]:
+    """
+    Split an iterable into batches
+
+    @param   iterable  Iterable
+    @param   size      Maximum batch size
+    @return  Generator of batches
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
 
 def _just_keep_swimming(fn:Callable[..., Any]) -> Callable[..., Any]:
     """
@@ -139,29 +323,471 @@ def _just_keep_swimming(fn:Callable[..., Any]) -> Callable[..., Any]:
     for reasons we can't control; but it recovers and so this decorator
     allows us to recover in kind.
 
+    It uses the same retry policy as the softer client (see `backoff`),
+    waiting out the circuit breaker rather than hammering the database
+    while it's open.
+
     It's similar to hgicommon.decorators.too_big_to_fail, but is per
     function and doesn't involve any shoddy metaprogramming black magic!
     """
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        it_worked = False
+        attempts = 0
 
-        while not it_worked:
+        while True:
             try:
-                output = fn(*args, **kwargs)
-                it_worked = True
+                return fn(*args, **kwargs)
 
-            except:
-                logging.exception('%s failed!! Retrying...', fn.__name__)
-                sleep(_COUCHDB_GRACE)
+            except CouchDBCircuitOpen as e:
+                # The database is known to be down, so don't log the
+                # same thing over and over again
+                logging.debug('%s failed fast!! Retrying...', fn.__name__)
+                attempts += 1
+                sleep(backoff(attempts, e))
 
-        return output
+            except Exception as e:
+                logging.exception('%s failed!! Retrying...', fn.__name__)
+                attempts += 1
+                sleep(backoff(attempts, e))
 
     return wrapper
 
 
+class _QueueCache(object):
+    """ Bounded, write-through cache of queue documents """
+    @staticmethod
+    def _strip(doc:dict) -> dict:
+        """ Strip the revision ID, which will go stale, from a document """
+        return {key: value for key, value in doc.items() if key != '_rev'}
+
+    def __init__(self, max_size:int):
+        """
+        Constructor
+
+        @param   max_size  Maximum number of cached documents (zero to
+                           disable caching)
+        """
+        self._max_size = max_size
+        self._entries = OrderedDict()  # type: Dict[str, Tuple[str, dict]]
+
+        # Evictions advance the generation, so lookups from the database
+        # that could have raced with them can be detected
+        self._generations = count(1)
+        self.generation = 0
+
+        self._following = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, identifier:str) -> Optional[Tuple[str, dict]]:
+        """
+        Get a cached queue document by its file identifier
+
+        @param   identifier  File identifier
+        @return  Document ID and Document tuple (None, if not cached)
+        """
+        entry = self._entries.get(identifier)
+
+        if entry is not None:
+            try:
+                self._entries.move_to_end(identifier)
+            except KeyError:
+                # Evicted in the meantime
+                pass
+
+        return entry
+
+    def set(self, identifier:str, doc_id:str, doc:dict):
+        """
+        Cache a queue document that has been written to the database
+
+        @param   identifier  File identifier
+        @param   doc_id      Document ID
+        @param   doc         Document
+        """
+        self._entries[identifier] = (doc_id, _QueueCache._strip(doc))
+
+        try:
+            self._entries.move_to_end(identifier)
+        except KeyError:
+            pass
+
+        self._trim()
+
+    def populate(self, identifier:str, doc_id:str, doc:dict, generation:int):
+        """
+        Cache a queue document that has been looked up from the database,
+        unless it has been cached (by a write) in the meantime
+
+        @param   identifier  File identifier
+        @param   doc_id      Document ID
+        @param   doc         Document
+        @param   generation  Cache generation from before the lookup
+        """
+        entry = (doc_id, _QueueCache._strip(doc))
+
+        if self._entries.setdefault(identifier, entry) is entry:
+            self._trim()
+
+            # An eviction during the lookup means it could be stale
+            if self.generation != generation:
+                self._discard(identifier, entry)
+
+    def evict(self, identifier:str):
+        """
+        Evict a queue document, after it has been changed or deleted
+
+        @param   identifier  File identifier
+        """
+        self.generation = next(self._generations)
+        self._entries.pop(identifier, None)
+
+    def clear(self):
+        """ Evict all queue documents """
+        self.generation = next(self._generations)
+        self._entries.clear()
+
+    def follow(self, sofa:Sofabed, timeout:timedelta = timedelta(seconds=60)):
+        """
+        Start following the database's changes feed, evicting queue
+        documents that have been changed by anything other than us
+
+        @param   sofa     Sofabed object
+        @param   timeout  Long-poll timeout of the changes feed
+        """
+        if not self._following:
+            self._following = True
+            Thread(target=self._follow, args=(sofa, timeout), daemon=True).start()
+
+    def stop_following(self):
+        """ Stop following the database's changes feed """
+        self._following = False
+
+    def _follow(self, sofa:Sofabed, timeout:timedelta):
+        """ Changes feed follower thread """
+        since = None
+        attempts = 0
+
+        while self._following:
+            try:
+                if since is None:
+                    since = sofa.get_update_seq()
+
+                since, changes = sofa.changes(since, timeout, include_docs = 'true',
+                                                              filter       = '_view',
+                                                              view         = 'queue/get_id')
+
+                for change in changes:
+                    self._reconcile(change['doc'])
+
+                attempts = 0
+
+            except Exception as e:
+                # We could have missed changes, so can't trust anything
+                logging.exception('Could not follow changes feed!! Retrying...')
+                self.clear()
+                attempts += 1
+                sleep(backoff(attempts, e))
+
+    def _reconcile(self, doc:dict):
+        """
+        Evict a queue document if it differs from a changed document;
+        if it doesn't, the change was (presumably) our own
+
+        @param   doc  Changed document (with deletions as tombstones)
+        """
+        identifier = doc.get('identifier')
+        entry = self._entries.get(identifier)
+
+        if entry is not None:
+            doc_id, cached_doc = entry
+            if doc.get('_deleted') or doc['_id'] != doc_id or _QueueCache._strip(doc) != cached_doc:
+                self.evict(identifier)
+
+    def _discard(self, identifier:str, entry:Tuple[str, dict]):
+        """ Remove the given entry, providing it's still cached """
+        if self._entries.get(identifier) is entry:
+            self._entries.pop(identifier, None)
+
+    def _trim(self):
+        """ Remove the least recently used entries over capacity """
+        while len(self._entries) > self._max_size:
+            try:
+                self._entries.popitem(last=False)
+            except KeyError:
+                break
+
+
+class _QueueLength(object):
+    """ Approximate, incrementally maintained queue length """
+    def __init__(self, max_age:timedelta):
+        """
+        Constructor
+
+        @param   max_age  Maximum time between reconciliations
+        """
+        self._max_age = max_age.total_seconds()
+        self._lock = Lock()
+
+        self._length = 0
+        self._delayed = []  # type: List[int]
+        self._reconciled_at = None  # type: Optional[float]
+
+    def add(self, queue_from:int):
+        """
+        Count a file that has been queued
+
+        @param   queue_from  Timestamp from when it's queued (Unix epoch)
+        """
+        with self._lock:
+            if queue_from > _now():
+                heappush(self._delayed, queue_from)
+            else:
+                self._length += 1
+
+    def remove(self, count:int = 1):
+        """
+        Discount files that have left the queue
+
+        @param   count  Number of files
+        """
+        with self._lock:
+            self._length = max(self._length - count, 0)
+
+    def reconcile(self, length:int):
+        """
+        Reset the approximation to the exact queue length
+
+        @param   length  Exact queue length
+        """
+        with self._lock:
+            self._length = length
+            self._delayed = []
+            self._reconciled_at = monotonic()
+
+    def get(self) -> Optional[int]:
+        """
+        @return  The approximate queue length (None, if it is due to be
+                 reconciled)
+        """
+        with self._lock:
+            if self._reconciled_at is None or monotonic() - self._reconciled_at > self._max_age:
+                return None
+
+            # Delayed files count once they're due
+            now = _now()
+            while self._delayed and self._delayed[0] <= now:
+                heappop(self._delayed)
+                self._length += 1
+
+            return self._length
+
+
+class _Prefetcher(object):
+    """ Background dequeuer, keeping hydrated cookies ready to process """
+    # Weight of the latest observation in the moving averages
+    _SMOOTHING = 0.2
+
+    def __init__(self, fetch:Callable[[int], List[Cookie]], capacity:int):
+        """
+        Constructor
+
+        @param   fetch     Function that dequeues and hydrates up to the
+                           given number of cookies
+        @param   capacity  Maximum number of prefetched cookies
+        """
+        self._fetch = fetch
+        self._capacity = capacity
+
+        self._ready = deque()
+        self._condition = Condition()
+        self._running = False
+        self._exhausted = False
+        self._thread = None  # type: Optional[Thread]
+
+        # Moving averages of the time between cookies being taken and
+        # of the time taken to fetch a batch
+        self._take_interval = None  # type: Optional[float]
+        self._fetch_latency = None  # type: Optional[float]
+        self._last_take = None  # type: Optional[float]
+
+    def __len__(self) -> int:
+        return len(self._ready)
+
+    def _average(self, average:Optional[float], value:float) -> float:
+        """ Update an exponentially weighted moving average """
+        if average is None:
+            return value
+
+        return (1 - _Prefetcher._SMOOTHING) * average + _Prefetcher._SMOOTHING * value
+
+    def low_water_mark(self) -> int:
+        """
+        @return  The number of cookies to keep ready, such that they
+                 won't run out while the next batch is being fetched
+        """
+        if self._take_interval is None or self._fetch_latency is None:
+            return 1
+
+        needed = ceil(self._fetch_latency / max(self._take_interval, 1e-6)) + 1
+        return min(max(needed, 1), self._capacity)
+
+    def start(self):
+        """ Start prefetching """
+        with self._condition:
+            if not self._running:
+                self._running = True
+                self._thread = Thread(target=self._prefetch, daemon=True)
+                self._thread.start()
+
+    def stop(self) -> List[Cookie]:
+        """
+        Stop prefetching, waiting for any fetch in progress to finish
+
+        @return  The cookies that were prefetched, but not taken
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        with self._condition:
+            remaining = list(self._ready)
+            self._ready.clear()
+
+        return remaining
+
+    def wake(self):
+        """ Prompt a fetch, after the queue has changed """
+        with self._condition:
+            self._exhausted = False
+            self._condition.notify_all()
+
+    def take(self) -> Optional[Cookie]:
+        """
+        Take a prefetched cookie
+
+        @return  The next prefetched cookie (None, if there are none)
+        """
+        with self._condition:
+            now = monotonic()
+            if self._last_take is not None:
+                self._take_interval = self._average(self._take_interval, now - self._last_take)
+            self._last_take = now
+
+            if not self._ready:
+                return None
+
+            cookie = self._ready.popleft()
+
+            if len(self._ready) < self.low_water_mark():
+                self._exhausted = False
+                self._condition.notify_all()
+
+            return cookie
+
+    def _prefetch(self):
+        """ Prefetcher thread """
+        attempts = 0
+
+        while True:
+            with self._condition:
+                while self._running and (self._exhausted or len(self._ready) >= self.low_water_mark()):
+                    self._condition.wait()
+
+                if not self._running:
+                    return
+
+                # Fetch enough to stay above the low-water mark for
+                # another batch's worth of time
+                batch_size = min(2 * self.low_water_mark(), self._capacity) - len(self._ready)
+
+            started_at = monotonic()
+            try:
+                cookies = self._fetch(max(batch_size, 1))
+            except Exception as e:
+                logging.exception('Could not prefetch cookies!! Retrying...')
+                attempts += 1
+                sleep(backoff(attempts, e))
+                continue
+
+            attempts = 0
+
+            with self._condition:
+                if cookies:
+                    self._fetch_latency = self._average(self._fetch_latency, monotonic() - started_at)
+                    self._ready.extend(cookies)
+                else:
+                    self._exhausted = True
+
+
+class _LeaseKeeper(object):
+    """ Background renewer of leases and reclaimer of expired leases """
+    # Number of renewals per lease duration
+    _RENEWALS_PER_LEASE = 3
+
+    def __init__(self, queue:'_Bert', on_reclaimed:Callable[[], None], page_size:int = 1000):
+        """
+        Constructor
+
+        @param   queue         Queue management DBI, with leasing
+        @param   on_reclaimed  Function called after leases have been
+                               reclaimed (i.e., files requeued)
+        @param   page_size     Maximum number of documents per request
+                               when reclaiming
+        """
+        self._queue = queue
+        self._on_reclaimed = on_reclaimed
+        self._page_size = page_size
+        self._interval = queue.lease_duration.total_seconds() / _LeaseKeeper._RENEWALS_PER_LEASE
+
+        self._stopped = Event()
+        self._thread = None  # type: Optional[Thread]
+
+    def start(self):
+        """ Start renewing and reclaiming leases """
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = Thread(target=self._keep, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stop renewing and reclaiming leases """
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _keep(self):
+        """ Lease keeper thread """
+        # Expired leases are reclaimed once per lease duration
+        for renewal in count(1):
+            if self._stopped.wait(self._interval):
+                return
+
+            try:
+                self._queue.renew_leases()
+
+                if renewal % _LeaseKeeper._RENEWALS_PER_LEASE == 0:
+                    if self._queue.reclaim_expired_leases(self._page_size):
+                        self._on_reclaimed()
+
+            except Exception:
+                # Renewal is retried on the next interval, which is
+                # (hopefully) before the leases expire
+                logging.exception('Could not renew or reclaim leases!! Retrying...')
+
+
 class _Bert(object):
     """ Interface to the queue database documents """
+    # Number of times to try claiming files lost to other instances
+    _CLAIM_ATTEMPTS = 3
+
     @staticmethod
     def _reset_processing(row:dict) -> dict:
         """
@@ -170,91 +796,569 @@ class _Bert(object):
         """
         return {
             **row['doc'],
-            'dirty':      True,
-            'processing': False,
-            'queue_from': _now()
+            'dirty':         True,
+            'processing':    False,
+            'queue_from':    _now(),
+            'owner':         None,
+            'lease_expires': None
         }
 
-    def __init__(self, sofa:Sofabed):
+    @staticmethod
+    def _is_queued(doc:dict) -> bool:
+        """ Whether a queue document is (or will be) up for processing """
+        return bool(doc.get('dirty') and not doc.get('processing') and not doc.get('deleted'))
+
+    @staticmethod
+    def _deletion(doc:dict) -> dict:
+        """ Deletion of a queue document, at the revision it was read """
+        return {
+            '_id':        doc['_id'],
+            '_rev':       doc['_rev'],
+            '_deleted':   True,
+            'identifier': doc['identifier']
+        }
+
+    @staticmethod
+    def _deleted(doc:dict) -> dict:
+        """
+        Deletion of a queue document, or it marked for deletion if it is
+        currently being processed
+        """
+        if doc['processing']:
+            return {**doc, 'deleted': True}
+
+        return _Bert._deletion(doc)
+
+    def __init__(self, sofa:Sofabed, cache:Optional[_QueueCache] = None,
+                                     length:Optional[_QueueLength] = None,
+                                     stale_dequeue:bool = False,
+                                     sanitise_in_background:bool = False,
+                                     page_size:int = 1000,
+                                     lease:Optional[timedelta] = None,
+                                     owner:Optional[str] = None):
         """
         Constructor: Create/update the views to provide the queue
         management interface
 
-        @param   sofa  Sofabed object
+        @param   sofa                    Sofabed object
+        @param   cache                   Queue document cache (None for
+                                         no caching)
+        @param   length                  Approximate queue length (None
+                                         to always count the queue
+                                         exactly)
+        @param   stale_dequeue           Dequeue from the queue's index
+                                         without waiting for it to be
+                                         rebuilt
+        @param   sanitise_in_background  Sanitise the queue state after
+                                         an unclean restart in the
+                                         background, rather than before
+                                         returning
+        @param   page_size               Maximum number of documents
+                                         per request when sanitising
+        @param   lease                   Duration of the leases on
+                                         dequeued files, for sharing the
+                                         queue with other instances
+                                         (None, if this is the only one)
+        @param   owner                   Worker ID of this instance, as
+                                         the owner of its leases (None
+                                         for a unique default)
         """
         self._db = sofa
+        self._stale_dequeue = stale_dequeue
+        self._cache = cache if cache is not None else _QueueCache(0)
+        self._length = length if length is not None else _QueueLength(timedelta(0))
+
+        # Transitions are read-modify-write, so are serialised per file,
+        # such that they reach the database and the cache in the same order
+        self._locks = _LockPool()
         logging.debug('Initialising CouchDB queue management schema')
         self._define_schema()
 
         # Document schema, with defaults
         self._schema = {
-            '$queue':     True,
-            'identifier': None,
-            'dirty':      False,
-            'processing': False,
-            'deleted':    False,
-            'queue_from': None
+            '$queue':        True,
+            'identifier':    None,
+            'dirty':         False,
+            'processing':    False,
+            'deleted':       False,
+            'queue_from':    None,
+            'owner':         None,
+            'lease_expires': None
         }
 
-        # If there are any files marked as currently processing, this
-        # must be due to a previous failure. Reset all of these for
-        # immediate reprocessing
-        in_progress = self._db.query('queue', 'in_progress', wrapper      = _Bert._reset_processing,
-                                                             include_docs = True,
-                                                             reduce       = False)
-        unclean_restart = False
-        for doc in in_progress:
-            unclean_restart = True
-            self._db.upsert(doc)
+        # Leases held by this instance, keyed by file identifier
+        self._lease = lease.total_seconds() if lease is not None else None
+        self.owner = owner or get_worker_id()
+        self._leases = {}  # type: Dict[str, str]
+        self._leases_lock = Lock()
+
+        # Queue documents that don't have a derived ID have to be looked
+        # up through a view, until the database has been migrated
+        self._has_legacy_documents = self._count_legacy_documents() > 0
+        if self._has_legacy_documents:
+            logging.warning('Queue documents without derived IDs found; the database should be migrated')
+
+        # Files dequeued while sanitising in the background, which must
+        # be left alone by it
+        self._claimed = set()  # type: Set[str]
+        self._claimed_lock = Lock()
+        self._sanitising = sanitise_in_background
+
+        if sanitise_in_background:
+            Thread(target=self._sanitise, args=(page_size,), daemon=True).start()
+        else:
+            self._sanitise(page_size)
+
+    @_just_keep_swimming
+    def _sanitise(self, page_size:int):
+        """
+        Sanitise the queue state after an unclean restart, a page of
+        documents at a time
+
+        @param   page_size  Maximum number of documents per page
+        """
+        if self.is_leasing:
+            # Other instances may be processing files, so only those
+            # whose leases have expired can be reset
+            reset = self.reclaim_expired_leases(page_size)
+
+        else:
+            # If there are any files marked as currently processing,
+            # this must be due to a previous failure. Reset all of these
+            # for immediate reprocessing
+            in_progress = self._db.query_paged('queue', 'in_progress', page_size, flat         = 'doc',
+                                                                                  include_docs = True,
+                                                                                  reduce       = False)
+            reset = 0
+            for docs in _batches(in_progress, page_size):
+                reset += self._reset_processing_docs(docs)
+
+        # If there are any files marked as deleted, they can be cleaned
+        # up without consequence
+        to_delete = self._db.query_paged('queue', 'to_clean', page_size, flat         = 'doc',
+                                                                        include_docs = True,
+                                                                        reduce       = False)
+        cleaned = 0
+        for docs in _batches(to_delete, page_size):
+            cleaned += self._clean_deleted_docs(docs)
+
+        with self._claimed_lock:
+            self._sanitising = False
+            self._claimed.clear()
+
+        if reset or cleaned:
+            logging.info('Queue state sanitised after unclean restart: %d files reset and %d cleaned up',
+                         reset, cleaned)
+
+    def _unclaimed(self, docs:List[dict], still:Callable[[dict], bool]) -> List[dict]:
+        """
+        Filter the documents read for sanitisation to those that can
+        still be sanitised: When sanitising in the background, they may
+        have changed since, so are fetched again; and those dequeued
+        since starting up are left alone
+
+        @param   docs   Queue documents
+        @param   still  Whether a current document can be sanitised
+        @return  Queue documents to sanitise
+        """
+        with self._claimed_lock:
+            if not self._sanitising:
+                return docs
+
+        current = self._db.fetch_all(doc['_id'] for doc in docs)
+
+        with self._claimed_lock:
+            return [doc for doc in current if still(doc) and doc['identifier'] not in self._claimed]
+
+    def _reset_processing_docs(self, docs:List[dict]) -> int:
+        """
+        Reset the processing state of queue documents, in bulk
+
+        @param   docs  Queue documents
+        @return  Number of documents reset
+        """
+        docs = self._unclaimed(docs, lambda doc: doc.get('processing') and not doc.get('deleted'))
+        to_reset = [_Bert._reset_processing({'doc': doc}) for doc in docs]
+        self._db.upsert_all(to_reset)
+
+        for doc in to_reset:
+            self._cache.evict(doc['identifier'])
+            self._length.add(doc['queue_from'])
+
+        return len(to_reset)
+
+    def _clean_deleted_docs(self, docs:List[dict]) -> int:
+        """
+        Delete queue documents that are marked as deleted, in bulk
+
+        @param   docs  Queue documents
+        @return  Number of documents deleted
+        """
+        if self.is_leasing:
+            # Those still processing will be deleted by their owner, or
+            # when their lease is reclaimed; the rest are deleted unless
+            # they've been changed since
+            docs = self._db.update_if_unchanged(
+                _Bert._deletion(doc) for doc in docs if not doc.get('processing'))
+
+            for doc in docs:
+                self._cache.evict(doc['identifier'])
+
+            return len(docs)
+
+        docs = self._unclaimed(docs, lambda doc: doc.get('deleted'))
+        self._db.delete_all(doc['_id'] for doc in docs)
+
+        for doc in docs:
+            self._cache.evict(doc['identifier'])
+
+        return len(docs)
+
+    @property
+    def is_leasing(self) -> bool:
+        """ Whether dequeued files are leased """
+        return self._lease is not None
+
+    @property
+    def lease_duration(self) -> Optional[timedelta]:
+        """ Duration of the leases on dequeued files """
+        return timedelta(seconds=self._lease) if self.is_leasing else None
+
+    def reclaim_expired_leases(self, page_size:int = 1000) -> int:
+        """
+        Reset the queue state of files whose leases have expired (i.e.,
+        that were dequeued by instances that have since died), or delete
+        them if they were marked as such
+
+        @param   page_size  Maximum number of documents per request
+        @return  Number of files reclaimed
+        """
+        expired = self._db.query_paged('queue', 'leases', page_size, flat         = 'doc',
+                                                                     include_docs = True,
+                                                                     endkey       = time())
+        reclaimed = 0
+        for docs in _batches(expired, page_size):
+            reclaimed += self._reclaim_docs(docs)
+
+        if reclaimed:
+            logging.info('Reclaimed %d files with expired leases', reclaimed)
+
+        return reclaimed
+
+    def _reclaim_docs(self, docs:List[dict]) -> int:
+        """
+        Reset (or delete) queue documents with expired leases, in bulk,
+        unless they've been changed since they were read
+
+        @param   docs  Queue documents
+        @return  Number of documents reclaimed
+        """
+        # Leases could have been renewed since they were indexed
+        now = time()
+        to_reclaim = [
+            _Bert._deletion(doc) if doc.get('deleted') else _Bert._reset_processing({'doc': doc})
+            for doc in docs
+            if  doc.get('processing') and (doc.get('lease_expires') or 0) <= now
+        ]
+
+        reclaimed = self._db.update_if_unchanged(to_reclaim)
+
+        for doc in reclaimed:
+            self._cache.evict(doc['identifier'])
+            with self._leases_lock:
+                self._leases.pop(doc['identifier'], None)
+
+            if not doc.get('_deleted'):
+                self._length.add(doc['queue_from'])
+
+        return len(reclaimed)
+
+    def renew_leases(self) -> List[str]:
+        """
+        Extend the leases held by this instance
+
+        @return  File identifiers whose leases were lost (i.e., reclaimed
+                 or otherwise taken over, in the meantime)
+        """
+        with self._leases_lock:
+            held = dict(self._leases)
+
+        if not held:
+            return []
+
+        current = {doc['identifier']: doc for doc in self._db.fetch_all(held.values())}
+        lost = [
+            identifier for identifier in held
+            if identifier not in current or not self._owns(current[identifier])
+        ]
+
+        with self._locked(current.keys()):
+            expires = time() + self._lease
+            renewed = self._db.update_if_unchanged(
+                {**doc, 'lease_expires': expires} for identifier, doc in current.items() if identifier not in lost)
+
+            # Conflicting renewals (e.g., the file having been marked dirty
+            # in the meantime) are retried next time
+            for doc in renewed:
+                self._cache.set(doc['identifier'], doc['_id'], doc)
+
+        with self._leases_lock:
+            for identifier in lost:
+                self._leases.pop(identifier, None)
+
+        for identifier in lost:
+            self._cache.evict(identifier)
+            logging.warning('Lease on %s has been lost', identifier)
+
+        return lost
+
+    @contextmanager
+    def _locked(self, identifiers:Iterable[str]) -> Iterator[None]:
+        """
+        Hold the transition locks of files
+
+        @param   identifiers  File identifiers
+        """
+        # Locks are taken in order, so concurrent batches can't deadlock
+        identifiers = sorted(set(identifiers))
+
+        for identifier in identifiers:
+            self._locks.acquire(identifier)
+        try:
+            yield
+
+        finally:
+            for identifier in identifiers:
+                self._locks.release(identifier)
+                self._locks.cleanup(identifier)
+
+    def _owns(self, doc:dict) -> bool:
+        """ Whether a queue document is leased by this instance """
+        return bool(doc.get('processing') and doc.get('owner') == self.owner)
+
+    @_just_keep_swimming
+    def get_by_identifier(self, identifier:str) -> Optional[Tuple[str, dict]]:
+        """
+        Get queue document by its file identifier
+
+        @param   identifier  File identifier
+        @return  Document ID and Document tuple (None, if not found)
+        """
+        cached = self._cache.get(identifier)
+        if cached is not None:
+            return cached
+
+        generation = self._cache.generation
+
+        if self._has_legacy_documents:
+            results = self._db.query('queue', 'get_id', key          = identifier,
+                                                        include_docs = True,
+                                                        reduce       = False)
+            result = next(results, None)
+            doc_id, doc = (result['value'], result['doc']) if result else (None, None)
+
+        else:
+            doc_id = get_queue_document_id(identifier)
+            doc = self._db.fetch(doc_id)
+
+        if doc is None:
+            return None
+
+        self._cache.populate(identifier, doc_id, doc, generation)
+        return doc_id, doc
+
+    @_just_keep_swimming
+    def delete(self, identifier:str):
+        """
+        Delete a queue document, or mark it for deletion if it is
+        currently being processed
+
+        @param   identifier  File identifier
+        """
+        if self.is_leasing:
+            return self._delete_all_leased([identifier])
+
+        with self._locked([identifier]):
+            doc_id, current_doc = self.get_by_identifier(identifier) or (None, None)
+
+            if doc_id:
+                if current_doc['processing']:
+                    deleted_doc = {
+                        **current_doc,
+                        'deleted': True
+                    }
+                    self._db.upsert(deleted_doc)
+                    self._cache.set(identifier, doc_id, deleted_doc)
+                else:
+                    self._db.delete(doc_id)
+                    self._cache.evict(identifier)
+
+                    if _Bert._is_queued(current_doc):
+                        self._length.remove()
+
+    @_just_keep_swimming
+    def get_all_by_identifier(self, identifiers:Iterable[str]) -> Dict[str, Tuple[str, dict]]:
+        """
+        Get queue documents by their file identifiers, fetching those
+        that aren't cached in a single request
+
+        @param   identifiers  File identifiers
+        @return  Dictionary of document ID and document tuples, keyed by
+                 file identifier (omitting those not found)
+        """
+        found = {}
+        uncached = []
+        for identifier in set(identifiers):
+            cached = self._cache.get(identifier)
+            if cached is not None:
+                found[identifier] = cached
+            else:
+                uncached.append(identifier)
+
+        if not uncached:
+            return found
+
+        generation = self._cache.generation
+
+        if self._has_legacy_documents:
+            results = self._db.query('queue', 'get_id', keys         = uncached,
+                                                        include_docs = True,
+                                                        reduce       = False)
+            fetched = [(result['value'], result['doc']) for result in results if result.get('doc')]
+
+        else:
+            docs = self._db.fetch_all(get_queue_document_id(identifier) for identifier in uncached)
+            fetched = [(doc['_id'], doc) for doc in docs]
+
+        for doc_id, doc in fetched:
+            self._cache.populate(doc['identifier'], doc_id, doc, generation)
+            found[doc['identifier']] = (doc_id, doc)
+
+        return found
+
+    @_just_keep_swimming
+    def delete_all(self, identifiers:Iterable[str]):
+        """
+        Delete queue documents, or mark them for deletion if they are
+        currently being processed, in batches
+
+        @param   identifiers  File identifiers
+        """
+        if self.is_leasing:
+            return self._delete_all_leased(identifiers)
+
+        identifiers = list(identifiers)
+
+        with self._locked(identifiers):
+            to_mark = []
+            to_delete = []
+            dequeued = 0
+            for identifier, (doc_id, current_doc) in self.get_all_by_identifier(identifiers).items():
+                if current_doc['processing']:
+                    to_mark.append((identifier, doc_id, {**current_doc, 'deleted': True}))
+                else:
+                    to_delete.append((identifier, doc_id))
+                    dequeued += _Bert._is_queued(current_doc)
+
+            if to_mark:
+                self._db.upsert_all(deleted_doc for _, _, deleted_doc in to_mark)
+                for identifier, doc_id, deleted_doc in to_mark:
+                    self._cache.set(identifier, doc_id, deleted_doc)
+
+            if to_delete:
+                self._db.delete_all(doc_id for _, doc_id in to_delete)
+                for identifier, _ in to_delete:
+                    self._cache.evict(identifier)
+
+                self._length.remove(dequeued)
+
+    def _delete_all_leased(self, identifiers:Iterable[str]):
+        """
+        Delete queue documents, or mark them for deletion if they are
+        currently being processed, when sharing the queue with other
+        instances: Each document is only written if it hasn't changed
+        since it was read (such that files leased by another instance in
+        the meantime aren't deleted from under it), retrying otherwise
+
+        @param   identifiers  File identifiers
+        """
+        remaining = set(identifiers)
 
-        # If there are any files marked as deleted, they can be cleaned
-        # up without consequence
-        to_delete = self._db.query('queue', 'to_clean', flat='value', reduce=False)
+        with self._locked(remaining):
+            while remaining:
+                # The cached documents don't have their revision IDs and may
+                # have been leased by another instance since
+                for identifier in remaining:
+                    self._cache.evict(identifier)
 
-        for doc_id in to_delete:
-            unclean_restart = True
-            self._db.delete(doc_id)
+                found = self.get_all_by_identifier(remaining)
+                updated = self._db.update_if_unchanged(_Bert._deleted(doc) for _, doc in found.values())
 
-        if unclean_restart:
-            logging.info('Queue state sanitised after unclean restart')
+                dequeued = 0
+                for doc in updated:
+                    identifier = doc['identifier']
+                    if doc.get('_deleted'):
+                        self._cache.evict(identifier)
+                        dequeued += _Bert._is_queued(found[identifier][1])
+                    else:
+                        self._cache.set(identifier, doc['_id'], doc)
 
-    @_just_keep_swimming
-    def get_by_identifier(self, identifier:str) -> Optional[Tuple[str, dict]]:
+                self._length.remove(dequeued)
+
+                # Those that conflicted are tried again
+                remaining = set(found.keys()) - {doc['identifier'] for doc in updated}
+
+    def get_identifiers_by_prefix(self, prefix:str, page_size:int = 1000) -> Iterable[List[str]]:
         """
-        Get queue document by its file identifier
+        Get the file identifiers of the queue documents starting with a
+        prefix, in pages
 
-        @param   identifier  File identifier
-        @return  Document ID and Document tuple (None, if not found)
+        @param   prefix     File identifier prefix
+        @param   page_size  Maximum number of identifiers per page
+        @return  Generator of pages of file identifiers
         """
-        results = self._db.query('queue', 'get_id', key          = identifier,
-                                                    include_docs = True,
-                                                    reduce       = False)
-        try:
-            result = next(results)
-            return result['value'], result['doc']
+        last_row = None
+        while True:
+            rows = self._get_id_range(prefix, page_size + 1, last_row)
 
-        except StopIteration:
-            return None
+            # Pages start from the last row of the previous page, if it
+            # still exists (i.e., rather than skipping it, as deleting
+            # the previous page may have removed it from the view)
+            if rows and last_row and (rows[0]['key'], rows[0]['id']) == (last_row['key'], last_row['id']):
+                rows = rows[1:]
+
+            rows = rows[:page_size]
+            if not rows:
+                break
+
+            yield [row['key'] for row in rows]
+            last_row = rows[-1]
 
     @_just_keep_swimming
-    def delete(self, identifier:str):
+    def _get_id_range(self, prefix:str, limit:int, after:Optional[dict] = None) -> List[dict]:
         """
-        Delete a queue document, or mark it for deletion if it is
-        currently being processed
+        Get a page of the queue/get_id view over a file identifier
+        prefix, continuing from the given row
 
-        @param   identifier  File identifier
+        @param   prefix  File identifier prefix
+        @param   limit   Maximum number of rows
+        @param   after   Row to continue from (None, from the start)
+        @return  View rows
         """
-        doc_id, current_doc = self.get_by_identifier(identifier) or (None, None)
+        options = {
+            'startkey': prefix,
+            'endkey':   prefix + '\ufff0',
+            'limit':    limit,
+            'reduce':   False
+        }
 
-        if doc_id:
-            if current_doc['processing']:
-                deleted_doc = {
-                    **current_doc,
-                    'deleted': True
-                }
-                self._db.upsert(deleted_doc)
-            else:
-                self._db.delete(doc_id)
+        if after is not None:
+            options.update({
+                'startkey':       after['key'],
+                'startkey_docid': after['id']
+            })
+
+        return list(self._db.query('queue', 'get_id', **options))
 
     @_just_keep_swimming
     def queue_length(self) -> int:
@@ -265,36 +1369,121 @@ class _Bert(object):
                                                         reduce = True,
                                                         group  = False)
         try:
-            return next(results)['value']
+            length = next(results)['value']
 
         except StopIteration:
-            return 0
+            length = 0
+
+        self._length.reconcile(length)
+        return length
+
+    def approximate_queue_length(self) -> Tuple[int, bool]:
+        """
+        Get the queue length from the approximation maintained by this
+        interface's own changes, falling back to (and reconciling with)
+        the exact queue length when it is due
+
+        @return  Tuple of the queue length and whether it is exact
+        """
+        length = self._length.get()
+        if length is None:
+            return self.queue_length(), True
+
+        return length, False
 
     @_just_keep_swimming
-    def mark_dirty(self, identifier:str, latency:Optional[timedelta] = None):
+    def next_queued_from(self) -> Optional[int]:
         """
-        Mark a file as requiring, potentially delayed, (re)processing,
-        resetting any deleted status
+        @return The timestamp from when the head of the queue was queued
+                (None, if the queue is empty)
+        """
+        options = {'endkey': _now(), 'reduce': False, 'limit': 1}
+        if self._stale_dequeue:
+            options['stale'] = 'update_after'
 
-        @param  identifier  File identifier
-        @param  latency     Requeue latency
+        found = next(self._db.query('queue', 'to_process', **options), None)
+        return None if found is None else (found['key'] or 0)
+
+    def _dirty(self, identifier:str, found:Optional[Tuple[str, dict]], latency:Optional[timedelta]) -> dict:
+        """
+        Mark a queue document as requiring (re)processing
+
+        @param   identifier  File identifier
+        @param   found       Document ID and current document tuple
+                             (None, if there isn't one)
+        @param   latency     Requeue latency
+        @return  Dirty document
         """
         # Get document, or define minimal default
-        doc_id, current_doc = self.get_by_identifier(identifier) or (None, {'identifier': identifier})
+        doc_id, current_doc = found or (get_queue_document_id(identifier), {'identifier': identifier})
 
         dirty_doc = {
             **self._schema,
             **current_doc,
             'dirty':      True,
             'deleted':    False,
-            'queue_from': _now()
+            'queue_from': _now(),
+            '_id':        doc_id
         }
 
         # Latency is only for existing documents
-        if doc_id and latency:
+        if found is not None and latency:
             dirty_doc['queue_from'] += latency.total_seconds()
 
-        self._db.upsert(dirty_doc)
+        return dirty_doc
+
+    @_just_keep_swimming
+    def mark_dirty(self, identifier:str, latency:Optional[timedelta] = None):
+        """
+        Mark a file as requiring, potentially delayed, (re)processing,
+        resetting any deleted status
+
+        @param  identifier  File identifier
+        @param  latency     Requeue latency
+        """
+        if self.is_leasing:
+            return self._mark_dirty_leased(identifier, latency)
+
+        with self._locked([identifier]):
+            found = self.get_by_identifier(identifier)
+            dirty_doc = self._dirty(identifier, found, latency)
+
+            self._db.upsert(dirty_doc)
+            self._cache.set(identifier, dirty_doc['_id'], dirty_doc)
+
+            if not (found and _Bert._is_queued(found[1])) and _Bert._is_queued(dirty_doc):
+                self._length.add(dirty_doc['queue_from'])
+
+    def _mark_dirty_leased(self, identifier:str, latency:Optional[timedelta]):
+        """
+        Mark a file as requiring, potentially delayed, (re)processing,
+        when sharing the queue with other instances: The document is
+        only written if it hasn't changed since it was read (such that
+        the lease of another instance that is processing the file is
+        kept), retrying otherwise
+
+        @param  identifier  File identifier
+        @param  latency     Requeue latency
+        """
+        with self._locked([identifier]):
+            while True:
+                # The cached document doesn't have its revision ID and may
+                # have been leased by another instance since
+                self._cache.evict(identifier)
+                found = self.get_by_identifier(identifier)
+
+                # New documents are created, unless another instance has
+                # created one in the meantime
+                updated = self._db.update_if_unchanged([self._dirty(identifier, found, latency)])
+
+                if updated:
+                    dirty_doc, = updated
+                    self._cache.set(identifier, dirty_doc['_id'], dirty_doc)
+
+                    if not (found and _Bert._is_queued(found[1])) and _Bert._is_queued(dirty_doc):
+                        self._length.add(dirty_doc['queue_from'])
+
+                    return
 
     @_just_keep_swimming
     def dequeue(self, count:int) -> List[str]:
@@ -305,10 +1494,27 @@ class _Bert(object):
         @param   count  The maximum number of documents to dequeue
         @return  List (potentially empty) of dequeued document IDs
         """
-        results = self._db.query('queue', 'to_process', endkey       = _now(),
-                                                        include_docs = True,
-                                                        reduce       = False,
-                                                        limit        = count)
+        if self.is_leasing:
+            return self._dequeue_leased(count)
+
+        now = _now()
+        options = {'endkey': now, 'include_docs': True, 'reduce': False, 'limit': count}
+
+        if self._stale_dequeue:
+            # The index may be out of date, but the included documents
+            # are not, so we can skip those no longer up for processing.
+            # If there are none left, fall back to waiting for the index
+            results = [
+                found for found in self._db.query('queue', 'to_process', stale='update_after', **options)
+                if found['doc'] and _Bert._is_queued(found['doc']) and (found['doc']['queue_from'] or 0) <= now
+            ]
+
+            if not results:
+                results = self._db.query('queue', 'to_process', **options)
+
+        else:
+            results = self._db.query('queue', 'to_process', **options)
+
         output = []
 
         for found in results:
@@ -321,11 +1527,137 @@ class _Bert(object):
                 'queue_from': None
             }
 
-            self._db.upsert(processing_doc)
+            with self._claimed_lock:
+                if self._sanitising:
+                    self._claimed.add(identifier)
+
+            with self._locked([identifier]):
+                self._db.upsert(processing_doc)
+                self._cache.set(identifier, found['id'], processing_doc)
+
             output.append(identifier)
 
+        self._length.remove(len(output))
+        return output
+
+    def _get_candidates(self, count:int) -> List[dict]:
+        """
+        Get up to count queue documents that are up for processing, as
+        they currently stand in the database
+
+        @param   count  The maximum number of documents
+        @return  Queue documents (with their revision IDs)
+        """
+        now = _now()
+        options = {'endkey': now, 'include_docs': True, 'reduce': False, 'limit': count}
+
+        def is_candidate(found:dict) -> bool:
+            doc = found['doc']
+            return bool(doc and _Bert._is_queued(doc) and (doc['queue_from'] or 0) <= now)
+
+        if self._stale_dequeue:
+            candidates = [found['doc'] for found in self._db.query('queue', 'to_process', stale='update_after', **options)
+                                       if  is_candidate(found)]
+            if candidates:
+                return candidates
+
+        return [found['doc'] for found in self._db.query('queue', 'to_process', **options) if is_candidate(found)]
+
+    @_just_keep_swimming
+    def _dequeue_leased(self, count:int) -> List[str]:
+        """
+        Fetch up to count documents (IDs) off the queue and lease them,
+        claiming each only if no other instance has in the meantime
+
+        @param   count  The maximum number of documents to dequeue
+        @return  List (potentially empty) of dequeued document IDs
+        """
+        output = []
+
+        # Other instances will be racing for the head of the queue, so
+        # try again for those that were lost to them
+        for _ in range(_Bert._CLAIM_ATTEMPTS):
+            candidates = self._get_candidates(count - len(output))
+            if not candidates:
+                break
+
+            with self._locked(doc['identifier'] for doc in candidates):
+                expires = time() + self._lease
+                claimed = self._db.update_if_unchanged({
+                    **doc,
+                    'dirty':         False,
+                    'processing':    True,
+                    'queue_from':    None,
+                    'owner':         self.owner,
+                    'lease_expires': expires
+                } for doc in candidates)
+
+                for doc in claimed:
+                    identifier = doc['identifier']
+
+                    with self._leases_lock:
+                        self._leases[identifier] = doc['_id']
+
+                    with self._claimed_lock:
+                        if self._sanitising:
+                            self._claimed.add(identifier)
+
+                    self._cache.set(identifier, doc['_id'], doc)
+                    output.append(identifier)
+
+            if len(claimed) == len(candidates) or len(output) >= count:
+                break
+
+        self._length.remove(len(output))
         return output
 
+    def _update_leased(self, identifier:str, update:Callable[[dict], dict]):
+        """
+        Update the queue document of a file leased by this instance,
+        giving up the lease, unless it has been lost in the meantime
+
+        @param   identifier  File identifier
+        @param   update      Function from the current document to the
+                             updated document
+        """
+        with self._leases_lock:
+            self._leases.pop(identifier, None)
+
+        with self._locked([identifier]):
+            while True:
+                # The cached document doesn't have its revision ID
+                self._cache.evict(identifier)
+                doc_id, current_doc = self.get_by_identifier(identifier) or (None, None)
+
+                if doc_id is None:
+                    return
+
+                if not self._owns(current_doc):
+                    logging.warning('Lease on %s was lost before it was given up; leaving it be', identifier)
+                    return
+
+                if current_doc['deleted']:
+                    if self._db.update_if_unchanged([_Bert._deletion(current_doc)]):
+                        self._cache.evict(identifier)
+                        return
+
+                else:
+                    updated = self._db.update_if_unchanged([{
+                        **update(current_doc),
+                        'processing':    False,
+                        'owner':         None,
+                        'lease_expires': None
+                    }])
+
+                    if updated:
+                        updated_doc, = updated
+                        self._cache.set(identifier, doc_id, updated_doc)
+
+                        if _Bert._is_queued(updated_doc):
+                            self._length.add(updated_doc['queue_from'] or _now())
+
+                        return
+
     @_just_keep_swimming
     def mark_finished(self, identifier:str):
         """
@@ -334,20 +1666,75 @@ class _Bert(object):
 
         @param  identifier  File identifier
         """
-        # Get document
-        doc_id, current_doc = self.get_by_identifier(identifier) or (None, None)
+        if self.is_leasing:
+            # Files marked dirty while processing are requeued
+            return self._update_leased(identifier, lambda doc: doc)
+
+        with self._locked([identifier]):
+            # Get document
+            doc_id, current_doc = self.get_by_identifier(identifier) or (None, None)
+
+            if doc_id:
+                if current_doc['deleted']:
+                    self._db.delete(doc_id)
+                    self._cache.evict(identifier)
+
+                else:
+                    finished_doc = {
+                        **current_doc,
+                        'processing': False
+                    }
 
-        if doc_id:
-            if current_doc['deleted']:
-                self._db.delete(doc_id)
+                    self._db.upsert(finished_doc)
+                    self._cache.set(identifier, doc_id, finished_doc)
 
-            else:
-                finished_doc = {
-                    **current_doc,
-                    'processing': False
-                }
+                    # Files marked dirty while processing are requeued
+                    if _Bert._is_queued(finished_doc):
+                        self._length.add(finished_doc['queue_from'] or _now())
+
+    @_just_keep_swimming
+    def release(self, identifier:str):
+        """
+        Return a file that was dequeued, but not processed, to the queue,
+        or delete it if it was marked as such in the meantime
+
+        @param  identifier  File identifier
+        """
+        if self.is_leasing:
+            return self._update_leased(identifier, lambda doc: {**doc, 'dirty': True, 'queue_from': _now()})
+
+        with self._locked([identifier]):
+            doc_id, current_doc = self.get_by_identifier(identifier) or (None, None)
+
+            if doc_id:
+                if current_doc['deleted']:
+                    self._db.delete(doc_id)
+                    self._cache.evict(identifier)
+
+                else:
+                    released_doc = {
+                        **current_doc,
+                        'dirty':      True,
+                        'processing': False,
+                        'queue_from': _now()
+                    }
+
+                    self._db.upsert(released_doc)
+                    self._cache.set(identifier, doc_id, released_doc)
+                    self._length.add(released_doc['queue_from'])
+
+    @_just_keep_swimming
+    def _count_legacy_documents(self) -> int:
+        """
+        @return The number of queue documents without a derived ID
+        """
+        results = self._db.query('queue', 'legacy', reduce = True,
+                                                    group  = False)
+        try:
+            return next(results)['value']
 
-                self._db.upsert(finished_doc)
+        except StopIteration:
+            return 0
 
     def _define_schema(self):
         """ Define views """
@@ -380,6 +1767,20 @@ class _Bert(object):
             """
         )
 
+        # View: queue/leases
+        # Queue documents marked as currently processing, keyed by when
+        # their lease expires (zero if they're not leased); set the
+        # endkey in queries appropriately
+        queue.define_view('leases',
+            map_fn = """
+                function(doc) {
+                    if (doc.$queue && doc.processing) {
+                        emit(doc.lease_expires || 0, doc.owner || null);
+                    }
+                }
+            """
+        )
+
         # View: queue/to_clean
         # Queue documents marked for deletion
         queue.define_view('to_clean',
@@ -404,20 +1805,35 @@ class _Bert(object):
             """
         )
 
+        # View: queue/legacy
+        # Queue documents without a derived ID, keyed by their file
+        # identifier; reduce to the number of such documents
+        queue.define_view('legacy',
+            map_fn = """
+                function (doc) {
+                    if (doc.$queue && doc._id.indexOf('%s') !== 0) {
+                        emit(doc.identifier, doc._id);
+                    }
+                }
+            """ % QUEUE_DOCUMENT_ID_PREFIX,
+            reduce_fn = '_count'
+        )
+
         self._db.commit_designs()
 
 
 class _Ernie(object):
     """ Interface to the metadata database documents """
+    # View of the metadata document IDs, keyed by file identifier
+    _index_view = 'collate'
+
     @staticmethod
     def _to_enrichment(row:dict) -> Enrichment:
         """
         Wrapper function that decodes enrichment data from query result
         rows into its respective Enrichment object
         """
-        # FIXME? Annoyingly, we have to re-encode the data back to JSON
-        row_json = json.dumps(row['doc'])
-        return json.loads(row_json, cls=EnrichmentJSONDecoder)
+        return decode_enrichment(row['doc'])
 
     def __init__(self, sofa:Sofabed):
         """
@@ -447,8 +1863,7 @@ class _Ernie(object):
         @param  identifier  File identifier
         @param  enrichment  Enrichment model
         """
-        # FIXME? Annoyingly, we have to convert back and forth
-        enrichment_dict = json.loads(json.dumps(enrichment, cls=EnrichmentJSONEncoder))
+        enrichment_dict = encode_enrichment(enrichment)
 
         enrichment_doc = {
             **self._schema,
@@ -486,6 +1901,62 @@ class _Ernie(object):
         for doc_id in to_delete:
             self._db.delete(doc_id)
 
+    @_just_keep_swimming
+    def delete_all_metadata(self, identifiers:Iterable[str]):
+        """
+        Delete all the enrichments for files, in batches
+
+        @param   identifiers  File identifiers
+        """
+        identifiers = list(set(identifiers))
+        if not identifiers:
+            return
+
+        to_delete = self._db.query('metadata', self._index_view, flat   = 'value',
+                                                                 keys   = identifiers,
+                                                                 reduce = False)
+
+        self._db.delete_all(to_delete)
+
+    def delete_by_prefix(self, prefix:str, page_size:int = 1000) -> int:
+        """
+        Delete all the enrichments for files with identifiers starting
+        with a prefix, in batches
+
+        @param   prefix     File identifier prefix
+        @param   page_size  Maximum number of documents per batch
+        @return  Number of files whose enrichments were deleted
+        """
+        deleted = set()
+
+        while True:
+            # Deleted documents drop out of the view, so the first page
+            # is always the next batch
+            rows = self._get_range(prefix, page_size)
+            if not rows:
+                break
+
+            identifiers = {row['key'] for row in rows}
+            self.delete_all_metadata(identifiers)
+            deleted.update(identifiers)
+
+        return len(deleted)
+
+    @_just_keep_swimming
+    def _get_range(self, prefix:str, limit:int) -> List[dict]:
+        """
+        Get the first page of the metadata index view over a file
+        identifier prefix
+
+        @param   prefix  File identifier prefix
+        @param   limit   Maximum number of rows
+        @return  View rows
+        """
+        return list(self._db.query('metadata', self._index_view, startkey = prefix,
+                                                                 endkey   = prefix + '\ufff0',
+                                                                 limit    = limit,
+                                                                 reduce   = False))
+
     def _define_schema(self):
         """ Define views """
         metadata = self._db.create_design('metadata')
@@ -502,39 +1973,275 @@ class _Ernie(object):
             """
         )
 
+        # View: metadata/chunks
+        # Consolidated metadata chunk document IDs keyed by `identifier`
+        metadata.define_view('chunks',
+            map_fn = """
+                function(doc) {
+                    if (doc.$metadata_chunk) {
+                        emit(doc.identifier, doc._id);
+                    }
+                }
+            """
+        )
+
         self._db.commit_designs()
 
 
+class _ConsolidatedErnie(_Ernie):
+    """ Interface to the consolidated metadata database documents """
+    _index_view = 'chunks'
+
+    def __init__(self, sofa:Sofabed, chunk_size:int = 500):
+        """
+        Constructor
+
+        @param   sofa        Sofabed object
+        @param   chunk_size  Maximum number of enrichments per chunk
+        """
+        super().__init__(sofa)
+        self._chunk_size = chunk_size if chunk_size > 0 else 1
+
+        # Appending is read-modify-write, so is serialised per file
+        self._locks = _LockPool()
+
+        # Document schema, with defaults
+        self._chunk_schema = {
+            '$metadata_chunk': True,
+            'identifier':      None,
+            'chunk':           0,
+            'enrichments':     []
+        }
+
+    @_just_keep_swimming
+    def enrich(self, identifier:str, enrichment:Enrichment):
+        """
+        Append a metadata enrichment to a file's latest chunk document,
+        starting a new chunk if it is full
+
+        @param  identifier  File identifier
+        @param  enrichment  Enrichment model
+        """
+        enrichment_dict = encode_enrichment(enrichment)
+
+        self._locks.acquire(identifier)
+        try:
+            latest = self._db.fetch_by_prefix(get_metadata_chunk_id(identifier), descending=True, limit=1)
+
+            if latest and len(latest[0]['enrichments']) < self._chunk_size:
+                chunk_doc = latest[0]
+            else:
+                chunk = latest[0]['chunk'] + 1 if latest else 0
+                chunk_doc = {
+                    **self._chunk_schema,
+                    '_id':        get_metadata_chunk_id(identifier, chunk),
+                    'identifier': identifier,
+                    'chunk':      chunk
+                }
+
+            self._db.upsert({
+                **chunk_doc,
+                'enrichments': chunk_doc['enrichments'] + [enrichment_dict]
+            })
+
+        finally:
+            self._locks.release(identifier)
+            self._locks.cleanup(identifier)
+
+    @_just_keep_swimming
+    def get_metadata(self, identifier:str) -> Iterable:
+        """
+        Get all the collected enrichments for a file
+
+        @param   identifier  File identifier
+        @return  Iterator of Enrichments
+        """
+        chunk_docs = self._db.fetch_by_prefix(get_metadata_chunk_id(identifier))
+        return sorted(
+            decode_enrichment(enrichment)
+            for chunk_doc in chunk_docs
+            for enrichment in chunk_doc['enrichments']
+        )
+
+    @_just_keep_swimming
+    def delete_metadata(self, identifier:str):
+        """
+        Delete all the enrichments for a file
+
+        @param   identifier  File identifier
+        """
+        self._locks.acquire(identifier)
+        try:
+            chunk_docs = self._db.fetch_by_prefix(get_metadata_chunk_id(identifier))
+            self._db.delete_all(chunk_doc['_id'] for chunk_doc in chunk_docs)
+
+        finally:
+            self._locks.release(identifier)
+            self._locks.cleanup(identifier)
+
+    def delete_all_metadata(self, identifiers:Iterable[str]):
+        """
+        Delete all the enrichments for files, in batches
+
+        @param   identifiers  File identifiers
+        """
+        # Locks are taken in order, so concurrent batches can't deadlock
+        identifiers = sorted(set(identifiers))
+
+        for identifier in identifiers:
+            self._locks.acquire(identifier)
+        try:
+            super().delete_all_metadata(identifiers)
+
+        finally:
+            for identifier in identifiers:
+                self._locks.release(identifier)
+                self._locks.cleanup(identifier)
+
+
 class BiscuitTin(CookieJar):
     """ Persistent implementation of `CookieJar` """
     def __init__(self, couchdb_url:str, couchdb_name:str, buffer_capacity:int = 1000,
                                                           buffer_latency:timedelta = timedelta(milliseconds=50),
+                                                          queue_cache_size:int = 10000,
+                                                          follow_changes:bool = False,
+                                                          consolidate_metadata:bool = False,
+                                                          metadata_chunk_size:int = 500,
+                                                          queue_length_max_age:timedelta = timedelta(seconds=10),
+                                                          prefetch_capacity:int = 0,
+                                                          stale_dequeue:bool = False,
+                                                          sanitise_in_background:bool = False,
+                                                          lease_duration:Optional[timedelta] = None,
+                                                          worker_id:Optional[str] = None,
                                                           **kwargs):
         """
         Constructor: Initialise the database interfaces
 
-        @param  couchdb_url      CouchDB URL
-        @param  couchdb_name     Database name
-        @param  buffer_capacity  Buffer capacity
-        @param  buffer_latency   Buffer latency
+        @param  couchdb_url           CouchDB URL
+        @param  couchdb_name          Database name
+        @param  buffer_capacity       Buffer capacity
+        @param  buffer_latency        Buffer latency
+        @param  queue_cache_size      Maximum number of cached queue
+                                      documents (zero to disable caching)
+        @param  follow_changes        Keep the queue cache coherent with
+                                      other writers to the database, by
+                                      following its changes feed
+        @param  consolidate_metadata  Store each file's enrichments in a
+                                      few chunk documents, rather than
+                                      one document per enrichment
+        @param  metadata_chunk_size   Maximum number of enrichments per
+                                      chunk, when consolidated
+        @param  queue_length_max_age  Maximum time between reconciling
+                                      the approximate queue length with
+                                      the database (zero to always count
+                                      the queue exactly)
+        @param  prefetch_capacity     Maximum number of cookies to
+                                      dequeue ahead of processing, in
+                                      the background (zero to disable
+                                      prefetching)
+        @param  stale_dequeue         Dequeue from the queue's index
+                                      without waiting for it to be
+                                      rebuilt, where possible
+        @param  sanitise_in_background
+                                      Reset the queue state of files
+                                      left processing by an unclean
+                                      restart in the background, while
+                                      other files can be processed
+        @param  lease_duration        Lease dequeued files for this
+                                      long, renewing them while they're
+                                      processed, such that other
+                                      instances can share the queue
+                                      (None, if this is the only one)
+        @param  worker_id             Owner of this instance's leases
+                                      (None for a unique default)
+        @kwargs Additional constructor parameters to Sofabed (e.g.,
+                `view_warming_threshold`), SofterCouchDB (e.g.,
+                `max_connections`, which should be sized to the number
+                of processor threads) and pycouchdb.client.Server
         """
         super().__init__()
         self._sofa = Sofabed(couchdb_url, couchdb_name, buffer_capacity, buffer_latency, **kwargs)
-        self._queue = _Bert(self._sofa)
-        self._metadata = _Ernie(self._sofa)
+        self._queue_cache = _QueueCache(queue_cache_size)
+
+        # Bulk operations are batched to fill the buffer
+        self._bulk_size = max(buffer_capacity, 1)
+
+        self._queue = _Bert(self._sofa, self._queue_cache, _QueueLength(queue_length_max_age), stale_dequeue,
+                            sanitise_in_background, self._bulk_size, lease_duration, worker_id)
+
+        self._lease_keeper = None  # type: Optional[_LeaseKeeper]
+        if self._queue.is_leasing:
+            self._lease_keeper = _LeaseKeeper(self._queue, self._broadcast, self._bulk_size)
+            self._lease_keeper.start()
+
+        if follow_changes:
+            self._queue_cache.follow(self._sofa)
+
+        if consolidate_metadata:
+            self._metadata = _ConsolidatedErnie(self._sofa, metadata_chunk_size)
+        else:
+            self._metadata = _Ernie(self._sofa)
 
         self._queue_lock = CountingLock()
         self._pending_cache = deque()
 
         self._latency = buffer_latency.total_seconds()
 
+        self._prefetcher = None  # type: Optional[_Prefetcher]
+        if prefetch_capacity > 0:
+            self._prefetcher = _Prefetcher(self._dequeue, prefetch_capacity)
+            self._prefetcher.start()
+
     def _broadcast(self):
         """
         Broadcast to all listeners
         This should be called on queue changes
         """
+        if self._prefetcher is not None:
+            self._prefetcher.wake()
+
         self.notify_listeners()
 
+    def _dequeue(self, count:int) -> List[Cookie]:
+        """
+        Dequeue up to the given number of Cookies and hydrate them
+
+        @param   count  The maximum number of Cookies to dequeue
+        @return  List (potentially empty) of dequeued Cookies
+        """
+        with self._queue_lock:
+            to_process = self._queue.dequeue(count)
+
+        cookies = [self._get_cookie(identifier) for identifier in to_process]
+        return [cookie for cookie in cookies if cookie is not None]
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Get the usage statistics of the CouchDB connection pool
+
+        @return  Dictionary of the number of requests made, connections
+                 opened and requests that reused a connection
+        """
+        return self._sofa.connection_stats()
+
+    def stop(self):
+        """
+        Stop the background threads, returning any prefetched Cookies to
+        the queue and no longer renewing leases
+        """
+        self._queue_cache.stop_following()
+
+        if self._prefetcher is not None:
+            for cookie in self._prefetcher.stop():
+                self._queue.release(cookie.identifier)
+            self._prefetcher = None
+
+        # Leases on files still being processed will be reclaimed by
+        # another instance, once they expire
+        if self._lease_keeper is not None:
+            self._lease_keeper.stop()
+            self._lease_keeper = None
+
     def _get_cookie(self, identifier: str) -> Optional[Cookie]:
         """
         This method *actually* fetches the Cookie, but is not targeted
@@ -557,6 +2264,23 @@ class BiscuitTin(CookieJar):
         self._metadata.delete_metadata(identifier)
         self._queue.delete(identifier)
 
+    def delete_cookies(self, identifiers: Iterable[str]):
+        for batch in _batches(identifiers, self._bulk_size):
+            self._metadata.delete_all_metadata(batch)
+            self._queue.delete_all(batch)
+
+    def delete_by_prefix(self, prefix: str) -> int:
+        deleted = 0
+        for identifiers in self._queue.get_identifiers_by_prefix(prefix, self._bulk_size):
+            self._metadata.delete_all_metadata(identifiers)
+            self._queue.delete_all(identifiers)
+            deleted += len(identifiers)
+
+        # Clean up any enrichments without a queue document
+        self._metadata.delete_by_prefix(prefix, self._bulk_size)
+
+        return deleted
+
     def enrich_cookie(self, identifier: str, enrichment: Enrichment, mark_for_processing: bool=True):
         self._metadata.enrich(identifier, enrichment)
         if mark_for_processing:
@@ -584,6 +2308,25 @@ class BiscuitTin(CookieJar):
         self._broadcast()
 
     def get_next_for_processing(self) -> Optional[Cookie]:
+        prefetcher = self._prefetcher
+        if prefetcher is not None:
+            cookie = prefetcher.take()
+            if cookie is not None:
+                return cookie
+
+        cookie = self._get_next_for_processing()
+
+        # There was more to process than was prefetched
+        if cookie is not None and prefetcher is not None:
+            prefetcher.wake()
+
+        return cookie
+
+    def _get_next_for_processing(self) -> Optional[Cookie]:
+        """
+        Dequeue the next Cookie for processing, along with a Cookie for
+        each thread that's waiting to do the same
+        """
         with self._queue_lock:
             if not self._pending_cache:
                 # Dequeue up to as many Cookies (IDs) as there are
@@ -605,6 +2348,17 @@ class BiscuitTin(CookieJar):
     def queue_length(self) -> int:
         return self._queue.queue_length()
 
+    def approximate_queue_length(self) -> Tuple[int, bool]:
+        return self._queue.approximate_queue_length()
+
+    def next_queued_from(self) -> Optional[float]:
+        # Cookies already dequeued ahead of processing are up next
+        prefetcher = self._prefetcher
+        if self._pending_cache or (prefetcher is not None and len(prefetcher) > 0):
+            return 0
+
+        return self._queue.next_queued_from()
+
 
 @rate_limited
 class RateLimitedBiscuitTin(BiscuitTin):
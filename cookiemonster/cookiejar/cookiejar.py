@@ -21,6 +21,13 @@ Jars. Such implementations must define the following methods:
 * `delete_cookie` should remove a file and its associated metadata from
   the repository and processing queue. This won't delete upstream data.
 
+* `delete_cookies` should remove many files, as with `delete_cookie`, in
+  as few operations as the implementation allows.
+
+* `delete_by_prefix` should remove all the files with identifiers that
+  start with a given prefix (e.g., a retired collection), as with
+  `delete_cookie`, returning how many were removed.
+
 * `enrich_cookie` should update/append provided metadata (and its
   source) to the repository for the specified file. If a change is
   detected, then said file should be queued for processing (if it isn't
@@ -48,6 +55,15 @@ Jars. Such implementations must define the following methods:
 * `queue_length` should return the number of files currently in the
   queue for processing
 
+Implementations may also override `approximate_queue_length`, which
+returns the queue length along with whether it is exact, where counting
+the queue exactly is expensive. By default, it is exact.
+
+Likewise, `next_queued_from` returns when the next file for processing
+was queued, such that the queues of several Cookie Jars can be merged
+(see `ShardedCookieJar`). By default, files are ordered only by whether
+there are any.
+
 Legalese
 --------
 Copyright (c) 2015, 2016 Genome Research Ltd.
@@ -72,7 +88,7 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 
 from abc import ABCMeta, abstractmethod
 from datetime import timedelta
-from typing import Optional
+from typing import Iterable, Optional, Tuple
 
 from hgicommon.mixable import Listenable
 
@@ -103,6 +119,28 @@ class CookieJar(Listenable[None], metaclass=ABCMeta):
         @param  identifier  Cookie identifier
         """
 
+    @abstractmethod
+    def delete_cookies(self, identifiers: Iterable[str]):
+        """
+        Delete files and their associated metadata from the CookieJar by
+        their identifiers (n.b., this will not delete upstream, only the
+        CookieJar will be affected)
+
+        @param  identifiers  Cookie identifiers
+        """
+
+    @abstractmethod
+    def delete_by_prefix(self, prefix: str) -> int:
+        """
+        Delete all the files, and their associated metadata, with
+        identifiers starting with a prefix from the CookieJar (n.b.,
+        this will not delete upstream, only the CookieJar will be
+        affected)
+
+        @param  prefix  Cookie identifier prefix
+        @return Number of Cookies deleted
+        """
+
     @abstractmethod
     def enrich_cookie(self, identifier: str, enrichment: Enrichment, mark_for_processing: bool=True):
         """
@@ -161,3 +199,23 @@ class CookieJar(Listenable[None], metaclass=ABCMeta):
 
         @return Number of items in the queue
         """
+
+    def approximate_queue_length(self) -> Tuple[int, bool]:
+        """
+        Get the number of items ready for processing, which may be
+        approximate, for frequent polling (e.g., monitoring)
+
+        @return Tuple of the number of items in the queue and whether
+                it is exact
+        """
+        return self.queue_length(), True
+
+    def next_queued_from(self) -> Optional[float]:
+        """
+        Get when the next item for processing was queued, which may be
+        approximate
+
+        @return Timestamp from when it was queued (Unix epoch; None, if
+                the queue is empty)
+        """
+        return 0 if self.queue_length() > 0 else None
@@ -26,17 +26,54 @@ against the database.
 The Sofabed object will gracefully manage document conflicts and any
 connection problems it may have with the database.
 
+The views of committed design documents are cached in memory, so
+queries don't need to first check that their view exists. After a
+large batch (at least `view_warming_threshold` documents) has been
+written, the views are touched in the background, so their indices are
+rebuilt ahead of being queried, rather than by the first query to need
+them. Queries can also, per call, accept a stale index (e.g., with
+`stale='update_after'`, or `update='lazy'` on CouchDB 2), so they don't
+block on the index being rebuilt.
+
+Query results are streamed: rows are parsed as the response arrives.
+Scans over views too large to hold in memory should use `query_paged`,
+which makes a request per page of rows. Each page continues from the
+key and document ID of the previous page's last row, rather than
+skipping over rows, so rows can be changed or deleted between pages.
+
 Methods:
 
 * `fetch` Fetch a document by its ID and, optionally, revision
 
+* `fetch_all` Fetch documents by their IDs
+
+* `fetch_by_prefix` Fetch the documents with IDs starting with a prefix
+
 * `upsert` Insert or update a document into the database, via a buffer
   and upsert queue
 
+* `upsert_all` Insert or update documents into the database, via a
+  buffer and upsert queue, such that they can be batched together
+
+* `update_if_unchanged` Update documents in the database, in bulk and
+  bypassing the buffer, provided they haven't changed since they were
+  read
+
 * `delete` Delete a document from the database, via a buffer and
   deletion queue
 
-* `query` Query a predefined view
+* `delete_all` Delete documents from the database, via a buffer and
+  deletion queue, such that they can be batched together
+
+* `query` Query a predefined view, optionally accepting a stale index
+
+* `query_paged` Query a predefined view, a page of rows at a time
+
+* `get_update_seq` Get the database's current update sequence
+
+* `changes` Long-poll the database's changes feed
+
+* `connection_stats` Get the connection pool's usage statistics
 
 * `create_design` Create a new, in-memory design document
 
@@ -44,6 +81,9 @@ Methods:
 
 * `commit_designs` Commit all in-memory designs to the database
 
+* `warm_views` Touch the views of all committed designs, in the
+  background, so their indices are rebuilt
+
 Note that buffered and queued documents only exist in memory until they
 are pushed to the database. Data will be lost in the event of failure.
 
@@ -85,8 +125,9 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 import logging
 from copy import deepcopy
 from datetime import timedelta
-from threading import Event
-from typing import Any, Callable, Generator, Optional
+from threading import Event, Lock, Thread
+from time import sleep
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Set, Tuple
 from uuid import uuid4
 
 from pycouchdb.exceptions import Conflict, NotFound
@@ -94,7 +135,7 @@ from pycouchdb.exceptions import Conflict, NotFound
 from hgicommon.collections import ThreadSafeDefaultdict
 from hgicommon.threading import CountingLock
 
-from cookiemonster.cookiejar.couchdb.softer import SofterCouchDB, UnresponsiveCouchDB, InvalidCouchDBKey
+from cookiemonster.cookiejar.couchdb.softer import SofterCouchDB, UnresponsiveCouchDB, CouchDBCircuitOpen, InvalidCouchDBKey, backoff
 from cookiemonster.cookiejar.couchdb.dream_catcher import Buffer, Actions, BatchListenerT
 
 
@@ -122,10 +163,47 @@ class _LockPool(object):
         self._purge.set()
 
 
+class _ViewWarmer(object):
+    """
+    Background task that touches views, such that their indices are
+    rebuilt ahead of being queried; requests made while warming are
+    coalesced into a single subsequent warming
+    """
+    def __init__(self, warm:Callable[[], None]):
+        """
+        @param   warm  Function that touches the views
+        """
+        self._warm = warm
+        self._pending = Event()
+        self._thread = None  # type: Optional[Thread]
+        self._thread_lock = Lock()
+
+    def request(self):
+        """ Request that the views be warmed """
+        self._pending.set()
+
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        """ View warming thread """
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+
+            try:
+                self._warm()
+            except Exception:
+                logging.exception('Could not warm views!!')
+
+
 class _DesignDocument(object):
     """ Design document model """
     def __init__(self, db:SofterCouchDB, name:str, language='javascript'):
         self._db = db
+        self.name = name
         self.design_id = '_design/{}'.format(name)
 
         # Synchronise the design with what already exists
@@ -165,6 +243,11 @@ class _DesignDocument(object):
 
             self._design_dirty = False
 
+    @property
+    def views(self) -> Set[str]:
+        """ The names of the design's views """
+        return set(self._design.get('views', {}))
+
     def define_view(self, name:str, map_fn:str, reduce_fn:Optional[str] = None):
         """
         Define a MapReduce view
@@ -189,16 +272,22 @@ class Sofabed(object):
     """ Buffered, append-optimised CouchDB interface """
     def __init__(self, url:str, database:str, max_buffer_size:int = 1000,
                                               buffer_latency:timedelta = timedelta(milliseconds=50),
+                                              view_warming_threshold:int = 100,
                                               **kwargs):
         """
         Acquire a connection with the CouchDB server and initialise the
         buffering queue
 
-        @param   url              CouchDB server URL
-        @param   database         Database name
-        @param   max_buffer_size  Maximum buffer size (no. of documents)
-        @param   buffer_latency   Buffer latency before discharge
-        @kwargs  Additional constructor parameters to
+        @param   url                     CouchDB server URL
+        @param   database                Database name
+        @param   max_buffer_size         Maximum buffer size (no. of
+                                         documents)
+        @param   buffer_latency          Buffer latency before discharge
+        @param   view_warming_threshold  Batch size (no. of documents)
+                                         after which views are warmed
+                                         (zero to never warm them)
+        @kwargs  Additional constructor parameters to SofterCouchDB
+                 (i.e., its connection pool configuration) and
                  pycouchdb.client.Server should be passed through here
         """
         self._db = SofterCouchDB(url, database, **kwargs)
@@ -206,6 +295,12 @@ class Sofabed(object):
         self._designs = []
         self._designs_dirty = False
 
+        # Validated views, by design document name
+        self._views = {}  # type: Dict[str, Set[str]]
+
+        self._view_warming_threshold = view_warming_threshold
+        self._view_warmer = _ViewWarmer(self._warm_views)
+
         # Batch action to DB method mapping
         self._batch_methods = {
             Actions.Upsert: self._db.save_bulk,
@@ -229,23 +324,23 @@ class Sofabed(object):
         to_batch = deepcopy(docs)
         to_log = {}
 
-        # To avoid conflicts, we must merge in the revision IDs of
-        # existing documents
-        document_ids = [doc['_id'] for doc in to_batch]
-        revision_ids = {
-            query_row['id']: query_row['value']['rev']
-            for query_row in self._db.all(keys=document_ids, include_docs=False)
-            if 'error' not in query_row
-        }
+        try:
+            # To avoid conflicts, we must merge in the revision IDs of
+            # existing documents
+            document_ids = [doc['_id'] for doc in to_batch]
+            revision_ids = {
+                query_row['id']: query_row['value']['rev']
+                for query_row in self._db.all(keys=document_ids, include_docs=False)
+                if 'error' not in query_row
+            }
 
-        for doc in to_batch:
-            doc_id = doc['_id']
-            if doc_id in revision_ids:
-                doc['_rev'] = revision_ids[doc_id]
+            for doc in to_batch:
+                doc_id = doc['_id']
+                if doc_id in revision_ids:
+                    doc['_rev'] = revision_ids[doc_id]
 
-            to_log[doc_id] = doc['identifier']
+                to_log[doc_id] = doc['identifier']
 
-        try:
             logging.debug('Performing batch update: %s %s', action.name, to_log)
             _ = self._batch_methods[action](to_batch, transaction=True)
 
@@ -261,7 +356,15 @@ class Sofabed(object):
 
             logging.debug('Batch update completed')
 
-        except (UnresponsiveCouchDB, Conflict):
+            if self._view_warming_threshold and len(to_batch) >= self._view_warming_threshold:
+                self.warm_views()
+
+        except (UnresponsiveCouchDB, Conflict) as e:
+            if isinstance(e, CouchDBCircuitOpen):
+                # Requeueing discharges immediately, so wait for the
+                # circuit to close rather than spinning
+                sleep(backoff(1, e))
+
             logging.info('Couldn\'t perform batch update; requeueing')
             self._buffer.requeue(action, docs)
 
@@ -289,6 +392,46 @@ class Sofabed(object):
 
         return output
 
+    def fetch_all(self, keys:Iterable[str]) -> List[dict]:
+        """
+        Get database documents by their IDs, in a single request
+
+        @param   keys  Document IDs
+        @return  Database documents (omitting those not found)
+        """
+        keys = list(keys)
+        if not keys:
+            return []
+
+        return [
+            row['doc']
+            for row in self._db.all(keys=keys, include_docs=True)
+            if 'error' not in row and row.get('doc')
+        ]
+
+    def fetch_by_prefix(self, prefix:str, descending:bool = False, limit:Optional[int] = None) -> List[dict]:
+        """
+        Get the database documents with IDs starting with a prefix, in
+        order of their IDs
+
+        @param   prefix      Document ID prefix
+        @param   descending  Whether to get the documents in reverse order
+        @param   limit       Maximum number of documents to get
+        @return  Database documents
+        """
+        # The high Unicode character sorts after any ID with the prefix
+        start, end = prefix, prefix + '\ufff0'
+        if descending:
+            start, end = end, start
+
+        options = {'startkey': start, 'endkey': end, 'include_docs': 'true'}
+        if descending:
+            options['descending'] = 'true'
+        if limit is not None:
+            options['limit'] = limit
+
+        return [row['doc'] for row in self._db.all(**options)]
+
     def upsert(self, data:dict, key:Optional[str] = None):
         """
         Upsert document, via the upsert buffer and queue
@@ -319,6 +462,71 @@ class Sofabed(object):
         self._doc_locks.release(doc_id)
         self._doc_locks.cleanup(doc_id)
 
+    def upsert_all(self, docs:Iterable[dict]):
+        """
+        Upsert documents, via the upsert buffer and queue
+
+        @param   docs  Documents' data
+
+        NOTE The same conditions apply as to `upsert`
+        """
+        to_upsert = []
+        for data in docs:
+            if '_rev' in data:
+                del data['_rev']
+
+            if any(key.startswith('_') for key in data.keys() if key != '_id'):
+                raise InvalidCouchDBKey
+
+            to_upsert.append({'_id': data.get('_id', uuid4().hex), **data})
+
+        for doc in to_upsert:
+            self._doc_locks.acquire(doc['_id'])
+            self._buffer.append(doc)
+
+        # Block until upsertion, then cleanup (if possible)
+        for doc in to_upsert:
+            self._doc_locks.acquire(doc['_id'])
+            self._doc_locks.release(doc['_id'])
+            self._doc_locks.cleanup(doc['_id'])
+
+    def update_if_unchanged(self, docs:Iterable[dict]) -> List[dict]:
+        """
+        Update documents immediately, in bulk, provided their revisions
+        are still current (i.e., optimistically, for when several
+        clients may be racing to update the same documents)
+
+        @param   docs  Documents, with the revision IDs they were read at
+                       (or `_deleted` set, to delete them)
+        @return  The documents that were updated, with their new
+                 revision IDs
+
+        NOTE Unlike `upsert`, revision IDs are required and the documents
+        aren't buffered; the same conditions otherwise apply
+        """
+        docs = list(docs)
+        for data in docs:
+            if any(key.startswith('_') for key in data.keys() if key not in ['_id', '_rev', '_deleted']):
+                raise InvalidCouchDBKey
+
+        if not docs:
+            return []
+
+        # Wait for any buffered writes to the same documents to land (in
+        # order, so concurrent updates can't deadlock), such that they
+        # can't silently overwrite these updates afterwards
+        doc_ids = sorted({doc['_id'] for doc in docs})
+        for doc_id in doc_ids:
+            self._doc_locks.acquire(doc_id)
+
+        try:
+            return [doc for doc in self._db.try_save_bulk(docs) if doc is not None]
+
+        finally:
+            for doc_id in doc_ids:
+                self._doc_locks.release(doc_id)
+                self._doc_locks.cleanup(doc_id)
+
     def delete(self, key:str):
         """
         Delete document from CouchDB, via the deletion buffer and queue
@@ -346,6 +554,37 @@ class Sofabed(object):
             self._doc_locks.release(doc_id)
             self._doc_locks.cleanup(doc_id)
 
+    def delete_all(self, keys:Iterable[str]):
+        """
+        Delete documents from CouchDB, via the deletion buffer and queue
+
+        @param   keys  Document IDs
+        """
+        # Fetch all the documents in one request, rather than per key
+        docs = self.fetch_all(set(keys))
+
+        doc_ids = []
+        for doc in docs:
+            # Remove all CouchDB keys except _id
+            to_delete = {
+                key: value
+                for key, value in doc.items()
+                if  key == '_id'
+                or  not key.startswith('_')
+            }
+
+            doc_id = to_delete['_id']
+            doc_ids.append(doc_id)
+
+            self._doc_locks.acquire(doc_id)
+            self._buffer.remove(to_delete)
+
+        # Block until deletion, then cleanup (if possible)
+        for doc_id in doc_ids:
+            self._doc_locks.acquire(doc_id)
+            self._doc_locks.release(doc_id)
+            self._doc_locks.cleanup(doc_id)
+
     def query(self, design:str, view:str, wrapper:Optional[Callable[[dict], Any]] = None, **kwargs) -> Generator:
         """
         Query a predefined view
@@ -353,16 +592,118 @@ class Sofabed(object):
         @param   design   Design document name
         @param   view     View name
         @param   wrapper  Wrapper function applied over result rows
-        @kwargs  Query string options for CouchDB
+        @kwargs  Query string options for CouchDB (e.g., `stale`, to
+                 not wait for the index to be rebuilt)
         @return  Results generator
         """
-        # Check view exists
-        doc = self.fetch('_design/{}'.format(design))
-        if not doc or 'views' not in doc or view not in doc['views']:
-            raise NotFound
+        # Check view exists, if it's not already known to
+        if view not in self._views.get(design, ()):
+            doc = self.fetch('_design/{}'.format(design))
+            if not doc or 'views' not in doc or view not in doc['views']:
+                raise NotFound
+
+            self._views[design] = set(doc['views'])
 
         view_name = '{}/{}'.format(design, view)
-        return self._db.query(view_name, wrapper=wrapper, **kwargs)
+        return self._forget_if_not_found(design, self._db.query_stream(view_name, wrapper=wrapper, **kwargs))
+
+    def query_paged(self, design:str, view:str, page_size:int = 1000,
+                                                wrapper:Optional[Callable[[dict], Any]] = None,
+                                                flat:Optional[str] = None,
+                                                **kwargs) -> Generator:
+        """
+        Query a predefined view, a page of rows at a time
+
+        @param   design     Design document name
+        @param   view       View name
+        @param   page_size  Maximum number of rows per request
+        @param   wrapper    Wrapper function applied over result rows
+        @param   flat       Member of the result rows to get, instead
+        @kwargs  Query string options for CouchDB (except `keys`,
+                 `skip` and `limit`)
+        @return  Results generator
+        """
+        if any(option in kwargs for option in ['keys', 'skip', 'limit']):
+            raise ValueError('Paged queries can\'t have keys, skip or limit options')
+
+        if 'key' in kwargs:
+            kwargs['startkey'] = kwargs['endkey'] = kwargs.pop('key')
+
+        if flat is not None:
+            wrapper = lambda row: row[flat]
+
+        last_row = None
+        while True:
+            options = {**kwargs, 'limit': page_size + 1}
+            if last_row is not None:
+                options.update({
+                    'startkey':       last_row['key'],
+                    'startkey_docid': last_row['id']
+                })
+
+            rows = list(self.query(design, view, **options))
+            exhausted = len(rows) <= page_size
+
+            # Pages start from the last row of the previous page, if it
+            # still exists, so it's not skipped if it doesn't
+            if rows and last_row and (rows[0]['key'], rows[0]['id']) == (last_row['key'], last_row['id']):
+                rows = rows[1:]
+
+            rows = rows[:page_size]
+            for row in rows:
+                yield row if wrapper is None else wrapper(row)
+
+            if exhausted or not rows:
+                break
+
+            last_row = rows[-1]
+
+    def _forget_if_not_found(self, design:str, results:Generator) -> Generator:
+        """
+        Forget a design's validated views, if querying it fails because
+        it's been changed behind our back
+
+        @param   design   Design document name
+        @param   results  Results generator
+        @return  Results generator
+        """
+        try:
+            yield from results
+
+        except NotFound:
+            self._views.pop(design, None)
+            raise
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Get the connection pool's usage statistics
+
+        @return  Dictionary of the number of requests made, connections
+                 opened and requests that reused a connection
+        """
+        return self._db.connection_stats()
+
+    def get_update_seq(self) -> Any:
+        """
+        Get the database's current update sequence
+
+        @return  Update sequence (an integer or opaque string, depending
+                 on the CouchDB version)
+        """
+        return self._db.config()['update_seq']
+
+    def changes(self, since:Any, timeout:timedelta = timedelta(seconds=60), **kwargs) -> Tuple[Any, List[dict]]:
+        """
+        Long-poll the changes feed, blocking until there are changes
+        since the given update sequence or the timeout expires
+
+        @param   since    Update sequence
+        @param   timeout  Long-poll timeout
+        @kwargs  Query string options for CouchDB
+        @return  Tuple of the last update sequence and the changes
+        """
+        return self._db.changes_list(since=since, feed='longpoll',
+                                     timeout=int(timeout.total_seconds() * 1000), **kwargs)
 
     def create_design(self, name:str) -> _DesignDocument:
         """
@@ -395,4 +736,23 @@ class Sofabed(object):
         if self._designs_dirty:
             for design in self._designs:
                 design._commit()
+                self._views[design.name] = design.views
+
             self._designs_dirty = False
+
+    def warm_views(self):
+        """
+        Touch the views of all committed design documents, in the
+        background, such that their indices are rebuilt
+        """
+        self._view_warmer.request()
+
+    def _warm_views(self):
+        """ Touch the views of all committed design documents """
+        for design, views in list(self._views.items()):
+            if views:
+                # CouchDB indexes all of a design's views together, so
+                # we only need to touch one
+                view_name = '{}/{}'.format(design, sorted(views)[0])
+                logging.debug('Warming view: %s', view_name)
+                self._db.query(view_name, limit=0, as_list=True)
@@ -2,11 +2,13 @@
 Low-Level CouchDB Interface
 ===========================
 This module provides a wrapper to pycouchdb such that every request made
-to the CouchDB server is repeated a set amount of times, after a grace
-timeout, before giving up.
+to the CouchDB server is repeated a set amount of times, backing off
+between attempts, before giving up.
 
-Exportable classes: `SofterCouchDB`
-Exportable exceptions: `UnresponsiveCouchDB`, `InvalidCouchDBKey`
+Exportable classes: `SofterCouchDB`, `CircuitBreaker`
+Exportable functions: `get_circuit_breaker`, `backoff`
+Exportable exceptions: `UnresponsiveCouchDB`, `CouchDBCircuitOpen`,
+`InvalidCouchDBKey`
 
 SofterCouchDB
 -------------
@@ -18,18 +20,64 @@ found on the CouchDB server, it will be created.
 The available methods are a subset of those provided by
 pycouchdb.client.Database, using the same calling conventions.
 
+Each `SofterCouchDB` has its own HTTP connection pool, which can be
+configured with the following constructor parameters:
+
+* `max_connections` Maximum number of connections kept open to the
+  server; this should be at least the number of threads making requests
+  through it concurrently (e.g., processor threads, plus any background
+  threads), otherwise connections will be discarded and reopened
+
+* `pool_block` Whether to wait for a connection to be returned to the
+  pool when all of them are in use, rather than opening a new one that
+  is discarded after use
+
+* `keep_alive` Whether connections are kept open between requests
+
+The `connection_stats` method reports the number of requests made and
+connections opened through the pool, from which connection reuse can be
+monitored.
+
+View queries can also be made with `query_stream`, which parses the
+rows of the response incrementally, as it arrives, rather than
+buffering and parsing the whole response before the first row can be
+consumed; thus the memory used is bounded by the size of a row, rather
+than that of the response.
+
+Retry Policy
+------------
+Failed requests (i.e., server errors and connection failures, rather
+than missing documents, bad requests or conflicts) are retried after an
+exponentially increasing, randomly jittered delay, such that clients
+don't retry in lockstep and keep an overloaded server overloaded. The
+delay for a given attempt is provided by `backoff`, which should also be
+used by anything retrying operations built atop this interface.
+
+All clients of the same CouchDB server share a `CircuitBreaker` (per
+`get_circuit_breaker`). After a number of consecutive failures, the
+breaker opens and requests fail fast, raising `CouchDBCircuitOpen`,
+until the reset timeout has elapsed. A single trial request is then let
+through: if it succeeds, the breaker closes; otherwise it opens again.
+`CouchDBCircuitOpen` carries the time until the next trial in its
+`retry_after` attribute (in seconds). Breaker state transitions are
+logged.
+
 Environmental Factors
 ---------------------
 This CouchDB interface is designed to be more resilient to server
 problems, when used in anger, such that data doesn't get lost. This is
 parametrised through the following environment variables:
 
-Environment Variable          | Description                    | Default
-------------------------------+--------------------------------+--------
-COOKIEMONSTER_COUCHDB_GRACE   | Grace time before retry (ms)   |    1000
-COOKIEMONSTER_COUCHDB_RETRIES | Maximum retries before failure |       0
+Environment Variable                    | Description                          | Default
+----------------------------------------+--------------------------------------+--------
+COOKIEMONSTER_COUCHDB_GRACE             | Initial grace time before retry (ms) |    1000
+COOKIEMONSTER_COUCHDB_MAX_GRACE         | Maximum grace time before retry (ms) |   60000
+COOKIEMONSTER_COUCHDB_RETRIES           | Maximum retries before failure       |       0
+COOKIEMONSTER_COUCHDB_BREAKER_THRESHOLD | Consecutive failures to open circuit |       5
+COOKIEMONSTER_COUCHDB_BREAKER_RESET     | Time before circuit trial (ms)       |   30000
 
-n.b., Zero retries means never give up.
+n.b., Zero retries means never give up (although requests will still
+fail fast while the circuit is open).
 
 Dependencies
 ------------
@@ -89,20 +137,30 @@ STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
 ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE.
 """
+import codecs
+import json
 import logging
+import re
 from datetime import timedelta
 from os import environ
-from time import sleep
-from typing import Optional
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional
 
 # NOTE We rely on undocumented APIs within the base library, hence this
 # is fragile wrt version changes...
 import pycouchdb
+import requests
+from requests.adapters import HTTPAdapter
 
 # We get the CouchDB hammering configuration from the environment, as we
 # don't want to have to explicitly set every last little thing.
-_COUCHDB_GRACE   = timedelta(milliseconds=int(environ.get('COOKIEMONSTER_COUCHDB_GRACE', 1000))).total_seconds()
-_COUCHDB_RETRIES = int(environ.get('COOKIEMONSTER_COUCHDB_RETRIES', 0))
+_COUCHDB_GRACE             = timedelta(milliseconds=int(environ.get('COOKIEMONSTER_COUCHDB_GRACE', 1000))).total_seconds()
+_COUCHDB_MAX_GRACE         = timedelta(milliseconds=int(environ.get('COOKIEMONSTER_COUCHDB_MAX_GRACE', 60000))).total_seconds()
+_COUCHDB_RETRIES           = int(environ.get('COOKIEMONSTER_COUCHDB_RETRIES', 0))
+_COUCHDB_BREAKER_THRESHOLD = int(environ.get('COOKIEMONSTER_COUCHDB_BREAKER_THRESHOLD', 5))
+_COUCHDB_BREAKER_RESET     = timedelta(milliseconds=int(environ.get('COOKIEMONSTER_COUCHDB_BREAKER_RESET', 30000))).total_seconds()
 
 
 class UnresponsiveCouchDB(Exception):
@@ -110,43 +168,314 @@ class UnresponsiveCouchDB(Exception):
     pass
 
 
+class CouchDBCircuitOpen(UnresponsiveCouchDB):
+    """ Failing fast, while the circuit to the database is open """
+    def __init__(self, retry_after:float):
+        """
+        @param   retry_after  Time until the circuit will let a trial
+                              request through (seconds)
+        """
+        super().__init__('Circuit open; retry after {:.1f}s'.format(retry_after))
+        self.retry_after = retry_after
+
+
 class InvalidCouchDBKey(Exception):
     """ Invalid (i.e., prefixed with an underscore) key exception """
     pass
 
 
+def backoff(attempt:int, error:Optional[BaseException] = None) -> float:
+    """
+    Get the time to wait before retrying a failed operation: Capped
+    exponential backoff, with full jitter; or, if the failure was due to
+    the circuit being open, until its trial request (plus jitter, so
+    waiting clients don't all try at once)
+
+    @param   attempt  Number of consecutive failed attempts (from 1)
+    @param   error    Exception raised by the failed attempt
+    @return  Delay before retrying (seconds)
+    """
+    if isinstance(error, CouchDBCircuitOpen):
+        return error.retry_after + uniform(0, _COUCHDB_GRACE)
+
+    return uniform(0, min(_COUCHDB_MAX_GRACE, _COUCHDB_GRACE * 2 ** max(attempt - 1, 0)))
+
+
+class CircuitBreaker(object):
+    """ Circuit breaker for requests to a CouchDB server """
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name:str, threshold:Optional[int] = None, reset_timeout:Optional[float] = None):
+        """
+        @param   name           Name to log state transitions with
+        @param   threshold      Consecutive failures to open the circuit
+        @param   reset_timeout  Time before a trial request (seconds)
+        """
+        self._name = name
+        self._threshold = threshold or _COUCHDB_BREAKER_THRESHOLD
+        self._reset_timeout = _COUCHDB_BREAKER_RESET if reset_timeout is None else reset_timeout
+
+        self._lock = Lock()
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trialling = False
+        self._trial_started_at = 0.0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def _transition(self, state:str):
+        """ Change state and log it (call with the lock held) """
+        if state != self._state:
+            log = logging.warning if state == CircuitBreaker.OPEN else logging.info
+            log('Circuit to %s is %s (was %s)', self._name, state, self._state)
+            self._state = state
+
+    def allow(self) -> Optional[float]:
+        """
+        Check whether a request may be made
+
+        @return  None, if it may; otherwise the time until a trial
+                 request will be let through (seconds)
+        """
+        with self._lock:
+            if self._state == CircuitBreaker.CLOSED:
+                return None
+
+            now = monotonic()
+
+            if self._state == CircuitBreaker.OPEN:
+                if now < self._opened_at + self._reset_timeout:
+                    return self._opened_at + self._reset_timeout - now
+
+                self._transition(CircuitBreaker.HALF_OPEN)
+
+            # Let a single trial request through, unless one is already
+            # in flight (we give up on it if it doesn't come back)
+            if not self._trialling or now >= self._trial_started_at + self._reset_timeout:
+                self._trialling = True
+                self._trial_started_at = now
+                return None
+
+            return self._trial_started_at + self._reset_timeout - now
+
+    def succeeded(self):
+        """ Record a request that got a response """
+        with self._lock:
+            self._failures = 0
+            self._trialling = False
+            self._transition(CircuitBreaker.CLOSED)
+
+    def failed(self):
+        """ Record a failed request """
+        with self._lock:
+            self._failures += 1
+
+            if self._state == CircuitBreaker.HALF_OPEN or self._failures >= self._threshold:
+                self._opened_at = monotonic()
+                self._trialling = False
+                self._transition(CircuitBreaker.OPEN)
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = Lock()
+
+def get_circuit_breaker(url:str) -> CircuitBreaker:
+    """
+    Get the circuit breaker shared by all clients of a CouchDB server
+
+    @param   url  CouchDB server URL (without credentials)
+    @return  Circuit breaker
+    """
+    key = url.rstrip('/')
+    with _circuit_breakers_lock:
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = CircuitBreaker(key)
+
+        return _circuit_breakers[key]
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class _StreamedRows(object):
+    """
+    Incremental parser of the rows of a view response, such that they
+    can be consumed as they arrive, rather than after the whole response
+    has been buffered and parsed
+    """
+    def __init__(self, chunks:Iterable[bytes]):
+        """
+        @param   chunks  Response body chunks
+        """
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+        self._exhausted = False
+
+    def _fill(self) -> bool:
+        """
+        Read the next chunk into the buffer, dropping what has already
+        been consumed
+
+        @return  Whether there was another chunk
+        """
+        if self._exhausted:
+            return False
+
+        try:
+            text = self._text_decoder.decode(next(self._chunks))
+        except StopIteration:
+            text = self._text_decoder.decode(b'', final=True)
+            self._exhausted = True
+
+        self._buffer = self._buffer[self._position:] + text
+        self._position = 0
+        return not self._exhausted or len(text) > 0
+
+    def _peek(self) -> str:
+        """ Get the next non-whitespace character (empty at the end) """
+        while True:
+            self._position = _WHITESPACE.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+
+            if not self._fill():
+                return ''
+
+    def _expect(self, expected:str) -> str:
+        """ Consume the next non-whitespace character, which is expected """
+        char = self._peek()
+        if not char or char not in expected:
+            raise ValueError('Expected one of "{}" in view response, not "{}"'.format(expected, char))
+
+        self._position += 1
+        return char
+
+    def _value(self) -> Any:
+        """ Decode the next JSON value """
+        self._peek()
+
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._position)
+
+            except json.JSONDecodeError:
+                if self._exhausted:
+                    raise
+
+                # Read until the unconsumed buffer has doubled, so large
+                # values aren't reparsed for every chunk
+                target = 2 * (len(self._buffer) - self._position)
+                while len(self._buffer) - self._position < target and self._fill():
+                    pass
+
+                continue
+
+            # Scalars at the end of the buffer may be truncated
+            if end < len(self._buffer) or self._exhausted:
+                self._position = end
+                return value
+
+            self._fill()
+
+    def __iter__(self) -> Generator:
+        self._expect('{')
+        if self._peek() == '}':
+            return
+
+        while True:
+            key = self._value()
+            self._expect(':')
+
+            if key == 'rows':
+                self._expect('[')
+                if self._peek() == ']':
+                    self._position += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+
+            else:
+                # e.g., total_rows and offset
+                self._value()
+
+            if self._expect(',}') == '}':
+                return
+
+
 class _SofterResource(pycouchdb.resource.Resource):
     """
     Reimplementation of pycouchdb.resource.Resource such that requests
     are gracefully retried up until some limit
     """
+    def __init__(self, *args, circuit_breaker:Optional[CircuitBreaker] = None, **kwargs):
+        """
+        Override constructor to take the server's circuit breaker
+        """
+        super().__init__(*args, **kwargs)
+        self.circuit_breaker = circuit_breaker or get_circuit_breaker(self.base_url)
+
+    def __call__(self, *path):
+        """
+        Override child resource creation to share the circuit breaker
+        Modified from pycouchdb.resource.Resource.__call__
+        """
+        base_url = pycouchdb.utils.urljoin(self.base_url, *path)
+        return self.__class__(base_url, session=self.session, circuit_breaker=self.circuit_breaker)
+
+    def _check_result(self, response, result):
+        """
+        Override result checking to parse the errors of streamed
+        responses, which would otherwise all be generic
+        Modified from pycouchdb.resource.Resource._check_result
+        """
+        if result is None and response.status_code > 205:
+            result = pycouchdb.utils.as_json(response)
+
+        super()._check_result(response, result)
+
     def _keep_trying(self, method:str, path:Optional[str]=None, **kwargs):
         """ Keep requesting in the event of an unknown failure """
-        good_response = False
         attempts = 0
 
-        while not good_response and (_COUCHDB_RETRIES == 0 or attempts < _COUCHDB_RETRIES):
+        while True:
+            retry_after = self.circuit_breaker.allow()
+            if retry_after is not None:
+                raise CouchDBCircuitOpen(retry_after)
+
             try:
                 response = self.request(method, path, **kwargs)
-                good_response = True
 
-            except (pycouchdb.exceptions.NotFound, pycouchdb.exceptions.BadRequest):
-                # This is a genuine problem, so just reraise
+            except (pycouchdb.exceptions.NotFound, pycouchdb.exceptions.BadRequest, pycouchdb.exceptions.Conflict):
+                # This is a genuine problem, so just reraise (but the
+                # server is evidently responsive)
+                self.circuit_breaker.succeeded()
                 raise
 
-            except pycouchdb.exceptions.GenericError:
+            except (pycouchdb.exceptions.GenericError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                 # This could be due to some kind of transient
                 # server/network failure, so retry
-                logging.exception('%s request to %s failed!! Retrying...', method, path)
-
+                self.circuit_breaker.failed()
                 attempts += 1
-                sleep(_COUCHDB_GRACE)
 
-        if not good_response:
-            logging.error('Could not make %s request to %s!!', method, path)
-            raise UnresponsiveCouchDB
+                if _COUCHDB_RETRIES and attempts >= _COUCHDB_RETRIES:
+                    logging.error('Could not make %s request to %s!!', method, path)
+                    raise UnresponsiveCouchDB
 
-        return response
+                logging.warning('%s request to %s failed (attempt %d)!! Retrying...', method, path, attempts, exc_info=True)
+                sleep(backoff(attempts))
+
+            else:
+                self.circuit_breaker.succeeded()
+                return response
 
     def get(self, path:Optional[str] = None, **kwargs):
         """
@@ -184,6 +513,52 @@ class _SofterResource(pycouchdb.resource.Resource):
         return self._keep_trying('HEAD', path, **kwargs)
 
 
+class _CountingAdapter(HTTPAdapter):
+    """
+    HTTP adapter that counts the requests sent through it and the
+    connections opened to send them
+    """
+    def __init__(self, *args, **kwargs):
+        self._count_lock = Lock()
+        self.requests = 0
+        self.connections = 0
+        super().__init__(*args, **kwargs)
+
+    def _count_connection(self):
+        with self._count_lock:
+            self.connections += 1
+
+    def init_poolmanager(self, *args, **kwargs):
+        """
+        Override the pool manager initialiser to use connection pools
+        whose connections are counted (this only affects this adapter)
+        """
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        def counting_pool(base):
+            class _Connection(base.ConnectionCls):
+                def connect(self):
+                    adapter._count_connection()
+                    super().connect()
+
+            class _ConnectionPool(base):
+                ConnectionCls = _Connection
+
+            return _ConnectionPool
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: counting_pool(pool_class)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def send(self, *args, **kwargs):
+        with self._count_lock:
+            self.requests += 1
+
+        return super().send(*args, **kwargs)
+
+
 class _SofterServer(pycouchdb.client.Server):
     """
     Reimplementation of pycouchdb.client.Server using _SofterResource
@@ -198,7 +573,8 @@ class _SofterServer(pycouchdb.client.Server):
                                         full_commit,
                                         credentials=credentials,
                                         authmethod=authmethod,
-                                        verify=verify)
+                                        verify=verify,
+                                        circuit_breaker=get_circuit_breaker(self.base_url))
 
 
 class SofterCouchDB(object):
@@ -209,12 +585,19 @@ class SofterCouchDB(object):
     at runtime, to avoid too many layers of metaprogramming! For
     convenience sake, only the methods that we use have been specified.
     """
-    def __init__(self, url:str, database:str, **kwargs):
+    def __init__(self, url:str, database:str, max_connections:int = 10,
+                                              pool_block:bool = False,
+                                              keep_alive:bool = True,
+                                              **kwargs):
         """
         Acquire a connection with the CouchDB database
 
-        @param   url       CouchDB server URL
-        @param   database  Database name
+        @param   url              CouchDB server URL
+        @param   database         Database name
+        @param   max_connections  Maximum number of pooled connections
+        @param   pool_block       Wait for a pooled connection to become
+                                  free, rather than opening another
+        @param   keep_alive       Keep connections open between requests
         @kwargs  Additional constructor parameters to
                  pycouchdb.client.Server should be passed through here
         """
@@ -227,18 +610,56 @@ class SofterCouchDB(object):
             **kwargs
         })
 
+        # Configure the connection pool of this client's session only,
+        # rather than patching the defaults for the whole process
+        session = self._server.resource.session
+        self._adapter = _CountingAdapter(pool_maxsize=max_connections, pool_block=pool_block)
+        session.mount('http://', self._adapter)
+        session.mount('https://', self._adapter)
+
+        if not keep_alive:
+            session.headers.update({'Connection': 'close'})
+
         # Connect to the database
         try:
             self._db = self._server.database(database)
         except pycouchdb.exceptions.NotFound:
             self._db = self._server.create(database)
 
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        return self._server.resource.circuit_breaker
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Get the connection pool's usage statistics
+
+        @return  Dictionary of the number of `requests` made, the number
+                 of `connections` opened and, hence, the number of
+                 requests that `reused` a connection
+        """
+        requests, connections = self._adapter.requests, self._adapter.connections
+
+        return {
+            'requests':    requests,
+            'connections': connections,
+            'reused':      max(requests - connections, 0)
+        }
+
     # Exposed pycouchdb.client.Database methods
-    # all delete delete_bulk get query revisions save save_bulk
+    # all changes_list config delete delete_bulk get query revisions
+    # save save_bulk
+    # ...plus query_stream and try_save_bulk
 
     def all(self, *args, **kwargs):
         return self._db.all(*args, **kwargs)
 
+    def changes_list(self, *args, **kwargs):
+        return self._db.changes_list(*args, **kwargs)
+
+    def config(self, *args, **kwargs):
+        return self._db.config(*args, **kwargs)
+
     def delete(self, *args, **kwargs):
         return self._db.delete(*args, **kwargs)
     
@@ -250,6 +671,44 @@ class SofterCouchDB(object):
     
     def query(self, *args, **kwargs):
         return self._db.query(*args, **kwargs)
+
+    def query_stream(self, name:str, wrapper:Optional[Callable[[dict], Any]] = None,
+                                     flat:Optional[str] = None,
+                                     chunk_size:int = 65536,
+                                     **kwargs) -> Generator:
+        """
+        Query a view, parsing the rows of the response as they arrive
+        Modified from pycouchdb.client.Database.query
+
+        @param   name        View name (i.e., design/view)
+        @param   wrapper     Wrapper function applied over result rows
+        @param   flat        Member of the result rows to get, instead
+        @param   chunk_size  Size of the chunks the response is read in
+        @kwargs  Query string options for CouchDB
+        @return  Results generator
+        """
+        params = dict(kwargs)
+        data = None
+        if 'keys' in params:
+            data = pycouchdb.utils.force_bytes(pycouchdb.utils.to_json({'keys': params.pop('keys')}))
+
+        params = pycouchdb.utils.encode_view_options(params)
+        resource = self._db.resource(*pycouchdb.utils._path_from_name(name, '_view'))
+
+        if data is None:
+            response, _ = resource.get(params=params, stream=True)
+        else:
+            response, _ = resource.post(data=data, params=params, stream=True)
+
+        if flat is not None:
+            wrapper = lambda row: row[flat]
+
+        try:
+            for row in _StreamedRows(response.iter_content(chunk_size)):
+                yield row if wrapper is None else wrapper(row)
+
+        finally:
+            response.close()
     
     def revisions(self, *args, **kwargs):
         return self._db.revisions(*args, **kwargs)
@@ -259,3 +718,27 @@ class SofterCouchDB(object):
     
     def save_bulk(self, *args, **kwargs):
         return self._db.save_bulk(*args, **kwargs)
+
+    def try_save_bulk(self, docs:List[dict]) -> List[Optional[dict]]:
+        """
+        Save documents in bulk, with each document's revision checked
+        individually, rather than failing the whole request on conflict
+
+        @param   docs  Documents (with the revision they were read at)
+        @return  The saved documents, with their new revisions, or None
+                 for each document that conflicted
+        """
+        data = pycouchdb.utils.force_bytes(pycouchdb.utils.to_json({'docs': docs}))
+
+        # Conflicts are reported per document, which pycouchdb would
+        # raise unless the response is streamed
+        response, _ = self._db.resource.post('_bulk_docs', data=data, stream=True)
+        try:
+            results = response.json()
+        finally:
+            response.close()
+
+        return [
+            None if 'error' in result else {**doc, '_id': result['id'], '_rev': result['rev']}
+            for doc, result in zip(docs, results)
+        ]
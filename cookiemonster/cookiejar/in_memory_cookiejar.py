@@ -23,26 +23,34 @@ You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import time
-from collections import defaultdict
+from collections import OrderedDict
 from datetime import timedelta
-from multiprocessing import Lock
-from threading import Timer
-from typing import Any, Optional, List, Dict
+from enum import Enum
+from heapq import heappop, heappush
+from itertools import count
+from threading import Lock, Timer
+from typing import Optional, List, Dict, Iterable, Set, Tuple
 
 from cookiemonster.common.collections import EnrichmentCollection
 from cookiemonster.common.models import Cookie, Enrichment
 from cookiemonster.cookiejar import CookieJar
 
 
-def _remove_if_exists(lst:List, el:Any):
-    """ Remove first appearance of el from lst, if exists """
-    if el in lst:
-        lst.remove(el)
+class _State(Enum):
+    """ Enumeration of the queue states of a Cookie """
+    Waiting = 1
+    Processing = 2
+    Failed = 3
+    Completed = 4
 
 
 class InMemoryCookieJar(CookieJar):
     """
     In memory implementation of a `CookieJar`.
+
+    Each Cookie's queue state is kept by its identifier, with the Cookies waiting to be processed in an ordered
+    dictionary and delayed requeues in a heap, such that every state transition takes constant (or, for delayed
+    requeues, logarithmic) time.
     """
     def __init__(self):
         """
@@ -50,99 +58,91 @@ class InMemoryCookieJar(CookieJar):
         """
         super().__init__()
         self._known_data = dict()   # type: Dict[str, Cookie]
-        self._processing = []   # type: List[str]
-        self._waiting = []  # type: List[str]
-        self._failed = []   # type: List[str]
-        self._completed = []    # type: List[str]
-        self._reprocess_on_complete = []    # type: List[str]
-        self._delete_on_complete = []    # type: List[str]
-        self._lists_lock = Lock()
-        self._timers = defaultdict(list)   # type: Dict[int, List[Timer]]
+        self._states = dict()   # type: Dict[str, _State]
+        self._waiting = OrderedDict()   # type: OrderedDict[str, None]
+        self._reprocess_on_complete = set()    # type: Set[str]
+        self._delete_on_complete = set()    # type: Set[str]
+        self._lock = Lock()
+
+        # Delayed requeues, as (end time, sequence number, identifier), of which only those whose sequence number is
+        # still current for their identifier are due
+        self._delayed = []  # type: List[Tuple[float, int, str]]
+        self._requeue_sequence = dict()    # type: Dict[str, int]
+        self._sequence = count()
+        self._requeue_timer = None  # type: Optional[Timer]
+        self._requeue_timer_end_time = None    # type: Optional[float]
 
     def fetch_cookie(self, identifier: str) -> Optional[Cookie]:
-        with self._lists_lock:
+        with self._lock:
             return self._known_data.get(identifier, None)
 
     def delete_cookie(self, identifier: str):
-        with self._lists_lock:
-            if identifier in self._known_data:
-                if identifier in self._processing:
-                    self._known_data[identifier].enrichments = EnrichmentCollection()
-                    self._delete_on_complete.append(identifier)
-                else:
-                    self._cleanup(identifier)
+        with self._lock:
+            self._delete(identifier)
+
+    def delete_cookies(self, identifiers: Iterable[str]):
+        with self._lock:
+            for identifier in identifiers:
+                self._delete(identifier)
+
+    def delete_by_prefix(self, prefix: str) -> int:
+        with self._lock:
+            identifiers = [identifier for identifier in self._known_data if identifier.startswith(prefix)]
+            for identifier in identifiers:
+                self._delete(identifier)
+        return len(identifiers)
 
     def enrich_cookie(self, identifier: str, enrichment: Enrichment, mark_for_processing: bool=True):
-        with self._lists_lock:
-            if identifier not in self._known_data:
-                self._known_data[identifier] = Cookie(identifier)
+        with self._lock:
+            self._get_or_create(identifier).enrichments.add(enrichment)
+            notify = mark_for_processing and self._enqueue(identifier)
 
-        self._known_data[identifier].enrichments.add(enrichment)
-        if mark_for_processing:
-            self.mark_for_processing(identifier)
+        if notify:
+            self.notify_listeners()
 
     def mark_as_failed(self, identifier: str, requeue_delay: timedelta=timedelta(0)):
-        if identifier not in self._known_data:
-            raise ValueError("Not known: %s" % identifier)
-        with self._lists_lock:
-            self._assert_is_being_processed(identifier)
-            self._processing.remove(identifier)
-            self._failed.append(identifier)
-
-        if requeue_delay is not None:
-            if requeue_delay.total_seconds() == 0:
-                self._reprocess(identifier)
-            else:
-                end_time = self._get_time() + requeue_delay.total_seconds()
+        with self._lock:
+            self._finish(identifier, _State.Failed)
 
-                def on_delay_end():
-                    if timer in self._timers[end_time]:
-                        self._timers[end_time].remove(timer)
-                        self._reprocess(identifier)
+            if requeue_delay is None:
+                notify = self._on_complete(identifier)
+            elif requeue_delay.total_seconds() == 0:
+                notify = self._enqueue(identifier)
+            else:
+                self._schedule_requeue(identifier, requeue_delay.total_seconds())
+                notify = False
 
-                timer = Timer(requeue_delay.total_seconds(), on_delay_end)
-                self._timers[end_time].append(timer)
-                timer.start()
-        else:
-            self._on_complete(identifier)
+        if notify:
+            self.notify_listeners()
 
     def mark_as_complete(self, identifier: str):
-        if identifier not in self._known_data:
-            raise ValueError("Not known: %s" % identifier)
-        with self._lists_lock:
-            self._assert_is_being_processed(identifier)
-            self._processing.remove(identifier)
-            self._completed.append(identifier)
-        self._on_complete(identifier)
+        with self._lock:
+            self._finish(identifier, _State.Completed)
+            notify = self._on_complete(identifier)
+
+        if notify:
+            self.notify_listeners()
 
     def mark_for_processing(self, identifier: str):
-        if identifier not in self._known_data:
-            self._known_data[identifier] = Cookie(identifier)
-
-        notify = True
-        with self._lists_lock:
-            if identifier in self._completed:
-                self._completed.remove(identifier)
-            if identifier in self._processing:
-                if identifier not in self._reprocess_on_complete:
-                    self._reprocess_on_complete.append(identifier)
-                notify = False
-            elif identifier not in self._waiting:
-                self._waiting.append(identifier)
+        with self._lock:
+            self._get_or_create(identifier)
+            notify = self._enqueue(identifier)
 
         if notify:
             self.notify_listeners()
 
     def get_next_for_processing(self) -> Optional[Cookie]:
-        with self._lists_lock:
+        self._requeue_due()
+
+        with self._lock:
             if len(self._waiting) == 0:
                 return None
-            identifier = self._waiting.pop(0)
-            self._processing.append(identifier)
-            self._assert_is_being_processed(identifier)
-        return self._known_data[identifier]
+            identifier, _ = self._waiting.popitem(last=False)
+            self._states[identifier] = _State.Processing
+            return self._known_data[identifier]
 
     def queue_length(self) -> int:
+        self._requeue_due()
         return len(self._waiting)
 
     def _get_time(self) -> int:
@@ -152,38 +152,141 @@ class InMemoryCookieJar(CookieJar):
         """
         return time.monotonic()
 
-    def _reprocess(self, identifier: str):
+    def _get_or_create(self, identifier: str) -> Cookie:
+        """
+        Gets the Cookie with the given identifier, creating it if it is not known. Must be called with the lock held.
+        :param identifier: the Cookie's identifier
+        :return: the Cookie
+        """
+        cookie = self._known_data.get(identifier)
+        if cookie is None:
+            cookie = Cookie(identifier)
+            self._known_data[identifier] = cookie
+        return cookie
+
+    def _enqueue(self, identifier: str) -> bool:
         """
-        Reprocess Cookie with the given identifier where processing has previously failed.
-        :param identifier: identifier of cookie to reprocess
+        Puts the Cookie with the given identifier up for processing or, if it is currently being processed, marks it
+        for reprocessing once it is complete. Must be called with the lock held.
+        :param identifier: identifier of the Cookie
+        :return: whether listeners should be notified of the change
         """
-        with self._lists_lock:
-            self._failed.remove(identifier)
-        self.mark_for_processing(identifier)
+        state = self._states.get(identifier)
+        if state == _State.Processing:
+            self._reprocess_on_complete.add(identifier)
+            return False
+
+        # Any delayed requeue is superseded
+        self._requeue_sequence.pop(identifier, None)
+        self._reprocess_on_complete.discard(identifier)
+        if state != _State.Waiting:
+            self._waiting[identifier] = None
+            self._states[identifier] = _State.Waiting
+        return True
+
+    def _finish(self, identifier: str, state: _State):
+        """
+        Moves the Cookie with the given identifier out of processing, into the given state. Must be called with the lock
+        held.
+        :param identifier: identifier of the Cookie
+        :param state: the state the Cookie is left in
+        """
+        if identifier not in self._known_data:
+            raise ValueError("Not known: %s" % identifier)
+        self._assert_is_being_processed(identifier)
+        self._states[identifier] = state
+
+    def _delete(self, identifier: str):
+        """
+        Deletes the Cookie with the given identifier or, if it is currently being processed, clears its enrichments and
+        deletes it once it is complete. Must be called with the lock held.
+        :param identifier: identifier of the Cookie
+        """
+        if identifier in self._known_data:
+            if self._states.get(identifier) == _State.Processing:
+                self._known_data[identifier].enrichments = EnrichmentCollection()
+                self._delete_on_complete.add(identifier)
+            else:
+                self._cleanup(identifier)
+
+    def _schedule_requeue(self, identifier: str, delay: float):
+        """
+        Schedules the failed Cookie with the given identifier to be requeued after the given delay. Must be called with
+        the lock held.
+        :param identifier: identifier of the Cookie
+        :param delay: the delay (in seconds)
+        """
+        sequence = next(self._sequence)
+        self._requeue_sequence[identifier] = sequence
+        heappush(self._delayed, (self._get_time() + delay, sequence, identifier))
+        self._arm_requeue_timer()
+
+    def _arm_requeue_timer(self):
+        """
+        Sets the timer to go off when the earliest delayed requeue is due, replacing any timer set for later. Must be
+        called with the lock held.
+        """
+        if len(self._delayed) == 0:
+            return
+        end_time = self._delayed[0][0]
+        if self._requeue_timer is not None:
+            if self._requeue_timer_end_time <= end_time:
+                return
+            self._requeue_timer.cancel()
+
+        self._requeue_timer = Timer(max(end_time - self._get_time(), 0), self._requeue_due)
+        self._requeue_timer.daemon = True
+        self._requeue_timer_end_time = end_time
+        self._requeue_timer.start()
+
+    def _requeue_due(self):
+        """
+        Requeues the failed Cookies whose requeue delay has ended.
+        """
+        requeued = 0
+        with self._lock:
+            now = self._get_time()
+            while len(self._delayed) > 0 and self._delayed[0][0] <= now:
+                _, sequence, identifier = heappop(self._delayed)
+                if self._requeue_sequence.get(identifier) == sequence:
+                    del self._requeue_sequence[identifier]
+                    if self._enqueue(identifier):
+                        requeued += 1
+
+            # The timer has (or should have) gone off
+            if self._requeue_timer is not None and self._requeue_timer_end_time <= now:
+                self._requeue_timer.cancel()
+                self._requeue_timer = None
+            self._arm_requeue_timer()
+
+        for _ in range(requeued):
+            self.notify_listeners()
 
     def _cleanup(self, identifier: str):
         """
-        Clean up the queue state of a deleted in-progress Cookie
+        Clean up the queue state of a deleted in-progress Cookie. Must be called with the lock held.
         :param identifier: identifier of cookie to cleanup
         """
-        _remove_if_exists(self._processing, identifier)
-        _remove_if_exists(self._waiting, identifier)
-        _remove_if_exists(self._failed, identifier)
-        _remove_if_exists(self._completed, identifier)
-        _remove_if_exists(self._reprocess_on_complete, identifier)
-        _remove_if_exists(self._delete_on_complete, identifier)
+        self._states.pop(identifier, None)
+        self._waiting.pop(identifier, None)
+        self._requeue_sequence.pop(identifier, None)
+        self._reprocess_on_complete.discard(identifier)
+        self._delete_on_complete.discard(identifier)
         del self._known_data[identifier]
 
-    def _on_complete(self, identifier: str):
-        reprocess = False
-        with self._lists_lock:
-            if identifier in self._delete_on_complete:
-                self._cleanup(identifier)
-            if identifier in self._reprocess_on_complete:
-                self._reprocess_on_complete.remove(identifier)
-                reprocess = True
-        if reprocess:
-            self.mark_for_processing(identifier)
+    def _on_complete(self, identifier: str) -> bool:
+        """
+        Deletes or reprocesses the Cookie with the given identifier, if either was requested while it was being
+        processed. Must be called with the lock held.
+        :param identifier: identifier of the Cookie
+        :return: whether listeners should be notified of the change
+        """
+        if identifier in self._delete_on_complete:
+            self._cleanup(identifier)
+            return False
+        if identifier in self._reprocess_on_complete:
+            return self._enqueue(identifier)
+        return False
 
     def _assert_is_being_processed(self, identifier: str):
         """
@@ -191,7 +294,5 @@ class InMemoryCookieJar(CookieJar):
         :param identifier: the file's identifier
         """
         assert identifier in self._known_data
-        assert identifier in self._processing
-        assert identifier not in self._completed
-        assert identifier not in self._failed
+        assert self._states.get(identifier) == _State.Processing
         assert identifier not in self._waiting
@@ -32,6 +32,8 @@ from cookiemonster.logging.injector import LoggingContext, RuntimeLogging, Loggi
 MEASUREMENT_QUERY_TIME = {
     CookieJar.fetch_cookie.__name__: "fetch_cookie_time",
     CookieJar.delete_cookie.__name__: "delete_cookie_time",
+    CookieJar.delete_cookies.__name__: "delete_cookies_time",
+    CookieJar.delete_by_prefix.__name__: "delete_by_prefix_time",
     CookieJar.enrich_cookie.__name__: "enrich_cookie_time",
     CookieJar.mark_as_failed.__name__: "mark_as_failed_time",
     CookieJar.mark_as_complete.__name__: "mark_as_complete_time",
@@ -0,0 +1,120 @@
+"""
+Queue Document Migration
+========================
+Migrate the queue documents of a `BiscuitTin` database that predate
+queue document IDs being derived from file identifiers, such that they
+can be fetched directly, rather than looked up through a view
+
+Exportable functions: `migrate_queue_documents`
+
+migrate_queue_documents
+-----------------------
+Rewrite each queue document without a derived ID to one with it, then
+delete the original. If a document with the derived ID already exists,
+it is kept and the original is just deleted. Migration is idempotent,
+so an interrupted migration can be resumed by running it again.
+
+No `BiscuitTin` should be using the database while it's being migrated.
+Like starting a `BiscuitTin`, migration will reset the queue state of
+any files that were being processed.
+
+It can be run from the command line with:
+
+    python -m cookiemonster.cookiejar.migration --couchdb-url URL --couchdb-name NAME
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+from argparse import ArgumentParser
+
+from cookiemonster.cookiejar.biscuit_tin import _Bert, get_queue_document_id
+from cookiemonster.cookiejar.couchdb import Sofabed
+from cookiemonster.cookiejar.couchdb.softer import SofterCouchDB
+
+
+def migrate_queue_documents(couchdb_url:str, couchdb_name:str, batch_size:int = 1000, **kwargs) -> int:
+    """
+    Migrate the queue documents without derived IDs
+
+    @param   couchdb_url   CouchDB URL
+    @param   couchdb_name  Database name
+    @param   batch_size    Number of documents to migrate per request
+    @kwargs  Additional constructor parameters to
+             pycouchdb.client.Server should be passed through here
+    @return  Number of documents migrated
+    """
+    # Bringing up the queue management interface defines the views
+    sofa = Sofabed(couchdb_url, couchdb_name, **kwargs)
+    _Bert(sofa)
+
+    db = SofterCouchDB(couchdb_url, couchdb_name, **kwargs)
+    migrated = 0
+
+    while True:
+        legacy_docs = list(sofa.query('queue', 'legacy', flat         = 'doc',
+                                                         include_docs = True,
+                                                         reduce       = False,
+                                                         limit        = batch_size))
+        if not legacy_docs:
+            break
+
+        # Documents with a derived ID take precedence (as does the first
+        # of any duplicates in the batch)
+        derived_ids = {get_queue_document_id(doc['identifier']) for doc in legacy_docs}
+        existing_ids = {
+            row['id']
+            for row in db.all(keys=list(derived_ids), include_docs=False)
+            if 'error' not in row and not row['value'].get('deleted')
+        }
+
+        to_save = {}
+        for doc in legacy_docs:
+            derived_id = get_queue_document_id(doc['identifier'])
+            if derived_id not in existing_ids and derived_id not in to_save:
+                to_save[derived_id] = {
+                    **{key: value for key, value in doc.items() if not key.startswith('_')},
+                    '_id': derived_id
+                }
+
+        # Save before deleting, so nothing is lost if interrupted
+        if to_save:
+            db.save_bulk(list(to_save.values()))
+        db.delete_bulk(legacy_docs)
+
+        migrated += len(legacy_docs)
+        logging.info('Migrated %d queue documents', migrated)
+
+    return migrated
+
+
+def main():
+    parser = ArgumentParser(description="Migrate a BiscuitTin database's queue documents to derived IDs")
+    parser.add_argument("--couchdb-url", required=True, help="URL of the CouchDB server")
+    parser.add_argument("--couchdb-name", required=True, help="Name of the database to migrate")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of documents to migrate per request")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    migrated = migrate_queue_documents(arguments.couchdb_url, arguments.couchdb_name, arguments.batch_size)
+    print("Migrated %d queue documents" % migrated)
+
+
+if __name__ == "__main__":
+    main()
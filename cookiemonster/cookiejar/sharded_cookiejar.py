@@ -0,0 +1,347 @@
+"""
+Sharded Cookie Jar
+==================
+An implementation of `CookieJar` that partitions files across several
+underlying Cookie Jars (e.g., `BiscuitTin`s on different databases or
+servers), such that no one database has to hold (and index) them all
+
+Exportable classes: `HashRing`, `ShardedCookieJar`
+Exportable functions: `rebalance_shards`
+
+HashRing
+--------
+Consistent hash of file identifiers onto named shards. Each shard is
+placed on the ring at a number of pseudo-random points (its replicas)
+and a file belongs to the shard at the first point after the hash of
+its identifier. Adding or removing a shard thus only moves the files
+between it and its neighbours (i.e., about 1/N of them), rather than
+reshuffling everything.
+
+ShardedCookieJar
+----------------
+`ShardedCookieJar` implements the interface decreed by `CookieJar` over
+a dictionary of named shards. Operations on a single file are routed to
+the shard it hashes to; those over many files are split by shard and
+made against each shard in parallel.
+
+To get the next Cookie for processing, the heads of the shards' queues
+are looked up in parallel (see `CookieJar.next_queued_from`) and the
+Cookie is dequeued from the shard whose head was queued first, falling
+back to the next, should it have been taken in the meantime. The queue
+is thus (approximately) processed in the same order as it would be by a
+single Cookie Jar.
+
+Listeners are notified of queue changes to any shard. Shard names, not
+their order, determine where files belong, so they must be kept stable.
+
+rebalance_shards
+----------------
+Move the files of a set of `BiscuitTin` databases, after adding or
+removing a shard, to where they now hash. Each misplaced file's
+enrichments and queue state are copied to its new shard, before it is
+deleted from the old one, a batch at a time. Rebalancing is idempotent,
+so an interrupted rebalancing can be resumed by running it again.
+
+No `BiscuitTin` should be using the databases while they're being
+rebalanced. It can be run from the command line with:
+
+    python -m cookiemonster.cookiejar.sharded_cookiejar \
+        --shard NAME URL DATABASE --shard NAME URL DATABASE ...
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+from argparse import ArgumentParser
+from bisect import bisect
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from hashlib import sha1
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from cookiemonster.common.models import Cookie, Enrichment
+from cookiemonster.cookiejar.biscuit_tin import _Bert, _ConsolidatedErnie, _Ernie
+from cookiemonster.cookiejar.cookiejar import CookieJar
+from cookiemonster.cookiejar.couchdb import Sofabed
+
+
+def _hash(key:str) -> int:
+    """ Position of a key on the hash ring """
+    return int(sha1(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """ Consistent hash of file identifiers onto named shards """
+    def __init__(self, shards:Iterable[str], replicas:int = 100):
+        """
+        Constructor
+
+        @param   shards    Shard names
+        @param   replicas  Number of points on the ring per shard
+        """
+        self.shards = sorted(set(shards))
+        if not self.shards:
+            raise ValueError('A hash ring needs at least one shard')
+
+        ring = sorted(
+            (_hash('{}-{}'.format(shard, replica)), shard)
+            for shard in self.shards
+            for replica in range(max(replicas, 1))
+        )
+
+        self._points = [point for point, _ in ring]
+        self._owners = [shard for _, shard in ring]
+
+    def get_shard(self, identifier:str) -> str:
+        """
+        Get the shard a file belongs to
+
+        @param   identifier  File identifier
+        @return  Shard name
+        """
+        index = bisect(self._points, _hash(identifier)) % len(self._points)
+        return self._owners[index]
+
+
+class ShardedCookieJar(CookieJar):
+    """ Implementation of `CookieJar` partitioned across named shards """
+    def __init__(self, shards:Dict[str, CookieJar], replicas:int = 100):
+        """
+        Constructor
+
+        @param   shards    Cookie Jars, keyed by shard name
+        @param   replicas  Number of points on the hash ring per shard
+        """
+        super().__init__()
+        self._shards = dict(shards)
+        self._ring = HashRing(self._shards.keys(), replicas)
+        self._executor = ThreadPoolExecutor(max_workers=len(self._shards))
+
+        for shard in self._shards.values():
+            shard.add_listener(self.notify_listeners)
+
+    @property
+    def shards(self) -> Dict[str, CookieJar]:
+        """ The Cookie Jars, keyed by shard name """
+        return dict(self._shards)
+
+    def get_shard(self, identifier:str) -> CookieJar:
+        """
+        Get the Cookie Jar a file belongs to
+
+        @param   identifier  File identifier
+        @return  Cookie Jar
+        """
+        return self._shards[self._ring.get_shard(identifier)]
+
+    def _map(self, fn:Callable[[CookieJar], Any]) -> Dict[str, Any]:
+        """
+        Apply a function to every shard, in parallel
+
+        @param   fn  Function of a Cookie Jar
+        @return  Results, keyed by shard name
+        """
+        futures = {name: self._executor.submit(fn, shard) for name, shard in self._shards.items()}
+
+        return {name: future.result() for name, future in futures.items()}
+
+    def _partition(self, identifiers:Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Split file identifiers by the shard they belong to
+
+        @param   identifiers  File identifiers
+        @return  File identifiers, keyed by shard name
+        """
+        partitioned = defaultdict(list)
+        for identifier in identifiers:
+            partitioned[self._ring.get_shard(identifier)].append(identifier)
+
+        return partitioned
+
+    def stop(self):
+        """ Stop the shards' background threads, where they have any """
+        for shard in self._shards.values():
+            stop = getattr(shard, 'stop', None)
+            if stop is not None:
+                stop()
+
+        self._executor.shutdown(wait=False)
+
+    def fetch_cookie(self, identifier: str) -> Optional[Cookie]:
+        return self.get_shard(identifier).fetch_cookie(identifier)
+
+    def delete_cookie(self, identifier: str):
+        self.get_shard(identifier).delete_cookie(identifier)
+
+    def delete_cookies(self, identifiers: Iterable[str]):
+        partitioned = self._partition(identifiers)
+        futures = [
+            self._executor.submit(self._shards[name].delete_cookies, shard_identifiers)
+            for name, shard_identifiers in partitioned.items()
+        ]
+
+        for future in futures:
+            future.result()
+
+    def delete_by_prefix(self, prefix: str) -> int:
+        return sum(self._map(lambda shard: shard.delete_by_prefix(prefix)).values())
+
+    def enrich_cookie(self, identifier: str, enrichment: Enrichment, mark_for_processing: bool=True):
+        self.get_shard(identifier).enrich_cookie(identifier, enrichment, mark_for_processing)
+
+    def mark_as_failed(self, identifier: str, requeue_delay: timedelta=timedelta(0)):
+        self.get_shard(identifier).mark_as_failed(identifier, requeue_delay)
+
+    def mark_as_complete(self, identifier: str):
+        self.get_shard(identifier).mark_as_complete(identifier)
+
+    def mark_for_processing(self, identifier: str):
+        self.get_shard(identifier).mark_for_processing(identifier)
+
+    def get_next_for_processing(self) -> Optional[Cookie]:
+        heads = self._map(lambda shard: shard.next_queued_from())
+        queued = sorted((queued_from, name) for name, queued_from in heads.items() if queued_from is not None)
+
+        # The head of a shard's queue may have been taken in the
+        # meantime, in which case, try the next
+        for _, name in queued:
+            cookie = self._shards[name].get_next_for_processing()
+            if cookie is not None:
+                return cookie
+
+        return None
+
+    def queue_length(self) -> int:
+        return sum(self._map(lambda shard: shard.queue_length()).values())
+
+    def approximate_queue_length(self) -> Tuple[int, bool]:
+        lengths = self._map(lambda shard: shard.approximate_queue_length()).values()
+        return sum(length for length, _ in lengths), all(exact for _, exact in lengths)
+
+    def next_queued_from(self) -> Optional[float]:
+        heads = [queued_from for queued_from in self._map(lambda shard: shard.next_queued_from()).values()
+                             if  queued_from is not None]
+        return min(heads, default=None)
+
+
+class _Shard(object):
+    """ Database interfaces of a shard, for rebalancing """
+    def __init__(self, couchdb_url:str, couchdb_name:str, consolidate_metadata:bool, **kwargs):
+        self.sofa = Sofabed(couchdb_url, couchdb_name, **kwargs)
+        self.queue = _Bert(self.sofa)
+        self.metadata = _ConsolidatedErnie(self.sofa) if consolidate_metadata else _Ernie(self.sofa)
+
+
+def _move(source:_Shard, target:_Shard, identifiers:List[str]):
+    """
+    Move files from one shard to another
+
+    @param   source       Shard the files are on
+    @param   target       Shard the files belong to
+    @param   identifiers  File identifiers
+    """
+    source_docs = source.queue.get_all_by_identifier(identifiers)
+    target_docs = target.queue.get_all_by_identifier(identifiers)
+
+    # Enrichments that were already copied (or written since) aren't
+    # copied again
+    for identifier in identifiers:
+        copied = target.metadata.get_metadata(identifier)
+        for enrichment in source.metadata.get_metadata(identifier):
+            if enrichment not in copied:
+                target.metadata.enrich(identifier, enrichment)
+
+    to_save = []
+    for identifier, (_, doc) in source_docs.items():
+        if identifier not in target_docs:
+            to_save.append({key: value for key, value in doc.items() if key != '_rev'})
+        elif _Bert._is_queued(doc):
+            target.queue.mark_dirty(identifier)
+
+    # Save before deleting, so nothing is lost if interrupted
+    target.sofa.upsert_all(to_save)
+    source.metadata.delete_all_metadata(identifiers)
+    source.queue.delete_all(identifiers)
+
+
+def rebalance_shards(shards:Dict[str, Tuple[str, str]], replicas:int = 100,
+                                                       batch_size:int = 1000,
+                                                       consolidate_metadata:bool = False,
+                                                       **kwargs) -> int:
+    """
+    Move the files of `BiscuitTin` databases to the shard they hash to
+
+    @param   shards                CouchDB URL and database name tuples,
+                                   keyed by shard name
+    @param   replicas              Number of points on the hash ring per
+                                   shard
+    @param   batch_size            Maximum number of files to move per
+                                   batch
+    @param   consolidate_metadata  Whether the databases' metadata is
+                                   consolidated
+    @kwargs  Additional constructor parameters to Sofabed and
+             pycouchdb.client.Server should be passed through here
+    @return  Number of files moved
+    """
+    ring = HashRing(shards.keys(), replicas)
+
+    # Bringing up the queue management interfaces defines the views
+    # and sanitises the queue state
+    interfaces = {
+        name: _Shard(couchdb_url, couchdb_name, consolidate_metadata, **kwargs)
+        for name, (couchdb_url, couchdb_name) in shards.items()
+    }
+
+    moved = 0
+    for name, source in interfaces.items():
+        for identifiers in source.queue.get_identifiers_by_prefix('', batch_size):
+            misplaced = defaultdict(list)
+            for identifier in identifiers:
+                target = ring.get_shard(identifier)
+                if target != name:
+                    misplaced[target].append(identifier)
+
+            for target, to_move in misplaced.items():
+                _move(source, interfaces[target], to_move)
+                moved += len(to_move)
+
+            if misplaced:
+                logging.info('Moved %d files', moved)
+
+    return moved
+
+
+def main():
+    parser = ArgumentParser(description="Move the files of sharded BiscuitTin databases to where they hash")
+    parser.add_argument("--shard", nargs=3, action="append", required=True, metavar=("NAME", "URL", "DATABASE"),
+                        help="shard name, CouchDB URL and database name (given once per shard)")
+    parser.add_argument("--replicas", type=int, default=100, help="Number of points on the hash ring per shard")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of files to move per batch")
+    parser.add_argument("--consolidate-metadata", action="store_true", help="The databases' metadata is consolidated")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    shards = {name: (couchdb_url, couchdb_name) for name, couchdb_url, couchdb_name in arguments.shard}
+    moved = rebalance_shards(shards, arguments.replicas, arguments.batch_size, arguments.consolidate_metadata)
+    print("Moved %d files" % moved)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,515 @@
+"""
+SQLite Cookie Jar
+=================
+An implementation of `CookieJar` using SQLite as its database, for
+single-node deployments that don't need the cost of a CouchDB server
+(and an HTTP request per operation)
+
+Exportable classes: `SQLiteCookieJar`
+
+SQLiteCookieJar
+---------------
+`SQLiteCookieJar` implements the interface decreed by `CookieJar`. It
+must be instantiated with the path to its database file, which will be
+created (along with its schema), if necessary.
+
+The queue has the same states as that of `BiscuitTin` (see `_Bert`):
+each file has a row that is dirty (i.e., marked for processing, from its
+`queue_from` time), processing, or deleted (i.e., marked for deletion
+when it finishes processing). Files marked for processing while they're
+being processed are requeued when they finish; failed files are requeued
+after the given delay. Each file's enrichments are stored as compressed
+JSON blobs.
+
+The database is in write-ahead logging mode, so reads (made with a
+connection per thread) aren't blocked by writes, nor writes by reads.
+All writes are made by a dedicated writer thread, which batches those
+that are submitted together (up to `max_batch_size`, waiting up to
+`batch_latency` for more) into one transaction, each in a savepoint, so
+a failed write doesn't affect the others in its batch. Writes return
+once their transaction has been committed, so are immediately visible
+to subsequent reads.
+
+On start up, the queue state of files left processing by an unclean
+restart is reset and files left marked for deletion are cleaned up.
+
+`SQLiteCookieJar` implements `Listenable`; when a cookie is queued, it
+will broadcast the queue change to all downstream listeners. Its writer
+thread should be stopped, with `stop`, when it is no longer used.
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import logging
+import sqlite3
+import zlib
+from concurrent.futures import Future
+from datetime import timedelta
+from queue import Empty, Queue
+from threading import Lock, Thread, Timer, local
+from time import monotonic, time
+from typing import Any, Callable, Iterable, List, Optional
+
+from cookiemonster.common.collections import EnrichmentCollection
+from cookiemonster.common.helpers import FastEnrichmentJSONEncoder, FastEnrichmentJSONDecoder
+from cookiemonster.common.models import Cookie, Enrichment
+from cookiemonster.cookiejar.cookiejar import CookieJar
+
+
+# Rows that are (or will be) up for processing; queries must use the
+# same predicate for the partial index to be used
+_QUEUED = 'dirty = 1 AND processing = 0 AND deleted = 0'
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS queue (
+        identifier  TEXT PRIMARY KEY,
+        dirty       INTEGER NOT NULL DEFAULT 0,
+        processing  INTEGER NOT NULL DEFAULT 0,
+        deleted     INTEGER NOT NULL DEFAULT 0,
+        queue_from  REAL
+    );
+
+    CREATE INDEX IF NOT EXISTS to_process ON queue (queue_from) WHERE {queued};
+
+    CREATE TABLE IF NOT EXISTS enrichments (
+        id          INTEGER PRIMARY KEY,
+        identifier  TEXT NOT NULL,
+        enrichment  BLOB NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS enrichments_by_identifier ON enrichments (identifier);
+""".format(queued=_QUEUED)
+
+# Upper bound of the identifiers that start with a given prefix
+_MAX_CHARACTER = '\U0010ffff'
+
+
+def _now() -> int:
+    """ @return The current Unix time """
+    return int(time())
+
+
+def _encode(enrichment:Enrichment) -> bytes:
+    """ Compact blob of an enrichment """
+    encoded = json.dumps(enrichment, cls=FastEnrichmentJSONEncoder, separators=(',', ':'))
+    return zlib.compress(encoded.encode('utf-8'))
+
+
+def _decode(blob:bytes) -> Enrichment:
+    """ Enrichment from its compact blob """
+    return json.loads(zlib.decompress(blob).decode('utf-8'), cls=FastEnrichmentJSONDecoder)
+
+
+def _connect(path:str) -> sqlite3.Connection:
+    """
+    Connect to the database, in autocommit mode (i.e., transactions are
+    managed explicitly) and write-ahead logging mode
+
+    @param   path  Database file path
+    @return  Database connection
+    """
+    connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = NORMAL')
+    return connection
+
+
+def _mark_dirty(connection:sqlite3.Connection, identifier:str, latency:float = 0):
+    """
+    Mark a file as requiring, potentially delayed, (re)processing,
+    resetting any deleted status
+
+    @param  connection  Writer connection
+    @param  identifier  File identifier
+    @param  latency     Requeue latency (seconds)
+    """
+    now = _now()
+
+    # Latency is only for existing rows
+    updated = connection.execute(
+        'UPDATE queue SET dirty = 1, deleted = 0, queue_from = ? WHERE identifier = ?',
+        (now + latency, identifier)).rowcount
+
+    if not updated:
+        connection.execute('INSERT INTO queue (identifier, dirty, queue_from) VALUES (?, 1, ?)', (identifier, now))
+
+
+def _mark_finished(connection:sqlite3.Connection, identifier:str):
+    """
+    Mark a file as finished processing, or delete it if it is marked
+    as such
+
+    @param  connection  Writer connection
+    @param  identifier  File identifier
+    """
+    # Files marked dirty while processing are requeued
+    connection.execute('DELETE FROM queue WHERE identifier = ? AND deleted = 1', (identifier,))
+    connection.execute('UPDATE queue SET processing = 0 WHERE identifier = ?', (identifier,))
+
+
+def _delete(connection:sqlite3.Connection, identifiers:List[str]):
+    """
+    Delete files' enrichments and queue rows, or mark the latter for
+    deletion if they are currently being processed
+
+    @param  connection   Writer connection
+    @param  identifiers  File identifiers
+    """
+    parameters = [(identifier,) for identifier in identifiers]
+    connection.executemany('DELETE FROM enrichments WHERE identifier = ?', parameters)
+    connection.executemany('UPDATE queue SET deleted = 1 WHERE identifier = ? AND processing = 1', parameters)
+    connection.executemany('DELETE FROM queue WHERE identifier = ? AND processing = 0', parameters)
+
+
+def _delete_by_prefix(connection:sqlite3.Connection, prefix:str) -> int:
+    """
+    Delete the files whose identifiers start with the given prefix
+
+    @param   connection  Writer connection
+    @param   prefix      File identifier prefix
+    @return  Number of files deleted
+    """
+    bounds = (prefix, prefix + _MAX_CHARACTER)
+    in_range = 'identifier >= ? AND identifier < ?'
+
+    deleted, = connection.execute(
+        'SELECT COUNT(*) FROM queue WHERE {} AND deleted = 0'.format(in_range), bounds).fetchone()
+
+    # Enrichments without a queue row are cleaned up too
+    connection.execute('DELETE FROM enrichments WHERE {}'.format(in_range), bounds)
+    connection.execute('UPDATE queue SET deleted = 1 WHERE {} AND processing = 1'.format(in_range), bounds)
+    connection.execute('DELETE FROM queue WHERE {} AND processing = 0'.format(in_range), bounds)
+
+    return deleted
+
+
+def _dequeue(connection:sqlite3.Connection, count:int) -> List[str]:
+    """
+    Take up to count files off the queue and mark them as being
+    processed
+
+    @param   connection  Writer connection
+    @param   count       The maximum number of files to dequeue
+    @return  List (potentially empty) of dequeued file identifiers
+    """
+    rows = connection.execute(
+        'SELECT identifier FROM queue WHERE {} AND queue_from <= ? ORDER BY queue_from LIMIT ?'.format(_QUEUED),
+        (_now(), count)).fetchall()
+
+    connection.executemany(
+        'UPDATE queue SET dirty = 0, processing = 1, queue_from = NULL WHERE identifier = ?', rows)
+
+    return [identifier for identifier, in rows]
+
+
+def _sanitise(connection:sqlite3.Connection):
+    """
+    Reset the queue state of files left processing by an unclean
+    restart and clean up those left marked for deletion
+
+    @param  connection  Writer connection
+    """
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        reset = connection.execute(
+            'UPDATE queue SET dirty = 1, processing = 0, queue_from = ? WHERE processing = 1 AND deleted = 0',
+            (_now(),)).rowcount
+        cleaned = connection.execute('DELETE FROM queue WHERE deleted = 1').rowcount
+        connection.execute('COMMIT')
+
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+    if reset or cleaned:
+        logging.info('Reset %d files left processing and cleaned up %d files left for deletion', reset, cleaned)
+
+
+class _Writer(object):
+    """ Dedicated thread making all writes, in batched transactions """
+    def __init__(self, connection:sqlite3.Connection, max_batch_size:int, batch_latency:timedelta):
+        """
+        Constructor
+
+        @param   connection      Writer connection
+        @param   max_batch_size  Maximum number of writes per transaction
+        @param   batch_latency   Maximum time to wait for more writes to
+                                 batch with the first
+        """
+        self._connection = connection
+        self._max_batch_size = max(max_batch_size, 1)
+        self._latency = batch_latency.total_seconds()
+
+        self._pending = Queue()
+        self._stopped = False
+
+        self._thread = Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def submit(self, operation:Callable[[sqlite3.Connection], Any]) -> Any:
+        """
+        Make a write and wait for it to be committed
+
+        @param   operation  Function of the writer connection
+        @return  The operation's return value
+        """
+        if self._stopped:
+            raise RuntimeError('The writer has been stopped')
+
+        future = Future()
+        self._pending.put((operation, future))
+
+        # Any exception the operation raised is reraised here
+        return future.result()
+
+    def stop(self):
+        """ Commit the outstanding writes and stop the thread """
+        if not self._stopped:
+            self._stopped = True
+            self._pending.put(None)
+            self._thread.join()
+            self._connection.close()
+
+    def _next_batch(self) -> Optional[List[tuple]]:
+        """
+        Block until there are writes, then take those that follow within
+        the batch latency, up to the batch size
+
+        @return  Batch of operations and their futures (None, if stopped)
+        """
+        first = self._pending.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = monotonic() + self._latency
+
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - monotonic()
+
+            try:
+                if remaining > 0:
+                    pending = self._pending.get(timeout=remaining)
+                else:
+                    pending = self._pending.get_nowait()
+
+            except Empty:
+                break
+
+            if pending is None:
+                # Stop once this batch is committed
+                self._pending.put(None)
+                break
+
+            batch.append(pending)
+
+        return batch
+
+    def _write(self):
+        """ Commit batches of writes, until stopped """
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            self._commit(batch)
+
+    def _commit(self, batch:List[tuple]):
+        """
+        Make a batch of writes in one transaction, each in its own
+        savepoint, then resolve their futures
+
+        @param   batch  Operations and their futures
+        """
+        connection = self._connection
+        outcomes = []
+
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+
+            for operation, _ in batch:
+                connection.execute('SAVEPOINT operation')
+                try:
+                    outcomes.append((operation(connection), None))
+                    connection.execute('RELEASE operation')
+
+                except Exception as e:
+                    # Only this operation is rolled back
+                    connection.execute('ROLLBACK TO operation')
+                    connection.execute('RELEASE operation')
+                    outcomes.append((None, e))
+
+            connection.execute('COMMIT')
+
+        except Exception as e:
+            logging.exception('Could not commit a batch of %d writes', len(batch))
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+
+            outcomes = [(None, e)] * len(batch)
+
+        for (result, exception), (_, future) in zip(outcomes, batch):
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
+
+
+class SQLiteCookieJar(CookieJar):
+    """ Single-node, persistent implementation of `CookieJar` """
+    def __init__(self, path:str, max_batch_size:int = 1000, batch_latency:timedelta = timedelta(0)):
+        """
+        Constructor: Connect to (and create, if necessary) the database
+        and start the writer thread
+
+        @param  path            Database file path
+        @param  max_batch_size  Maximum number of writes per transaction
+        @param  batch_latency   Maximum time to wait for more writes to
+                                batch together (zero to batch only those
+                                already waiting)
+        """
+        super().__init__()
+        self._path = path
+        self._bulk_size = max(max_batch_size, 1)
+
+        connection = _connect(path)
+        connection.executescript(_SCHEMA)
+        _sanitise(connection)
+
+        self._writer = _Writer(connection, max_batch_size, batch_latency)
+
+        # Each thread reads with its own connection
+        self._local = local()
+        self._readers = []  # type: List[sqlite3.Connection]
+        self._readers_lock = Lock()
+
+    def _reader(self) -> sqlite3.Connection:
+        """ @return The current thread's reader connection """
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            connection = _connect(self._path)
+            self._local.connection = connection
+            with self._readers_lock:
+                self._readers.append(connection)
+
+        return connection
+
+    def _read(self, operation:Callable[[sqlite3.Connection], Any]) -> Any:
+        """
+        Make reads from a consistent snapshot of the database
+
+        @param   operation  Function of a reader connection
+        @return  The operation's return value
+        """
+        connection = self._reader()
+        connection.execute('BEGIN')
+        try:
+            return operation(connection)
+        finally:
+            connection.execute('COMMIT')
+
+    def stop(self):
+        """ Commit the outstanding writes and close the database """
+        self._writer.stop()
+
+        with self._readers_lock:
+            for connection in self._readers:
+                connection.close()
+            self._readers = []
+
+        self._local = local()
+
+    def fetch_cookie(self, identifier: str) -> Optional[Cookie]:
+        def fetch(connection:sqlite3.Connection) -> Optional[Cookie]:
+            if connection.execute('SELECT 1 FROM queue WHERE identifier = ?', (identifier,)).fetchone() is None:
+                return None
+
+            blobs = connection.execute('SELECT enrichment FROM enrichments WHERE identifier = ?', (identifier,))
+
+            cookie = Cookie(identifier)
+            cookie.enrichments = EnrichmentCollection(sorted(_decode(blob) for blob, in blobs))
+            return cookie
+
+        return self._read(fetch)
+
+    def delete_cookie(self, identifier: str):
+        self._writer.submit(lambda connection: _delete(connection, [identifier]))
+
+    def delete_cookies(self, identifiers: Iterable[str]):
+        identifiers = list(identifiers)
+        for i in range(0, len(identifiers), self._bulk_size):
+            batch = identifiers[i:i + self._bulk_size]
+            self._writer.submit(lambda connection: _delete(connection, batch))
+
+    def delete_by_prefix(self, prefix: str) -> int:
+        return self._writer.submit(lambda connection: _delete_by_prefix(connection, prefix))
+
+    def enrich_cookie(self, identifier: str, enrichment: Enrichment, mark_for_processing: bool=True):
+        blob = _encode(enrichment)
+
+        def enrich(connection:sqlite3.Connection):
+            connection.execute('INSERT INTO enrichments (identifier, enrichment) VALUES (?, ?)', (identifier, blob))
+
+            if mark_for_processing:
+                _mark_dirty(connection, identifier)
+            else:
+                connection.execute('INSERT OR IGNORE INTO queue (identifier) VALUES (?)', (identifier,))
+
+        self._writer.submit(enrich)
+
+        if mark_for_processing:
+            self.notify_listeners()
+
+    def mark_as_failed(self, identifier: str, requeue_delay: timedelta=timedelta(0)):
+        def fail(connection:sqlite3.Connection):
+            _mark_finished(connection, identifier)
+            _mark_dirty(connection, identifier, requeue_delay.total_seconds())
+
+        self._writer.submit(fail)
+        logging.debug('%s has been marked as failed', identifier)
+
+        # Broadcast the change after the requeue delay
+        Timer(requeue_delay.total_seconds(), self.notify_listeners).start()
+
+    def mark_as_complete(self, identifier: str):
+        self._writer.submit(lambda connection: _mark_finished(connection, identifier))
+        logging.debug('%s has been marked as complete', identifier)
+
+    def mark_for_processing(self, identifier: str):
+        self._writer.submit(lambda connection: _mark_dirty(connection, identifier))
+        self.notify_listeners()
+
+    def get_next_for_processing(self) -> Optional[Cookie]:
+        dequeued = self._writer.submit(lambda connection: _dequeue(connection, 1))
+        if not dequeued:
+            return None
+
+        return self.fetch_cookie(dequeued[0])
+
+    def queue_length(self) -> int:
+        length, = self._read(lambda connection: connection.execute(
+            'SELECT COUNT(*) FROM queue WHERE {} AND queue_from <= ?'.format(_QUEUED), (_now(),)).fetchone())
+        return length
+
+    def next_queued_from(self) -> Optional[float]:
+        queued_from, = self._read(lambda connection: connection.execute(
+            'SELECT MIN(queue_from) FROM queue WHERE {} AND queue_from <= ?'.format(_QUEUED), (_now(),)).fetchone())
+        return queued_from
@@ -8,7 +8,8 @@ CookieJarHandlers
 Method handlers for the Cookie Jar:
 
 * `GET_queue_length` GET handler for the Cookie Jar "to process" queue
-  length; returns a dictionary with a `queue_length` member
+  length; returns a dictionary with a `queue_length` member and an
+  `exact` member, which is false if the length is approximate
 
 * `POST_mark_for_processing` POST handler for marking cookies for
   (re)processing; expects either a plain string or a dictionary with a
@@ -19,6 +20,12 @@ Method handlers for the Cookie Jar:
 
 * `DELETE_cookie` DELETE handler for removing a cookie by its identifier
 
+* `DELETE_cookies` DELETE handler for removing cookies in bulk, either
+  by multiple `identifier`s or by an identifier `prefix` in the query
+  string; returns a dictionary with a `deleted` member (a list of the
+  identifiers or, for a prefix, the number of cookies deleted). A single
+  identifier is handled as per `DELETE_cookie`
+
 Legalese
 --------
 Copyright (c) 2016 Genome Research Ltd.
@@ -45,7 +52,7 @@ from typing import Any
 
 from werkzeug.exceptions import NotFound
 
-from cookiemonster.common.helpers import EnrichmentJSONEncoder
+from cookiemonster.common.helpers import FastEnrichmentJSONEncoder
 from cookiemonster.cookiejar import BiscuitTin
 from cookiemonster.elmo._handler_injection import DependencyInjectionHandler
 
@@ -54,7 +61,8 @@ class CookieJarHandlers(DependencyInjectionHandler):
     """ Handler functions for CookieJar """
     def GET_queue_length(self, **kwargs):
         cookiejar = self._dependency
-        return {'queue_length': cookiejar.queue_length()}
+        queue_length, exact = cookiejar.approximate_queue_length()
+        return {'queue_length': queue_length, 'exact': exact}
 
     def POST_mark_for_processing(self, data:Any, **kwargs):
         cookiejar = self._dependency
@@ -83,7 +91,7 @@ class CookieJarHandlers(DependencyInjectionHandler):
             raise NotFound
 
         # TODO: This defines a JSON representation of a Cookie that could be encapsulated in a JSONEncoder
-        enrichments = EnrichmentJSONEncoder().default(list(cookie.enrichments))
+        enrichments = FastEnrichmentJSONEncoder().default(list(cookie.enrichments))
         return {'identifier':cookie.identifier, 'enrichments':enrichments}
 
     def DELETE_cookie(self, **kwargs):
@@ -101,3 +109,18 @@ class CookieJarHandlers(DependencyInjectionHandler):
 
         cookiejar.delete_cookie(identifier)
         return {'deleted':identifier}
+
+    def DELETE_cookies(self, **kwargs):
+        cookiejar = self._dependency
+
+        prefix = kwargs['_query'].get('prefix')
+        if prefix:
+            deleted = cookiejar.delete_by_prefix(prefix)
+            return {'prefix':prefix, 'deleted':deleted}
+
+        identifiers = kwargs['_query'].getlist('identifier')
+        if len(identifiers) > 1:
+            cookiejar.delete_cookies(identifiers)
+            return {'deleted':identifiers}
+
+        return self.DELETE_cookie(**kwargs)
@@ -40,6 +40,10 @@ The following routes have been specified:
       n.b. The query string version of this route is to accommodate
       identifiers that start with a leading slash
 
+    /cookiejar?identifier=<identifier>&identifier=<identifier>...
+    /cookiejar?prefix=<prefix>
+      DELETE  Delete cookies in bulk, by identifiers or identifier prefix
+
     /debug/threads
       GET     Dump thread debugging data
 
@@ -126,7 +130,7 @@ class HTTP_API(object):
 
         api.create_route('/cookiejar') \
             .set_method_handler(HTTPMethod.GET, dep[APIDependency.CookieJar].GET_cookie) \
-            .set_method_handler(HTTPMethod.DELETE, dep[APIDependency.CookieJar].DELETE_cookie)
+            .set_method_handler(HTTPMethod.DELETE, dep[APIDependency.CookieJar].DELETE_cookies)
 
         api.create_route('/cookiejar/<path:identifier>') \
             .set_method_handler(HTTPMethod.GET, dep[APIDependency.CookieJar].GET_cookie) \
@@ -28,6 +28,7 @@ from cookiemonster.monitor.monitor import Monitor
 
 MEASURED_COOKIE_JAR_STATUS = "cookie_jar_status"
 MEASURED_COOKIE_JAR_TO_PROCESS = "to_process"
+MEASURED_COOKIE_JAR_TO_PROCESS_EXACT = "to_process_exact"
 
 
 class CookieJarMonitor(Monitor):
@@ -45,10 +46,11 @@ class CookieJarMonitor(Monitor):
         self._cookie_jar = cookie_jar
 
     def do_log_record(self):
-        cookies_to_process = self._cookie_jar.queue_length()
+        cookies_to_process, exact = self._cookie_jar.approximate_queue_length()
         self._logger.record(
             MEASURED_COOKIE_JAR_STATUS,
             {
-                MEASURED_COOKIE_JAR_TO_PROCESS: cookies_to_process
+                MEASURED_COOKIE_JAR_TO_PROCESS: cookies_to_process,
+                MEASURED_COOKIE_JAR_TO_PROCESS_EXACT: exact
             }
         )
@@ -0,0 +1,56 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+from datetime import timedelta
+
+from cookiemonster.cookiejar import BiscuitTin
+from cookiemonster.logging.logger import Logger
+from cookiemonster.monitor.monitor import Monitor
+
+MEASURED_COUCHDB_CONNECTIONS = "couchdb_connections"
+MEASURED_COUCHDB_REQUESTS = "requests"
+MEASURED_COUCHDB_CONNECTIONS_OPENED = "connections"
+MEASURED_COUCHDB_CONNECTIONS_REUSED = "reused"
+
+
+class CouchDBConnectionsMonitor(Monitor):
+    """
+    Monitors the reuse of the connections to CouchDB made by a `BiscuitTin`.
+    """
+    def __init__(self, logger: Logger, period: timedelta, biscuit_tin: BiscuitTin):
+        """
+        Constructor.
+        :param logger: logger to use to record logs
+        :param period: how often the monitor should record a log
+        :param biscuit_tin: the `BiscuitTin` whose connections are to be monitored
+        """
+        super().__init__(logger, period)
+        self._biscuit_tin = biscuit_tin
+
+    def do_log_record(self):
+        connection_stats = self._biscuit_tin.connection_stats()
+        self._logger.record(
+            MEASURED_COUCHDB_CONNECTIONS,
+            {
+                MEASURED_COUCHDB_REQUESTS: connection_stats["requests"],
+                MEASURED_COUCHDB_CONNECTIONS_OPENED: connection_stats["connections"],
+                MEASURED_COUCHDB_CONNECTIONS_REUSED: connection_stats["reused"]
+            }
+        )
@@ -24,8 +24,9 @@ import logging
 import time
 from datetime import datetime
 from multiprocessing import Lock
-from threading import Thread
-from typing import TypeVar
+from queue import Queue, Full
+from threading import Event, Thread
+from typing import Any, Iterable, Optional, Tuple, TypeVar
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 from hgicommon.mixable import Listenable
@@ -44,20 +45,37 @@ MEASURED_RETRIEVAL_DURATION = "retrieval_duration"
 MEASURED_RETRIEVAL_UPDATE_COUNT = "number_of_updates"
 MEASURED_RETRIEVAL_MOST_RECENT_RETRIEVED = "most_recent_update"
 
+_DEFAULT_MAX_PENDING_BATCHES = 2
+_PENDING_BATCH_WAIT_TIMEOUT = 1.0
+_END_OF_STREAM = object()
+
 
 class RetrievalManager(Listenable[UpdateCollection]):
     """
     Manages the retrieval of updates.
     """
-    def __init__(self, update_mapper: UpdateMapper, logger: Logger=PythonLoggingLogger()):
+    def __init__(self, update_mapper: UpdateMapper, logger: Logger=PythonLoggingLogger(),
+                 batch_size: Optional[int]=None, max_pending_batches: int=_DEFAULT_MAX_PENDING_BATCHES):
         """
         Default constructor.
         :param update_mapper: the object through which updates can be retrieved from the source
         :param logger: log recorder
+        :param batch_size: the maximum number of updates that listeners are notified about at a time. If set, updates
+        are streamed from the mapper to the listeners as they become available, instead of listeners being notified
+        once about all of the updates retrieved (default)
+        :param max_pending_batches: when streaming, the maximum number of batches that may be retrieved ahead of the
+        listeners before retrieval is paused
         """
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("Batch size must be at least 1, not %d" % batch_size)
+        if max_pending_batches < 1:
+            raise ValueError("Must allow at least one pending batch, not %d" % max_pending_batches)
+
         super().__init__()
         self.update_mapper = update_mapper
         self._logger = logger
+        self._batch_size = batch_size
+        self._max_pending_batches = max_pending_batches
 
     def run(self, updates_since: datetime=datetime.min):
         """
@@ -67,44 +85,116 @@ class RetrievalManager(Listenable[UpdateCollection]):
         updates_since = localise_to_utc(updates_since)
         self._do_retrieval(updates_since)
 
-    def _do_retrieval(self, updates_since: datetime) -> UpdateCollection:
+    def _do_retrieval(self, updates_since: datetime) -> Optional[datetime]:
         """
         Handles the retrieval of updates by getting the data using the retriever, notifying the listeners and then
         logging the retrieval.
         :param updates_since: the time from which to retrieve updates since
-        :return: the updates retrieved
+        :return: the timestamp of the most recent update retrieved (`None` if no updates were retrieved)
         """
         logging.debug("Starting update retrieval...")
 
         # Do retrieve
         started_at_clock_time = RetrievalManager._get_clock_time()
         started_at = RetrievalManager._get_monotonic_time()
-        updates = self.update_mapper.get_all_since(updates_since)
-        seconds_taken_to_complete_query = RetrievalManager._get_monotonic_time() - started_at
-        assert updates is not None
-        logging.debug("Retrieved %d updates since %s (query took: %s)"
-                      % (len(updates), updates_since, seconds_taken_to_complete_query))
+        if self._batch_size is None:
+            updates = self.update_mapper.get_all_since(updates_since)
+            seconds_taken_to_complete_query = RetrievalManager._get_monotonic_time() - started_at
+            assert updates is not None
+            logging.debug("Retrieved %d updates since %s (query took: %s)"
+                          % (len(updates), updates_since, seconds_taken_to_complete_query))
 
-        # Notify listeners of retrieval
-        if len(updates) > 0:
-            logging.debug("Notifying %d listeners of %d update(s)" % (len(self.get_listeners()), len(updates)))
-            self.notify_listeners(updates)
+            # Notify listeners of retrieval
+            number_of_updates, most_recent_retrieved = self._notify_listeners_of_batch(updates, 0, None)
+        else:
+            number_of_updates = 0
+            most_recent_retrieved = None
+            for updates in self._stream_batches(updates_since):
+                assert updates is not None
+                number_of_updates, most_recent_retrieved = self._notify_listeners_of_batch(
+                    updates, number_of_updates, most_recent_retrieved)
+            seconds_taken_to_complete_query = RetrievalManager._get_monotonic_time() - started_at
+            logging.debug("Streamed %d updates since %s (retrieval took: %s)"
+                          % (number_of_updates, updates_since, seconds_taken_to_complete_query))
 
         # Store log of retrieval
-        most_recent_retrieved = updates.get_most_recent()[0].timestamp if len(updates) > 0 else None
         self._logger.record(
             MEASURED_RETRIEVAL,
             {
                 MEASURED_RETRIEVAL_UPDATES_SINCE: updates_since.isoformat(),
                 MEASURED_RETRIEVAL_STARTED_AT: started_at_clock_time.isoformat(),
                 MEASURED_RETRIEVAL_DURATION: seconds_taken_to_complete_query,
-                MEASURED_RETRIEVAL_UPDATE_COUNT: len(updates),
+                MEASURED_RETRIEVAL_UPDATE_COUNT: number_of_updates,
                 MEASURED_RETRIEVAL_MOST_RECENT_RETRIEVED:
                     None if most_recent_retrieved is None else most_recent_retrieved.isoformat()
             }
         )
 
-        return updates
+        return most_recent_retrieved
+
+    def _notify_listeners_of_batch(self, updates: UpdateCollection, number_of_updates: int,
+                                   most_recent_retrieved: Optional[datetime]) -> Tuple[int, Optional[datetime]]:
+        """
+        Notifies the listeners about the given batch of updates (if not empty), keeping a running count of the updates
+        and of the most recent timestamp.
+        :param updates: the batch of updates
+        :param number_of_updates: the number of updates retrieved before this batch
+        :param most_recent_retrieved: the most recent timestamp retrieved before this batch
+        :return: tuple where the first element is the updated count and the second the updated most recent timestamp
+        """
+        if len(updates) == 0:
+            return number_of_updates, most_recent_retrieved
+
+        logging.debug("Notifying %d listeners of %d update(s)" % (len(self.get_listeners()), len(updates)))
+        self.notify_listeners(updates)
+
+        most_recent_in_batch = updates.get_most_recent()[0].timestamp
+        if most_recent_retrieved is None \
+                or localise_to_utc(most_recent_in_batch) > localise_to_utc(most_recent_retrieved):
+            most_recent_retrieved = most_recent_in_batch
+
+        return number_of_updates + len(updates), most_recent_retrieved
+
+    def _stream_batches(self, updates_since: datetime) -> Iterable[UpdateCollection]:
+        """
+        Streams batches of updates from the mapper. Retrieval happens in a separate thread, which is blocked whilst
+        there are `max_pending_batches` that have not been taken from the returned generator.
+        :param updates_since: the time from which to retrieve updates since
+        :return: generator of batches of updates
+        """
+        pending = Queue(maxsize=self._max_pending_batches)
+        consumer_stopped = Event()
+
+        def put(item: Any):
+            while not consumer_stopped.is_set():
+                try:
+                    pending.put(item, timeout=_PENDING_BATCH_WAIT_TIMEOUT)
+                    return
+                except Full:
+                    pass
+
+        def produce():
+            try:
+                for batch in self.update_mapper.get_all_since_in_batches(updates_since, self._batch_size):
+                    put(batch)
+                    if consumer_stopped.is_set():
+                        return
+                put(_END_OF_STREAM)
+            except Exception as e:
+                put(e)
+
+        Thread(target=produce, daemon=True).start()
+
+        try:
+            while True:
+                item = pending.get()
+                if item is _END_OF_STREAM:
+                    return
+                elif isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            consumer_stopped.set()
 
     @staticmethod
     def _get_monotonic_time() -> TimeDeltaInSecondsT:
@@ -128,14 +218,17 @@ class PeriodicRetrievalManager(RetrievalManager):
     Manages the periodic retrieval of updates.
     """
     def __init__(self, retrieval_period: TimeDeltaInSecondsT, update_mapper: UpdateMapper,
-                 logger: Logger=PythonLoggingLogger()):
+                 logger: Logger=PythonLoggingLogger(), batch_size: Optional[int]=None,
+                 max_pending_batches: int=_DEFAULT_MAX_PENDING_BATCHES):
         """
         Constructor.
         :param retrieval_period: the period that dictates the frequency at which data is retrieved
         :param update_mapper: the object through which updates can be retrieved from the source
         :param logger: log recorder
+        :param batch_size: see `RetrievalManager.__init__`
+        :param max_pending_batches: see `RetrievalManager.__init__`
         """
-        super().__init__(update_mapper, logger)
+        super().__init__(update_mapper, logger, batch_size, max_pending_batches)
         self._retrieval_period = retrieval_period
         self._running = False
         self._state_lock = Lock()
@@ -173,11 +266,11 @@ class PeriodicRetrievalManager(RetrievalManager):
 
     def _do_periodic_retrieval(self):
         assert self._updates_since is not None
-        updates = self._do_retrieval(self._updates_since)
+        most_recent_retrieved = self._do_retrieval(self._updates_since)
 
-        if len(updates) > 0:
+        if most_recent_retrieved is not None:
             # Next time, get all updates since the most recent that was received last time
-            self._updates_since = updates.get_most_recent()[0].timestamp
+            self._updates_since = most_recent_retrieved
         else:
             # Get all updates since same time in future (not going to move since time forward to simplify things - there
             # is no risk of getting duplicates as no updates in range queried previously). Therefore not changing
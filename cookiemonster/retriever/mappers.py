@@ -22,6 +22,7 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 from abc import abstractmethod, ABCMeta
 from datetime import datetime
+from typing import Iterable
 
 from cookiemonster.common.collections import UpdateCollection
 
@@ -37,3 +38,21 @@ class UpdateMapper(metaclass=ABCMeta):
         :param since: the time at which to get updates from (`fileUpdate.timestamp > since`)
         :return: the results of the query
         """
+
+    def get_all_since_in_batches(self, since: datetime, batch_size: int) -> Iterable[UpdateCollection]:
+        """
+        Gets models of all of the updates that have happened since the given time, yielded in batches of at most the
+        given size as they become available.
+
+        The default implementation retrieves all of the updates using `get_all_since` and then splits them into
+        batches; implementations that can produce updates incrementally should override this method.
+        :param since: the time at which to get updates from (`fileUpdate.timestamp > since`)
+        :param batch_size: the maximum number of updates in each batch
+        :return: iterable of the batches of updates
+        """
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1, not %d" % batch_size)
+
+        updates = self.get_all_since(since)
+        for i in range(0, len(updates), batch_size):
+            yield UpdateCollection(updates[i:i + batch_size])
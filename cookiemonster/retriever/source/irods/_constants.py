@@ -22,6 +22,10 @@ with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 MODIFIED_DATA_QUERY_ALIAS = "dataModifiedPartial"
 MODIFIED_METADATA_QUERY_ALIAS = "metadataModifiedPartial"
+MODIFIED_DATA_ID_ONLY_QUERY_ALIAS = "dataModifiedIdOnly"
+MODIFIED_METADATA_ID_ONLY_QUERY_ALIAS = "metadataModifiedIdOnly"
+MODIFIED_DATA_IN_ID_RANGE_QUERY_ALIAS = "dataModifiedPartialInIdRange"
+MODIFIED_METADATA_IN_ID_RANGE_QUERY_ALIAS = "metadataModifiedPartialInIdRange"
 
 MODIFIED_COLLECTION_NAME_PROPERTY = "coll_name"
 
@@ -24,10 +24,14 @@ import logging
 import math
 import time
 from datetime import datetime, timezone
-from threading import Semaphore, Thread
-from typing import Dict, List, Optional, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import Dict, Iterable, List, Optional, Sequence, Sized, Tuple
 
+from baton._baton._baton_runner import BatonBinary
+from baton._baton._constants import BATON_SPECIFIC_QUERY_PROPERTY
 from baton._baton.baton_custom_object_mappers import BatonCustomObjectMapper
+from baton._baton.json import PreparedSpecificQueryJSONEncoder
 from baton.collections import IrodsMetadata
 from baton.models import PreparedSpecificQuery, DataObjectReplica
 from hgicommon.collections import Metadata
@@ -40,25 +44,202 @@ from cookiemonster.retriever.source.irods._constants import MODIFIED_METADATA_AT
     MODIFIED_COLLECTION_NAME_PROPERTY, MODIFIED_DATA_NAME_PROPERTY, MODIFIED_DATA_REPLICA_CHECKSUM_PROPERTY, \
     MODIFIED_DATA_TIMESTAMP_PROPERTY, MODIFIED_METADATA_TIMESTAMP_PROPERTY, MODIFIED_DATA_QUERY_ALIAS, \
     MODIFIED_METADATA_ATTRIBUTE_VALUE_PROPERTY, MODIFIED_METADATA_QUERY_ALIAS, MODIFIED_DATA_REPLICA_NUMBER_PROPERTY, \
-    MODIFIED_DATA_REPLICA_STATUS_PROPERTY
-from cookiemonster.retriever.source.irods.json_convert import DataObjectModificationJSONEncoder
-from cookiemonster.retriever.source.irods.models import DataObjectUpdate
+    MODIFIED_DATA_REPLICA_STATUS_PROPERTY, MODIFIED_DATA_ID_PROPERTY, MODIFIED_DATA_ID_ONLY_QUERY_ALIAS, \
+    MODIFIED_METADATA_ID_ONLY_QUERY_ALIAS, MODIFIED_DATA_IN_ID_RANGE_QUERY_ALIAS, \
+    MODIFIED_METADATA_IN_ID_RANGE_QUERY_ALIAS
+from cookiemonster.retriever.source.irods.json_convert import FastDataObjectModificationJSONEncoder
+from cookiemonster.retriever.source.irods.models import DataObjectUpdate, DataObjectModification
 
 _EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 _MAX_IRODS_TIMESTAMP = int(math.pow(2, 31)) - 1
+# The in-id-range specific queries cast IDs to (32-bit) integers
+_MAX_IRODS_ID = int(math.pow(2, 31)) - 1
+
+
+def _partition_into_id_ranges(ids: Iterable[int], number_of_partitions: int) -> List[Tuple[int, int]]:
+    """
+    Partitions the space of data object IDs into (at most) the given number of inclusive, contiguous ID ranges, each
+    containing roughly the same number of the given IDs.
+
+    The ranges cover every possible ID, not just those between the smallest and largest of the given IDs, so that a
+    data object that is modified after its ID could have been seen (e.g. between the id-only query and the queries for
+    the details) is still found.
+    :param ids: the IDs to partition
+    :param number_of_partitions: the maximum number of partitions
+    :return: list of tuples, where the first element is the lower bound and the second the upper bound of a range
+    """
+    ids = sorted(set(ids))
+    if len(ids) == 0:
+        return [(0, _MAX_IRODS_ID)]
+
+    partition_size = int(math.ceil(len(ids) / number_of_partitions))
+    upper_bounds = [ids[i + partition_size - 1] for i in range(0, len(ids) - partition_size, partition_size)]
+    upper_bounds.append(_MAX_IRODS_ID)
+    lower_bounds = [0] + [upper_bound + 1 for upper_bound in upper_bounds[:-1]]
+    return list(zip(lower_bounds, upper_bounds))
+
+
+def _row_to_data_object_update(object_as_json: dict) -> DataObjectUpdate:
+    """
+    Deserialises a row returned by one of the modified data or metadata specific queries into a model of the (single)
+    update that the row describes.
+    :param object_as_json: the row
+    :return: the update
+    """
+    metadata_update = MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY in object_as_json
+
+    path = "%s/%s" % (object_as_json[MODIFIED_COLLECTION_NAME_PROPERTY],
+                      object_as_json[MODIFIED_DATA_NAME_PROPERTY])
+    modified_at_as_string = object_as_json[MODIFIED_DATA_TIMESTAMP_PROPERTY] if not metadata_update \
+        else object_as_json[MODIFIED_METADATA_TIMESTAMP_PROPERTY]
+    modified_at = datetime.fromtimestamp(int(modified_at_as_string), tz=timezone.utc)
+    data_object_update = DataObjectUpdate(path, modified_at)
+
+    if metadata_update:
+        key = object_as_json[MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY]
+        value = object_as_json[MODIFIED_METADATA_ATTRIBUTE_VALUE_PROPERTY]
+        data_object_update.modification.modified_metadata = IrodsMetadata({key: {value}})
+    else:
+        replica_number = int(object_as_json[MODIFIED_DATA_REPLICA_NUMBER_PROPERTY])
+        checksum = object_as_json[MODIFIED_DATA_REPLICA_CHECKSUM_PROPERTY] \
+            if MODIFIED_DATA_REPLICA_CHECKSUM_PROPERTY in object_as_json else ""
+        up_to_date = bool(object_as_json[MODIFIED_DATA_REPLICA_STATUS_PROPERTY])
+
+        replica = DataObjectReplica(replica_number, checksum, up_to_date=up_to_date)
+        data_object_update.modification.modified_replicas.add(replica)
+
+    return data_object_update
+
+
+class _UpdateRows(Sized):
+    """
+    Columnar store of the rows returned by the modified data and metadata specific queries. Rows related to the same
+    data object can be merged without first building a model of the update each row describes.
+    """
+    def __init__(self, rows: Iterable[Dict]=()):
+        self.paths = []     # type: List[str]
+        self.timestamps = []    # type: List[int]
+        self.metadata_keys = []     # type: List[Optional[str]]
+        self.metadata_values = []   # type: List[Optional[str]]
+        self.replica_numbers = []   # type: List[Optional[int]]
+        self.replica_checksums = []     # type: List[Optional[str]]
+        self.replica_statuses = []  # type: List[Optional[bool]]
+        self.extend(rows)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def extend(self, rows: Iterable[Dict]):
+        """
+        Adds the given rows to the columns.
+        :param rows: rows returned by the modified data or metadata specific queries
+        """
+        for row in rows:
+            self.paths.append("%s/%s" % (row[MODIFIED_COLLECTION_NAME_PROPERTY], row[MODIFIED_DATA_NAME_PROPERTY]))
+
+            if MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY in row:
+                self.timestamps.append(int(row[MODIFIED_METADATA_TIMESTAMP_PROPERTY]))
+                self.metadata_keys.append(row[MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY])
+                self.metadata_values.append(row[MODIFIED_METADATA_ATTRIBUTE_VALUE_PROPERTY])
+                self.replica_numbers.append(None)
+                self.replica_checksums.append(None)
+                self.replica_statuses.append(None)
+            else:
+                self.timestamps.append(int(row[MODIFIED_DATA_TIMESTAMP_PROPERTY]))
+                self.metadata_keys.append(None)
+                self.metadata_values.append(None)
+                self.replica_numbers.append(int(row[MODIFIED_DATA_REPLICA_NUMBER_PROPERTY]))
+                self.replica_checksums.append(row.get(MODIFIED_DATA_REPLICA_CHECKSUM_PROPERTY, ""))
+                self.replica_statuses.append(bool(row[MODIFIED_DATA_REPLICA_STATUS_PROPERTY]))
+
+    def combine_for_same_entity(self) -> List[DataObjectUpdate]:
+        """
+        Combines the rows related to the same entities into single "merged" updates, equivalent to those produced by
+        `BatonUpdateMapper._combine_updates_for_same_entity`. Rows are grouped by sorting on their path, therefore the
+        merged updates are ordered by path.
+        :return: the combined updates
+        """
+        paths = self.paths
+        timestamps = self.timestamps
+        metadata_keys = self.metadata_keys
+        metadata_values = self.metadata_values
+        replica_numbers = self.replica_numbers
+        replica_checksums = self.replica_checksums
+        replica_statuses = self.replica_statuses
+
+        combined_updates = []   # type: List[DataObjectUpdate]
+        for path, indices in groupby(sorted(range(len(paths)), key=paths.__getitem__), key=paths.__getitem__):
+            indices = list(indices)
+            modification = DataObjectModification()
+
+            for i in indices:
+                key = metadata_keys[i]
+                if key is not None:
+                    modification.modified_metadata.add(key, metadata_values[i])
+                else:
+                    modification.modified_replicas.add(
+                        DataObjectReplica(replica_numbers[i], replica_checksums[i], up_to_date=replica_statuses[i]))
+
+            # Merged updates have the timestamp of the most recent update that was merged into them
+            timestamp = datetime.fromtimestamp(max(timestamps[i] for i in indices), tz=timezone.utc)
+            combined_updates.append(DataObjectUpdate(path, timestamp, modification))
+
+        return combined_updates
 
 
 class BatonUpdateMapper(BatonCustomObjectMapper[DataObjectUpdate], UpdateMapper):
     """
     Retrieves updates from iRODS using baton.
     """
-    DATA_OBJECT_MODIFICATION_JSON_ENCODER = DataObjectModificationJSONEncoder()
+    DATA_OBJECT_MODIFICATION_JSON_ENCODER = FastDataObjectModificationJSONEncoder()
 
-    def __init__(self, baton_binaries_directory: str, zone: str=None):
+    def __init__(self, baton_binaries_directory: str, zone: str=None, number_of_shards: int=1):
+        """
+        Constructor.
+        :param baton_binaries_directory: the directory containing the baton binaries
+        :param zone: the iRODS zone to query
+        :param number_of_shards: the number of data object ID ranges to split the retrieval of updates across. If
+        greater than 1, the id-only and in-id-range specific queries must also be installed on the iRODS server
+        """
+        if number_of_shards < 1:
+            raise ValueError("Number of shards must be at least 1, not %d" % number_of_shards)
         super().__init__(baton_binaries_directory)
         self.zone = zone
+        self.number_of_shards = number_of_shards
 
     def get_all_since(self, since: datetime) -> UpdateCollection:
+        combined_modifications = self._get_combined_modifications_since(since)
+
+        # Package modifications into `UpdateCollection`
+        started_at = time.monotonic()
+        updates = BatonUpdateMapper._data_object_updates_to_generic_update_collection(combined_modifications)
+        logging.info("Took %f seconds (wall time) to convert %d updates to generic updates that can be stored in the "
+                     "knowledge base" % (time.monotonic() - started_at, len(combined_modifications)))
+
+        return updates
+
+    def get_all_since_in_batches(self, since: datetime, batch_size: int) -> Iterable[UpdateCollection]:
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1, not %d" % batch_size)
+
+        # Updates to the same entity have to be merged before any can be released, therefore it is only the conversion
+        # to generic updates that can be streamed
+        combined_modifications = list(self._get_combined_modifications_since(since))
+
+        started_at = time.monotonic()
+        for i in range(0, len(combined_modifications), batch_size):
+            yield BatonUpdateMapper._data_object_updates_to_generic_update_collection(
+                combined_modifications[i:i + batch_size])
+        logging.info("Took %f seconds (wall time) to convert and stream %d updates to generic updates that can be "
+                     "stored in the knowledge base" % (time.monotonic() - started_at, len(combined_modifications)))
+
+    def _get_combined_modifications_since(self, since: datetime) -> Sequence[DataObjectUpdate]:
+        """
+        Gets all of the data object updates that have happened since the given time from iRODS, with the updates to
+        the same data object merged together.
+        :param since: the time at which to get updates from
+        :return: the merged data object updates
+        """
         # iRODS works with Epoch time therefore ensure `since` is localised as UTC
         since = localise_to_utc(since)
 
@@ -67,71 +248,84 @@ class BatonUpdateMapper(BatonCustomObjectMapper[DataObjectUpdate], UpdateMapper)
 
         since_timestamp = str(int(since.timestamp()))
         until_timestamp = str(_MAX_IRODS_TIMESTAMP)
-
         arguments = [since_timestamp, until_timestamp]
-        aliases = [MODIFIED_DATA_QUERY_ALIAS, MODIFIED_METADATA_QUERY_ALIAS]
-        all_updates = []  # type: List[DataObjectUpdate]
-        semaphore = Semaphore(0)
-        error = None    # type: Optional(Exception)
-
-        def run_threaded(alias: str):
-            updates_query = PreparedSpecificQuery(alias, arguments)
-            try:
-                started_at = time.monotonic()
-                updates = self._get_with_prepared_specific_query(updates_query, zone=self.zone)
-                logging.info("Took %f seconds (wall time) to get and then parse %d iRODS updates using `%s` query"
-                             % (time.monotonic() - started_at, len(updates), alias))
-                all_updates.extend(list(updates))
-            except Exception as e:
-                nonlocal error
-                error = e
-            finally:
-                semaphore.release()
-
-        for alias in aliases:
-            Thread(target=run_threaded, args=(alias, )).start()
-        for _ in range(len(aliases)):
-            semaphore.acquire()
-            if error is not None:
-                raise error
+
+        if self.number_of_shards == 1:
+            queries = [PreparedSpecificQuery(alias, arguments)
+                       for alias in [MODIFIED_DATA_QUERY_ALIAS, MODIFIED_METADATA_QUERY_ALIAS]]
+        else:
+            queries = self._get_sharded_queries(arguments)
+
+        rows = _UpdateRows()
+        with ThreadPoolExecutor(max_workers=max(len(queries), 1)) as executor:
+            for query_rows in executor.map(self._get_rows_with_query, queries):
+                rows.extend(query_rows)
 
         started_at = time.monotonic()
-        combined_modifications = BatonUpdateMapper._combine_updates_for_same_entity(all_updates)
+        combined_modifications = rows.combine_for_same_entity()
         logging.info("Took %f seconds (wall time) to merge %d updates related to %d data objects"
-                     % (time.monotonic() - started_at, len(all_updates), len(combined_modifications)))
+                     % (time.monotonic() - started_at, len(rows), len(combined_modifications)))
 
-        # Package modifications into `UpdateCollection`
+        return combined_modifications
+
+    def _get_rows_with_query(self, query: PreparedSpecificQuery) -> List[Dict]:
+        """
+        Gets the (not deserialised) rows returned by the given specific query.
+        :param query: the prepared specific query
+        :return: the rows
+        """
         started_at = time.monotonic()
-        updates = BatonUpdateMapper._data_object_updates_to_generic_update_collection(combined_modifications)
-        logging.info("Took %f seconds (wall time) to convert %d updates to generic updates that can be stored in the "
-                     "knowledge base" % (time.monotonic() - started_at, len(combined_modifications)))
+        rows = self._get_raw_with_prepared_specific_query(query)
+        logging.info("Took %f seconds (wall time) to get and then parse %d iRODS updates using `%s` query with "
+                     "arguments %s" % (time.monotonic() - started_at, len(rows), query.alias, query.query_arguments))
+        return rows
 
-        return updates
+    def _get_sharded_queries(self, arguments: List[str]) -> List[PreparedSpecificQuery]:
+        """
+        Uses the (cheap) id-only specific queries to find the IDs of the data objects that have been modified and then
+        creates queries for the details of those modifications, where each query covers a range of IDs that contains
+        roughly the same number of modified data objects. Between them, the ranges cover all IDs, as data objects may be
+        modified after the id-only queries.
+        :param arguments: the arguments given to the id-only and partial specific queries
+        :return: the queries to get the modification details with
+        """
+        id_queries = [
+            (MODIFIED_DATA_ID_ONLY_QUERY_ALIAS, MODIFIED_DATA_IN_ID_RANGE_QUERY_ALIAS),
+            (MODIFIED_METADATA_ID_ONLY_QUERY_ALIAS, MODIFIED_METADATA_IN_ID_RANGE_QUERY_ALIAS)
+        ]
+
+        def get_ids(id_only_alias: str) -> List[int]:
+            started_at = time.monotonic()
+            id_only_query = PreparedSpecificQuery(id_only_alias, arguments)
+            ids = self._get_raw_with_prepared_specific_query(id_only_query)
+            logging.info("Took %f seconds (wall time) to get the IDs of %d modified data objects using `%s` query"
+                         % (time.monotonic() - started_at, len(ids), id_only_alias))
+            return [int(row[MODIFIED_DATA_ID_PROPERTY]) for row in ids]
+
+        queries = []    # type: List[PreparedSpecificQuery]
+        with ThreadPoolExecutor(max_workers=len(id_queries)) as executor:
+            modified_ids = executor.map(get_ids, [id_only_alias for id_only_alias, _ in id_queries])
+
+            for ids, (_, in_id_range_alias) in zip(modified_ids, id_queries):
+                for lower, upper in _partition_into_id_ranges(ids, self.number_of_shards):
+                    queries.append(PreparedSpecificQuery(in_id_range_alias, arguments + [str(lower), str(upper)]))
+
+        return queries
+
+    def _get_raw_with_prepared_specific_query(self, specific_query: PreparedSpecificQuery) -> List[Dict]:
+        """
+        Gets the (not deserialised) results of the given prepared specific query.
+        :param specific_query: the prepared specific query
+        :return: the JSON results
+        """
+        specific_query_as_baton_json = {
+            BATON_SPECIFIC_QUERY_PROPERTY: PreparedSpecificQueryJSONEncoder().default(specific_query)
+        }
+        arguments = ["--zone", self.zone] if self.zone is not None else []
+        return self.run_baton_query(BatonBinary.BATON_SPECIFIC_QUERY, arguments, input_data=specific_query_as_baton_json)
 
     def _object_deserialiser(self, object_as_json: dict) -> DataObjectUpdate:
-        metadata_update = MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY in object_as_json
-
-        path = "%s/%s" % (object_as_json[MODIFIED_COLLECTION_NAME_PROPERTY],
-                          object_as_json[MODIFIED_DATA_NAME_PROPERTY])
-        modified_at_as_string = object_as_json[MODIFIED_DATA_TIMESTAMP_PROPERTY] if not metadata_update \
-            else object_as_json[MODIFIED_METADATA_TIMESTAMP_PROPERTY]
-        modified_at = datetime.fromtimestamp(int(modified_at_as_string), tz=timezone.utc)
-        data_object_update = DataObjectUpdate(path, modified_at)
-
-        if metadata_update:
-            key = object_as_json[MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY]
-            value = object_as_json[MODIFIED_METADATA_ATTRIBUTE_VALUE_PROPERTY]
-            data_object_update.modification.modified_metadata = IrodsMetadata({key: {value}})
-        else:
-            replica_number = int(object_as_json[MODIFIED_DATA_REPLICA_NUMBER_PROPERTY])
-            checksum = object_as_json[MODIFIED_DATA_REPLICA_CHECKSUM_PROPERTY] \
-                if MODIFIED_DATA_REPLICA_CHECKSUM_PROPERTY in object_as_json else ""
-            up_to_date = bool(object_as_json[MODIFIED_DATA_REPLICA_STATUS_PROPERTY])
-
-            replica = DataObjectReplica(replica_number, checksum, up_to_date=up_to_date)
-            data_object_update.modification.modified_replicas.add(replica)
-
-        return data_object_update
+        return _row_to_data_object_update(object_as_json)
 
     @staticmethod
     def _combine_updates_for_same_entity(updates: Sequence[DataObjectUpdate]) -> Sequence[DataObjectUpdate]:
@@ -20,8 +20,14 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+from json import JSONEncoder
+
+from baton._baton._constants import BATON_AVU_ATTRIBUTE_PROPERTY, BATON_AVU_VALUE_PROPERTY, \
+    BATON_REPLICA_NUMBER_PROPERTY, BATON_REPLICA_CHECKSUM_PROPERTY, BATON_REPLICA_LOCATION_PROPERTY, \
+    BATON_REPLICA_RESOURCE_PROPERTY, BATON_REPLICA_VALID_PROPERTY
 from baton._baton.json import DataObjectReplicaCollectionJSONDecoder, IrodsMetadataJSONEncoder, IrodsMetadataJSONDecoder, \
     DataObjectReplicaCollectionJSONEncoder
+from hgijson.types import PrimitiveJsonSerializableType
 from hgijson.json.builders import MappingJSONEncoderClassBuilder, MappingJSONDecoderClassBuilder
 from hgijson.json.models import JsonPropertyMapping
 
@@ -46,3 +52,37 @@ DataObjectModificationJSONEncoder = MappingJSONEncoderClassBuilder(
     DataObjectModification, _data_object_modification_json_mappings, (_IrodsEntityModificationJSONEncoder,)).build()
 DataObjectModificationJSONDecoder = MappingJSONDecoderClassBuilder(
     DataObjectModification, _data_object_modification_json_mappings, (_IrodsEntityModificationJSONDecoder,)).build()
+
+
+class FastDataObjectModificationJSONEncoder(JSONEncoder):
+    """
+    JSON encoder for `DataObjectModification` that produces the same output as `DataObjectModificationJSONEncoder`
+    but builds it directly, rather than through the generic property mappings.
+    """
+    def default(self, data_object_modification: DataObjectModification) -> PrimitiveJsonSerializableType:
+        if not isinstance(data_object_modification, DataObjectModification):
+            return super().default(data_object_modification)
+
+        modified_metadata = [
+            {BATON_AVU_ATTRIBUTE_PROPERTY: key, BATON_AVU_VALUE_PROPERTY: value}
+            for key, values in data_object_modification.modified_metadata.items()
+            for value in values
+        ]
+
+        modified_replicas = []
+        for replica in data_object_modification.modified_replicas:
+            replica_as_json = {
+                BATON_REPLICA_NUMBER_PROPERTY: replica.number,
+                BATON_REPLICA_CHECKSUM_PROPERTY: replica.checksum,
+                BATON_REPLICA_VALID_PROPERTY: replica.up_to_date
+            }
+            if replica.host is not None:
+                replica_as_json[BATON_REPLICA_LOCATION_PROPERTY] = replica.host
+            if replica.resource_name is not None:
+                replica_as_json[BATON_REPLICA_RESOURCE_PROPERTY] = replica.resource_name
+            modified_replicas.append(replica_as_json)
+
+        return {
+            "modified_metadata": modified_metadata,
+            "modified_replicas": modified_replicas
+        }
@@ -0,0 +1,206 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import sqlite3
+import time
+from abc import ABCMeta, abstractmethod
+from bisect import bisect_right
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+
+from cookiemonster.common.collections import UpdateCollection
+from cookiemonster.common.helpers import localise_to_utc
+from cookiemonster.retriever.mappers import UpdateMapper
+from cookiemonster.retriever.source.irods._constants import MODIFIED_DATA_TIMESTAMP_PROPERTY, \
+    MODIFIED_METADATA_TIMESTAMP_PROPERTY
+from cookiemonster.retriever.source.irods.baton_mappers import BatonUpdateMapper, _UpdateRows, _EPOCH, \
+    _MAX_IRODS_TIMESTAMP
+
+
+def _get_row_timestamp(row: Dict) -> int:
+    """
+    Gets the timestamp of the modification described by the given row.
+    :param row: row in the format returned by the modified data or metadata specific queries
+    :return: the timestamp (seconds since the Epoch)
+    """
+    if MODIFIED_DATA_TIMESTAMP_PROPERTY in row:
+        return int(row[MODIFIED_DATA_TIMESTAMP_PROPERTY])
+    return int(row[MODIFIED_METADATA_TIMESTAMP_PROPERTY])
+
+
+class _ReplayUpdateMapper(UpdateMapper, metaclass=ABCMeta):
+    """
+    Retrieves updates from a local dataset of rows in the same format as those returned by the iRODS modified data and
+    metadata specific queries, optionally replaying them at a controlled rate.
+
+    When replaying, the dataset's clock starts at the earliest timestamp in the dataset when updates are first
+    requested and then advances `replay_speed` times faster than wall time. Only rows with a timestamp at or before the
+    dataset's clock are served.
+    """
+    def __init__(self, replay_speed: float=None):
+        """
+        Constructor.
+        :param replay_speed: the number of seconds of the dataset that are replayed per second of wall time. If `None`,
+        all updates in the dataset are available immediately
+        """
+        if replay_speed is not None and replay_speed <= 0:
+            raise ValueError("Replay speed must be positive, not %s" % replay_speed)
+        self.replay_speed = replay_speed
+        self._replay_started_at = None  # type: Optional[float]
+        self._replay_origin = None  # type: Optional[int]
+        self._replay_lock = Lock()
+
+    def get_all_since(self, since: datetime) -> UpdateCollection:
+        since = localise_to_utc(since)
+        if since < _EPOCH:
+            since = _EPOCH
+
+        rows = self._get_rows(int(since.timestamp()), self._get_replay_timestamp())
+        combined_modifications = _UpdateRows(rows).combine_for_same_entity()
+        return BatonUpdateMapper._data_object_updates_to_generic_update_collection(combined_modifications)
+
+    @abstractmethod
+    def _get_rows(self, since_timestamp: int, until_timestamp: int) -> List[Dict]:
+        """
+        Gets the rows in the dataset with a timestamp in the given range.
+        :param since_timestamp: the timestamp to get rows from (exclusive)
+        :param until_timestamp: the timestamp to get rows until (inclusive)
+        :return: the rows
+        """
+
+    @abstractmethod
+    def _get_earliest_timestamp(self) -> Optional[int]:
+        """
+        Gets the earliest timestamp of the rows in the dataset.
+        :return: the earliest timestamp, `None` if the dataset is empty
+        """
+
+    def _get_replay_timestamp(self) -> int:
+        """
+        Gets the timestamp that the replay of the dataset has reached, starting the replay if this is the first call.
+        :return: the timestamp that rows can be served until (inclusive)
+        """
+        if self.replay_speed is None:
+            return _MAX_IRODS_TIMESTAMP
+
+        with self._replay_lock:
+            if self._replay_started_at is None:
+                self._replay_origin = self._get_earliest_timestamp()
+                self._replay_started_at = time.monotonic()
+
+        if self._replay_origin is None:
+            return _MAX_IRODS_TIMESTAMP
+
+        elapsed = time.monotonic() - self._replay_started_at
+        return self._replay_origin + int(elapsed * self.replay_speed)
+
+
+class FileUpdateMapper(_ReplayUpdateMapper):
+    """
+    Retrieves updates from a JSON file containing a list of rows in the format returned by the iRODS modified data and
+    metadata specific queries (i.e. the output of `baton-specificquery`).
+    """
+    @staticmethod
+    def write_rows(file_location: str, rows: Iterable[Dict]):
+        """
+        Writes the given rows to a file that can be used as the dataset of a `FileUpdateMapper`.
+        :param file_location: the location of the file to write
+        :param rows: the rows to write
+        """
+        with open(file_location, "w") as file:
+            json.dump(list(rows), file)
+
+    def __init__(self, file_location: str, replay_speed: float=None):
+        """
+        Constructor.
+        :param file_location: the location of the JSON file containing the rows
+        :param replay_speed: see `_ReplayUpdateMapper.__init__`
+        """
+        super().__init__(replay_speed)
+        with open(file_location, "r") as file:
+            rows = json.load(file)
+
+        timestamped_rows = sorted(((_get_row_timestamp(row), row) for row in rows), key=lambda pair: pair[0])
+        self._timestamps = [timestamp for timestamp, _ in timestamped_rows]
+        self._rows = [row for _, row in timestamped_rows]
+
+    def _get_rows(self, since_timestamp: int, until_timestamp: int) -> List[Dict]:
+        start = bisect_right(self._timestamps, since_timestamp)
+        end = bisect_right(self._timestamps, until_timestamp)
+        return self._rows[start:end]
+
+    def _get_earliest_timestamp(self) -> Optional[int]:
+        return self._timestamps[0] if len(self._timestamps) > 0 else None
+
+
+class SQLiteUpdateMapper(_ReplayUpdateMapper):
+    """
+    Retrieves updates from a SQLite database of rows in the format returned by the iRODS modified data and metadata
+    specific queries. The database is expected to have been created with `SQLiteUpdateMapper.write_rows`.
+    """
+    _TABLE_NAME = "modifications"
+
+    @staticmethod
+    def write_rows(database_location: str, rows: Iterable[Dict]):
+        """
+        Writes the given rows to a SQLite database that can be used as the dataset of a `SQLiteUpdateMapper`, creating
+        the database if it does not exist.
+        :param database_location: the location of the database
+        :param rows: the rows to write
+        """
+        connection = sqlite3.connect(database_location)
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS %s (timestamp INTEGER NOT NULL, row TEXT NOT NULL)"
+                                   % SQLiteUpdateMapper._TABLE_NAME)
+                connection.execute("CREATE INDEX IF NOT EXISTS %s_timestamp ON %s (timestamp)"
+                                   % (SQLiteUpdateMapper._TABLE_NAME, SQLiteUpdateMapper._TABLE_NAME))
+                connection.executemany("INSERT INTO %s (timestamp, row) VALUES (?, ?)" % SQLiteUpdateMapper._TABLE_NAME,
+                                       ((_get_row_timestamp(row), json.dumps(row)) for row in rows))
+        finally:
+            connection.close()
+
+    def __init__(self, database_location: str, replay_speed: float=None):
+        """
+        Constructor.
+        :param database_location: the location of the SQLite database containing the rows
+        :param replay_speed: see `_ReplayUpdateMapper.__init__`
+        """
+        super().__init__(replay_speed)
+        self.database_location = database_location
+
+    def _get_rows(self, since_timestamp: int, until_timestamp: int) -> List[Dict]:
+        # Connections are not shared as retrievals may happen on different threads
+        connection = sqlite3.connect(self.database_location)
+        try:
+            cursor = connection.execute("SELECT row FROM %s WHERE timestamp > ? AND timestamp <= ?" % self._TABLE_NAME,
+                                        (since_timestamp, until_timestamp))
+            return [json.loads(row) for row, in cursor]
+        finally:
+            connection.close()
+
+    def _get_earliest_timestamp(self) -> Optional[int]:
+        connection = sqlite3.connect(self.database_location)
+        try:
+            return connection.execute("SELECT MIN(timestamp) FROM %s" % self._TABLE_NAME).fetchone()[0]
+        finally:
+            connection.close()
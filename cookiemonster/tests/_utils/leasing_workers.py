@@ -0,0 +1,198 @@
+"""
+Multi-Process Leasing Workers
+=============================
+Harness for running several `BiscuitTin` consumers, with leasing, in
+separate processes against the same (e.g., fake) CouchDB server, as
+horizontally scaled processors would be, optionally alongside a process
+that keeps marking the cookies for processing, as the retriever would.
+
+Exportable classes: `Processed`
+Exportable functions: `create_queue`, `start_workers`, `start_marker`,
+                      `collect_processed`
+
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+from datetime import timedelta
+from random import Random
+from time import monotonic, sleep, time
+from typing import Dict, List, NamedTuple, Optional
+
+from cookiemonster.cookiejar.biscuit_tin import BiscuitTin
+
+# Processes are spawned, rather than forked, such that they don't
+# inherit the parent's threads (e.g., the fake CouchDB server)
+_CONTEXT = multiprocessing.get_context("spawn")
+
+# The processing of a cookie by a worker
+Processed = NamedTuple("Processed", [("worker_id", str), ("started_at", float), ("finished_at", float)])
+
+
+def _work(couchdb_url: str, database: str, worker_id: str, lease_duration: float, idle_timeout: float,
+          processed: multiprocessing.Queue, crash_after: Optional[int], processing_time: float):
+    """
+    Processes cookies until there have been none for the given time, reporting each one that is completed (with when
+    it was processed).
+    :param couchdb_url: the URL of the CouchDB server
+    :param database: the name of the database
+    :param worker_id: the worker ID, as the owner of the leases
+    :param lease_duration: the lease duration (in seconds)
+    :param idle_timeout: the time without any cookies after which to stop (in seconds)
+    :param processed: queue onto which the worker ID and identifier of completed cookies are put
+    :param crash_after: the number of cookies to complete before dying, while holding a lease (None to not die)
+    :param processing_time: the time taken to process each cookie (in seconds)
+    """
+    logging.disable(logging.CRITICAL)
+    cookie_jar = BiscuitTin(couchdb_url, database, 10, timedelta(milliseconds=20), follow_changes=True,
+                            lease_duration=timedelta(seconds=lease_duration), worker_id=worker_id)
+
+    completed = 0
+    idle_since = monotonic()
+    while monotonic() - idle_since < idle_timeout:
+        cookie = cookie_jar.get_next_for_processing()
+        if cookie is None:
+            sleep(0.05)
+            continue
+
+        if crash_after is not None and completed >= crash_after:
+            # Die without finishing, or giving up the lease
+            os._exit(1)
+
+        started_at = time()
+        sleep(processing_time)
+        finished_at = time()
+        cookie_jar.mark_as_complete(cookie.identifier)
+        processed.put((cookie.identifier, Processed(worker_id, started_at, finished_at)))
+        completed += 1
+        idle_since = monotonic()
+
+    cookie_jar.stop()
+
+
+def _mark(couchdb_url: str, database: str, identifiers: List[str], lease_duration: float, duration: float):
+    """
+    Marks random cookies for processing, from the same cookie jar instance (such that it has cached copies of their
+    queue documents), for the given time.
+    :param couchdb_url: the URL of the CouchDB server
+    :param database: the name of the database
+    :param identifiers: the identifiers of the cookies to mark for processing
+    :param lease_duration: the lease duration (in seconds)
+    :param duration: the time for which to keep marking cookies for processing (in seconds)
+    """
+    logging.disable(logging.CRITICAL)
+    cookie_jar = BiscuitTin(couchdb_url, database, 10, timedelta(milliseconds=20),
+                            lease_duration=timedelta(seconds=lease_duration), worker_id="marker-%s" % os.getpid())
+
+    random = Random(os.getpid())
+    stop_at = monotonic() + duration
+    while monotonic() < stop_at:
+        cookie_jar.mark_for_processing(random.choice(identifiers))
+        sleep(0.01)
+
+    cookie_jar.stop()
+
+
+def start_marker(couchdb_url: str, database: str, identifiers: List[str], lease_duration: timedelta,
+                 duration: timedelta) -> multiprocessing.Process:
+    """
+    Starts a process that keeps marking the given cookies for processing, while workers hold leases on them.
+    :param couchdb_url: the URL of the CouchDB server
+    :param database: the name of the database
+    :param identifiers: the identifiers of the cookies to mark for processing
+    :param lease_duration: the lease duration
+    :param duration: the time for which to keep marking cookies for processing
+    :return: the started process
+    """
+    marker = _CONTEXT.Process(target=_mark, args=(couchdb_url, database, identifiers, lease_duration.total_seconds(),
+                                                  duration.total_seconds()))
+    marker.start()
+    return marker
+
+
+def start_workers(couchdb_url: str, database: str, number_of_workers: int, lease_duration: timedelta,
+                  idle_timeout: timedelta, processed: multiprocessing.Queue, crash_after: Optional[int]=None,
+                  processing_time: timedelta=timedelta(0)) -> List[multiprocessing.Process]:
+    """
+    Starts worker processes, each consuming the queue of the given database with leasing.
+    :param couchdb_url: the URL of the CouchDB server
+    :param database: the name of the database
+    :param number_of_workers: the number of worker processes
+    :param lease_duration: the lease duration
+    :param idle_timeout: the time without any cookies after which the workers stop
+    :param processed: queue (from `create_queue`) onto which completed cookies are reported
+    :param crash_after: the number of cookies each worker completes before dying (None to not die)
+    :param processing_time: the time each worker takes to process a cookie
+    :return: the started worker processes
+    """
+    workers = [
+        _CONTEXT.Process(target=_work, args=(couchdb_url, database, "worker-%d-%s" % (i, os.getpid()),
+                                             lease_duration.total_seconds(), idle_timeout.total_seconds(),
+                                             processed, crash_after, processing_time.total_seconds()))
+        for i in range(number_of_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def create_queue() -> multiprocessing.Queue:
+    """
+    Creates a queue onto which workers can report completed cookies.
+    :return: the queue
+    """
+    return _CONTEXT.Queue()
+
+
+def collect_processed(workers: List[multiprocessing.Process], processed: multiprocessing.Queue,
+                      timeout: timedelta) -> Dict[str, List[Processed]]:
+    """
+    Waits for the workers to stop, collecting the cookies they completed.
+    :param workers: the worker processes
+    :param processed: queue onto which completed cookies are reported
+    :param timeout: the maximum time to wait
+    :return: the processing of each cookie by the workers that completed it, keyed by the cookie's identifier
+    """
+    completed_by = {}
+    deadline = monotonic() + timeout.total_seconds()
+
+    def drain():
+        while True:
+            try:
+                identifier, processing = processed.get_nowait()
+            except queue.Empty:
+                return
+            completed_by.setdefault(identifier, []).append(Processed(*processing))
+
+    # Drained while waiting, as a process can't exit until its queued
+    # items have been consumed
+    while any(worker.is_alive() for worker in workers) and monotonic() < deadline:
+        drain()
+        sleep(0.05)
+
+    for worker in workers:
+        worker.join(max(deadline - monotonic(), 0))
+        if worker.is_alive():
+            worker.terminate()
+    drain()
+
+    return completed_by
@@ -0,0 +1,109 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import unittest
+from unittest.mock import patch
+
+from cookiemonster.benchmarks._measurements import Timings, percentile, summarise
+from cookiemonster.benchmarks.pipeline import SCENARIOS, run, IN_MEMORY_COOKIE_JAR, COUCHDB_COOKIE_JAR, \
+    SQLITE_COOKIE_JAR
+from cookiemonster.cookiejar.in_memory_cookiejar import InMemoryCookieJar
+
+_SMALL_PARAMETERS = {
+    "number_of_cookies": 10,
+    "enrichments_per_cookie": 2,
+    "number_of_rules": 5,
+    "number_of_enrichments": 5,
+    "number_of_evaluations": 2,
+    "number_of_rows": 100,
+    "batch_size": 10
+}
+
+
+class TestScenarios(unittest.TestCase):
+    """
+    Tests for the pipeline benchmark scenarios.
+    """
+    def test_scenarios_with_in_memory_cookie_jar(self):
+        for name, scenario in SCENARIOS.items():
+            timings = Timings()
+            scenario(InMemoryCookieJar(), timings, **_SMALL_PARAMETERS)
+            self.assertGreater(len(timings.latencies), 0, name)
+
+    def test_bulk_enrich_with_threads(self):
+        cookie_jar = InMemoryCookieJar()
+        timings = Timings()
+        SCENARIOS["bulk_enrich"](cookie_jar, timings, **{**_SMALL_PARAMETERS, "number_of_threads": 4})
+        self.assertEqual(len(timings.latencies), 20)
+        self.assertEqual(len(cookie_jar.fetch_cookie("/cookie/0").enrichments), 2)
+        self.assertEqual(cookie_jar.queue_length(), 10)
+
+    def test_run_skips_couchdb_without_url(self):
+        results = run(["bulk_enrich"], [IN_MEMORY_COOKIE_JAR, COUCHDB_COOKIE_JAR], parameters=_SMALL_PARAMETERS)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]["operations"], 20)
+        self.assertGreater(results[0]["peak_rss_kb"], 0)
+        self.assertIn("skipped", results[1])
+
+    def test_run_against_sqlite(self):
+        results = run(["bulk_enrich", "dequeue_complete_churn"], [SQLITE_COOKIE_JAR], parameters=_SMALL_PARAMETERS)
+        self.assertEqual([result["operations"] for result in results], [20, 10])
+
+    def test_run_against_fake_couchdb(self):
+        results = run(["bulk_enrich", "dequeue_complete_churn"], [COUCHDB_COOKIE_JAR], parameters=_SMALL_PARAMETERS,
+                      fake_couchdb=True, fake_couchdb_latency=0.001)
+        self.assertEqual([result["operations"] for result in results], [20, 10])
+        self.assertEqual(results[0]["fake_couchdb"]["latency"], 0.001)
+
+    def test_run_against_fake_couchdb_with_failures(self):
+        # Failed requests are retried by the cookie jar, after a (shortened) grace time
+        with patch.dict(os.environ, {"COOKIEMONSTER_COUCHDB_GRACE": "1", "COOKIEMONSTER_COUCHDB_MAX_GRACE": "10"}):
+            results = run(["bulk_enrich"], [COUCHDB_COOKIE_JAR], parameters=_SMALL_PARAMETERS, fake_couchdb=True,
+                          fake_couchdb_failure_rate=0.1)
+        self.assertEqual(results[0]["operations"], 20)
+        self.assertEqual(results[0]["fake_couchdb"]["failure_rate"], 0.1)
+
+
+class TestMeasurements(unittest.TestCase):
+    """
+    Tests for the benchmark measurements.
+    """
+    def test_percentile(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertEqual(percentile([3.0], 0.99), 3.0)
+
+    def test_percentile_of_no_values(self):
+        self.assertRaises(ValueError, percentile, [], 0.5)
+
+    def test_summarise(self):
+        timings = Timings()
+        timings.time_all([lambda: None] * 4, 2)
+        summary = summarise(timings, 2.0)
+        self.assertEqual(summary["operations"], 4)
+        self.assertEqual(summary["operations_per_second"], 2.0)
+        self.assertLessEqual(summary["latency_p50"], summary["latency_p99"])
+
+
+if __name__ == "__main__":
+    unittest.main()
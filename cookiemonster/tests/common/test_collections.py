@@ -25,6 +25,7 @@ from copy import deepcopy
 from datetime import datetime, timedelta
 
 from cookiemonster.common.collections import UpdateCollection, EnrichmentCollection
+from cookiemonster.common.helpers import get_enrichment_changes_from_source
 from cookiemonster.common.models import Update, Enrichment
 from hgicommon.collections import Metadata
 
@@ -196,6 +197,64 @@ class TestEnrichmentCollection(unittest.TestCase):
         enrichments = self.enrichments.get_all_since_enrichment_from_source(source)
         self.assertCountEqual(enrichments, [_ENRICHMENT_3])
 
+    def test_add_with_same_timestamp_as_previous(self):
+        same_time = Enrichment("other_source", _ENRICHMENT_1.timestamp, Metadata())
+        self.enrichments.add([_ENRICHMENT_1, _ENRICHMENT_2])
+        self.enrichments.add(same_time)
+        self.assertSequenceEqual(self.enrichments, [_ENRICHMENT_1, same_time, _ENRICHMENT_2])
+
+    def test_get_changes_from_source_when_no_enrichments_from_source(self):
+        self.enrichments.add(_ENRICHMENT_1)
+        self.assertEqual(self.enrichments.get_changes_from_source("other_source"), [])
+
+    def test_get_changes_from_source_ignores_other_sources(self):
+        enrichments = self._create_mixed_source_enrichments()
+        self.enrichments.add(enrichments)
+        from_source = [enrichment for enrichment in enrichments if enrichment.source == "source"]
+        self.assertEqual(self.enrichments.get_changes_from_source("source"),
+                         get_enrichment_changes_from_source(from_source, "source"))
+
+    def test_get_changes_from_source_with_keys_and_since(self):
+        enrichments = self._create_mixed_source_enrichments()
+        self.enrichments.add(enrichments)
+        from_source = [enrichment for enrichment in enrichments if enrichment.source == "source"]
+        for keys in (None, "a", ["a", "b"]):
+            for since in (None, datetime(2016, 1, 1), datetime(2016, 1, 1, second=5), datetime(2017, 1, 1)):
+                self.assertEqual(self.enrichments.get_changes_from_source("source", keys, since),
+                                 get_enrichment_changes_from_source(from_source, "source", keys, since))
+
+    def test_get_changes_from_source_after_add(self):
+        enrichments = self._create_mixed_source_enrichments()
+        self.enrichments.add(enrichments[:6])
+        self.enrichments.get_changes_from_source("source")
+        for enrichment in reversed(enrichments[6:]):
+            self.enrichments.add(enrichment)
+            self.assertEqual(self.enrichments.get_changes_from_source("source"),
+                             EnrichmentCollection(self.enrichments).get_changes_from_source("source"))
+
+    def test_get_changes_from_source_with_enrichment_added_before_previous(self):
+        enrichments = self._create_mixed_source_enrichments()
+        self.enrichments.add(enrichments[1:])
+        self.enrichments.get_changes_from_source("source", "a")
+        self.enrichments.add(enrichments[0])
+        self.assertEqual(self.enrichments.get_changes_from_source("source", "a"),
+                         EnrichmentCollection(enrichments).get_changes_from_source("source", "a"))
+
+    @staticmethod
+    def _create_mixed_source_enrichments():
+        """
+        Creates enrichments from two sources, where the metadata from "source" changes in a number of ways over time.
+        :return: the enrichments, in time order
+        """
+        enrichments = []
+        for i in range(12):
+            timestamp = datetime(2016, 1, 1, second=i)
+            metadata = Metadata({"a": i // 3, "b": i // 4})
+            if i % 5 != 0:
+                metadata["c"] = i
+            enrichments.append(Enrichment("source" if i % 3 != 2 else "other_source", timestamp, metadata))
+        return enrichments
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -20,11 +20,16 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import json
+import random
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from typing import Any
+from unittest.mock import patch
 
 from cookiemonster.common.collections import UpdateCollection, EnrichmentCollection
-from cookiemonster.common.helpers import get_enrichment_changes_from_source
+from cookiemonster.common.helpers import get_enrichment_changes_from_source, EnrichmentJSONEncoder, \
+    EnrichmentJSONDecoder, FastEnrichmentJSONEncoder, FastEnrichmentJSONDecoder, decode_enrichment, encode_enrichment
 from cookiemonster.common.models import Update, Enrichment, EnrichmentDiff
 from hgicommon.collections import Metadata
 
@@ -96,6 +101,112 @@ class TestEnrichmentCollection(unittest.TestCase):
         self.assertEqual(diff.additions, Metadata({'bar': 123}))
         self.assertEqual(diff.deletions, Metadata({'foo': 123}))
 
+    def test_enrichment_diff_restricted_to_keys(self):
+        self.enrichments.add(Enrichment('source', datetime(1, 1, 1), Metadata({'foo': 123, 'bar': 456, 'quux': 789})))
+        self.enrichments.add(Enrichment('source', datetime(2, 2, 2), Metadata({'xyz': 123, 'bar': 456, 'quux': 999})))
+
+        diff = get_enrichment_changes_from_source(self.enrichments, 'source')[0]
+        restricted = diff.restricted_to(['foo', 'bar'])
+        self.assertEqual(restricted, get_enrichment_changes_from_source(self.enrichments, 'source', ['foo', 'bar'])[0])
+        self.assertEqual(diff.additions, Metadata({'xyz': 123, 'quux': 999}))
+
+
+class TestEnrichmentJSON(unittest.TestCase):
+    """
+    Tests for `EnrichmentJSONEncoder` and `EnrichmentJSONDecoder`.
+    """
+    def setUp(self):
+        self.enrichment = Enrichment('source', datetime(2016, 1, 1, tzinfo=timezone.utc), Metadata({'key': 'value'}))
+
+    def test_round_trip(self):
+        encoded = json.dumps(self.enrichment, cls=EnrichmentJSONEncoder)
+        self.assertEqual(json.loads(encoded, cls=EnrichmentJSONDecoder), self.enrichment)
+
+    def test_decoded_metadata_keys_interned(self):
+        encoded = json.dumps(self.enrichment, cls=EnrichmentJSONEncoder).replace('"key"', '"%s"' % ('x' * 50))
+        keys = [next(iter(json.loads(encoded, cls=EnrichmentJSONDecoder).metadata.keys())) for _ in range(2)]
+        self.assertIs(keys[0], keys[1])
+
+
+def _random_value(rng: random.Random, depth: int=0) -> Any:
+    """
+    Generates a random JSON value.
+    :param rng: the random number generator
+    :param depth: how deeply nested the value is
+    :return: the value
+    """
+    kind = rng.randrange(7 if depth < 3 else 5)
+    if kind == 0:
+        return None
+    elif kind == 1:
+        return rng.random() < 0.5
+    elif kind == 2:
+        return rng.randint(-2 ** 63, 2 ** 63)
+    elif kind == 3:
+        return rng.uniform(-1e6, 1e6)
+    elif kind == 4:
+        return "".join(rng.choice("abc/_ \"\\\u00e9\u2603\U0001f36a") for _ in range(rng.randrange(10)))
+    elif kind == 5:
+        return [_random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+    else:
+        return {"key_%d" % rng.randrange(5): _random_value(rng, depth + 1) for _ in range(rng.randrange(4))}
+
+
+def _random_enrichment(rng: random.Random) -> Enrichment:
+    """
+    Generates a random enrichment.
+    :param rng: the random number generator
+    :return: the enrichment
+    """
+    microseconds = rng.choice([0, rng.randrange(10 ** 6)])
+    timestamp = datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=rng.randrange(2 ** 32),
+                                                                      microseconds=microseconds)
+    metadata = Metadata({"key_%d" % rng.randrange(10): _random_value(rng) for _ in range(rng.randrange(6))})
+    return Enrichment(rng.choice(["irods_update", "rule_application", "source"]), timestamp, metadata)
+
+
+class TestFastEnrichmentJSON(unittest.TestCase):
+    """
+    Tests for `FastEnrichmentJSONEncoder` and `FastEnrichmentJSONDecoder`, against the codec built from the generic
+    property mappings.
+    """
+    def setUp(self):
+        rng = random.Random(42)
+        self.enrichments = [_random_enrichment(rng) for _ in range(500)]
+
+    def test_same_encoding(self):
+        for enrichment in self.enrichments:
+            self.assertEqual(json.dumps(enrichment, cls=FastEnrichmentJSONEncoder),
+                             json.dumps(enrichment, cls=EnrichmentJSONEncoder))
+        self.assertEqual(FastEnrichmentJSONEncoder().default(self.enrichments),
+                         EnrichmentJSONEncoder().default(self.enrichments))
+
+    def test_same_decoding(self):
+        for enrichment in self.enrichments:
+            encoded = json.dumps(enrichment, cls=EnrichmentJSONEncoder)
+            decoded = json.loads(encoded, cls=FastEnrichmentJSONDecoder)
+            self.assertEqual(decoded, json.loads(encoded, cls=EnrichmentJSONDecoder))
+            self.assertEqual(decoded.timestamp, enrichment.timestamp.replace(microsecond=0))
+            self.assertEqual(decoded.metadata, enrichment.metadata)
+
+        encoded = json.dumps(self.enrichments, cls=EnrichmentJSONEncoder)
+        self.assertEqual(json.loads(encoded, cls=FastEnrichmentJSONDecoder),
+                         json.loads(encoded, cls=EnrichmentJSONDecoder))
+
+    def test_round_trip_through_dictionaries(self):
+        for enrichment in self.enrichments:
+            self.assertEqual(decode_enrichment({**encode_enrichment(enrichment), "_id": "ignored"}),
+                             json.loads(json.dumps(enrichment, cls=EnrichmentJSONEncoder), cls=EnrichmentJSONDecoder))
+
+    def test_decoding_falls_back_from_faster_parser(self):
+        def unsupported(encoded: str):
+            raise ValueError(encoded)
+
+        encoded = json.dumps(self.enrichments[0], cls=EnrichmentJSONEncoder)
+        with patch("cookiemonster.common.helpers._fast_loads", side_effect=unsupported):
+            self.assertEqual(json.loads(encoded, cls=FastEnrichmentJSONDecoder),
+                             json.loads(encoded, cls=EnrichmentJSONDecoder))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -22,12 +22,16 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import copy
+import pickle
 import unittest
-from datetime import datetime
+from datetime import datetime, timezone
 
 from cookiemonster.common.models import Cookie, Enrichment
 from hgicommon.collections import Metadata
 
+import pytz
+
 
 class TestCookie(unittest.TestCase):
     """
@@ -43,6 +47,59 @@ class TestCookie(unittest.TestCase):
         self._cookie.enrich(enrichment)
         self.assertCountEqual(self._cookie.enrichments, [enrichment])
 
+    def test_slotted(self):
+        self.assertFalse(hasattr(self._cookie, "__dict__"))
+
+    def test_equality(self):
+        self.assertEqual(self._cookie, Cookie(TestCookie._IDENTIFIER))
+        self.assertNotEqual(self._cookie, Cookie("other"))
+
+
+class TestEnrichment(unittest.TestCase):
+    """
+    Tests for `Enrichment`.
+    """
+    def setUp(self):
+        self.timestamp = datetime(2016, 1, 1, tzinfo=timezone.utc)
+        self.enrichment = Enrichment("".join(["sou", "rce"]), self.timestamp, Metadata({"key": "value"}))
+
+    def test_slotted(self):
+        self.assertFalse(hasattr(self.enrichment, "__dict__"))
+
+    def test_source_interned(self):
+        self.assertIs(self.enrichment.source, Enrichment("".join(["so", "urce"]), self.timestamp, Metadata()).source)
+
+    def test_timestamp_kept_as_epoch(self):
+        self.assertIsInstance(self.enrichment._timestamp, int)
+        self.assertEqual(self.enrichment.timestamp, self.timestamp)
+        self.assertIs(self.enrichment.timestamp.tzinfo, timezone.utc)
+
+    def test_timestamp_not_exactly_representable_as_epoch(self):
+        for timestamp in [datetime(2016, 1, 1), datetime(2016, 1, 1, 0, 0, 0, 1, tzinfo=timezone.utc)]:
+            enrichment = Enrichment("source", timestamp, Metadata())
+            self.assertIs(enrichment.timestamp, timestamp)
+
+    def test_equality(self):
+        same = Enrichment("source", self.timestamp, Metadata({"key": "value"}))
+        self.assertEqual(self.enrichment, same)
+        self.assertEqual(hash(self.enrichment), hash(same))
+        self.assertNotEqual(self.enrichment, Enrichment("source", self.timestamp, Metadata({"key": "other"})))
+        self.assertNotEqual(self.enrichment, Enrichment("other", self.timestamp, Metadata({"key": "value"})))
+
+    def test_equality_across_timestamp_representations(self):
+        pytz_utc = datetime(2016, 1, 1, tzinfo=timezone.utc).astimezone(pytz.utc)
+        self.assertEqual(self.enrichment, Enrichment("source", pytz_utc, Metadata({"key": "value"})))
+
+    def test_ordering(self):
+        later = Enrichment("source", datetime(2016, 1, 2, tzinfo=timezone.utc), Metadata())
+        microsecond_later = Enrichment("source", datetime(2016, 1, 1, 0, 0, 0, 1, tzinfo=timezone.utc), Metadata())
+        self.assertEqual(sorted([later, microsecond_later, self.enrichment]),
+                         [self.enrichment, microsecond_later, later])
+
+    def test_copy_and_pickle(self):
+        self.assertEqual(copy.deepcopy(self.enrichment), self.enrichment)
+        self.assertEqual(pickle.loads(pickle.dumps(self.enrichment)).timestamp, self.timestamp)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,127 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import time
+import unittest
+from datetime import timedelta
+
+from pycouchdb.exceptions import NotFound
+
+from cookiemonster.benchmarks._fake_couchdb import FakeCouchDBServer
+from cookiemonster.cookiejar.couchdb import Sofabed
+
+_DATABASE = "test"
+_VIEWS = {
+    "test/by_value": lambda doc: [(doc["value"], doc["identifier"])] if "value" in doc else []
+}
+
+
+class TestSofabedViews(unittest.TestCase):
+    """
+    Tests for the view querying of `Sofabed`, run against a fake CouchDB server.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer(views=_VIEWS)
+        self.sofa = Sofabed(self.couchdb.couchdb_fqdn, _DATABASE, 3, timedelta(milliseconds=50),
+                            view_warming_threshold=3)
+        design = self.sofa.create_design("test")
+        design.define_view("by_value", "function(doc) { emit(doc.value, doc.identifier); }")
+        self.sofa.commit_designs()
+
+    def tearDown(self):
+        buffer = self.sofa._buffer
+        for discharger in [buffer._queue, *buffer._buffers.values()]:
+            discharger._watching = False
+        self.couchdb.tear_down()
+
+    def _query(self, **kwargs):
+        return [row["value"] for row in self.sofa.query("test", "by_value", **kwargs)]
+
+    def test_query_does_not_fetch_committed_design(self):
+        document_requests = self.couchdb.request_counts["GET document"]
+        self._query()
+        self.assertEqual(self.couchdb.request_counts["GET document"], document_requests)
+
+    def test_query_undefined_view(self):
+        self.assertRaises(NotFound, self.sofa.query, "test", "undefined")
+        self.assertRaises(NotFound, self.sofa.query, "undefined", "by_value")
+
+    def test_query_stale(self):
+        self.sofa.upsert({"identifier": "/a", "value": 1})
+        self.assertEqual(self._query(), ["/a"])
+
+        self.sofa.upsert({"identifier": "/b", "value": 2})
+        self.assertEqual(self._query(stale="ok"), ["/a"])
+        self.assertEqual(self._query(stale="update_after"), ["/a"])
+        self.assertEqual(self._query(stale="ok"), ["/a", "/b"])
+
+    def test_query_paged(self):
+        # One at a time, so the views aren't warmed in the meantime
+        for i in range(7):
+            self.sofa.upsert({"identifier": "/%d" % i, "value": i % 3})
+        view_requests = self.couchdb.request_counts["GET _view/test/by_value"]
+
+        rows = list(self.sofa.query_paged("test", "by_value", 2, flat="value"))
+        self.assertEqual(sorted(rows), ["/%d" % i for i in range(7)])
+        self.assertEqual(self.couchdb.request_counts["GET _view/test/by_value"], view_requests + 4)
+
+        self.assertEqual(sorted(self.sofa.query_paged("test", "by_value", 1, flat="value", key=1)), ["/1", "/4"])
+
+    def test_query_paged_with_deletion_between_pages(self):
+        self.sofa.upsert_all([{"_id": "doc-%d" % i, "identifier": "/%d" % i, "value": i} for i in range(6)])
+
+        seen = []
+        for row in self.sofa.query_paged("test", "by_value", 2):
+            seen.append(row["value"])
+            self.sofa.delete(row["id"])
+        self.assertEqual(seen, ["/%d" % i for i in range(6)])
+
+    def test_query_paged_invalid_options(self):
+        self.assertRaises(ValueError, list, self.sofa.query_paged("test", "by_value", keys=[1]))
+        self.assertRaises(ValueError, list, self.sofa.query_paged("test", "by_value", limit=1))
+
+    def test_update_if_unchanged(self):
+        self.sofa.upsert({"_id": "doc", "identifier": "/a", "value": 1})
+        read = self.sofa.fetch("doc")
+
+        updated = self.sofa.update_if_unchanged([{**read, "value": 2}])
+        self.assertEqual([doc["value"] for doc in updated], [2])
+        self.assertEqual(self.sofa.update_if_unchanged([{**read, "value": 3}]), [])
+        self.assertEqual(self.sofa.fetch("doc")["value"], 2)
+
+    def test_views_warmed_after_large_batch(self):
+        self._query()
+        self.sofa.upsert_all([{"identifier": "/%d" % i, "value": i} for i in range(3)])
+
+        expected = ["/0", "/1", "/2"]
+        deadline = time.monotonic() + 5
+        while self._query(stale="ok") != expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self._query(stale="ok"), expected)
+
+    def test_views_not_warmed_after_small_batch(self):
+        self._query()
+        self.sofa.upsert_all([{"identifier": "/%d" % i, "value": i} for i in range(2)])
+        time.sleep(0.1)
+        self.assertEqual(self._query(stale="ok"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
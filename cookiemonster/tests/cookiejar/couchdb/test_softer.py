@@ -0,0 +1,288 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import time
+import unittest
+from threading import Thread
+from unittest.mock import patch
+
+import pycouchdb
+
+from cookiemonster.benchmarks._fake_couchdb import FakeCouchDBServer, FailureProfile, LatencyProfile
+from cookiemonster.cookiejar.couchdb.softer import SofterCouchDB, CircuitBreaker, CouchDBCircuitOpen, backoff, \
+    _StreamedRows
+
+_DATABASE = "test"
+
+
+@patch("cookiemonster.cookiejar.couchdb.softer._COUCHDB_GRACE", 0)
+class TestSofterCouchDB(unittest.TestCase):
+    """
+    Tests for `SofterCouchDB`, run against a fake CouchDB server.
+    """
+    def setUp(self):
+        self.failure_profile = FailureProfile(endpoints={"POST _bulk_docs", "GET document"})
+        self.latency_profile = LatencyProfile()
+        self.couchdb = FakeCouchDBServer(latency_profile=self.latency_profile, failure_profile=self.failure_profile)
+        self.db = SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE)
+
+    def tearDown(self):
+        self.couchdb.tear_down()
+
+    def test_save_and_get(self):
+        saved = self.db.save({"_id": "foo", "value": 123})
+        self.assertIn("_rev", saved)
+        self.assertEqual(self.db.get("foo")["value"], 123)
+
+    def test_save_with_stale_revision(self):
+        saved = self.db.save({"_id": "foo", "value": 123})
+        self.db.save({**saved, "value": 456})
+        self.assertRaises(pycouchdb.exceptions.Conflict, self.db.save, {**saved, "value": 789})
+
+    def test_get_retried_after_failure(self):
+        self.db.save({"_id": "foo", "value": 123})
+        self.failure_profile.fail_next(2)
+        self.assertEqual(self.db.get("foo")["value"], 123)
+        self.assertEqual(self.couchdb.request_counts["GET document"], 3)
+
+    def test_bulk_save_retried_after_failure(self):
+        self.failure_profile.fail_next()
+        self.db.save_bulk([{"_id": "foo"}, {"_id": "bar"}])
+        self.assertEqual(self.couchdb.request_counts["POST _bulk_docs"], 2)
+        self.assertEqual(len(list(self.db.all(keys=["foo", "bar"]))), 2)
+
+    def test_bulk_save_retried_after_lost_response(self):
+        self.failure_profile.after_processing = True
+        self.failure_profile.fail_next()
+        # The first attempt was processed, so the retry conflicts with it
+        self.assertRaises(pycouchdb.exceptions.Conflict, self.db.save_bulk, [{"_id": "foo"}])
+        self.assertEqual(self.couchdb.request_counts["POST _bulk_docs"], 2)
+        self.assertEqual(len(list(self.db.revisions("foo"))), 1)
+
+    def test_try_save_bulk(self):
+        saved = self.db.save({"_id": "foo", "value": 123})
+        self.db.save({**saved, "value": 456})
+
+        results = self.db.try_save_bulk([{**saved, "value": 789}, {"_id": "bar", "value": 123}])
+        self.assertIsNone(results[0])
+        self.assertEqual(results[1]["_rev"], self.db.get("bar")["_rev"])
+        self.assertEqual(self.db.get("foo")["value"], 456)
+
+    def test_get_fails_fast_when_circuit_open(self):
+        self.db.save({"_id": "foo", "value": 123})
+        self.failure_profile.fail_next(100)
+        self.assertRaises(CouchDBCircuitOpen, self.db.get, "foo")
+        self.assertEqual(self.db.circuit_breaker.state, CircuitBreaker.OPEN)
+
+        requests_made = self.couchdb.request_counts["GET document"]
+        self.assertRaises(CouchDBCircuitOpen, self.db.get, "foo")
+        self.assertEqual(self.couchdb.request_counts["GET document"], requests_made)
+
+    def test_circuit_breaker_shared_between_clients(self):
+        other_db = SofterCouchDB(self.couchdb.couchdb_fqdn, "other")
+        self.assertIs(other_db.circuit_breaker, self.db.circuit_breaker)
+
+    def test_query_stream(self):
+        self.db.save_bulk([{"_id": "foo", "$queue": True, "identifier": "/foo"},
+                           {"_id": "bar", "$queue": True, "identifier": "/bar"}])
+        self.db.save({"_id": "_design/queue", "views": {"get_id": {"map": ""}}})
+
+        rows = list(self.db.query_stream("queue/get_id", chunk_size=16, include_docs=True))
+        self.assertEqual([(row["key"], row["value"]) for row in rows], [("/bar", "bar"), ("/foo", "foo")])
+        self.assertEqual(rows[0]["doc"]["identifier"], "/bar")
+
+        self.assertEqual(list(self.db.query_stream("queue/get_id", flat="value", keys=["/foo"])), ["foo"])
+        self.assertEqual(list(self.db.query_stream("queue/get_id", wrapper=lambda row: row["id"], key="/bar")),
+                         ["bar"])
+
+    def test_query_stream_undefined_view(self):
+        self.assertRaises(pycouchdb.exceptions.NotFound, list, self.db.query_stream("queue/get_id"))
+
+    def test_latency(self):
+        self.latency_profile.base = 0.1
+        started_at = time.monotonic()
+        self.db.save({"_id": "foo"})
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.1)
+
+
+class TestStreamedRows(unittest.TestCase):
+    """
+    Tests for `_StreamedRows`.
+    """
+    def _parse(self, response: dict, chunk_size: int, indent: int=None) -> list:
+        encoded = json.dumps(response, ensure_ascii=False, indent=indent).encode("utf-8")
+        return list(_StreamedRows(encoded[i:i + chunk_size] for i in range(0, len(encoded), chunk_size)))
+
+    def test_no_rows(self):
+        self.assertEqual(self._parse({"total_rows": 0, "offset": 0, "rows": []}, 1), [])
+        self.assertEqual(self._parse({}, 1), [])
+
+    def test_rows(self):
+        rows = [
+            {"id": "doc-%d" % i, "key": ["/cookie/%d" % i, "\u2603" * i], "value": value, "doc": {"x": "y" * 100 * i}}
+            for i, value in enumerate([123456, 1.5, None, True, "value", {"a": [1, 2]}])
+        ]
+        response = {"total_rows": 123456, "offset": 0, "rows": rows, "update_seq": 42}
+        for chunk_size in [1, 7, 64, 65536]:
+            self.assertEqual(self._parse(response, chunk_size), rows)
+            self.assertEqual(self._parse(response, chunk_size, indent=1), rows)
+
+    def test_reduced_rows(self):
+        self.assertEqual(self._parse({"rows": [{"key": None, "value": 12}]}, 3), [{"key": None, "value": 12}])
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, list, _StreamedRows([b'{"rows": [{"key": 1}, {"key"']))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Tests for `CircuitBreaker`.
+    """
+    def setUp(self):
+        self.reset_timeout = 0.05
+        self.circuit_breaker = CircuitBreaker("test", threshold=2, reset_timeout=self.reset_timeout)
+
+    def _open(self):
+        for _ in range(2):
+            self.circuit_breaker.failed()
+
+    def test_allows_when_closed(self):
+        self.assertIsNone(self.circuit_breaker.allow())
+        self.assertEqual(self.circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_opens_after_consecutive_failures(self):
+        self.circuit_breaker.failed()
+        self.circuit_breaker.succeeded()
+        self.circuit_breaker.failed()
+        self.assertEqual(self.circuit_breaker.state, CircuitBreaker.CLOSED)
+
+        self.circuit_breaker.failed()
+        self.assertEqual(self.circuit_breaker.state, CircuitBreaker.OPEN)
+        retry_after = self.circuit_breaker.allow()
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, self.reset_timeout)
+
+    def test_single_trial_when_half_open(self):
+        self._open()
+        time.sleep(self.reset_timeout)
+        self.assertIsNone(self.circuit_breaker.allow())
+        self.assertEqual(self.circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertIsNotNone(self.circuit_breaker.allow())
+
+    def test_closes_after_successful_trial(self):
+        self._open()
+        time.sleep(self.reset_timeout)
+        self.circuit_breaker.allow()
+        self.circuit_breaker.succeeded()
+        self.assertEqual(self.circuit_breaker.state, CircuitBreaker.CLOSED)
+        self.assertIsNone(self.circuit_breaker.allow())
+
+    def test_reopens_after_failed_trial(self):
+        self._open()
+        time.sleep(self.reset_timeout)
+        self.circuit_breaker.allow()
+        self.circuit_breaker.failed()
+        self.assertEqual(self.circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertIsNotNone(self.circuit_breaker.allow())
+
+    def test_transitions_logged(self):
+        with self.assertLogs(level="INFO") as logs:
+            self._open()
+            time.sleep(self.reset_timeout)
+            self.circuit_breaker.allow()
+            self.circuit_breaker.succeeded()
+        self.assertEqual(len(logs.output), 3)
+
+
+@patch("cookiemonster.cookiejar.couchdb.softer._COUCHDB_MAX_GRACE", 4)
+@patch("cookiemonster.cookiejar.couchdb.softer._COUCHDB_GRACE", 1)
+class TestBackoff(unittest.TestCase):
+    """
+    Tests for `backoff`.
+    """
+    def test_backoff_is_jittered(self):
+        delays = {backoff(1) for _ in range(10)}
+        self.assertGreater(len(delays), 1)
+        for delay in delays:
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, 1)
+
+    def test_backoff_is_capped(self):
+        for _ in range(10):
+            self.assertLessEqual(backoff(10), 4)
+
+    def test_backoff_when_circuit_open(self):
+        for _ in range(10):
+            delay = backoff(1, CouchDBCircuitOpen(2))
+            self.assertGreaterEqual(delay, 2)
+            self.assertLessEqual(delay, 3)
+
+
+class TestSofterCouchDBConnectionPool(unittest.TestCase):
+    """
+    Tests for the connection pool of `SofterCouchDB`, run against a fake CouchDB server.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer(latency_profile=LatencyProfile(base=0.05))
+
+    def tearDown(self):
+        self.couchdb.tear_down()
+
+    def _get_concurrently(self, db: SofterCouchDB, number_of_threads: int):
+        db.save({"_id": "foo"})
+        threads = [Thread(target=db.get, args=("foo", )) for _ in range(number_of_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_connections_reused(self):
+        db = SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE)
+        for i in range(5):
+            db.save({"_id": "foo%d" % i})
+
+        connection_stats = db.connection_stats()
+        self.assertEqual(connection_stats["connections"], 1)
+        self.assertGreaterEqual(connection_stats["requests"], 5)
+        self.assertEqual(connection_stats["reused"], connection_stats["requests"] - 1)
+
+    def test_connections_not_kept_alive(self):
+        db = SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE, keep_alive=False)
+        for i in range(5):
+            db.save({"_id": "foo%d" % i})
+
+        connection_stats = db.connection_stats()
+        self.assertEqual(connection_stats["connections"], connection_stats["requests"])
+        self.assertEqual(connection_stats["reused"], 0)
+
+    def test_blocking_pool_bounds_connections(self):
+        db = SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE, max_connections=2, pool_block=True)
+        self._get_concurrently(db, 6)
+        self.assertLessEqual(db.connection_stats()["connections"], 2)
+
+    def test_non_blocking_pool_opens_more_connections(self):
+        db = SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE, max_connections=2)
+        self._get_concurrently(db, 6)
+        self.assertGreater(db.connection_stats()["connections"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,1054 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import shutil
+import subprocess
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from threading import Event, Thread
+from typing import Dict, List
+from unittest.mock import MagicMock, call, patch
+from urllib.request import Request, urlopen
+from uuid import uuid4
+
+from pycouchdb.exceptions import NotFound
+
+from cookiemonster.benchmarks._fake_couchdb import FakeCouchDBServer
+from cookiemonster.common.models import Cookie, Enrichment, Metadata
+from cookiemonster.cookiejar.biscuit_tin import BiscuitTin, _Prefetcher, _QueueCache, _QueueLength, \
+    _just_keep_swimming, get_queue_document_id, get_metadata_chunk_id
+from cookiemonster.cookiejar.couchdb.softer import SofterCouchDB, CouchDBCircuitOpen
+from cookiemonster.tests._utils.leasing_workers import collect_processed, create_queue, start_marker, start_workers
+
+_DATABASE = "cookiejar-test"
+
+
+def _stop_threads(cookie_jar: BiscuitTin):
+    """
+    Stops the background threads of the given cookie jar.
+    :param cookie_jar: the cookie jar
+    """
+    cookie_jar.stop()
+    buffer = cookie_jar._sofa._buffer
+    for discharger in [buffer._queue, *buffer._buffers.values()]:
+        discharger._watching = False
+
+
+@patch("cookiemonster.cookiejar.biscuit_tin.sleep")
+class TestJustKeepSwimming(unittest.TestCase):
+    """
+    Tests for `_just_keep_swimming`.
+    """
+    def test_retries_until_success(self, sleep: MagicMock):
+        fn = MagicMock(side_effect=[ValueError(), ValueError(), 123], __name__="fn")
+        self.assertEqual(_just_keep_swimming(fn)(), 123)
+        self.assertEqual(fn.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_waits_for_circuit_when_open(self, sleep: MagicMock):
+        fn = MagicMock(side_effect=[CouchDBCircuitOpen(10), 123], __name__="fn")
+        self.assertEqual(_just_keep_swimming(fn)(), 123)
+        self.assertGreaterEqual(sleep.call_args[0][0], 10)
+
+
+class TestQueueCache(unittest.TestCase):
+    """
+    Tests for `_QueueCache`.
+    """
+    def setUp(self):
+        self.cache = _QueueCache(2)
+
+    def test_get_when_not_cached(self):
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_set(self):
+        self.cache.set("a", "1", {"_id": "1", "_rev": "1-x", "dirty": True})
+        self.assertEqual(self.cache.get("a"), ("1", {"_id": "1", "dirty": True}))
+
+    def test_least_recently_used_evicted_when_full(self):
+        self.cache.set("a", "1", {})
+        self.cache.set("b", "2", {})
+        self.cache.get("a")
+        self.cache.set("c", "3", {})
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+
+    def test_caching_disabled(self):
+        cache = _QueueCache(0)
+        cache.set("a", "1", {})
+        self.assertIsNone(cache.get("a"))
+
+    def test_populate(self):
+        self.cache.populate("a", "1", {"dirty": True}, self.cache.generation)
+        self.assertEqual(self.cache.get("a"), ("1", {"dirty": True}))
+
+    def test_populate_does_not_replace_write(self):
+        generation = self.cache.generation
+        self.cache.set("a", "1", {"dirty": False})
+        self.cache.populate("a", "1", {"dirty": True}, generation)
+        self.assertEqual(self.cache.get("a"), ("1", {"dirty": False}))
+
+    def test_populate_after_eviction_during_lookup(self):
+        generation = self.cache.generation
+        self.cache.evict("a")
+        self.cache.populate("a", "1", {"dirty": True}, generation)
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_evict(self):
+        self.cache.set("a", "1", {})
+        self.cache.evict("a")
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_reconcile_with_own_change(self):
+        self.cache.set("a", "1", {"_id": "1", "identifier": "a", "dirty": True})
+        self.cache._reconcile({"_id": "1", "_rev": "2-x", "identifier": "a", "dirty": True})
+        self.assertIsNotNone(self.cache.get("a"))
+
+    def test_reconcile_with_other_change(self):
+        self.cache.set("a", "1", {"_id": "1", "identifier": "a", "dirty": True})
+        self.cache._reconcile({"_id": "1", "_rev": "2-x", "identifier": "a", "dirty": False})
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_reconcile_with_deletion(self):
+        self.cache.set("a", "1", {"_id": "1", "identifier": "a"})
+        self.cache._reconcile({"_id": "1", "_rev": "2-x", "_deleted": True, "identifier": "a"})
+        self.assertIsNone(self.cache.get("a"))
+
+
+class TestBiscuitTinQueueCache(unittest.TestCase):
+    """
+    Tests for the queue cache of `BiscuitTin`.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.cookie_jars = []   # type: List[BiscuitTin]
+
+    def tearDown(self):
+        for cookie_jar in self.cookie_jars:
+            _stop_threads(cookie_jar)
+        self.couchdb.tear_down()
+
+    def _create_cookie_jar(self, **kwargs) -> BiscuitTin:
+        cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0), **kwargs)
+        self.cookie_jars.append(cookie_jar)
+        return cookie_jar
+
+    def _process(self, cookie_jar: BiscuitTin, identifier: str):
+        cookie_jar.enrich_cookie(identifier, Enrichment("source", datetime(2016, 1, 1), Metadata()))
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, identifier)
+        cookie_jar.mark_as_complete(identifier)
+
+    def _count_lookups(self, cookie_jar: BiscuitTin, identifier: str) -> int:
+        cookie_jar._sofa.fetch = MagicMock(wraps=cookie_jar._sofa.fetch)
+        self._process(cookie_jar, identifier)
+        return cookie_jar._sofa.fetch.call_args_list.count(call(get_queue_document_id(identifier)))
+
+    def test_state_transitions_do_not_look_up_state(self):
+        uncached_cookie_jar = self._create_cookie_jar(queue_cache_size=0)
+        self.assertGreater(self._count_lookups(uncached_cookie_jar, "/uncached"), 1)
+
+        cookie_jar = self._create_cookie_jar()
+        self.assertEqual(self._count_lookups(cookie_jar, "/cached"), 1)
+
+    def test_coherent_with_own_deletion(self):
+        cookie_jar = self._create_cookie_jar()
+        self._process(cookie_jar, "/cookie")
+        cookie_jar.delete_cookie("/cookie")
+        self.assertIsNone(cookie_jar.fetch_cookie("/cookie"))
+        self.assertEqual(cookie_jar.queue_length(), 0)
+
+    def test_coherent_with_concurrent_transitions(self):
+        cookie_jar = self._create_cookie_jar()
+        self._process(cookie_jar, "/cookie")
+        cookie_jar.mark_for_processing("/cookie")
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+        # Hold up caching the completion, during which the cookie is enriched by another thread
+        caching = Event()
+        cache_set = cookie_jar._queue_cache.set
+
+        def slow_cache_set(*args):
+            if not caching.is_set():
+                caching.set()
+                time.sleep(0.5)
+            cache_set(*args)
+
+        cookie_jar._queue_cache.set = slow_cache_set
+
+        completion = Thread(target=cookie_jar.mark_as_complete, args=("/cookie",))
+        completion.start()
+        caching.wait()
+        cookie_jar.enrich_cookie("/cookie", Enrichment("source", datetime(2016, 1, 2), Metadata()))
+        completion.join()
+
+        doc_id, cached_doc = cookie_jar._queue_cache.get("/cookie")
+        stored_doc = cookie_jar._sofa.fetch(doc_id)
+        self.assertEqual(cached_doc, {key: value for key, value in stored_doc.items() if key != "_rev"})
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+    def test_coherent_with_other_writers_when_following_changes(self):
+        cookie_jar = self._create_cookie_jar(follow_changes=True)
+        other_cookie_jar = self._create_cookie_jar()
+        self._process(cookie_jar, "/cookie")
+
+        other_cookie_jar.delete_cookie("/cookie")
+
+        timeout_at = time.monotonic() + 5
+        while len(cookie_jar._queue_cache) > 0 and time.monotonic() < timeout_at:
+            time.sleep(0.01)
+        self.assertIsNone(cookie_jar.fetch_cookie("/cookie"))
+
+
+class TestQueueLength(unittest.TestCase):
+    """
+    Tests for `_QueueLength`.
+    """
+    def setUp(self):
+        self.length = _QueueLength(timedelta(seconds=60))
+
+    def test_get_when_not_reconciled(self):
+        self.assertIsNone(self.length.get())
+
+    def test_get_when_due_to_be_reconciled(self):
+        length = _QueueLength(timedelta(0))
+        length.reconcile(1)
+        time.sleep(0.01)
+        self.assertIsNone(length.get())
+
+    def test_add_and_remove(self):
+        self.length.reconcile(2)
+        self.length.add(0)
+        self.assertEqual(self.length.get(), 3)
+        self.length.remove(2)
+        self.assertEqual(self.length.get(), 1)
+        self.length.remove(2)
+        self.assertEqual(self.length.get(), 0)
+
+    def test_add_delayed(self):
+        self.length.reconcile(0)
+        self.length.add(int(time.time()) + 1)
+        self.assertEqual(self.length.get(), 0)
+        time.sleep(1.5)
+        self.assertEqual(self.length.get(), 1)
+
+
+class TestBiscuitTinQueueLength(unittest.TestCase):
+    """
+    Tests for the approximate queue length of `BiscuitTin`.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0),
+                                     queue_length_max_age=timedelta(seconds=60))
+        self.enrichment = Enrichment("source", datetime(2016, 1, 1), Metadata())
+
+    def tearDown(self):
+        _stop_threads(self.cookie_jar)
+        self.couchdb.tear_down()
+
+    def _count_view_requests(self) -> int:
+        return self.couchdb.request_counts["GET _view/queue/to_process"]
+
+    def test_first_read_is_exact(self):
+        self.cookie_jar.mark_for_processing("/cookie")
+        self.assertEqual(self.cookie_jar.approximate_queue_length(), (1, True))
+        self.assertEqual(self.cookie_jar.approximate_queue_length(), (1, False))
+
+    def test_maintained_without_counting(self):
+        self.cookie_jar.approximate_queue_length()
+        view_requests = self._count_view_requests()
+
+        for identifier in ["/a", "/b", "/c"]:
+            self.cookie_jar.enrich_cookie(identifier, self.enrichment)
+        self.cookie_jar.enrich_cookie("/a", self.enrichment)
+        self.assertEqual(self.cookie_jar.approximate_queue_length(), (3, False))
+
+        processing = self.cookie_jar.get_next_for_processing().identifier
+        self.assertEqual(self.cookie_jar.approximate_queue_length(), (2, False))
+
+        # Dirty while processing, so requeued on completion
+        self.cookie_jar.mark_for_processing(processing)
+        self.assertEqual(self.cookie_jar.approximate_queue_length(), (2, False))
+        self.cookie_jar.mark_as_complete(processing)
+        self.assertEqual(self.cookie_jar.approximate_queue_length(), (3, False))
+
+        self.cookie_jar.delete_cookie("/a")
+        self.cookie_jar.delete_cookies(["/b"])
+        self.assertEqual(self.cookie_jar.approximate_queue_length(), (1, False))
+
+        # Only dequeuing needed the view
+        self.assertEqual(self._count_view_requests(), view_requests + 1)
+        self.assertEqual(self.cookie_jar.queue_length(), 1)
+
+    def test_reconciled_with_other_writers(self):
+        self.cookie_jar.approximate_queue_length()
+        other_cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0))
+        try:
+            other_cookie_jar.mark_for_processing("/cookie")
+            self.assertEqual(self.cookie_jar.approximate_queue_length(), (0, False))
+            self.assertEqual(self.cookie_jar.queue_length(), 1)
+            self.assertEqual(self.cookie_jar.approximate_queue_length(), (1, False))
+        finally:
+            _stop_threads(other_cookie_jar)
+
+
+class TestPrefetcher(unittest.TestCase):
+    """
+    Tests for `_Prefetcher`.
+    """
+    def setUp(self):
+        self.queue = ["/cookie/%d" % i for i in range(10)]
+        self.fetch = MagicMock(side_effect=self._fetch)
+        self.prefetcher = _Prefetcher(self.fetch, 4)
+
+    def tearDown(self):
+        self.prefetcher.stop()
+
+    def _fetch(self, count: int) -> List[Cookie]:
+        fetched, self.queue[:count] = self.queue[:count], []
+        return [Cookie(identifier) for identifier in fetched]
+
+    def _wait_until_ready(self, count: int):
+        timeout_at = time.monotonic() + 5
+        while len(self.prefetcher) < count and time.monotonic() < timeout_at:
+            time.sleep(0.01)
+
+    def test_take_when_not_started(self):
+        self.assertIsNone(self.prefetcher.take())
+
+    def test_prefetches_to_low_water_mark(self):
+        self.prefetcher.start()
+        self._wait_until_ready(1)
+        # Enough to stay above the low-water mark for another batch
+        self.assertEqual(self.fetch.call_args_list[0], call(2))
+        self.assertEqual(self.prefetcher.take().identifier, "/cookie/0")
+
+    def test_low_water_mark_adapts(self):
+        self.assertEqual(self.prefetcher.low_water_mark(), 1)
+        self.prefetcher._fetch_latency = 0.3
+        self.prefetcher._take_interval = 0.1
+        self.assertEqual(self.prefetcher.low_water_mark(), 4)
+        self.prefetcher._take_interval = 1.0
+        self.assertEqual(self.prefetcher.low_water_mark(), 2)
+        self.prefetcher._take_interval = 0.001
+        self.assertEqual(self.prefetcher.low_water_mark(), 4)
+
+    def test_stops_when_exhausted(self):
+        self.queue = ["/cookie"]
+        self.prefetcher.start()
+        self._wait_until_ready(1)
+        self.assertEqual(self.prefetcher.take().identifier, "/cookie")
+        time.sleep(0.1)
+        fetches = self.fetch.call_count
+
+        time.sleep(0.1)
+        self.assertEqual(self.fetch.call_count, fetches)
+
+        self.queue = ["/other"]
+        self.prefetcher.wake()
+        self._wait_until_ready(1)
+        self.assertEqual(self.prefetcher.take().identifier, "/other")
+
+    def test_stop_returns_remaining(self):
+        self.prefetcher.start()
+        self._wait_until_ready(2)
+        self.assertEqual([cookie.identifier for cookie in self.prefetcher.stop()], ["/cookie/0", "/cookie/1"])
+        self.assertIsNone(self.prefetcher.take())
+
+
+class TestBiscuitTinPrefetching(unittest.TestCase):
+    """
+    Tests for the prefetching of cookies for processing by `BiscuitTin`.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0), prefetch_capacity=4)
+        self.enrichment = Enrichment("source", datetime(2016, 1, 1, tzinfo=timezone.utc), Metadata())
+
+    def tearDown(self):
+        _stop_threads(self.cookie_jar)
+        self.couchdb.tear_down()
+
+    def _wait_until_prefetched(self, count: int):
+        timeout_at = time.monotonic() + 5
+        while len(self.cookie_jar._prefetcher) < count and time.monotonic() < timeout_at:
+            time.sleep(0.01)
+        self.assertGreaterEqual(len(self.cookie_jar._prefetcher), count)
+
+    def test_process_all(self):
+        identifiers = {"/cookie/%d" % i for i in range(10)}
+        for identifier in identifiers:
+            self.cookie_jar.enrich_cookie(identifier, self.enrichment)
+
+        processed = set()
+        cookie = self.cookie_jar.get_next_for_processing()
+        while cookie is not None:
+            self.assertEqual(list(cookie.enrichments), [self.enrichment])
+            processed.add(cookie.identifier)
+            self.cookie_jar.mark_as_complete(cookie.identifier)
+            cookie = self.cookie_jar.get_next_for_processing()
+
+        self.assertEqual(processed, identifiers)
+        self.assertEqual(self.cookie_jar.queue_length(), 0)
+
+    def test_prefetched_on_enrichment(self):
+        self.cookie_jar.enrich_cookie("/cookie", self.enrichment)
+        self._wait_until_prefetched(1)
+        self.assertEqual(self.cookie_jar.queue_length(), 0)
+        self.assertEqual(self.cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+    def test_prefetched_returned_to_queue_on_stop(self):
+        self.cookie_jar.enrich_cookie("/deleted", self.enrichment)
+        self._wait_until_prefetched(1)
+        self.cookie_jar.enrich_cookie("/cookie", self.enrichment)
+        self.cookie_jar.delete_cookie("/deleted")
+
+        self.cookie_jar.stop()
+
+        self.assertEqual(self.cookie_jar.queue_length(), 1)
+        self.assertEqual(self.cookie_jar.get_next_for_processing().identifier, "/cookie")
+        self.assertIsNone(self.cookie_jar.fetch_cookie("/deleted"))
+
+
+class TestFakeCouchDBViews(unittest.TestCase):
+    """
+    Tests that the Python emulations of the views of `BiscuitTin` used by `FakeCouchDBServer` match the JavaScript map
+    functions in the design documents that `BiscuitTin` defines.
+    """
+    _DOCUMENTS = [
+        {"_id": "queue-1", "$queue": True, "identifier": "/1", "dirty": True, "processing": False, "deleted": False,
+         "queue_from": 100},
+        {"_id": "queue-2", "$queue": True, "identifier": "/2", "dirty": True, "processing": True, "deleted": False,
+         "queue_from": 200, "owner": "worker", "lease_expires": 300},
+        {"_id": "queue-3", "$queue": True, "identifier": "/3", "dirty": False, "processing": True, "deleted": True,
+         "owner": "", "lease_expires": 0},
+        {"_id": "queue-4", "$queue": True, "identifier": "/4", "dirty": True, "processing": True, "owner": None,
+         "lease_expires": None},
+        {"_id": "queue-5", "$queue": True, "identifier": "/5", "dirty": True},
+        {"_id": "legacy", "$queue": True, "identifier": "/6", "dirty": False, "processing": False, "deleted": True},
+        {"_id": "metadata", "$metadata": True, "identifier": "/1"},
+        {"_id": "chunk", "$metadata_chunk": True, "identifier": "/1"},
+        {"_id": "other", "identifier": "/1", "dirty": True, "processing": True, "deleted": True}
+    ]
+
+    def setUp(self):
+        if shutil.which("node") is None:
+            self.skipTest("Node.js is required to evaluate the JavaScript map functions")
+        self.couchdb = FakeCouchDBServer()
+        self.cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0))
+
+    def tearDown(self):
+        _stop_threads(self.cookie_jar)
+        self.couchdb.tear_down()
+
+    def _request(self, path: str, data: Dict=None) -> Dict:
+        url = "%s/%s/%s" % (self.couchdb.couchdb_fqdn, _DATABASE, path)
+        body = json.dumps(data).encode("utf-8") if data is not None else None
+        request = Request(url, body, {"Content-Type": "application/json"})
+        with urlopen(request) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def test_views_match_design_documents(self):
+        self._request("_bulk_docs", {"docs": TestFakeCouchDBViews._DOCUMENTS})
+        documents = [self._request(document["_id"]) for document in TestFakeCouchDBViews._DOCUMENTS]
+
+        for design in ["queue", "metadata"]:
+            views = self._request("_design/%s" % design)["views"]
+            self.assertGreater(len(views), 0)
+            for view, definition in views.items():
+                expected = _evaluate_map_function(definition["map"], documents)
+                rows = self._request("_design/%s/_view/%s?reduce=false" % (design, view))["rows"]
+                actual = [[row["id"], row["key"], row["value"]] for row in rows]
+                self.assertCountEqual(actual, expected, "%s/%s" % (design, view))
+
+
+def _evaluate_map_function(map_function: str, documents: List[Dict]) -> List[List]:
+    """
+    Evaluates the given JavaScript map function against the given documents, as CouchDB would.
+    :param map_function: the map function
+    :param documents: the documents to map
+    :return: list of the emitted rows, as [document ID, key, value]
+    """
+    script = """
+        var input = JSON.parse(require("fs").readFileSync(0, "utf8"));
+        var rows = [];
+        var document;
+        function emit(key, value) {
+            rows.push([document._id, key === undefined ? null : key, value === undefined ? null : value]);
+        }
+        var map = eval("(" + input.map + ")");
+        input.documents.forEach(function(each) { document = each; map(each); });
+        process.stdout.write(JSON.stringify(rows));
+    """
+    output = subprocess.check_output(["node", "-e", script],
+                                     input=json.dumps({"map": map_function, "documents": documents}).encode("utf-8"))
+    return json.loads(output.decode("utf-8"))
+
+
+class TestBiscuitTinStaleDequeue(unittest.TestCase):
+    """
+    Tests for `BiscuitTin` dequeuing from a stale index.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0), stale_dequeue=True)
+        self.enrichment = Enrichment("source", datetime(2016, 1, 1), Metadata())
+
+    def tearDown(self):
+        _stop_threads(self.cookie_jar)
+        self.couchdb.tear_down()
+
+    def _count_view_requests(self) -> int:
+        return self.couchdb.request_counts["GET _view/queue/to_process"]
+
+    def test_dequeue_from_stale_index(self):
+        for identifier in ["/a", "/b"]:
+            self.cookie_jar.enrich_cookie(identifier, self.enrichment)
+        # Bring the index up to date
+        self.cookie_jar.queue_length()
+
+        view_requests = self._count_view_requests()
+        self.assertIsNotNone(self.cookie_jar.get_next_for_processing())
+        self.assertEqual(self._count_view_requests(), view_requests + 1)
+
+    def test_dequeue_skips_stale_rows(self):
+        for identifier in ["/a", "/b"]:
+            self.cookie_jar.enrich_cookie(identifier, self.enrichment)
+        self.cookie_jar.queue_length()
+
+        first = self.cookie_jar.get_next_for_processing()
+        second = self.cookie_jar.get_next_for_processing()
+        self.assertEqual({first.identifier, second.identifier}, {"/a", "/b"})
+        self.assertIsNone(self.cookie_jar.get_next_for_processing())
+
+    def test_not_stale_by_default(self):
+        cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0))
+        try:
+            self.assertFalse(cookie_jar._queue._stale_dequeue)
+        finally:
+            _stop_threads(cookie_jar)
+
+    def test_dequeue_falls_back_to_up_to_date_index(self):
+        self.cookie_jar.enrich_cookie("/a", self.enrichment)
+        self.assertEqual(self.cookie_jar.get_next_for_processing().identifier, "/a")
+
+
+class TestBiscuitTinSanitisation(unittest.TestCase):
+    """
+    Tests for the sanitisation of the queue state of `BiscuitTin` on start up.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.db = SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE)
+        self.db.save_bulk(
+            [self._create_queue_document("/processing/%d" % i, processing=True) for i in range(5)]
+            + [self._create_queue_document("/deleted/%d" % i, deleted=True) for i in range(3)]
+            + [self._create_queue_document("/dirty", dirty=True)])
+        self.cookie_jar = None
+
+    def tearDown(self):
+        if self.cookie_jar is not None:
+            _stop_threads(self.cookie_jar)
+        self.couchdb.tear_down()
+
+    @staticmethod
+    def _create_queue_document(identifier: str, **state) -> dict:
+        return {
+            "_id": get_queue_document_id(identifier),
+            "$queue": True,
+            "identifier": identifier,
+            "dirty": False,
+            "processing": False,
+            "deleted": False,
+            "queue_from": 0,
+            **state
+        }
+
+    def _get_queue_documents(self) -> dict:
+        return {
+            row["doc"]["identifier"]: row["doc"] for row in self.db.all(include_docs=True)
+            if not row["id"].startswith("_design/")
+        }
+
+    def _assert_sanitised(self):
+        docs = self._get_queue_documents()
+        self.assertEqual(set(docs.keys()), {"/dirty", *("/processing/%d" % i for i in range(5))})
+        for doc in docs.values():
+            self.assertTrue(doc["dirty"])
+            self.assertFalse(doc["processing"])
+
+    def test_sanitised_in_bulk(self):
+        bulk_requests = self.couchdb.request_counts["POST _bulk_docs"]
+        self.cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 2, timedelta(seconds=1))
+        self._assert_sanitised()
+        # Pages of two documents reset, then deleted
+        self.assertEqual(self.couchdb.request_counts["POST _bulk_docs"] - bulk_requests, 3 + 2)
+
+    def test_sanitised_in_background(self):
+        self.cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 2, timedelta(milliseconds=50),
+                                     sanitise_in_background=True)
+        deadline = time.monotonic() + 5
+        while len(self._get_queue_documents()) > 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self._assert_sanitised()
+
+
+class TestBiscuitTinLeasing(unittest.TestCase):
+    """
+    Tests for `BiscuitTin` with leasing, as when sharing the queue with other instances.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.db = SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE)
+        self.cookie_jars = []
+
+    def tearDown(self):
+        for cookie_jar in self.cookie_jars:
+            _stop_threads(cookie_jar)
+        self.couchdb.tear_down()
+
+    def _create_cookie_jar(self, worker_id: str, lease_duration: timedelta=timedelta(seconds=10)) -> BiscuitTin:
+        cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0), lease_duration=lease_duration,
+                                worker_id=worker_id)
+        self.cookie_jars.append(cookie_jar)
+        return cookie_jar
+
+    def _get_queue_document(self, identifier: str) -> dict:
+        return self.db.get(get_queue_document_id(identifier))
+
+    def _save_leased_document(self, identifier: str, owner: str, lease_expires: float):
+        self.db.save({
+            "_id": get_queue_document_id(identifier), "$queue": True, "identifier": identifier, "dirty": False,
+            "processing": True, "deleted": False, "queue_from": None, "owner": owner, "lease_expires": lease_expires
+        })
+
+    def test_dequeue_leases(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        cookie_jar.mark_for_processing("/cookie")
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+        doc = self._get_queue_document("/cookie")
+        self.assertTrue(doc["processing"])
+        self.assertEqual(doc["owner"], "worker")
+        self.assertGreater(doc["lease_expires"], time.time())
+
+    def test_dequeue_by_several_instances(self):
+        cookie_jars = [self._create_cookie_jar("worker-%d" % i) for i in range(2)]
+        for i in range(5):
+            cookie_jars[0].mark_for_processing("/cookie/%d" % i)
+
+        dequeued = []
+        for _ in range(5):
+            for cookie_jar in cookie_jars:
+                cookie = cookie_jar.get_next_for_processing()
+                if cookie is not None:
+                    dequeued.append(cookie.identifier)
+
+        self.assertCountEqual(dequeued, ["/cookie/%d" % i for i in range(5)])
+
+    def test_claim_conflicts_with_other_instance(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        cookie_jar.mark_for_processing("/cookie")
+        candidates = cookie_jar._queue._get_candidates(1)
+
+        self.assertEqual(self._create_cookie_jar("other").get_next_for_processing().identifier, "/cookie")
+        self.assertEqual(cookie_jar._sofa.update_if_unchanged(
+            [{**doc, "processing": True, "owner": "worker"} for doc in candidates]), [])
+        self.assertEqual(self._get_queue_document("/cookie")["owner"], "other")
+
+    def test_mark_as_complete_gives_up_lease(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        cookie_jar.mark_for_processing("/cookie")
+        cookie_jar.get_next_for_processing()
+        cookie_jar.mark_as_complete("/cookie")
+
+        doc = self._get_queue_document("/cookie")
+        self.assertFalse(doc["processing"])
+        self.assertIsNone(doc["owner"])
+        self.assertIsNone(doc["lease_expires"])
+        self.assertEqual(cookie_jar.queue_length(), 0)
+
+    def test_mark_as_failed_requeues(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        cookie_jar.mark_for_processing("/cookie")
+        cookie_jar.get_next_for_processing()
+        cookie_jar.mark_as_failed("/cookie")
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+    def test_lost_lease_left_to_new_owner(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        cookie_jar.mark_for_processing("/cookie")
+        cookie_jar.get_next_for_processing()
+
+        doc = self._get_queue_document("/cookie")
+        self.db.save({**doc, "owner": "other"})
+        cookie_jar.mark_as_complete("/cookie")
+
+        doc = self._get_queue_document("/cookie")
+        self.assertTrue(doc["processing"])
+        self.assertEqual(doc["owner"], "other")
+
+    def test_mark_for_processing_by_another_instance_keeps_lease(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        other_cookie_jar = self._create_cookie_jar("other")
+        # The other instance has a cached copy of the document from before it was leased
+        other_cookie_jar.mark_for_processing("/cookie")
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+        other_cookie_jar.mark_for_processing("/cookie")
+        doc = self._get_queue_document("/cookie")
+        self.assertTrue(doc["dirty"])
+        self.assertTrue(doc["processing"])
+        self.assertEqual(doc["owner"], "worker")
+        self.assertIsNone(other_cookie_jar.get_next_for_processing())
+
+        cookie_jar.mark_as_complete("/cookie")
+        self.assertEqual(other_cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+    def test_delete_by_another_instance_keeps_lease(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        other_cookie_jar = self._create_cookie_jar("other")
+        other_cookie_jar.mark_for_processing("/cookie")
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+        other_cookie_jar.delete_cookie("/cookie")
+        doc = self._get_queue_document("/cookie")
+        self.assertTrue(doc["deleted"])
+        self.assertTrue(doc["processing"])
+        self.assertEqual(doc["owner"], "worker")
+
+        cookie_jar.mark_as_complete("/cookie")
+        self.assertRaises(NotFound, self._get_queue_document, "/cookie")
+
+    def test_delete_many_by_another_instance_keeps_leases(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        other_cookie_jar = self._create_cookie_jar("other")
+        for identifier in ["/leased", "/queued"]:
+            other_cookie_jar.mark_for_processing(identifier)
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/leased")
+
+        other_cookie_jar.delete_cookies(["/leased", "/queued"])
+        doc = self._get_queue_document("/leased")
+        self.assertTrue(doc["deleted"])
+        self.assertEqual(doc["owner"], "worker")
+        self.assertRaises(NotFound, self._get_queue_document, "/queued")
+
+    def test_leases_renewed(self):
+        cookie_jar = self._create_cookie_jar("worker", timedelta(milliseconds=300))
+        cookie_jar.mark_for_processing("/cookie")
+        cookie_jar.get_next_for_processing()
+        time.sleep(0.6)
+
+        doc = self._get_queue_document("/cookie")
+        self.assertEqual(doc["owner"], "worker")
+        self.assertGreater(doc["lease_expires"], time.time())
+        self.assertEqual(self._create_cookie_jar("other")._queue.reclaim_expired_leases(), 0)
+
+    def test_lost_lease_not_renewed(self):
+        cookie_jar = self._create_cookie_jar("worker")
+        cookie_jar.mark_for_processing("/cookie")
+        cookie_jar.get_next_for_processing()
+
+        doc = self._get_queue_document("/cookie")
+        self.db.save({**doc, "owner": "other"})
+        self.assertEqual(cookie_jar._queue.renew_leases(), ["/cookie"])
+        self.assertEqual(cookie_jar._queue.renew_leases(), [])
+
+    def test_start_up_leaves_live_leases(self):
+        self._save_leased_document("/live", "other", time.time() + 60)
+        self._create_cookie_jar("worker")
+
+        doc = self._get_queue_document("/live")
+        self.assertTrue(doc["processing"])
+        self.assertEqual(doc["owner"], "other")
+
+    def test_start_up_reclaims_expired_leases(self):
+        self._save_leased_document("/expired", "dead", time.time() - 1)
+        self._save_leased_document("/unleased", None, None)
+        cookie_jar = self._create_cookie_jar("worker")
+
+        for identifier in ["/expired", "/unleased"]:
+            doc = self._get_queue_document(identifier)
+            self.assertTrue(doc["dirty"])
+            self.assertFalse(doc["processing"])
+            self.assertIsNone(doc["owner"])
+        self.assertEqual(cookie_jar.queue_length(), 2)
+
+    def test_expired_leases_reclaimed_while_running(self):
+        cookie_jar = self._create_cookie_jar("worker", timedelta(milliseconds=300))
+        self._save_leased_document("/cookie", "dead", time.time() + 0.2)
+
+        deadline = time.monotonic() + 5
+        while self._get_queue_document("/cookie")["processing"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/cookie")
+
+    def test_expired_lease_on_deleted_cookie_reclaimed(self):
+        self.db.save({
+            "_id": get_queue_document_id("/cookie"), "$queue": True, "identifier": "/cookie", "dirty": False,
+            "processing": True, "deleted": True, "queue_from": None, "owner": "dead", "lease_expires": 0
+        })
+        self._create_cookie_jar("worker")
+        self.assertRaises(NotFound, self._get_queue_document, "/cookie")
+
+
+class TestBiscuitTinLeasingAcrossProcesses(unittest.TestCase):
+    """
+    Tests for several `BiscuitTin` instances, with leasing, sharing a queue from separate processes.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 10, timedelta(milliseconds=20))
+        self.identifiers = ["/cookie/%d" % i for i in range(30)]
+        for identifier in self.identifiers:
+            cookie_jar.mark_for_processing(identifier)
+        _stop_threads(cookie_jar)
+        self.processed = create_queue()
+
+    def tearDown(self):
+        self.couchdb.tear_down()
+
+    def _run_workers(self, number_of_workers: int, crash_after: int=None):
+        workers = start_workers(self.couchdb.couchdb_fqdn, _DATABASE, number_of_workers, timedelta(seconds=1),
+                                timedelta(seconds=3), self.processed, crash_after)
+        return collect_processed(workers, self.processed, timedelta(seconds=60))
+
+    def test_each_cookie_processed_once(self):
+        completed_by = self._run_workers(3)
+        self.assertCountEqual(completed_by.keys(), self.identifiers)
+        for workers in completed_by.values():
+            self.assertEqual(len(workers), 1)
+
+    def test_leases_of_dead_worker_reclaimed(self):
+        crashed = self._run_workers(1, crash_after=5)
+        self.assertEqual(len(crashed), 5)
+
+        completed_by = self._run_workers(1)
+        self.assertCountEqual(list(crashed.keys()) + list(completed_by.keys()), self.identifiers)
+
+    def test_cookies_marked_for_processing_while_leased_not_processed_concurrently(self):
+        # More workers than cookies, such that a cookie whose lease is lost would be dequeued by an idle worker while
+        # it is still being processed
+        database = "%s-marked" % _DATABASE
+        identifiers = self.identifiers[:2]
+        cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, database, 10, timedelta(milliseconds=20))
+        for identifier in identifiers:
+            cookie_jar.mark_for_processing(identifier)
+        _stop_threads(cookie_jar)
+
+        # The workers must outlast the marker's start up
+        workers = start_workers(self.couchdb.couchdb_fqdn, database, 3, timedelta(seconds=1), timedelta(seconds=3),
+                                self.processed, processing_time=timedelta(milliseconds=300))
+        marker = start_marker(self.couchdb.couchdb_fqdn, database, identifiers, timedelta(seconds=1),
+                              timedelta(seconds=3))
+        completed_by = collect_processed(workers, self.processed, timedelta(seconds=60))
+        marker.join(10)
+        if marker.is_alive():
+            marker.terminate()
+
+        self.assertCountEqual(completed_by.keys(), identifiers)
+        for identifier, processed in completed_by.items():
+            processed = sorted(processed, key=lambda processing: processing.started_at)
+            for previous, following in zip(processed, processed[1:]):
+                self.assertLessEqual(previous.finished_at, following.started_at, identifier)
+        self.assertGreater(sum(len(processed) for processed in completed_by.values()), len(identifiers))
+
+
+class TestBiscuitTinWithLegacyQueueDocuments(unittest.TestCase):
+    """
+    Tests for `BiscuitTin` with a database containing queue documents that predate derived document IDs.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.legacy_doc_id = uuid4().hex
+        SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE).save({
+            "_id": self.legacy_doc_id, "$queue": True, "identifier": "/cookie", "dirty": False, "processing": False,
+            "deleted": False, "queue_from": None
+        })
+        self.cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1, timedelta(0))
+
+    def tearDown(self):
+        _stop_threads(self.cookie_jar)
+        self.couchdb.tear_down()
+
+    def test_fetch_cookie(self):
+        self.assertEqual(self.cookie_jar.fetch_cookie("/cookie").identifier, "/cookie")
+        self.assertIsNone(self.cookie_jar.fetch_cookie("/other"))
+
+    def test_mark_for_processing(self):
+        self.cookie_jar.mark_for_processing("/cookie")
+        self.assertEqual(self.cookie_jar.queue_length(), 1)
+        self.assertEqual(self.cookie_jar._queue.get_by_identifier("/cookie")[0], self.legacy_doc_id)
+
+    def test_mark_new_cookie_for_processing(self):
+        self.cookie_jar.mark_for_processing("/other")
+        self.assertEqual(self.cookie_jar._queue.get_by_identifier("/other")[0], get_queue_document_id("/other"))
+
+
+class TestBiscuitTinConsolidatedMetadata(unittest.TestCase):
+    """
+    Tests for the consolidated metadata storage of `BiscuitTin`.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        # Buffering with some latency, so that deletions can be batched
+        self.cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, 1000, timedelta(milliseconds=20),
+                                     consolidate_metadata=True, metadata_chunk_size=2)
+        self.enrichments = [
+            Enrichment("source", datetime(2016, 1, 1 + i, tzinfo=timezone.utc), Metadata({"i": i})) for i in range(5)
+        ]
+
+    def tearDown(self):
+        _stop_threads(self.cookie_jar)
+        self.couchdb.tear_down()
+
+    def _get_chunk_docs(self, identifier: str) -> List[dict]:
+        return self.cookie_jar._sofa.fetch_by_prefix(get_metadata_chunk_id(identifier))
+
+    def test_enrichments_chunked(self):
+        for enrichment in reversed(self.enrichments):
+            self.cookie_jar.enrich_cookie("/cookie", enrichment)
+        self.cookie_jar.enrich_cookie("/other", self.enrichments[0])
+
+        chunk_docs = self._get_chunk_docs("/cookie")
+        self.assertEqual([chunk_doc["chunk"] for chunk_doc in chunk_docs], [0, 1, 2])
+        self.assertEqual([len(chunk_doc["enrichments"]) for chunk_doc in chunk_docs], [2, 2, 1])
+        self.assertEqual(list(self.cookie_jar.fetch_cookie("/cookie").enrichments), self.enrichments)
+
+    def test_delete_in_one_batch(self):
+        for enrichment in self.enrichments:
+            self.cookie_jar.enrich_cookie("/cookie", enrichment)
+        self.cookie_jar.enrich_cookie("/other", self.enrichments[0])
+        batches = self.couchdb.request_counts["POST _bulk_docs"]
+
+        self.cookie_jar._metadata.delete_metadata("/cookie")
+
+        self.assertEqual(self.couchdb.request_counts["POST _bulk_docs"], batches + 1)
+        self.assertEqual(self._get_chunk_docs("/cookie"), [])
+        self.assertEqual(len(self._get_chunk_docs("/other")), 1)
+
+
+class TestBiscuitTinBulkDeletion(unittest.TestCase):
+    """
+    Tests for the bulk deletion of cookies from `BiscuitTin`.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.cookie_jars = []   # type: List[BiscuitTin]
+        self.enrichment = Enrichment("source", datetime(2016, 1, 1, tzinfo=timezone.utc), Metadata())
+
+    def tearDown(self):
+        for cookie_jar in self.cookie_jars:
+            _stop_threads(cookie_jar)
+        self.couchdb.tear_down()
+
+    def _create_cookie_jar(self, buffer_capacity: int=1000, **kwargs) -> BiscuitTin:
+        # Buffering with some latency, so that deletions can be batched
+        cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, _DATABASE, buffer_capacity, timedelta(milliseconds=20),
+                                **kwargs)
+        self.cookie_jars.append(cookie_jar)
+        return cookie_jar
+
+    def _enrich(self, cookie_jar: BiscuitTin, identifiers: List[str]):
+        for identifier in identifiers:
+            cookie_jar.enrich_cookie(identifier, self.enrichment)
+
+    def _assert_deleted(self, cookie_jar: BiscuitTin, identifiers: List[str]):
+        for identifier in identifiers:
+            self.assertIsNone(cookie_jar.fetch_cookie(identifier))
+            self.assertEqual(list(cookie_jar._metadata.get_metadata(identifier)), [])
+
+    def test_delete_cookies_in_one_batch(self):
+        cookie_jar = self._create_cookie_jar()
+        identifiers = ["/cookie/%d" % i for i in range(10)]
+        self._enrich(cookie_jar, identifiers + ["/other"])
+        batches = self.couchdb.request_counts["POST _bulk_docs"]
+
+        cookie_jar.delete_cookies(identifiers)
+
+        # One batch for the metadata and one for the queue documents
+        self.assertEqual(self.couchdb.request_counts["POST _bulk_docs"], batches + 2)
+        self._assert_deleted(cookie_jar, identifiers)
+        self.assertIsNotNone(cookie_jar.fetch_cookie("/other"))
+
+    def test_delete_cookies_when_not_found(self):
+        cookie_jar = self._create_cookie_jar()
+        cookie_jar.delete_cookies(["/missing"])
+        cookie_jar.delete_cookies([])
+        self.assertIsNone(cookie_jar.fetch_cookie("/missing"))
+
+    def test_delete_by_prefix_in_pages(self):
+        cookie_jar = self._create_cookie_jar(buffer_capacity=3)
+        identifiers = ["/collection/%d" % i for i in range(10)]
+        self._enrich(cookie_jar, identifiers + ["/other"])
+
+        self.assertEqual(cookie_jar.delete_by_prefix("/collection/"), 10)
+
+        self._assert_deleted(cookie_jar, identifiers)
+        self.assertIsNotNone(cookie_jar.fetch_cookie("/other"))
+
+    def test_delete_by_prefix_marks_processing(self):
+        cookie_jar = self._create_cookie_jar()
+        self._enrich(cookie_jar, ["/collection/0"])
+        self.assertEqual(cookie_jar.get_next_for_processing().identifier, "/collection/0")
+
+        self.assertEqual(cookie_jar.delete_by_prefix("/collection/"), 1)
+        self.assertIsNotNone(cookie_jar.fetch_cookie("/collection/0"))
+
+        cookie_jar.mark_as_complete("/collection/0")
+        self.assertIsNone(cookie_jar.fetch_cookie("/collection/0"))
+
+    def test_delete_by_prefix_deletes_orphaned_metadata(self):
+        cookie_jar = self._create_cookie_jar(buffer_capacity=2)
+        identifiers = ["/collection/%d" % i for i in range(5)]
+        for identifier in identifiers:
+            cookie_jar.enrich_cookie(identifier, self.enrichment, mark_for_processing=False)
+
+        self.assertEqual(cookie_jar.delete_by_prefix("/collection/"), 0)
+        self._assert_deleted(cookie_jar, identifiers)
+
+    def test_delete_by_prefix_with_consolidated_metadata(self):
+        cookie_jar = self._create_cookie_jar(buffer_capacity=2, consolidate_metadata=True, metadata_chunk_size=1)
+        identifiers = ["/collection/%d" % i for i in range(5)]
+        for identifier in identifiers:
+            self._enrich(cookie_jar, [identifier, identifier])
+        self._enrich(cookie_jar, ["/other"])
+
+        self.assertEqual(cookie_jar.delete_by_prefix("/collection/"), 5)
+
+        self._assert_deleted(cookie_jar, identifiers)
+        self.assertEqual(len(cookie_jar.fetch_cookie("/other").enrichments), 1)
+
+    def test_delete_by_prefix_with_legacy_queue_documents(self):
+        SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE).save_bulk([{
+            "_id": uuid4().hex, "$queue": True, "identifier": "/collection/%d" % i, "dirty": False,
+            "processing": False, "deleted": False, "queue_from": None
+        } for i in range(3)])
+        cookie_jar = self._create_cookie_jar(buffer_capacity=2)
+
+        self.assertEqual(cookie_jar.delete_by_prefix("/collection/"), 3)
+        self._assert_deleted(cookie_jar, ["/collection/%d" % i for i in range(3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
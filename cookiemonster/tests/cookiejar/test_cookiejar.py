@@ -31,6 +31,11 @@ The following sequences are tested:
 
 * Enrich -> Get Next -> Mark Complete -> Mark Reprocess -> Get Next
 
+* Enrich 1 -> Enrich 2 -> Get Next (X) -> Delete Both -> Mark X
+  Complete
+
+* Enrich Many -> Delete by Prefix
+
 The following sequences are specific to `BiscuitTin` and derivatives:
 
 * Enrich -> Reconnect (i.e., simulate failure) -> Get Next
@@ -66,24 +71,29 @@ Public License for more details.
 You should have received a copy of the GNU General Public License along
 with this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import shutil
 import unittest
 from unittest.mock import MagicMock
 from abc import ABCMeta, abstractmethod
 from datetime import datetime, timedelta, timezone
-from threading import Timer
+from tempfile import mkdtemp
 from typing import Any, Callable
 from numbers import Real
 
 from cookiemonster.common.collections import EnrichmentCollection
 from cookiemonster.cookiejar import CookieJar, BiscuitTin, RateLimitedBiscuitTin
 from cookiemonster.cookiejar.in_memory_cookiejar import InMemoryCookieJar
+from cookiemonster.cookiejar.sharded_cookiejar import ShardedCookieJar
+from cookiemonster.cookiejar.sqlite_cookiejar import SQLiteCookieJar
 from cookiemonster.common.models import Enrichment, Cookie
 from cookiemonster.tests._utils.docker_couchdb import CouchDBContainer
+from cookiemonster.benchmarks._fake_couchdb import FakeCouchDBServer
 
 from hgicommon.collections import Metadata
 
 # We need this for mocking
 import cookiemonster.cookiejar.biscuit_tin as _biscuit_tin
+import cookiemonster.cookiejar.sqlite_cookiejar as _sqlite_cookiejar
 
 
 class TestCookieJar(unittest.TestCase, metaclass=ABCMeta):
@@ -396,6 +406,43 @@ class TestCookieJar(unittest.TestCase, metaclass=ABCMeta):
         deleted = self.jar.fetch_cookie(ident)
         self.assertIsNone(deleted)
 
+    def test_delete_many_by_id(self):
+        """
+        CookieJar Sequence: Enrich 1 -> Enrich 2 -> Get Next (X) -> Delete
+        Both -> Mark X Complete
+        """
+        for identifier, enrichment in zip(self.eg_identifiers, self.eg_enrichments):
+            self.jar.enrich_cookie(identifier, enrichment)
+        self.jar.enrich_cookie('/other', self.eg_enrichments[0])
+
+        to_process = self.jar.get_next_for_processing()
+        self.jar.delete_cookies(self.eg_identifiers)
+
+        self.assertEqual(len(self.jar.fetch_cookie(to_process.identifier).enrichments), 0)
+        self.assertEqual(self.jar.queue_length(), 1)
+
+        self.jar.mark_as_complete(to_process.identifier)
+
+        for identifier in self.eg_identifiers:
+            self.assertIsNone(self.jar.fetch_cookie(identifier))
+        self.assertIsInstance(self.jar.fetch_cookie('/other'), Cookie)
+
+    def test_delete_by_prefix(self):
+        """
+        CookieJar Sequence: Enrich Many -> Delete by Prefix
+        """
+        identifiers = ['/collection/%d' % i for i in range(5)] + ['/collection', '/collections/0', '/other']
+        for identifier in identifiers:
+            self.jar.enrich_cookie(identifier, self.eg_enrichments[0])
+
+        self.assertEqual(self.jar.delete_by_prefix('/collection/'), 5)
+
+        for identifier in identifiers[:5]:
+            self.assertIsNone(self.jar.fetch_cookie(identifier))
+        for identifier in identifiers[5:]:
+            self.assertIsInstance(self.jar.fetch_cookie(identifier), Cookie)
+        self.assertEqual(self.jar.queue_length(), 3)
+
 
 class TestBiscuitTin(TestCookieJar):
     """
@@ -405,7 +452,7 @@ class TestBiscuitTin(TestCookieJar):
     abstraction are probably fine™
     """
     def setUp(self):
-        self.couchdb_container = CouchDBContainer()
+        self.couchdb_container = self._start_couchdb()
         self.HOST = self.couchdb_container.couchdb_fqdn
         self.DB   = 'cookiejar-test'
 
@@ -417,6 +464,13 @@ class TestBiscuitTin(TestCookieJar):
         self.couchdb_container.tear_down()
         _biscuit_tin.Timer.reset_mock()
 
+    def _start_couchdb(self) -> CouchDBContainer:
+        """
+        Starts the CouchDB server that the cookie jar is tested against.
+        :return: the started server
+        """
+        return CouchDBContainer()
+
     def _create_cookie_jar(self) -> BiscuitTin:
         # TODO? We don't test the buffering (only the trivial case of a
         # single document, zero-latency buffer)
@@ -470,6 +524,42 @@ class TestRateLimitedBiscuitTin(TestBiscuitTin):
         return RateLimitedBiscuitTin(10, self.HOST, self.DB, 1, timedelta(0))
 
 
+class TestBiscuitTinWithFakeCouchDB(TestBiscuitTin):
+    """
+    Tests for `BiscuitTin`, against an in-process fake of CouchDB rather than a Dockerised CouchDB.
+    """
+    def setUp(self):
+        self._created_jars = []
+        super().setUp()
+
+    def tearDown(self):
+        # Stop the buffers' watcher threads, which would otherwise (busily, with zero latency) outlive the test and
+        # slow down those that follow, now that the tests are quick enough for that to matter
+        for jar in self._created_jars:
+            buffer = jar._sofa._buffer
+            for discharger in [buffer._queue, *buffer._buffers.values()]:
+                discharger._watching = False
+        super().tearDown()
+
+    def _start_couchdb(self) -> FakeCouchDBServer:
+        return FakeCouchDBServer()
+
+    def _create_cookie_jar(self) -> BiscuitTin:
+        jar = super()._create_cookie_jar()
+        self._created_jars.append(jar)
+        return jar
+
+
+class TestBiscuitTinWithConsolidatedMetadata(TestBiscuitTinWithFakeCouchDB):
+    """
+    Tests for `BiscuitTin`, with each cookie's enrichments consolidated into chunk documents.
+    """
+    def _create_cookie_jar(self) -> BiscuitTin:
+        jar = BiscuitTin(self.HOST, self.DB, 1, timedelta(0), consolidate_metadata=True, metadata_chunk_size=2)
+        self._created_jars.append(jar)
+        return jar
+
+
 class TestInMemoryCookieJar(TestCookieJar):
     """
     Tests for `InMemoryCookieJar`.
@@ -485,13 +575,53 @@ class TestInMemoryCookieJar(TestCookieJar):
 
     def _change_time(self, cookie_jar: InMemoryCookieJar, change_time_to: int):
         cookie_jar._get_time = MagicMock(return_value=change_time_to)
+        cookie_jar._requeue_due()
+
+
+class TestShardedCookieJar(TestInMemoryCookieJar):
+    """
+    Tests for `ShardedCookieJar`, over in-memory shards.
+    """
+    def _create_cookie_jar(self) -> CookieJar:
+        return ShardedCookieJar({"shard-%d" % i: InMemoryCookieJar() for i in range(3)})
+
+    def _change_time(self, cookie_jar: ShardedCookieJar, change_time_to: int):
+        for shard in cookie_jar.shards.values():
+            super()._change_time(shard, change_time_to)
 
-        for end_time in cookie_jar._timers.keys():
-            if end_time <= change_time_to:
-                while len(cookie_jar._timers[end_time]) > 0:
-                    timer = cookie_jar._timers[end_time][0]    # type: Timer
-                    timer.interval = 0
-                    timer.run()
+
+class TestSQLiteCookieJar(TestCookieJar):
+    """
+    Tests for `SQLiteCookieJar`.
+    """
+    def setUp(self):
+        self._temp_directory = mkdtemp()
+        self._original_now = _sqlite_cookiejar._now
+        self._original_timer = _sqlite_cookiejar.Timer
+        _sqlite_cookiejar.Timer = MagicMock()
+        self._created_jars = []
+        super().setUp()
+
+    def tearDown(self):
+        for jar in self._created_jars:
+            jar.stop()
+        _sqlite_cookiejar._now = self._original_now
+        _sqlite_cookiejar.Timer = self._original_timer
+        shutil.rmtree(self._temp_directory)
+
+    def _create_cookie_jar(self) -> SQLiteCookieJar:
+        jar = SQLiteCookieJar("%s/cookiejar.db" % self._temp_directory)
+        self._created_jars.append(jar)
+        return jar
+
+    def _get_scheduled_fn(self) -> Callable[..., Any]:
+        return self.jar.notify_listeners
+
+    def _test_scheduling(self, expected_timeout:Real, expected_call:Callable[..., Any]):
+        _sqlite_cookiejar.Timer.assert_called_with(expected_timeout, expected_call)
+
+    def _change_time(self, cookie_jar: CookieJar, change_time_to: int):
+        _sqlite_cookiejar._now = MagicMock(return_value=change_time_to)
 
 
 # Trick required to stop Python's unittest from running the abstract base class as a test
@@ -0,0 +1,111 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+from cookiemonster.common.models import Enrichment, Metadata
+from cookiemonster.cookiejar.in_memory_cookiejar import InMemoryCookieJar
+
+
+def _create_enrichment(value: int) -> Enrichment:
+    return Enrichment("source", datetime(2016, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=value),
+                      Metadata({"value": value}))
+
+
+class TestInMemoryCookieJar(unittest.TestCase):
+    """
+    Tests for `InMemoryCookieJar`, beyond those of the `CookieJar` contract.
+    """
+    def setUp(self):
+        self.cookie_jar = InMemoryCookieJar()
+
+    def test_many_cookies(self):
+        identifiers = ["/cookie/%d" % i for i in range(100000)]
+        started_at = time.monotonic()
+        for identifier in identifiers:
+            self.cookie_jar.mark_for_processing(identifier)
+        for identifier in identifiers:
+            self.assertEqual(self.cookie_jar.get_next_for_processing().identifier, identifier)
+            self.cookie_jar.mark_as_complete(identifier)
+        self.assertLess(time.monotonic() - started_at, 10)
+        self.assertEqual(self.cookie_jar.queue_length(), 0)
+
+    def test_concurrent_enrichment(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: self.cookie_jar.enrich_cookie("/cookie/%d" % (i % 10), _create_enrichment(i)),
+                              range(1000)))
+        for i in range(10):
+            self.assertEqual(len(self.cookie_jar.fetch_cookie("/cookie/%d" % i).enrichments), 100)
+        self.assertEqual(self.cookie_jar.queue_length(), 10)
+
+    def test_delayed_requeue_by_timer(self):
+        listener = MagicMock()
+        self.cookie_jar.mark_for_processing("/cookie")
+        self.cookie_jar.add_listener(listener)
+        self.cookie_jar.mark_as_failed(self.cookie_jar.get_next_for_processing().identifier,
+                                       timedelta(milliseconds=50))
+        self.assertEqual(self.cookie_jar.queue_length(), 0)
+
+        time.sleep(0.2)
+        listener.assert_called_once_with()
+        self.assertEqual(self.cookie_jar.queue_length(), 1)
+
+    def test_delayed_requeues_in_order_of_end_time(self):
+        self.cookie_jar._get_time = MagicMock(return_value=0)
+        for identifier in ["/first", "/second"]:
+            self.cookie_jar.mark_for_processing(identifier)
+        self.cookie_jar.mark_as_failed(self.cookie_jar.get_next_for_processing().identifier, timedelta(seconds=20))
+        self.cookie_jar.mark_as_failed(self.cookie_jar.get_next_for_processing().identifier, timedelta(seconds=10))
+
+        self.cookie_jar._get_time.return_value = 15
+        self.assertEqual(self.cookie_jar.get_next_for_processing().identifier, "/second")
+        self.assertIsNone(self.cookie_jar.get_next_for_processing())
+
+        self.cookie_jar._get_time.return_value = 20
+        self.assertEqual(self.cookie_jar.get_next_for_processing().identifier, "/first")
+
+    def test_delayed_requeue_superseded_by_mark_for_processing(self):
+        self.cookie_jar._get_time = MagicMock(return_value=0)
+        self.cookie_jar.mark_for_processing("/cookie")
+        self.cookie_jar.mark_as_failed(self.cookie_jar.get_next_for_processing().identifier, timedelta(seconds=10))
+
+        self.cookie_jar.mark_for_processing("/cookie")
+        self.cookie_jar.mark_as_complete(self.cookie_jar.get_next_for_processing().identifier)
+
+        self.cookie_jar._get_time.return_value = 10
+        self.assertEqual(self.cookie_jar.queue_length(), 0)
+
+    def test_delayed_requeue_of_deleted_cookie(self):
+        self.cookie_jar._get_time = MagicMock(return_value=0)
+        self.cookie_jar.mark_for_processing("/cookie")
+        self.cookie_jar.mark_as_failed(self.cookie_jar.get_next_for_processing().identifier, timedelta(seconds=10))
+        self.cookie_jar.delete_cookie("/cookie")
+
+        self.cookie_jar._get_time.return_value = 10
+        self.assertEqual(self.cookie_jar.queue_length(), 0)
+        self.assertIsNone(self.cookie_jar.fetch_cookie("/cookie"))
+
+
+if __name__ == "__main__":
+    unittest.main()
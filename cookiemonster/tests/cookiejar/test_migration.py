@@ -0,0 +1,111 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import unittest
+from uuid import uuid4
+
+from cookiemonster.benchmarks._fake_couchdb import FakeCouchDBServer
+from cookiemonster.cookiejar.biscuit_tin import get_queue_document_id
+from cookiemonster.cookiejar.couchdb.softer import SofterCouchDB
+from cookiemonster.cookiejar.migration import migrate_queue_documents
+
+_DATABASE = "cookiejar-test"
+
+
+def _create_queue_document(identifier: str, doc_id: str=None, **state) -> dict:
+    """
+    Creates a queue document, with a random (i.e. legacy) ID by default.
+    :param identifier: the file identifier
+    :param doc_id: the document ID
+    :param state: queue state to override the defaults with
+    :return: the queue document
+    """
+    return {
+        "_id": doc_id or uuid4().hex,
+        "$queue": True,
+        "identifier": identifier,
+        "dirty": True,
+        "processing": False,
+        "deleted": False,
+        "queue_from": 0,
+        **state
+    }
+
+
+class TestMigrateQueueDocuments(unittest.TestCase):
+    """
+    Tests for `migrate_queue_documents`.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.db = SofterCouchDB(self.couchdb.couchdb_fqdn, _DATABASE)
+
+    def tearDown(self):
+        self.couchdb.tear_down()
+
+    def _get_queue_documents(self) -> dict:
+        return {
+            row["id"]: row["doc"] for row in self.db.all(include_docs=True)
+            if not row["id"].startswith("_design/")
+        }
+
+    def test_migrate_when_empty(self):
+        self.assertEqual(migrate_queue_documents(self.couchdb.couchdb_fqdn, _DATABASE), 0)
+
+    def test_migrate(self):
+        self.db.save_bulk([_create_queue_document("/cookie/%d" % i, queue_from=i) for i in range(5)])
+        self.db.save({"_id": "metadata", "$metadata": True, "identifier": "/cookie/0"})
+
+        self.assertEqual(migrate_queue_documents(self.couchdb.couchdb_fqdn, _DATABASE, batch_size=2), 5)
+
+        docs = self._get_queue_documents()
+        self.assertIn("metadata", docs)
+        for i in range(5):
+            doc = docs[get_queue_document_id("/cookie/%d" % i)]
+            self.assertEqual(doc["identifier"], "/cookie/%d" % i)
+            self.assertEqual(doc["queue_from"], i)
+        self.assertEqual(len(docs), 6)
+
+    def test_migrate_resets_processing(self):
+        self.db.save(_create_queue_document("/cookie", dirty=False, processing=True))
+        migrate_queue_documents(self.couchdb.couchdb_fqdn, _DATABASE)
+        doc = self._get_queue_documents()[get_queue_document_id("/cookie")]
+        self.assertTrue(doc["dirty"])
+        self.assertFalse(doc["processing"])
+
+    def test_migrate_when_already_migrated(self):
+        derived_id = get_queue_document_id("/cookie")
+        self.db.save(_create_queue_document("/cookie", doc_id=derived_id, queue_from=2))
+        self.db.save_bulk([_create_queue_document("/cookie", queue_from=1) for _ in range(2)])
+
+        self.assertEqual(migrate_queue_documents(self.couchdb.couchdb_fqdn, _DATABASE), 2)
+        docs = self._get_queue_documents()
+        self.assertEqual(list(docs.keys()), [derived_id])
+        self.assertEqual(docs[derived_id]["queue_from"], 2)
+
+    def test_migrate_is_idempotent(self):
+        self.db.save(_create_queue_document("/cookie"))
+        migrate_queue_documents(self.couchdb.couchdb_fqdn, _DATABASE)
+        self.assertEqual(migrate_queue_documents(self.couchdb.couchdb_fqdn, _DATABASE), 0)
+        self.assertEqual(len(self._get_queue_documents()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from unittest.mock import MagicMock, patch
+
+from cookiemonster.benchmarks._fake_couchdb import FakeCouchDBServer
+from cookiemonster.common.models import Enrichment, Metadata
+from cookiemonster.cookiejar.biscuit_tin import BiscuitTin
+from cookiemonster.cookiejar.sharded_cookiejar import HashRing, ShardedCookieJar, rebalance_shards
+
+_SHARDS = ["shard-a", "shard-b", "shard-c"]
+
+
+def _stop_threads(cookie_jar: BiscuitTin):
+    """
+    Stops the background threads of the given cookie jar.
+    :param cookie_jar: the cookie jar
+    """
+    cookie_jar.stop()
+    buffer = cookie_jar._sofa._buffer
+    for discharger in [buffer._queue, *buffer._buffers.values()]:
+        discharger._watching = False
+
+
+def _create_enrichment(value: int) -> Enrichment:
+    return Enrichment("source", datetime(2016, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=value),
+                      Metadata({"value": value}))
+
+
+class TestHashRing(unittest.TestCase):
+    """
+    Tests for `HashRing`.
+    """
+    def setUp(self):
+        self.identifiers = ["/cookie/%d" % i for i in range(3000)]
+
+    def test_get_shard_is_stable(self):
+        ring = HashRing(_SHARDS)
+        self.assertEqual([ring.get_shard(identifier) for identifier in self.identifiers],
+                         [HashRing(reversed(_SHARDS)).get_shard(identifier) for identifier in self.identifiers])
+
+    def test_identifiers_spread_across_shards(self):
+        ring = HashRing(_SHARDS)
+        counts = Counter(ring.get_shard(identifier) for identifier in self.identifiers)
+        self.assertEqual(set(counts.keys()), set(_SHARDS))
+        for shard_count in counts.values():
+            self.assertGreater(shard_count, len(self.identifiers) / len(_SHARDS) / 2)
+
+    def test_adding_shard_only_moves_identifiers_to_it(self):
+        ring = HashRing(_SHARDS)
+        new_ring = HashRing(_SHARDS + ["shard-d"])
+
+        moved = [identifier for identifier in self.identifiers
+                 if ring.get_shard(identifier) != new_ring.get_shard(identifier)]
+        self.assertLess(len(moved), len(self.identifiers) / 2)
+        for identifier in moved:
+            self.assertEqual(new_ring.get_shard(identifier), "shard-d")
+
+    def test_no_shards(self):
+        self.assertRaises(ValueError, HashRing, [])
+
+
+class TestShardedCookieJar(unittest.TestCase):
+    """
+    Tests for `ShardedCookieJar`, over `BiscuitTin`s on a fake CouchDB server.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.shards = {
+            shard: BiscuitTin(self.couchdb.couchdb_fqdn, shard, 1, timedelta(milliseconds=1))
+            for shard in _SHARDS
+        }
+        self.cookie_jar = ShardedCookieJar(self.shards)
+        self.identifiers = ["/cookie/%d" % i for i in range(12)]
+
+    def tearDown(self):
+        for shard in self.shards.values():
+            _stop_threads(shard)
+        self.cookie_jar.stop()
+        self.couchdb.tear_down()
+
+    def test_cookies_partitioned_across_shards(self):
+        for i, identifier in enumerate(self.identifiers):
+            self.cookie_jar.enrich_cookie(identifier, _create_enrichment(i))
+
+        for identifier in self.identifiers:
+            self.assertIsNotNone(self.cookie_jar.get_shard(identifier).fetch_cookie(identifier))
+            self.assertEqual(len(self.cookie_jar.fetch_cookie(identifier).enrichments), 1)
+        self.assertEqual(self.cookie_jar.queue_length(), len(self.identifiers))
+        self.assertEqual(sum(shard.queue_length() for shard in self.shards.values()), len(self.identifiers))
+        self.assertGreater(len({self.cookie_jar.get_shard(identifier) for identifier in self.identifiers}), 1)
+
+    @patch("cookiemonster.cookiejar.biscuit_tin._now")
+    def test_dequeue_ordered_by_queue_from(self, now: MagicMock):
+        now.side_effect = count(1000).__next__
+        for identifier in self.identifiers:
+            self.cookie_jar.mark_for_processing(identifier)
+
+        dequeued = []
+        cookie = self.cookie_jar.get_next_for_processing()
+        while cookie is not None:
+            dequeued.append(cookie.identifier)
+            cookie = self.cookie_jar.get_next_for_processing()
+
+        self.assertEqual(dequeued, self.identifiers)
+        self.assertIsNone(self.cookie_jar.next_queued_from())
+
+    def test_delete_cookies(self):
+        for identifier in self.identifiers:
+            self.cookie_jar.mark_for_processing(identifier)
+
+        self.cookie_jar.delete_cookies(self.identifiers[:6])
+        self.assertEqual(self.cookie_jar.queue_length(), 6)
+        self.assertEqual(self.cookie_jar.delete_by_prefix("/cookie/"), 6)
+        self.assertEqual(self.cookie_jar.queue_length(), 0)
+
+    def test_listeners_notified_of_changes_to_any_shard(self):
+        listener = MagicMock()
+        self.cookie_jar.add_listener(listener)
+        for identifier in self.identifiers:
+            self.cookie_jar.mark_for_processing(identifier)
+        self.assertEqual(listener.call_count, len(self.identifiers))
+
+
+class TestRebalanceShards(unittest.TestCase):
+    """
+    Tests for `rebalance_shards`.
+    """
+    def setUp(self):
+        self.couchdb = FakeCouchDBServer()
+        self.cookie_jars = []
+        self.identifiers = ["/cookie/%d" % i for i in range(20)]
+
+        # Everything starts on the one shard
+        cookie_jar = self._create_cookie_jar("shard-a")
+        for i, identifier in enumerate(self.identifiers):
+            cookie_jar.enrich_cookie(identifier, _create_enrichment(i))
+            cookie_jar.enrich_cookie(identifier, _create_enrichment(i + 100))
+        for _ in range(5):
+            cookie_jar.mark_as_complete(cookie_jar.get_next_for_processing().identifier)
+
+    def tearDown(self):
+        for cookie_jar in self.cookie_jars:
+            _stop_threads(cookie_jar)
+        self.couchdb.tear_down()
+
+    def _create_cookie_jar(self, shard: str) -> BiscuitTin:
+        cookie_jar = BiscuitTin(self.couchdb.couchdb_fqdn, shard, 1, timedelta(milliseconds=1), queue_cache_size=0)
+        self.cookie_jars.append(cookie_jar)
+        return cookie_jar
+
+    def _rebalance(self) -> int:
+        return rebalance_shards({shard: (self.couchdb.couchdb_fqdn, shard) for shard in _SHARDS}, batch_size=3,
+                                max_buffer_size=3, buffer_latency=timedelta(milliseconds=10))
+
+    def test_rebalance(self):
+        ring = HashRing(_SHARDS)
+        moved = self._rebalance()
+        self.assertEqual(moved, len([i for i in self.identifiers if ring.get_shard(i) != "shard-a"]))
+
+        shards = {shard: self._create_cookie_jar(shard) for shard in _SHARDS}
+        for identifier in self.identifiers:
+            for shard, cookie_jar in shards.items():
+                cookie = cookie_jar.fetch_cookie(identifier)
+                if shard == ring.get_shard(identifier):
+                    self.assertEqual(len(cookie.enrichments), 2)
+                else:
+                    self.assertIsNone(cookie)
+
+        cookie_jar = ShardedCookieJar(shards)
+        self.assertEqual(cookie_jar.queue_length(), len(self.identifiers) - 5)
+        cookie_jar.stop()
+
+    def test_rebalance_is_idempotent(self):
+        self._rebalance()
+        self.assertEqual(self._rebalance(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import shutil
+import sqlite3
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from tempfile import mkdtemp
+from unittest.mock import patch
+
+from cookiemonster.common.models import Enrichment, Metadata
+from cookiemonster.cookiejar.sqlite_cookiejar import SQLiteCookieJar, _Writer, _connect, _decode, _encode
+
+
+def _create_enrichment(value: int) -> Enrichment:
+    return Enrichment("source", datetime(2016, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=value),
+                      Metadata({"value": value, "description": "x" * 100}))
+
+
+class TestSQLiteCookieJar(unittest.TestCase):
+    """
+    Tests for `SQLiteCookieJar`, beyond those of the `CookieJar` contract.
+    """
+    def setUp(self):
+        self.temp_directory = mkdtemp()
+        self.path = os.path.join(self.temp_directory, "cookiejar.db")
+        self.cookie_jars = []
+        self.cookie_jar = self._create_cookie_jar()
+
+    def tearDown(self):
+        for cookie_jar in self.cookie_jars:
+            cookie_jar.stop()
+        shutil.rmtree(self.temp_directory)
+
+    def _create_cookie_jar(self, **kwargs) -> SQLiteCookieJar:
+        cookie_jar = SQLiteCookieJar(self.path, **kwargs)
+        self.cookie_jars.append(cookie_jar)
+        return cookie_jar
+
+    def test_write_ahead_logging(self):
+        connection = sqlite3.connect(self.path)
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        connection.close()
+
+    def test_enrichments_stored_as_compact_blobs(self):
+        enrichment = _create_enrichment(1)
+        blob = _encode(enrichment)
+        self.assertIsInstance(blob, bytes)
+        self.assertLess(len(blob), 100)
+        self.assertEqual(_decode(blob), enrichment)
+
+    def test_restart_resets_processing_and_cleans_up_deleted(self):
+        for i in range(3):
+            self.cookie_jar.enrich_cookie("/cookie/%d" % i, _create_enrichment(i))
+        processing = [self.cookie_jar.get_next_for_processing().identifier for _ in range(2)]
+        self.cookie_jar.delete_cookie(processing[1])
+        self.cookie_jar.stop()
+
+        restarted = self._create_cookie_jar()
+        self.assertEqual(restarted.queue_length(), 2)
+        self.assertIsNone(restarted.fetch_cookie(processing[1]))
+        self.assertEqual(len(restarted.fetch_cookie(processing[0]).enrichments), 1)
+
+    def test_delete_by_prefix_only_deletes_prefixed(self):
+        for identifier in ["/cookie/1", "/cookie/12", "/cookie-2"]:
+            self.cookie_jar.mark_for_processing(identifier)
+        self.assertEqual(self.cookie_jar.delete_by_prefix("/cookie/"), 2)
+        self.assertIsNotNone(self.cookie_jar.fetch_cookie("/cookie-2"))
+        self.assertEqual(self.cookie_jar.queue_length(), 1)
+
+    def test_concurrent_writes_are_batched(self):
+        cookie_jar = self._create_cookie_jar(batch_latency=timedelta(milliseconds=100))
+        original_commit = _Writer._commit
+        batch_sizes = []
+
+        def commit(writer: _Writer, batch):
+            batch_sizes.append(len(batch))
+            original_commit(writer, batch)
+
+        with patch.object(_Writer, "_commit", autospec=True, side_effect=commit):
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                list(executor.map(lambda i: cookie_jar.mark_for_processing("/cookie/%d" % i), range(10)))
+
+        self.assertEqual(sum(batch_sizes), 10)
+        self.assertLess(len(batch_sizes), 10)
+        self.assertEqual(cookie_jar.queue_length(), 10)
+
+    def test_failed_write_does_not_affect_its_batch(self):
+        connection = _connect(self.path)
+        writer = _Writer(connection, 10, timedelta(milliseconds=100))
+
+        def fail(connection: sqlite3.Connection):
+            connection.execute("INSERT INTO queue (identifier) VALUES ('/failed')")
+            raise ValueError()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            failed = executor.submit(writer.submit, fail)
+            succeeded = executor.submit(
+                writer.submit, lambda connection: connection.execute("INSERT INTO queue (identifier) VALUES ('/ok')"))
+            self.assertRaises(ValueError, failed.result)
+            succeeded.result()
+        writer.stop()
+
+        self.assertIsNone(self.cookie_jar.fetch_cookie("/failed"))
+        self.assertIsNotNone(self.cookie_jar.fetch_cookie("/ok"))
+
+    def test_next_queued_from(self):
+        self.assertIsNone(self.cookie_jar.next_queued_from())
+        self.cookie_jar.mark_for_processing("/cookie")
+        self.assertIsNotNone(self.cookie_jar.next_queued_from())
+        self.cookie_jar.get_next_for_processing()
+        self.assertIsNone(self.cookie_jar.next_queued_from())
+
+    def test_writes_after_stop(self):
+        self.cookie_jar.stop()
+        self.assertRaises(RuntimeError, self.cookie_jar.mark_for_processing, "/cookie")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -36,6 +36,7 @@ from typing import Any
 from time import sleep
 from datetime import datetime, timedelta, timezone
 from http.client import HTTPConnection, HTTPResponse
+from urllib.parse import urlencode
 
 from hgicommon.collections import Metadata
 
@@ -128,6 +129,7 @@ class TestElmo(unittest.TestCase):
 
         data = _decode_json_response(r)
         self.assertIn('queue_length', data)
+        self.assertIn('exact', data)
         self.assertEqual(data['queue_length'], self.jar.queue_length()) # Should be 0
 
         self.http.close()
@@ -239,6 +241,38 @@ class TestElmo(unittest.TestCase):
         """
         self._delete_test('foo_bar')
 
+    def _bulk_delete_test(self, query:list, expected:Any):
+        """ Generic bulk delete test """
+        identifiers = ['/path/to/foo', '/path/to/bar', '/elsewhere/baz']
+        for identifier in identifiers:
+            self.jar.mark_for_processing(identifier)
+
+        self.http.request('DELETE', '/cookiejar?{}'.format(urlencode(query)), headers=self.REQ_HEADER)
+        r = self.http.getresponse()
+
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.headers.get_content_type(), 'application/json')
+
+        data = _decode_json_response(r)
+        self.assertEqual(data, expected)
+
+        self.assertIsNone(self.jar.fetch_cookie('/path/to/foo'))
+        self.assertIsNone(self.jar.fetch_cookie('/path/to/bar'))
+        self.assertIsInstance(self.jar.fetch_cookie('/elsewhere/baz'), Cookie)
+
+    def test_delete_many_by_qs(self):
+        """
+        HTTP API: DELETE /cookiejar?identifier=<identifier>&identifier=<identifier>
+        """
+        self._bulk_delete_test([('identifier', '/path/to/foo'), ('identifier', '/path/to/bar')],
+                               {'deleted':['/path/to/foo', '/path/to/bar']})
+
+    def test_delete_by_prefix(self):
+        """
+        HTTP API: DELETE /cookiejar?prefix=<prefix>
+        """
+        self._bulk_delete_test([('prefix', '/path/to/')], {'prefix':'/path/to/', 'deleted':2})
+
     def test_thread_dump(self):
         """
         HTTP API: GET /debug/threads
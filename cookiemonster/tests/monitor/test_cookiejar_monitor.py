@@ -29,7 +29,7 @@ from hgicommon.collections import Metadata
 from cookiemonster.common.models import Enrichment
 from cookiemonster.cookiejar.in_memory_cookiejar import InMemoryCookieJar
 from cookiemonster.monitor.cookiejar_monitor import CookieJarMonitor, MEASURED_COOKIE_JAR_TO_PROCESS, \
-    MEASURED_COOKIE_JAR_STATUS
+    MEASURED_COOKIE_JAR_STATUS, MEASURED_COOKIE_JAR_TO_PROCESS_EXACT
 
 
 class TestThreadsMonitor(unittest.TestCase):
@@ -47,7 +47,7 @@ class TestThreadsMonitor(unittest.TestCase):
         self.assertEqual(self._logger.record.call_count, 1)
         call_args = self._logger.record.call_args[0]
         self.assertEqual(call_args[0], MEASURED_COOKIE_JAR_STATUS)
-        self.assertEqual(call_args[1], {MEASURED_COOKIE_JAR_TO_PROCESS: 1})
+        self.assertEqual(call_args[1], {MEASURED_COOKIE_JAR_TO_PROCESS: 1, MEASURED_COOKIE_JAR_TO_PROCESS_EXACT: True})
 
 
 if __name__ == "__main__":
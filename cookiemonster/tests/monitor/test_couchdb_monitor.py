@@ -0,0 +1,52 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import unittest
+from datetime import timedelta
+from unittest.mock import MagicMock
+
+from cookiemonster.monitor.couchdb_monitor import CouchDBConnectionsMonitor, MEASURED_COUCHDB_CONNECTIONS, \
+    MEASURED_COUCHDB_REQUESTS, MEASURED_COUCHDB_CONNECTIONS_OPENED, MEASURED_COUCHDB_CONNECTIONS_REUSED
+
+
+class TestCouchDBConnectionsMonitor(unittest.TestCase):
+    """
+    Tests for `CouchDBConnectionsMonitor`.
+    """
+    def setUp(self):
+        self._logger = MagicMock()
+        self._biscuit_tin = MagicMock()
+        self._biscuit_tin.connection_stats.return_value = {"requests": 10, "connections": 2, "reused": 8}
+        self._monitor = CouchDBConnectionsMonitor(self._logger, timedelta(microseconds=1), self._biscuit_tin)
+
+    def test_do_log_record(self):
+        self._monitor.do_log_record()
+        self.assertEqual(self._logger.record.call_count, 1)
+        call_args = self._logger.record.call_args[0]
+        self.assertEqual(call_args[0], MEASURED_COUCHDB_CONNECTIONS)
+        self.assertEqual(call_args[1], {
+            MEASURED_COUCHDB_REQUESTS: 10,
+            MEASURED_COUCHDB_CONNECTIONS_OPENED: 2,
+            MEASURED_COUCHDB_CONNECTIONS_REUSED: 8
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
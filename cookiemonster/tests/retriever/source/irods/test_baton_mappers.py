@@ -25,13 +25,20 @@ import math
 import unittest
 from datetime import datetime
 from os.path import join
+from typing import Dict, List
+from unittest.mock import MagicMock, patch
 
 from testwithirods.helpers import SetupHelper
 
+from baton._baton._baton_runner import BatonRunner
 from baton.collections import DataObjectReplicaCollection, IrodsMetadata
-from baton.models import DataObjectReplica
-from cookiemonster.retriever.source.irods._constants import MODIFIED_METADATA_QUERY_ALIAS
-from cookiemonster.retriever.source.irods.baton_mappers import BatonUpdateMapper, MODIFIED_DATA_QUERY_ALIAS
+from baton.models import DataObjectReplica, PreparedSpecificQuery
+from cookiemonster.retriever.source.irods._constants import MODIFIED_METADATA_QUERY_ALIAS, \
+    MODIFIED_DATA_ID_ONLY_QUERY_ALIAS, MODIFIED_METADATA_ID_ONLY_QUERY_ALIAS, MODIFIED_DATA_IN_ID_RANGE_QUERY_ALIAS, \
+    MODIFIED_METADATA_IN_ID_RANGE_QUERY_ALIAS, MODIFIED_DATA_ID_PROPERTY, MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY
+from cookiemonster.benchmarks.retrieval_merge import generate_rows
+from cookiemonster.retriever.source.irods.baton_mappers import BatonUpdateMapper, MODIFIED_DATA_QUERY_ALIAS, \
+    _partition_into_id_ranges, _UpdateRows, _row_to_data_object_update, _MAX_IRODS_ID
 from cookiemonster.retriever.source.irods.json_convert import DataObjectModificationJSONEncoder
 from cookiemonster.retriever.source.irods.models import DataObjectModification
 from cookiemonster.tests.retriever.source.irods._helpers import install_queries
@@ -41,7 +48,12 @@ from testwithbaton.api import TestWithBaton
 
 REQUIRED_SPECIFIC_QUERIES = {
     MODIFIED_DATA_QUERY_ALIAS: join("resources", "specific-queries", "data-modified-partial.sql"),
-    MODIFIED_METADATA_QUERY_ALIAS: join("resources", "specific-queries", "metadata-modified-partial.sql")
+    MODIFIED_METADATA_QUERY_ALIAS: join("resources", "specific-queries", "metadata-modified-partial.sql"),
+    MODIFIED_DATA_ID_ONLY_QUERY_ALIAS: join("resources", "specific-queries", "data-modified-id-only.sql"),
+    MODIFIED_METADATA_ID_ONLY_QUERY_ALIAS: join("resources", "specific-queries", "metadata-modified-id-only.sql"),
+    MODIFIED_DATA_IN_ID_RANGE_QUERY_ALIAS: join("resources", "specific-queries", "data-modified-partial-in-id-range.sql"),
+    MODIFIED_METADATA_IN_ID_RANGE_QUERY_ALIAS: join("resources", "specific-queries",
+                                                    "metadata-modified-partial-in-id-range.sql")
 }
 
 _DATA_OBJECT_NAMES = ["data_object_1", "data_object_2"]
@@ -149,5 +161,84 @@ class TestBatonUpdateMapper(unittest.TestCase):
         self.test_with_baton.tear_down()
 
 
+class TestShardedBatonUpdateMapper(TestBatonUpdateMapper):
+    """
+    Tests for `BatonUpdateMapper` when the retrieval of updates is split across ranges of data object IDs.
+    """
+    def setUp(self):
+        super().setUp()
+        zone = self.test_with_baton.irods_server.users[0].zone
+        self.mapper = BatonUpdateMapper(self.test_with_baton.baton_location, zone, number_of_shards=3)
+
+
+class TestPartitionIntoIdRanges(unittest.TestCase):
+    """
+    Tests for `_partition_into_id_ranges`.
+    """
+    def test_partition_when_no_ids(self):
+        self.assertEqual(_partition_into_id_ranges([], 3), [(0, _MAX_IRODS_ID)])
+
+    def test_partition_when_fewer_ids_than_partitions(self):
+        self.assertEqual(_partition_into_id_ranges([4], 3), [(0, _MAX_IRODS_ID)])
+
+    def test_partition(self):
+        self.assertEqual(_partition_into_id_ranges([10, 1, 3, 3, 9, 5, 2], 3), [(0, 2), (3, 5), (6, _MAX_IRODS_ID)])
+
+    def test_partition_covers_ids_between_and_outside_of_given(self):
+        ranges = _partition_into_id_ranges([10, 1, 3, 3, 9, 5, 2], 3)
+        for id in [0, 7, 11, _MAX_IRODS_ID]:
+            self.assertEqual(len([(lower, upper) for lower, upper in ranges if lower <= id <= upper]), 1)
+
+
+class TestShardedQueries(unittest.TestCase):
+    """
+    Tests for the queries used by `BatonUpdateMapper` when the retrieval of updates is split across ranges of data
+    object IDs.
+    """
+    def setUp(self):
+        with patch.object(BatonRunner, "validate_baton_binaries_location", return_value=None):
+            self.mapper = BatonUpdateMapper("", number_of_shards=3)
+
+    def test_finds_data_object_modified_after_id_only_query(self):
+        seen_rows = [row for row in generate_rows(20, 2) if int(row[MODIFIED_DATA_ID_PROPERTY]) != 6]
+        all_rows = generate_rows(20, 2)
+
+        def get_rows(query: PreparedSpecificQuery) -> List[Dict]:
+            if query.alias in (MODIFIED_DATA_ID_ONLY_QUERY_ALIAS, MODIFIED_METADATA_ID_ONLY_QUERY_ALIAS):
+                return [{MODIFIED_DATA_ID_PROPERTY: row[MODIFIED_DATA_ID_PROPERTY]} for row in seen_rows]
+            lower, upper = (int(argument) for argument in query.query_arguments[-2:])
+            metadata_query = query.alias == MODIFIED_METADATA_IN_ID_RANGE_QUERY_ALIAS
+            return [row for row in all_rows if lower <= int(row[MODIFIED_DATA_ID_PROPERTY]) <= upper
+                    and (MODIFIED_METADATA_ATTRIBUTE_NAME_PROPERTY in row) == metadata_query]
+
+        self.mapper._get_raw_with_prepared_specific_query = MagicMock(side_effect=get_rows)
+        paths = {update.entity.path for update in self.mapper._get_combined_modifications_since(datetime.min)}
+        self.assertIn("/zone/collection_6/data_object_6", paths)
+        self.assertEqual(len(paths), 10)
+
+
+class TestUpdateRows(unittest.TestCase):
+    """
+    Tests for `_UpdateRows`.
+    """
+    def test_combine_for_same_entity_when_empty(self):
+        self.assertEqual(_UpdateRows().combine_for_same_entity(), [])
+
+    def test_combine_for_same_entity_is_equivalent_to_object_merge(self):
+        rows = generate_rows(1000, 7)
+        updates = [_row_to_data_object_update(row) for row in rows]
+        expected = sorted(BatonUpdateMapper._combine_updates_for_same_entity(updates),
+                          key=lambda update: update.entity.path)
+
+        combined = _UpdateRows(rows).combine_for_same_entity()
+        self.assertEqual(combined, expected)
+
+    def test_combine_for_same_entity_preserves_most_recent_timestamp(self):
+        rows = generate_rows(10, 10)
+        combined = _UpdateRows(rows).combine_for_same_entity()
+        self.assertEqual(len(combined), 1)
+        self.assertEqual(combined[0].timestamp, max(_row_to_data_object_update(row).timestamp for row in rows))
+
+
 if __name__ == "__main__":
     unittest.main()
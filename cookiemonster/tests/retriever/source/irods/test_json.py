@@ -26,8 +26,10 @@ import unittest
 from baton.collections import DataObjectReplicaCollection, IrodsMetadata
 from baton.models import DataObjectReplica
 
+from cookiemonster.benchmarks.retrieval_merge import generate_rows
+from cookiemonster.retriever.source.irods.baton_mappers import _UpdateRows
 from cookiemonster.retriever.source.irods.json_convert import DataObjectModificationJSONEncoder, \
-    DataObjectModificationJSONDecoder
+    DataObjectModificationJSONDecoder, FastDataObjectModificationJSONEncoder
 from cookiemonster.retriever.source.irods.models import DataObjectModification
 
 _data_object_modification = None
@@ -62,5 +64,64 @@ class TestDataObjectModificationJSONEncoderAndDecoder(unittest.TestCase):
         self.assertEqual(decoded, self.data_object_modification)
 
 
+class TestFastDataObjectModificationJSONEncoder(unittest.TestCase):
+    """
+    Tests for `FastDataObjectModificationJSONEncoder`.
+    """
+    def setUp(self):
+        self.encoder = FastDataObjectModificationJSONEncoder()
+        self.generic_encoder = DataObjectModificationJSONEncoder()
+
+    def assert_equivalent(self, data_object_modification: DataObjectModification):
+        expected = self.generic_encoder.default(data_object_modification)
+        encoded = self.encoder.default(data_object_modification)
+        self.assertCountEqual(encoded.keys(), expected.keys())
+        for key in expected.keys():
+            self.assertCountEqual(encoded[key], expected[key])
+
+    def test_encode_empty(self):
+        self.assertEqual(self.encoder.default(DataObjectModification()),
+                         {"modified_metadata": [], "modified_replicas": []})
+        self.assert_equivalent(DataObjectModification())
+
+    def test_encode(self):
+        data_object_modification = DataObjectModification(
+            IrodsMetadata({"key_1": {"value_1", "value_2"}}),
+            DataObjectReplicaCollection([
+                DataObjectReplica(0, "checksum_1", "host_1", "resource_1", True),
+                DataObjectReplica(1, "checksum_2", up_to_date=False),
+                DataObjectReplica(2, "")
+            ])
+        )
+        encoded = self.encoder.default(data_object_modification)
+        self.assertCountEqual(encoded["modified_metadata"], [
+            {"attribute": "key_1", "value": "value_1"},
+            {"attribute": "key_1", "value": "value_2"}
+        ])
+        self.assertCountEqual(encoded["modified_replicas"], [
+            {"number": 0, "checksum": "checksum_1", "location": "host_1", "resource": "resource_1", "valid": True},
+            {"number": 1, "checksum": "checksum_2", "valid": False},
+            {"number": 2, "checksum": "", "valid": None}
+        ])
+        self.assert_equivalent(data_object_modification)
+
+    def test_encode_is_equivalent_to_generic_encoder_with_merged_updates(self):
+        for update in _UpdateRows(generate_rows(500, 5)).combine_for_same_entity():
+            self.assert_equivalent(update.modification)
+
+    def test_encoder_with_json_dumps(self):
+        encoded = json.dumps(self.data_object_modification(), cls=FastDataObjectModificationJSONEncoder)
+        decoded = DataObjectModificationJSONDecoder().decode(encoded)
+        self.assertEqual(decoded, self.data_object_modification())
+
+    def test_encode_other_type(self):
+        self.assertRaises(TypeError, self.encoder.default, object())
+
+    @staticmethod
+    def data_object_modification() -> DataObjectModification:
+        return DataObjectModification(IrodsMetadata({"key_1": {"value_1"}}),
+                                      DataObjectReplicaCollection([DataObjectReplica(0, "checksum", up_to_date=True)]))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,145 @@
+"""
+Legalese
+--------
+Copyright (c) 2016 Genome Research Ltd.
+
+This file is part of Cookie Monster.
+
+Cookie Monster is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by the
+Free Software Foundation; either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+Public License for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import shutil
+import unittest
+from abc import ABCMeta, abstractmethod
+from datetime import datetime, timezone
+from tempfile import mkdtemp
+from typing import Dict, Iterable
+from unittest.mock import patch
+
+from cookiemonster.benchmarks.retrieval_merge import generate_rows
+from cookiemonster.retriever.source.irods._constants import MODIFIED_DATA_TIMESTAMP_PROPERTY, \
+    MODIFIED_METADATA_TIMESTAMP_PROPERTY
+from cookiemonster.retriever.source.irods.baton_mappers import BatonUpdateMapper, _UpdateRows
+from cookiemonster.retriever.source.irods.replay_mappers import FileUpdateMapper, SQLiteUpdateMapper, \
+    _ReplayUpdateMapper, _get_row_timestamp
+
+_NUMBER_OF_ROWS = 200
+_ROWS_PER_DATA_OBJECT = 5
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class _TestReplayUpdateMapper(unittest.TestCase, metaclass=ABCMeta):
+    """
+    Tests for `_ReplayUpdateMapper` implementations.
+    """
+    @abstractmethod
+    def create_mapper(self, rows: Iterable[Dict], replay_speed: float=None) -> _ReplayUpdateMapper:
+        """
+        Creates the mapper under test, with the given rows as its dataset.
+        :param rows: the rows in the dataset
+        :param replay_speed: the replay speed
+        :return: the mapper
+        """
+
+    def setUp(self):
+        self.temp_directory = mkdtemp(suffix=type(self).__name__)
+        self.rows = generate_rows(_NUMBER_OF_ROWS, _ROWS_PER_DATA_OBJECT)
+        self.timestamps = sorted(_get_row_timestamp(row) for row in self.rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_directory)
+
+    def test_get_all_since_epoch(self):
+        mapper = self.create_mapper(self.rows)
+        updates = mapper.get_all_since(_EPOCH)
+        expected = BatonUpdateMapper._data_object_updates_to_generic_update_collection(
+            _UpdateRows(self.rows).combine_for_same_entity())
+        self.assertCountEqual([(update.target, update.timestamp) for update in updates],
+                              [(update.target, update.timestamp) for update in expected])
+
+    def test_get_all_since_excludes_earlier_updates(self):
+        mapper = self.create_mapper(self.rows)
+        since = self.timestamps[_NUMBER_OF_ROWS // 2 - 1]
+        updates = mapper.get_all_since(datetime.fromtimestamp(since, tz=timezone.utc))
+        expected_rows = [row for row in self.rows if _get_row_timestamp(row) > since]
+        self.assertEqual(sum(1 for _ in updates), len(_UpdateRows(expected_rows).combine_for_same_entity()))
+        for update in updates:
+            self.assertGreater(update.timestamp, datetime.fromtimestamp(since, tz=timezone.utc))
+
+    def test_get_all_since_with_empty_dataset(self):
+        mapper = self.create_mapper([], replay_speed=1.0)
+        self.assertEqual(len(mapper.get_all_since(_EPOCH)), 0)
+
+    def test_get_all_since_when_replaying(self):
+        mapper = self.create_mapper(self.rows, replay_speed=10.0)
+        with patch("cookiemonster.retriever.source.irods.replay_mappers.time.monotonic") as monotonic:
+            monotonic.return_value = 100.0
+            first_updates = mapper.get_all_since(_EPOCH)
+            monotonic.return_value = 105.0
+            second_updates = mapper.get_all_since(_EPOCH)
+
+        # The clock starts at the earliest timestamp so only rows with that timestamp are initially available
+        first_rows = [row for row in self.rows if _get_row_timestamp(row) <= self.timestamps[0]]
+        self.assertEqual(len(first_updates), len(_UpdateRows(first_rows).combine_for_same_entity()))
+        # 5 seconds of wall time is 50 seconds of replay
+        second_rows = [row for row in self.rows if _get_row_timestamp(row) <= self.timestamps[0] + 50]
+        self.assertEqual(len(second_updates), len(_UpdateRows(second_rows).combine_for_same_entity()))
+
+    def test_get_all_since_in_batches(self):
+        mapper = self.create_mapper(self.rows)
+        batches = list(mapper.get_all_since_in_batches(_EPOCH, 7))
+        self.assertTrue(all(len(batch) <= 7 for batch in batches))
+        self.assertCountEqual([update.target for batch in batches for update in batch],
+                              [update.target for update in mapper.get_all_since(_EPOCH)])
+
+    def test_invalid_replay_speed(self):
+        self.assertRaises(ValueError, self.create_mapper, self.rows, 0)
+
+
+class TestFileUpdateMapper(_TestReplayUpdateMapper):
+    """
+    Tests for `FileUpdateMapper`.
+    """
+    def create_mapper(self, rows: Iterable[Dict], replay_speed: float=None) -> FileUpdateMapper:
+        file_location = os.path.join(self.temp_directory, "rows.json")
+        FileUpdateMapper.write_rows(file_location, rows)
+        return FileUpdateMapper(file_location, replay_speed)
+
+
+class TestSQLiteUpdateMapper(_TestReplayUpdateMapper):
+    """
+    Tests for `SQLiteUpdateMapper`.
+    """
+    def create_mapper(self, rows: Iterable[Dict], replay_speed: float=None) -> SQLiteUpdateMapper:
+        database_location = os.path.join(self.temp_directory, "rows.db")
+        SQLiteUpdateMapper.write_rows(database_location, rows)
+        return SQLiteUpdateMapper(database_location, replay_speed)
+
+
+class TestGetRowTimestamp(unittest.TestCase):
+    """
+    Tests for `_get_row_timestamp`.
+    """
+    def test_with_data_row(self):
+        self.assertEqual(_get_row_timestamp({MODIFIED_DATA_TIMESTAMP_PROPERTY: "123"}), 123)
+
+    def test_with_metadata_row(self):
+        self.assertEqual(_get_row_timestamp({MODIFIED_METADATA_TIMESTAMP_PROPERTY: "456"}), 456)
+
+
+del _TestReplayUpdateMapper
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,6 +24,7 @@ import logging
 import unittest
 from datetime import datetime
 from threading import Thread, Semaphore, Lock
+from time import sleep
 from typing import List
 from unittest.mock import MagicMock, call
 
@@ -114,6 +115,47 @@ class TestRetrievalManager(_BaseRetrievalManagerTest):
         # Assert that retrieval is logged
         self._assert_logged_updated(self.updates)
 
+    def test_run_with_streamed_updates(self):
+        self.updates.append(Update("c", datetime(year=1999, month=1, day=1), Metadata()))
+        self.retrieval_manager = RetrievalManager(self.update_mapper, self.logger, batch_size=2)
+        listener = MagicMock()
+        self.retrieval_manager.add_listener(listener)
+
+        self.retrieval_manager.run(SINCE)
+
+        self.update_mapper.get_all_since.assert_called_once_with(SINCE)
+        listener.assert_has_calls([call(UpdateCollection(self.updates[0:2])), call(UpdateCollection(self.updates[2:]))])
+        self.assertEqual(listener.call_count, 2)
+        self._assert_logged_updated(self.updates)
+
+    def test_run_with_streamed_updates_when_retrieval_fails(self):
+        self.update_mapper.get_all_since = MagicMock(side_effect=IOError())
+        self.retrieval_manager = RetrievalManager(self.update_mapper, self.logger, batch_size=2)
+        listener = MagicMock()
+        self.retrieval_manager.add_listener(listener)
+
+        self.assertRaises(IOError, self.retrieval_manager.run, SINCE)
+        listener.assert_not_called()
+
+    def test_streamed_retrieval_is_bounded_by_max_pending_batches(self):
+        self.updates.extend([Update(str(i), datetime(year=1999, month=1, day=1), Metadata()) for i in range(10)])
+        retrieved = []
+
+        def get_all_since_in_batches(since: datetime, batch_size: int):
+            for update in self.updates:
+                retrieved.append(update)
+                yield UpdateCollection([update])
+
+        self.update_mapper.get_all_since_in_batches = get_all_since_in_batches
+        self.retrieval_manager = RetrievalManager(self.update_mapper, self.logger, batch_size=1, max_pending_batches=1)
+
+        batches = self.retrieval_manager._stream_batches(SINCE)
+        next(batches)
+        sleep(0.1)
+        # One batch taken, one waiting in the queue and one blocked on being put into the queue
+        self.assertLessEqual(len(retrieved), 3)
+        self.assertEqual(len(list(batches)), len(self.updates) - 1)
+
     def _assert_logged_updated(self, updates: UpdateCollection):
         """
         TODO